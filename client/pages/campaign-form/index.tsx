@@ -4,6 +4,7 @@ import dynamic from 'next/dynamic';
 import { toast as reactToast, ToastContainer } from "react-toastify";
 import "react-toastify/dist/ReactToastify.css";
 import apiClient from "../../utils/apiClient";
+import { uploadCreative } from "../../utils/uploadCreative";
 import Link from "next/link";
 import {
   Box,
@@ -222,17 +223,9 @@ const CampaignFormPage = () => {
       if (campaignResponse.data && campaignResponse.data.id) {
         const campaignId = campaignResponse.data.id;
         
-        // Upload each creative
+        // Upload each creative in resumable parts
         for (let i = 0; i < uploadedFiles.length; i++) {
-          const fileFormData = new FormData();
-          fileFormData.append('campaign', campaignId);
-          fileFormData.append('file', uploadedFiles[i]);
-          
-          await apiClient.post(`campaigns/${campaignId}/creatives/`, fileFormData, {
-            headers: {
-              'Content-Type': 'multipart/form-data',
-            },
-          });
+          await uploadCreative(campaignId, uploadedFiles[i]);
         }
       }
       
@@ -67,8 +67,10 @@ const MainPage = () => {
   const fetchUserCampaigns = async () => {
     try {
       const response = await campaignAPI.getCampaigns();
-      if (response.data && Array.isArray(response.data)) {
-        setExistingCampaigns(response.data);
+      // The list endpoint is cursor-paginated: { next, previous, results }
+      const campaigns = response.data?.results;
+      if (campaigns && Array.isArray(campaigns)) {
+        setExistingCampaigns(campaigns);
       } else {
         // If API returns unexpected format, use mock data for demo
         console.warn('API returned unexpected format, using mock data');
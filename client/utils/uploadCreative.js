@@ -0,0 +1,42 @@
+import apiClient from './apiClient';
+
+// Attempts per part before the upload is given up
+const MAX_PART_ATTEMPTS = 3;
+
+// Upload a creative in parts through the resumable upload API.
+// Parts that already reached the server are skipped, so calling this again
+// with the same uploadId resumes an interrupted upload.
+export async function uploadCreative(campaignId, file, uploadId = null) {
+  const base = `campaigns/${campaignId}/uploads/`;
+
+  const session = uploadId
+    ? (await apiClient.get(`${base}${uploadId}/`)).data
+    : (await apiClient.post(base, {
+        file_name: file.name,
+        file_type: file.type || 'application/octet-stream',
+        file_size: file.size,
+      })).data;
+
+  const received = new Set(session.received_parts);
+  for (let number = 1; number <= session.part_count; number++) {
+    if (received.has(number)) continue;
+
+    const start = (number - 1) * session.part_size;
+    const part = file.slice(start, Math.min(start + session.part_size, file.size));
+
+    for (let attempt = 1; ; attempt++) {
+      try {
+        await apiClient.put(`${base}${session.id}/parts/${number}/`, part, {
+          headers: { 'Content-Type': 'application/octet-stream' },
+          timeout: 0,
+        });
+        break;
+      } catch (error) {
+        if (attempt >= MAX_PART_ATTEMPTS) throw error;
+      }
+    }
+  }
+
+  const response = await apiClient.post(`${base}${session.id}/complete/`);
+  return response.data;
+}
@@ -3,15 +3,28 @@ Facebook OAuth authentication for QuickCampaigns
 """
 import os
 import logging
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.contrib.auth import get_user_model
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .exceptions import ServiceUnavailable
 from .models import FacebookAdAccount
+from .services.account_discovery import (
+    AccountDiscoveryError, fetch_ad_accounts_page, fetch_ad_accounts_page_async, save_ad_accounts
+)
+from .services import response_cache
+from .services.async_graph_client import async_graph_client
+from .services.circuit_breaker import GraphUnavailable
+from .services.graph_client import graph_client
+from .services.graph_scheduler import graph_context
+from .tasks import discover_ad_accounts
 
 logger = logging.getLogger(__name__)
 
@@ -21,19 +34,18 @@ def facebook_login(request):
     """
     Redirect the user to Facebook OAuth login page
     """
-    app_id = os.environ.get('FACEBOOK_APP_ID')
+    app_id = settings.FACEBOOK_APP_ID
     
-    # Use a hardcoded redirect URI that matches what's configured in Facebook
+    # The redirect URI must match what's configured in Facebook
     # This should be the URL that's allowed in your Facebook app settings
-    base_url = "https://quickcampaigns.onrender.com"
-    redirect_uri = f"{base_url}/api/campaigns/auth/facebook/callback/"
+    redirect_uri = f"{settings.BACKEND_URL}/api/campaigns/auth/facebook/callback/"
     
     # Define the permissions we need
     scope = 'ads_management,ads_read,business_management'
     
     # Build the authorization URL
     auth_url = (
-        f"https://www.facebook.com/v17.0/dialog/oauth?"
+        f"https://www.facebook.com/{settings.GRAPH_API_VERSION}/dialog/oauth?"
         f"client_id={app_id}&redirect_uri={redirect_uri}&"
         f"scope={scope}&response_type=code"
     )
@@ -65,22 +77,9 @@ def facebook_callback(request):
     
     try:
         # Exchange code for access token
-        app_id = os.environ.get('FACEBOOK_APP_ID')
-        app_secret = os.environ.get('FACEBOOK_APP_SECRET')
-        
-        # Use the same hardcoded redirect URI as in the login function
-        base_url = "https://quickcampaigns.onrender.com"
-        redirect_uri = f"{base_url}/api/campaigns/auth/facebook/callback/"
-        
-        response = requests.get(
-            'https://graph.facebook.com/v17.0/oauth/access_token',
-            params={
-                'client_id': app_id,
-                'client_secret': app_secret,
-                'redirect_uri': redirect_uri,
-                'code': code
-            }
-        )
+        # Use the same redirect URI as in the login function
+        with graph_context(fail_fast=True):
+            response = graph_client.get('oauth/access_token', params=_token_params(code))
         
         if response.status_code != 200:
             logger.error(f"Error exchanging code for token: {response.text}")
@@ -92,70 +91,157 @@ def facebook_callback(request):
         data = response.json()
         access_token = data.get('access_token')
         
-        # Get user's ad accounts
-        ad_accounts_response = requests.get(
-            'https://graph.facebook.com/v17.0/me/adaccounts',
-            params={
-                'access_token': access_token,
-                'fields': 'id,name,account_status'
-            }
-        )
-        
-        if ad_accounts_response.status_code != 200:
-            logger.error(f"Error fetching ad accounts: {ad_accounts_response.text}")
+        # Get the first page of the user's ad accounts
+        try:
+            with graph_context(fail_fast=True):
+                ad_accounts, next_cursor = fetch_ad_accounts_page(access_token)
+        except AccountDiscoveryError as e:
+            logger.error(str(e))
             return Response(
                 {"detail": "Failed to fetch Facebook ad accounts"},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        ad_accounts = ad_accounts_response.json().get('data', [])
-        
         if not ad_accounts:
             return Response(
                 {"detail": "No ad accounts found for this Facebook user"},
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # For now, just use the first ad account
-        ad_account = ad_accounts[0]
-        account_id = ad_account['id']
-        account_name = ad_account['name']
+        _connect_ad_accounts(request.user, access_token, ad_accounts, next_cursor)
         
-        # Get or create user if not authenticated
-        if request.user.is_authenticated:
-            user = request.user
-        else:
-            # For demo purposes, use the first user or create a demo user
-            # In production, you would handle this differently
-            User = get_user_model()
-            user, created = User.objects.get_or_create(
-                email='demo@example.com',
-                defaults={'username': 'demo_user'}
-            )
-            
-        # Save or update the Facebook ad account
-        fb_account, created = FacebookAdAccount.objects.update_or_create(
-            user=user,
-            account_id=account_id,
-            defaults={
-                'name': account_name,
-                'access_token': access_token,
-                'is_active': True
-            }
+        # Redirect to the dashboard with success message
+        return HttpResponseRedirect(_connected_url())
+        
+    except GraphUnavailable as e:
+        # Answered with a 503 and Retry-After by the API exception handler;
+        # throttled calls are not retried while the browser waits
+        logger.warning(f"Facebook callback refused while Facebook is degraded: {str(e)}")
+        raise
+    except Exception as e:
+        logger.exception(f"Error in Facebook callback: {str(e)}")
+        return Response(
+            {"detail": "Error processing Facebook authorization"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+async def facebook_callback_async(request):
+    """
+    Handle the callback from Facebook OAuth without holding a thread
+
+    Coroutine version of facebook_callback, routed instead of it when
+    Django is served under ASGI (ASYNC_VIEWS). The Graph calls are awaited
+    on the async client; only the database work runs in a thread.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"detail": f"Method \"{request.method}\" not allowed."}, status=405)
+    
+    code = request.GET.get('code')
+    error = request.GET.get('error')
+    
+    if error:
+        logger.error(f"Facebook OAuth error: {error}")
+        return JsonResponse({"detail": f"Facebook authorization failed: {error}"}, status=400)
+    
+    if not code:
+        logger.error("No code provided in Facebook callback")
+        return JsonResponse({"detail": "No authorization code provided"}, status=400)
+    
+    try:
+        with graph_context(fail_fast=True):
+            response = await async_graph_client.get('oauth/access_token', params=_token_params(code))
+        
+        if response.status_code != 200:
+            logger.error(f"Error exchanging code for token: {response.text}")
+            return JsonResponse({"detail": "Failed to exchange code for access token"}, status=400)
         
-        logger.info(f"{'Created' if created else 'Updated'} Facebook ad account for user {request.user.id}")
+        access_token = response.json().get('access_token')
+        
+        # Get the first page of the user's ad accounts
+        try:
+            with graph_context(fail_fast=True):
+                ad_accounts, next_cursor = await fetch_ad_accounts_page_async(access_token)
+        except AccountDiscoveryError as e:
+            logger.error(str(e))
+            return JsonResponse({"detail": "Failed to fetch Facebook ad accounts"}, status=400)
+        
+        if not ad_accounts:
+            return JsonResponse({"detail": "No ad accounts found for this Facebook user"}, status=404)
+        
+        user = await sync_to_async(_authenticated_user)(request)
+        await sync_to_async(_connect_ad_accounts)(user, access_token, ad_accounts, next_cursor)
         
         # Redirect to the dashboard with success message
-        frontend_url = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
-        return HttpResponseRedirect(f"{frontend_url}/main?facebook_connected=true")
+        return HttpResponseRedirect(_connected_url())
         
+    except GraphUnavailable as e:
+        logger.warning(f"Facebook callback refused while Facebook is degraded: {str(e)}")
+        unavailable = ServiceUnavailable(wait=e.retry_after)
+        response = JsonResponse({"detail": unavailable.detail}, status=unavailable.status_code)
+        response['Retry-After'] = str(unavailable.wait)
+        return response
     except Exception as e:
         logger.exception(f"Error in Facebook callback: {str(e)}")
-        return Response(
-            {"detail": f"Error processing Facebook authorization: {str(e)}"},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        return JsonResponse({"detail": "Error processing Facebook authorization"}, status=500)
+
+# Read by CsrfViewMiddleware; Django 3.2's csrf_exempt cannot wrap a coroutine
+facebook_callback_async.csrf_exempt = True
+
+def _callback_url():
+    # The redirect URI must match what's configured in Facebook
+    return f"{settings.BACKEND_URL}/api/campaigns/auth/facebook/callback/"
+
+def _token_params(code):
+    return {
+        'client_id': settings.FACEBOOK_APP_ID,
+        'client_secret': settings.FACEBOOK_APP_SECRET,
+        'redirect_uri': _callback_url(),
+        'code': code
+    }
+
+def _connected_url():
+    frontend_url = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
+    return f"{frontend_url}/main?facebook_connected=true"
+
+def _authenticated_user(request):
+    """The user of the request's JWT access token, if it has a valid one"""
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return authenticated[0] if authenticated else None
+
+def _connect_ad_accounts(user, access_token, ad_accounts, next_cursor):
+    """
+    Save the first page of the user's ad accounts and queue the others
+    
+    Args:
+        user: Requesting user; anonymous or None connects the demo user
+        access_token: User access token from the code exchange
+        ad_accounts: First page of ad accounts from the Graph API
+        next_cursor: Paging cursor of the next page, or None
+    """
+    # Get or create user if not authenticated
+    if user is None or not user.is_authenticated:
+        # For demo purposes, use the first user or create a demo user
+        # In production, you would handle this differently
+        User = get_user_model()
+        user, created = User.objects.get_or_create(
+            email='demo@example.com',
+            defaults={'username': 'demo_user'}
         )
+    
+    # Save or update the first page of Facebook ad accounts
+    created, updated = save_ad_accounts(user, access_token, ad_accounts)
+    logger.info(f"Created {created} and updated {updated} Facebook ad accounts for user {user.id}")
+    
+    # Finish the remaining pages in the background
+    if next_cursor:
+        source = FacebookAdAccount.objects.filter(
+            user=user, account_id__in=[account['id'] for account in ad_accounts]
+        ).values_list('id', flat=True).first()
+        if source:
+            discover_ad_accounts.delay(source, next_cursor)
 
 @api_view(['GET'])
 @permission_classes([])
@@ -163,6 +249,9 @@ def facebook_accounts(request):
     """
     Get the user's connected Facebook ad accounts
     """
+    return response_cache.cached_response(request, lambda: _list_facebook_accounts(request))
+
+def _list_facebook_accounts(request):
     if request.user.is_authenticated:
         accounts = FacebookAdAccount.objects.filter(user=request.user)
     else:
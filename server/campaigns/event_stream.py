@@ -0,0 +1,233 @@
+"""
+Server-sent event stream for QuickCampaigns
+
+``GET /api/events/?token=<JWT access token>`` keeps a text/event-stream
+response open and forwards the user's live events (launch progress,
+status changes, credit balance; see services.live_events) as they are
+published. EventSource cannot send an Authorization header, hence the
+token in the query string.
+
+The stream is a plain ASGI app mounted in front of Django (server/asgi.py),
+so an open connection holds no thread and no database connection: one
+coroutine, one disconnect watcher and a bounded queue. All connections of
+a process share one Redis connection, pattern-subscribed to every user
+channel, and EventHub hands each message to the queues of that user's
+connections.
+
+- A comment line every LIVE_EVENTS_HEARTBEAT seconds keeps proxies from
+  closing idle streams.
+- A client whose queue fills up (LIVE_EVENTS_QUEUE_SIZE) is disconnected
+  instead of being buffered without bound; EventSource reconnects.
+- The stream ends when the access token expires, and the client
+  reconnects with a fresh one.
+- Every stream starts with a ``ready`` event, and gets a ``resync`` event
+  after the hub lost Redis for a while. Events published in between are
+  lost, so clients reload their state on both.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .metrics import metrics
+from .services.live_events import CHANNEL_PREFIX
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PATH = '/api/events/'
+
+# Milliseconds EventSource waits before reconnecting
+RETRY_MS = 5000
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+
+def format_event(event, data):
+    """One server-sent event, as bytes"""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class EventHub:
+    """Fans the messages of one Redis subscription out to the streams of this process"""
+
+    def __init__(self):
+        self._queues = defaultdict(set)
+        self._listener = None
+
+    @property
+    def connections(self):
+        return sum(len(queues) for queues in self._queues.values())
+
+    def subscribe(self, user_id):
+        """
+        Register a stream of the user
+
+        Returns:
+            asyncio.Queue receiving formatted events; None means the
+            stream fell behind and must end
+        """
+        queue = asyncio.Queue(maxsize=settings.LIVE_EVENTS_QUEUE_SIZE)
+        self._queues[str(user_id)].add(queue)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.ensure_future(self._listen())
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self._queues.get(str(user_id))
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._queues[str(user_id)]
+
+    def dispatch(self, channel, message):
+        """Queue a published message for the streams of the channel's user"""
+        queues = self._queues.get(channel[len(CHANNEL_PREFIX):])
+        if not queues:
+            return
+        try:
+            message = json.loads(message)
+            chunk = format_event(message['event'], message.get('data'))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping malformed live event on {channel}: {str(e)}")
+            return
+        for queue in list(queues):
+            self._put(channel[len(CHANNEL_PREFIX):], queue, chunk)
+
+    def broadcast(self, chunk):
+        for user_id, queues in list(self._queues.items()):
+            for queue in list(queues):
+                self._put(user_id, queue, chunk)
+
+    def _put(self, user_id, queue, chunk):
+        try:
+            queue.put_nowait(chunk)
+        except asyncio.QueueFull:
+            # Make room for the end-of-stream marker and stop feeding it
+            self.unsubscribe(user_id, queue)
+            queue.get_nowait()
+            queue.put_nowait(None)
+            metrics.incr('live_events.overflow')
+
+    async def _listen(self):
+        delay = RECONNECT_DELAY
+        lost = False
+        while True:
+            client = aioredis.from_url(settings.CACHES['default']['LOCATION'], socket_keepalive=True)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                    if lost:
+                        self.broadcast(format_event('resync', {}))
+                        lost = False
+                    delay = RECONNECT_DELAY
+                    async for message in pubsub.listen():
+                        if message['type'] == 'pmessage':
+                            self.dispatch(message['channel'].decode(), message['data'])
+            except (RedisError, OSError) as e:
+                logger.warning(f"Live event subscription lost, reconnecting in {delay}s: {str(e)}")
+                lost = True
+            finally:
+                await client.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+hub = EventHub()
+
+
+def authenticate(scope):
+    """
+    The user and expiry of the access token in the query string
+
+    Returns:
+        Tuple of (user ID, expiry timestamp), or (None, None)
+    """
+    token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    if not token:
+        return None, None
+    try:
+        access = AccessToken(token[0])
+        return access[jwt_settings.USER_ID_CLAIM], access['exp']
+    except (TokenError, KeyError):
+        return None, None
+
+
+def response_headers(scope, content_type):
+    headers = [(b'content-type', content_type), (b'cache-control', b'no-cache')]
+    # The dashboard is served from another origin
+    origin = dict(scope.get('headers', [])).get(b'origin', b'').decode()
+    if origin and origin in settings.CORS_ALLOWED_ORIGINS:
+        headers.append((b'access-control-allow-origin', origin.encode()))
+        headers.append((b'vary', b'Origin'))
+        if settings.CORS_ALLOW_CREDENTIALS:
+            headers.append((b'access-control-allow-credentials', b'true'))
+    return headers
+
+
+async def send_error(scope, send, status, detail):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': response_headers(scope, b'application/json'),
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps({'detail': detail}).encode()})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def event_stream(scope, receive, send):
+    """ASGI app streaming the authenticated user's live events"""
+    if scope['method'] != 'GET':
+        await send_error(scope, send, 405, f"Method \"{scope['method']}\" not allowed.")
+        return
+    user_id, expires_at = authenticate(scope)
+    if user_id is None:
+        await send_error(scope, send, 401, "A valid access token is required as ?token=.")
+        return
+
+    queue = hub.subscribe(user_id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    metrics.incr('live_events.connected')
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': response_headers(scope, b'text/event-stream') + [(b'x-accel-buffering', b'no')],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': f"retry: {RETRY_MS}\n\n".encode() + format_event('ready', {}),
+            'more_body': True,
+        })
+        while not disconnected.done():
+            timeout = min(settings.LIVE_EVENTS_HEARTBEAT, expires_at - time.time())
+            if timeout <= 0:
+                break
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                chunk = b': ping\n\n'
+            else:
+                chunk = getter.result()
+                if chunk is None:
+                    break
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(user_id, queue)
+        metrics.incr('live_events.disconnected')
@@ -0,0 +1,32 @@
+"""
+API exception handling for QuickCampaigns
+"""
+import math
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.views import exception_handler as drf_exception_handler
+from .services.circuit_breaker import GraphUnavailable
+
+
+class ServiceUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Facebook is temporarily unavailable, please try again shortly.'
+    default_code = 'service_unavailable'
+
+    def __init__(self, detail=None, wait=None):
+        super().__init__(detail)
+        # DRF sends ``wait`` as the Retry-After header
+        self.wait = max(1, math.ceil(wait)) if wait is not None else None
+
+
+def exception_handler(exc, context):
+    """
+    DRF exception handler that answers refused Graph calls with a 503
+
+    Circuit breakers, the bulkhead and the rate limit scheduler refuse a
+    Graph call before it is sent; the client should retry after the
+    reported delay rather than see a 500.
+    """
+    if isinstance(exc, GraphUnavailable):
+        exc = ServiceUnavailable(wait=exc.retry_after)
+    return drf_exception_handler(exc, context)
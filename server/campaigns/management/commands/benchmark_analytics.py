@@ -0,0 +1,184 @@
+"""
+Latency benchmark for the analytics queries as campaign history grows
+
+Seeds users with launched campaigns and grows their daily insights in
+steps. After each step the rollups of the new days are refreshed, and
+the dashboard queries are timed against the rollups, and optionally
+against the raw insight rows:
+
+    python manage.py benchmark_analytics --users 100 --campaigns 20 --history 90,365,730,1095
+    python manage.py benchmark_analytics --raw --repeat 100
+
+With rollups, p95 should stay flat from the first step to the last; the
+raw sums grow with the history. Seeded rows belong to users named
+``<prefix>-<n>`` and are removed with --cleanup.
+"""
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+from campaigns.models import Campaign, CampaignDailyInsight, FacebookAdAccount, MetricRollup
+from campaigns.services import metric_rollups
+
+
+class Command(BaseCommand):
+    help = "Grow campaign insight history and report analytics query latency at each size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--campaigns', type=int, default=20, help='Campaigns per user')
+        parser.add_argument('--history', default='90,365,730,1095',
+                            help='Comma-separated days of history to measure at, ascending')
+        parser.add_argument('--repeat', type=int, default=50, help='Timed runs per query')
+        parser.add_argument('--raw', action='store_true', help='Also time the same sums over CampaignDailyInsight')
+        parser.add_argument('--prefix', default='analytics-bench')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded rows and exit')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        prefix = options['prefix']
+        seeded = User.objects.filter(username__startswith=f"{prefix}-")
+
+        if options['cleanup']:
+            MetricRollup.objects.filter(ad_account_id__startswith=f"act_{prefix}_").delete()
+            deleted, _ = seeded.delete()
+            self.stdout.write(f"Deleted {deleted} rows")
+            return
+
+        steps = sorted(int(days) for days in options['history'].split(','))
+        if seeded.exists():
+            raise CommandError("Seeded users already exist; run with --cleanup first")
+
+        campaigns = self.seed_campaigns(options)
+        user_ids = sorted({campaign.user_id for campaign in campaigns})
+        today = timezone.localdate()
+
+        results = []
+        seeded_days = 0
+        for days in steps:
+            started = time.monotonic()
+            self.seed_insights(campaigns, today, seeded_days, days, options['batch_size'])
+            seeded_days = days
+            rows = CampaignDailyInsight.objects.filter(campaign__user_id__in=user_ids).count()
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{days} days of history, {rows} insight rows (seeded in {time.monotonic() - started:.1f}s)"
+            ))
+            results.append((days, self.run_queries(user_ids, today, days, options)))
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Summary (p95 ms)"))
+        names = list(results[0][1])
+        self.stdout.write(f"{'query':<32}" + ''.join(f"{days:>10}d" for days, _ in results))
+        for name in names:
+            self.stdout.write(f"{name:<32}" + ''.join(f"{timings[name]:>11.3f}" for _, timings in results))
+
+    def seed_campaigns(self, options):
+        User = get_user_model()
+        prefix = options['prefix']
+        rng = random.Random(0)
+        User.objects.bulk_create(
+            [User(username=f"{prefix}-{n}") for n in range(options['users'])],
+            batch_size=options['batch_size'],
+        )
+        users = list(User.objects.filter(username__startswith=f"{prefix}-").values_list('id', flat=True))
+        FacebookAdAccount.objects.bulk_create([
+            FacebookAdAccount(user_id=user_id, account_id=f"act_{prefix}_{user_id}", name='Benchmark', access_token='benchmark')
+            for user_id in users
+        ], batch_size=options['batch_size'])
+        accounts = dict(FacebookAdAccount.objects.filter(user_id__in=users).values_list('user_id', 'id'))
+
+        objectives = [choice for choice, _ in Campaign.OBJECTIVE_CHOICES]
+        Campaign.objects.bulk_create([
+            Campaign(
+                user_id=user_id,
+                facebook_account_id=accounts[user_id],
+                name=f"Campaign {n}",
+                objective=rng.choice(objectives),
+                status='active',
+                budget=100,
+                start_date=timezone.localdate(),
+                facebook_campaign_id=f"{prefix}-{user_id}-{n}",
+            )
+            for user_id in users
+            for n in range(options['campaigns'])
+        ], batch_size=options['batch_size'])
+        return list(
+            Campaign.objects.filter(user_id__in=users).select_related('facebook_account')
+            .only('id', 'user_id', 'facebook_account__account_id')
+        )
+
+    def seed_insights(self, campaigns, today, from_days, to_days, batch_size):
+        """Add the days in [today - to_days, today - from_days) and refresh their rollups"""
+        rng = random.Random(to_days)
+        dates = [today - timedelta(days=offset) for offset in range(from_days, to_days)]
+        batch = []
+        for campaign in campaigns:
+            for day in dates:
+                impressions = rng.randint(100, 10000)
+                clicks = rng.randint(0, impressions // 50)
+                batch.append(CampaignDailyInsight(
+                    campaign_id=campaign.id,
+                    date=day,
+                    impressions=impressions,
+                    reach=impressions * 3 // 4,
+                    clicks=clicks,
+                    link_clicks=clicks * 4 // 5,
+                    conversions=rng.randint(0, max(1, clicks // 10)),
+                    spend=Decimal(rng.randint(100, 50000)) / 100,
+                ))
+                if len(batch) >= batch_size:
+                    CampaignDailyInsight.objects.bulk_create(batch)
+                    batch = []
+        CampaignDailyInsight.objects.bulk_create(batch)
+
+        for ad_account_id in sorted({campaign.facebook_account.account_id for campaign in campaigns}):
+            for start in range(0, len(dates), metric_rollups.REBUILD_CHUNK_DAYS):
+                metric_rollups.refresh_rollups(ad_account_id, dates[start:start + metric_rollups.REBUILD_CHUNK_DAYS])
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def run_queries(self, user_ids, today, days, options):
+        User = get_user_model()
+        rng = random.Random(1)
+        users = list(User.objects.filter(id__in=rng.sample(user_ids, min(len(user_ids), 50))))
+        since = today - timedelta(days=days - 1)
+        last_30 = today - timedelta(days=29)
+
+        queries = {
+            'last 30 days': lambda user: metric_rollups.query_metrics(user, last_30, today),
+            'last 30 days by day': lambda user: metric_rollups.query_metrics(user, last_30, today, interval='day'),
+            'full history by month': lambda user: metric_rollups.query_metrics(
+                user, since, today, interval='month', group_by=['objective']),
+            'full history by account': lambda user: metric_rollups.query_metrics(
+                user, since, today, group_by=['account', 'objective']),
+        }
+        if options['raw']:
+            sums = {field: Sum(field) for field in metric_rollups.METRIC_FIELDS}
+            queries['raw: last 30 days'] = lambda user: list(CampaignDailyInsight.objects.filter(
+                campaign__user=user, date__gte=last_30, date__lte=today).aggregate(**sums).items())
+            queries['raw: full history by account'] = lambda user: list(CampaignDailyInsight.objects.filter(
+                campaign__user=user, date__gte=since, date__lte=today
+            ).values('campaign__facebook_account__account_id', 'campaign__objective').annotate(**sums))
+
+        p95s = {}
+        for name, run in queries.items():
+            timings = []
+            for _ in range(options['repeat']):
+                user = rng.choice(users)
+                started = time.perf_counter()
+                run(user)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p95s[name] = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(
+                f"  {name:<32} median {statistics.median(timings):.3f} ms, p95 {p95s[name]:.3f} ms"
+            )
+        return p95s
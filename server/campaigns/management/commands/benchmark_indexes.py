@@ -0,0 +1,195 @@
+"""
+Query plan benchmark for the per-user access patterns
+
+Seeds users with campaigns, creatives, ad accounts and credit
+transactions, then prints the EXPLAIN plan and latency of each hot query:
+
+    python manage.py benchmark_indexes --users 10000 --campaigns 50 --transactions 200
+    python manage.py benchmark_indexes --skip-seed --compare
+
+--compare runs every query a second time with the Meta.indexes dropped
+inside a transaction that is rolled back afterwards, which gives the
+before/after numbers side by side. It needs a database with transactional
+DDL (PostgreSQL). Seeded rows belong to users named ``<prefix>-<n>`` and
+are removed with --cleanup.
+"""
+import random
+import statistics
+import time
+from datetime import date
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from campaigns.models import Campaign, CampaignCreative, CreditTransaction, FacebookAdAccount
+
+INDEXED_MODELS = [FacebookAdAccount, Campaign, CreditTransaction]
+
+
+class Command(BaseCommand):
+    help = "Seed per-user data and report EXPLAIN plans and latencies of the hot queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--campaigns', type=int, default=20, help='Campaigns per user')
+        parser.add_argument('--creatives', type=int, default=3, help='Creatives per campaign')
+        parser.add_argument('--accounts', type=int, default=3, help='Ad accounts per user')
+        parser.add_argument('--transactions', type=int, default=50, help='Credit transactions per user')
+        parser.add_argument('--repeat', type=int, default=50, help='Timed runs per query')
+        parser.add_argument('--prefix', default='bench')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse previously seeded rows')
+        parser.add_argument('--compare', action='store_true', help='Also run without the indexes')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded rows and exit')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        seeded = User.objects.filter(username__startswith=f"{options['prefix']}-")
+
+        if options['cleanup']:
+            deleted, _ = seeded.delete()
+            self.stdout.write(f"Deleted {deleted} rows")
+            return
+
+        if options['compare'] and not connection.features.can_rollback_ddl:
+            raise CommandError("--compare needs a database with transactional DDL, such as PostgreSQL")
+
+        if not options['skip_seed']:
+            self.seed(options)
+
+        user_ids = list(seeded.values_list('id', flat=True))
+        if not user_ids:
+            raise CommandError("No seeded users found; run without --skip-seed first")
+
+        self.stdout.write(self.style.MIGRATE_HEADING("With indexes"))
+        with_indexes = self.run_queries(user_ids, options['repeat'])
+
+        if options['compare']:
+            with transaction.atomic():
+                with connection.schema_editor() as editor:
+                    for model in INDEXED_MODELS:
+                        for index in model._meta.indexes:
+                            editor.remove_index(model, index)
+                self.stdout.write(self.style.MIGRATE_HEADING("Without indexes"))
+                without_indexes = self.run_queries(user_ids, options['repeat'])
+                transaction.set_rollback(True)
+
+            self.stdout.write(self.style.MIGRATE_HEADING("Summary (median ms)"))
+            for name, median in with_indexes.items():
+                before = without_indexes[name]
+                self.stdout.write(f"{name:<24} {before:>10.3f} -> {median:>8.3f}  ({before / max(median, 1e-6):.1f}x)")
+
+    def seed(self, options):
+        User = get_user_model()
+        prefix = options['prefix']
+        batch_size = options['batch_size']
+        rng = random.Random(0)
+        start = User.objects.filter(username__startswith=f"{prefix}-").count()
+
+        started = time.monotonic()
+        User.objects.bulk_create(
+            [User(username=f"{prefix}-{n}") for n in range(start, start + options['users'])],
+            batch_size=batch_size,
+        )
+        users = list(
+            User.objects.filter(username__startswith=f"{prefix}-").order_by('-id')
+            .values_list('id', flat=True)[:options['users']]
+        )
+
+        FacebookAdAccount.objects.bulk_create([
+            FacebookAdAccount(
+                user_id=user_id,
+                account_id=f"act_{prefix}_{user_id}_{n}",
+                name=f"Account {n}",
+                access_token='benchmark',
+                is_active=n == 0,
+            )
+            for user_id in users
+            for n in range(options['accounts'])
+        ], batch_size=batch_size)
+
+        statuses = [choice for choice, _ in Campaign.STATUS_CHOICES]
+        Campaign.objects.bulk_create([
+            Campaign(
+                user_id=user_id,
+                name=f"Campaign {n}",
+                objective='website',
+                status=rng.choice(statuses),
+                budget=100,
+                start_date=date.today(),
+            )
+            for user_id in users
+            for n in range(options['campaigns'])
+        ], batch_size=batch_size)
+
+        campaign_ids = Campaign.objects.filter(user_id__in=users).values_list('id', flat=True).iterator()
+        batch = []
+        for campaign_id in campaign_ids:
+            batch.extend(
+                CampaignCreative(
+                    campaign_id=campaign_id,
+                    file=f"campaign_creatives/bench/{campaign_id}-{n}.jpg",
+                    file_type='image',
+                    file_name=f"{n}.jpg",
+                    file_size=1024,
+                )
+                for n in range(options['creatives'])
+            )
+            if len(batch) >= batch_size:
+                CampaignCreative.objects.bulk_create(batch)
+                batch = []
+        CampaignCreative.objects.bulk_create(batch)
+
+        types = [choice for choice, _ in CreditTransaction.TRANSACTION_TYPES]
+        users_per_batch = max(1, batch_size // max(1, options['transactions']))
+        for offset in range(0, len(users), users_per_batch):
+            chunk = users[offset:offset + users_per_batch]
+            CreditTransaction.objects.bulk_create([
+                CreditTransaction(user_id=user_id, amount=rng.randint(-5, 20), transaction_type=rng.choice(types))
+                for user_id in chunk
+                for _ in range(options['transactions'])
+            ])
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        self.stdout.write(f"Seeded {len(users)} users in {time.monotonic() - started:.1f}s")
+
+    def run_queries(self, user_ids, repeat):
+        rng = random.Random(1)
+        samples = list(
+            Campaign.objects.filter(user_id__in=rng.sample(user_ids, min(len(user_ids), 100)))
+            .values_list('user_id', 'id')
+        )
+        if not samples:
+            raise CommandError("Seeded users have no campaigns")
+
+        queries = {
+            'campaign list': lambda user_id, campaign_id: Campaign.objects.filter(
+                user_id=user_id).order_by('-created_at', '-id')[:20],
+            'campaigns by status': lambda user_id, campaign_id: Campaign.objects.filter(
+                user_id=user_id, status='active'),
+            'active ad account': lambda user_id, campaign_id: FacebookAdAccount.objects.filter(
+                user_id=user_id, is_active=True).order_by('pk')[:1],
+            'campaign creatives': lambda user_id, campaign_id: CampaignCreative.objects.filter(
+                campaign_id=campaign_id, campaign__user_id=user_id),
+            'credit transactions': lambda user_id, campaign_id: CreditTransaction.objects.filter(
+                user_id=user_id).order_by('-created_at')[:50],
+        }
+
+        explain_options = {'analyze': True} if connection.vendor == 'postgresql' else {}
+        medians = {}
+        for name, build in queries.items():
+            self.stdout.write(self.style.SQL_TABLE(name))
+            self.stdout.write(build(*samples[0]).explain(**explain_options))
+
+            timings = []
+            for _ in range(repeat):
+                queryset = build(*rng.choice(samples))
+                started = time.perf_counter()
+                list(queryset)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            medians[name] = statistics.median(timings)
+            p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+            self.stdout.write(f"  median {medians[name]:.3f} ms, p95 {p95:.3f} ms over {repeat} runs\n")
+        return medians
@@ -0,0 +1,186 @@
+"""
+Load test for the live event streams
+
+Opens many idle event streams against a running ASGI server, holds them
+through a few heartbeats, then publishes events to their users and
+measures how many arrive and how late:
+
+    uvicorn server.asgi:application --port 8001 --no-access-log &
+    python manage.py loadtest_events --connections 10000 --events 2000 --server-pid $!
+
+Access tokens are minted for made-up user IDs starting at --first-user-id,
+so nothing is written to the database; the stream never reads it. With
+--server-pid the server's resident memory is sampled before and after
+connecting, which gives the cost of one idle connection.
+"""
+import asyncio
+import json
+import random
+import resource
+import statistics
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from redis import asyncio as aioredis
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from campaigns.services.live_events import channel
+
+
+class Command(BaseCommand):
+    help = "Hold many live event streams open and measure event delivery"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8001/api/events/')
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=0,
+                            help='Distinct users the connections belong to (default: one per connection)')
+        parser.add_argument('--first-user-id', type=int, default=10_000_000)
+        parser.add_argument('--connect-concurrency', type=int, default=200,
+                            help='Connections being opened at the same time')
+        parser.add_argument('--idle', type=float, default=30, help='Seconds to hold the idle streams')
+        parser.add_argument('--events', type=int, default=1000, help='Events to publish')
+        parser.add_argument('--rate', type=float, default=500, help='Events published per second')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for deliveries')
+        parser.add_argument('--server-pid', type=int, help='Process to sample resident memory of')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError("Only http:// URLs are supported")
+        # Every stream is a file descriptor on this side too
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < options['connections'] + 100:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        asyncio.run(self.run(url, options))
+
+    async def run(self, url, options):
+        connections = options['connections']
+        users = options['users'] or connections
+        user_ids = [options['first_user_id'] + n for n in range(users)]
+        tokens = {user_id: self.mint_token(user_id) for user_id in user_ids}
+        self.latencies = []
+        self.ready = 0
+        self.failures = []
+        rss_before = rss_kib(options['server_pid'])
+
+        # Connection n belongs to user n % users
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Opening {connections} streams for {users} users"))
+        limit = asyncio.Semaphore(options['connect_concurrency'])
+        started = time.monotonic()
+        clients = [
+            asyncio.ensure_future(self.client(url, tokens[user_ids[n % users]], limit))
+            for n in range(connections)
+        ]
+        while self.ready + len(self.failures) < connections:
+            await asyncio.sleep(0.2)
+        connect_seconds = time.monotonic() - started
+        self.stdout.write(
+            f"{self.ready} streams open, {len(self.failures)} failed, in {connect_seconds:.1f}s"
+        )
+        for failure in sorted(set(self.failures))[:5]:
+            self.stdout.write(self.style.WARNING(f"  {failure}"))
+
+        await asyncio.sleep(options['idle'])
+        rss_after = rss_kib(options['server_pid'])
+        open_after_idle = sum(1 for client in clients if not client.done())
+        self.stdout.write(f"{open_after_idle} streams still open after {options['idle']:.0f}s idle")
+
+        expected = await self.publish(user_ids, connections, users, options)
+        deadline = time.monotonic() + options['timeout']
+        while len(self.latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+
+        for client in clients:
+            client.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        self.report(expected, rss_before, rss_after)
+
+    async def client(self, url, token, limit):
+        async with limit:
+            try:
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                writer.write(
+                    f"GET {url.path}?token={token} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                    f"Accept: text/event-stream\r\n\r\n".encode()
+                )
+                status = await reader.readline()
+                if b' 200 ' not in status:
+                    raise ConnectionError(status.decode().strip() or 'connection closed')
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+            except (OSError, ConnectionError) as e:
+                self.failures.append(f"{type(e).__name__}: {str(e)}")
+                return
+        self.ready += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                # Chunked framing lines never start with "data: "
+                if line.startswith(b'data: {"sent"'):
+                    self.latencies.append(time.time() - json.loads(line[6:])['sent'])
+        finally:
+            writer.close()
+
+    async def publish(self, user_ids, connections, users, options):
+        """Publish the events at the requested rate; returns the deliveries expected"""
+        per_user = [connections // users + (1 if n < connections % users else 0) for n in range(users)]
+        client = aioredis.from_url(settings.CACHES['default']['LOCATION'])
+        expected = 0
+        interval = 1 / options['rate']
+        started = time.monotonic()
+        try:
+            for number in range(options['events']):
+                index = random.randrange(users)
+                await client.publish(channel(user_ids[index]), json.dumps({
+                    'event': 'loadtest', 'data': {'sent': time.time(), 'number': number},
+                }))
+                expected += per_user[index]
+                delay = started + (number + 1) * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            await client.close()
+        self.stdout.write(f"Published {options['events']} events in {time.monotonic() - started:.1f}s")
+        return expected
+
+    def mint_token(self, user_id):
+        token = AccessToken()
+        token[jwt_settings.USER_ID_CLAIM] = user_id
+        token.set_exp(lifetime=timedelta(hours=1))
+        return str(token)
+
+    def report(self, expected, rss_before, rss_after):
+        self.stdout.write(self.style.MIGRATE_HEADING("Results"))
+        delivered = len(self.latencies)
+        self.stdout.write(f"Delivered {delivered} of {expected} expected events")
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            self.stdout.write(
+                f"Latency ms: p50 {quantiles[49] * 1000:.1f}  p95 {quantiles[94] * 1000:.1f}  "
+                f"p99 {quantiles[98] * 1000:.1f}  max {latencies[-1] * 1000:.1f}"
+            )
+        if rss_before is not None and rss_after is not None and self.ready:
+            self.stdout.write(
+                f"Server memory: {rss_before / 1024:.1f} MiB -> {rss_after / 1024:.1f} MiB, "
+                f"{(rss_after - rss_before) / self.ready:.1f} KiB per stream"
+            )
+
+
+def rss_kib(pid):
+    """Resident memory of a process in KiB, from /proc (Linux only)"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
@@ -0,0 +1,18 @@
+"""
+Rebuild the campaign metric rollups from the daily insight rows
+
+The insights sync keeps the rollups current; this is for backfills and
+for rollups left stale by deleted campaigns:
+
+    python manage.py rebuild_metric_rollups
+"""
+from django.core.management.base import BaseCommand
+from campaigns.services.metric_rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the day, week and month metric rollups from CampaignDailyInsight"
+
+    def handle(self, *args, **options):
+        accounts = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt metric rollups of {accounts} ad accounts"))
@@ -0,0 +1,47 @@
+"""
+Recompute credit balances from the CreditTransaction ledger
+
+    python manage.py reconcile_credits            # report drift
+    python manage.py reconcile_credits --repair   # and fix it
+    python manage.py reconcile_credits --full     # rebuild snapshots from scratch
+"""
+from django.core.management.base import BaseCommand, CommandError
+from campaigns.services.credit_reconciliation import ReconciliationInProgress, reconcile_balances
+
+
+class Command(BaseCommand):
+    help = "Check UserCredit balances against SUM(CreditTransaction.amount) per user"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Overwrite drifted balances with the ledger value')
+        parser.add_argument('--full', action='store_true', help='Ignore the last checkpoint and rescan every transaction')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            checkpoint = reconcile_balances(
+                repair=options['repair'],
+                full=options['full'],
+                chunk_size=options['chunk_size'],
+            )
+        except ReconciliationInProgress as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Scanned {checkpoint.transactions_scanned} transactions for {checkpoint.users_updated} users "
+            f"up to transaction {checkpoint.last_transaction_id}"
+        )
+        self.stdout.write(
+            'Timings: ' + ', '.join(f"{phase}={seconds:.3f}s" for phase, seconds in checkpoint.timings.items())
+        )
+        for drift in checkpoint.drift_details:
+            self.stdout.write(f"  user {drift['user_id']}: balance {drift['balance']}, ledger {drift['ledger']}")
+
+        if checkpoint.drift_count and not options['repair']:
+            self.stdout.write(self.style.WARNING(f"{checkpoint.drift_count} balances drifted from the ledger"))
+        elif checkpoint.drift_count:
+            self.stdout.write(self.style.SUCCESS(
+                f"Repaired {checkpoint.repaired_count} of {checkpoint.drift_count} drifted balances"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS("All balances match the ledger"))
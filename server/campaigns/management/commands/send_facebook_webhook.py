@@ -0,0 +1,51 @@
+"""
+Send a signed Facebook webhook payload to a running server
+
+Builds the body Facebook sends for an ad object change, signs it with
+FACEBOOK_APP_SECRET, and posts it, for trying the receiver locally:
+
+    python manage.py send_facebook_webhook 120200000000001 --status PAUSED
+    python manage.py send_facebook_webhook 120200000000002 --level AD --field with_issues_ad_objects
+    python manage.py send_facebook_webhook 120200000000001 --status ACTIVE --time 1700000000 --repeat 3
+
+--print writes the headers and body instead of sending them.
+"""
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from campaigns.services.facebook_webhooks import STATUS_FIELDS, build_payload, sign_payload
+
+
+class Command(BaseCommand):
+    help = "Post a signed Facebook webhook payload for one ad object"
+
+    def add_arguments(self, parser):
+        parser.add_argument('object_id', help='Facebook ID of the campaign, ad set or ad')
+        parser.add_argument('--ad-account', default='act_0')
+        parser.add_argument('--level', default='CAMPAIGN', choices=['CAMPAIGN', 'ADSET', 'AD'])
+        parser.add_argument('--field', default='in_process_ad_objects', choices=sorted(STATUS_FIELDS))
+        parser.add_argument('--status', default='ACTIVE', help='status_name of in_process_ad_objects')
+        parser.add_argument('--time', type=int, help='Event time as a Unix timestamp, defaults to now')
+        parser.add_argument('--repeat', type=int, default=1, help='Deliveries of the same payload')
+        parser.add_argument('--url', default='http://localhost:8000/api/webhooks/facebook/')
+        parser.add_argument('--print', action='store_true', help='Print the request instead of sending it')
+
+    def handle(self, *args, **options):
+        if not settings.FACEBOOK_APP_SECRET:
+            raise CommandError("FACEBOOK_APP_SECRET must be set to sign the payload")
+
+        body = build_payload(
+            options['ad_account'], options['object_id'], field=options['field'],
+            status_name=options['status'], level=options['level'], time=options['time'],
+        )
+        headers = {'Content-Type': 'application/json', 'X-Hub-Signature-256': sign_payload(body)}
+
+        if options['print']:
+            for name, value in headers.items():
+                self.stdout.write(f"{name}: {value}")
+            self.stdout.write(body.decode())
+            return
+
+        for _ in range(options['repeat']):
+            response = requests.post(options['url'], data=body, headers=headers, timeout=10)
+            self.stdout.write(f"{response.status_code} in {response.elapsed.total_seconds() * 1000:.1f} ms")
@@ -0,0 +1,76 @@
+"""
+In-process metrics for QuickCampaigns
+
+Counters and timing summaries are kept per process and can be read
+through the staff-only metrics endpoint or logged by a worker.
+"""
+import threading
+from collections import defaultdict
+
+
+class Timing:
+    """Count / total / max summary of observed durations in seconds"""
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe registry of counters and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timings = defaultdict(Timing)
+
+    def incr(self, name, value=1, **tags):
+        """Increment a counter"""
+        key = _key(name, tags)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, seconds, **tags):
+        """Record a duration"""
+        key = _key(name, tags)
+        with self._lock:
+            self._timings[key].add(seconds)
+
+    def snapshot(self):
+        """Current values of every counter and timing"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': {key: timing.as_dict() for key, timing in self._timings.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+def _key(name, tags):
+    if not tags:
+        return name
+    labels = ','.join(f"{key}={value}" for key, value in sorted(tags.items()))
+    return f"{name}{{{labels}}}"
+
+
+metrics = MetricsRegistry()
@@ -1,3 +1,4 @@
+import uuid
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -12,6 +13,12 @@ class FacebookAdAccount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # launch looks up the user's active account
+            models.Index(fields=['user'], condition=models.Q(is_active=True), name='fb_account_user_active_idx'),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.account_id})"
 
@@ -42,31 +49,248 @@ class Campaign(models.Model):
     end_date = models.DateField(null=True, blank=True)
     target_audience = models.TextField(null=True, blank=True)
     facebook_campaign_id = models.CharField(max_length=100, null=True, blank=True)
+    facebook_ad_set_id = models.CharField(max_length=100, null=True, blank=True)
+    # effective_status last read from Facebook, and when to read it next
+    facebook_status = models.CharField(max_length=50, null=True, blank=True)
+    status_checked_at = models.DateTimeField(null=True, blank=True)
+    next_status_check_at = models.DateTimeField(null=True, blank=True)
+    # Seconds between checks; doubles while the status stays the same
+    status_check_interval = models.PositiveIntegerField(null=True, blank=True)
+    # Templates are kept to be cloned and are never launched themselves
+    is_template = models.BooleanField(default=False)
+    cloned_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='clones')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Matches the keyset ordering of the campaign list
+            models.Index(fields=['user', '-created_at', '-id'], name='campaign_user_created_idx'),
+            models.Index(fields=['user', 'status'], name='campaign_user_status_idx'),
+            # The status poller only scans launched campaigns that are due
+            models.Index(
+                fields=['next_status_check_at'],
+                condition=models.Q(facebook_campaign_id__isnull=False),
+                name='campaign_status_check_idx',
+            ),
+        ]
+
     def __str__(self):
         return self.name
 
 
+class CampaignDailyInsight(models.Model):
+    """One day of a launched campaign's delivery metrics, as reported by /insights"""
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='daily_insights')
+    date = models.DateField()
+    impressions = models.BigIntegerField(default=0)
+    reach = models.BigIntegerField(default=0)
+    clicks = models.BigIntegerField(default=0)
+    link_clicks = models.BigIntegerField(default=0)
+    conversions = models.BigIntegerField(default=0)
+    spend = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'date'], name='unique_campaign_daily_insight'),
+        ]
+
+    def __str__(self):
+        return f"{self.campaign_id} on {self.date}: {self.impressions} impressions"
+
+
+class MetricRollup(models.Model):
+    """
+    Campaign metrics summed per user, ad account and objective over a day,
+    an ISO week (starting Monday) or a calendar month
+    """
+    GRANULARITY_CHOICES = [
+        ('day', 'Day'),
+        ('week', 'Week'),
+        ('month', 'Month'),
+    ]
+
+    granularity = models.CharField(max_length=5, choices=GRANULARITY_CHOICES)
+    period_start = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='metric_rollups')
+    # Graph ad account ID rather than a foreign key, so disconnecting keeps the history
+    ad_account_id = models.CharField(max_length=100, blank=True, default='')
+    objective = models.CharField(max_length=50)
+    impressions = models.BigIntegerField(default=0)
+    clicks = models.BigIntegerField(default=0)
+    link_clicks = models.BigIntegerField(default=0)
+    conversions = models.BigIntegerField(default=0)
+    spend = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'granularity', 'period_start', 'ad_account_id', 'objective'],
+                name='unique_metric_rollup',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.granularity} of {self.period_start}: {self.spend} spent"
+
+
+class InsightSyncCheckpoint(models.Model):
+    """How far the insights of an ad account's campaigns have been synced"""
+    facebook_account = models.OneToOneField(FacebookAdAccount, on_delete=models.CASCADE, related_name='insight_checkpoint')
+    # Last day whose metrics were stored; the next run starts a few days before it
+    last_synced_date = models.DateField(null=True, blank=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    rows_synced = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Insights of {self.facebook_account_id} synced to {self.last_synced_date}"
+
+
+class CreativeBlob(models.Model):
+    """A creative file stored once, named after its SHA-256 content hash"""
+    PROCESSING_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('valid', 'Valid'),
+        ('invalid', 'Invalid'),
+        ('failed', 'Failed'),
+    ]
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(max_length=255)
+    file_size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, null=True, blank=True)
+    # CampaignCreative rows sharing this file; the file is deleted at zero
+    ref_count = models.PositiveIntegerField(default=0)
+
+    # Derived by the processing pipeline from the file itself
+    processing_status = models.CharField(max_length=20, choices=PROCESSING_STATUS_CHOICES, default='pending')
+    mime_type = models.CharField(max_length=100, null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    preview = models.FileField(upload_to='creative_previews/', max_length=255, null=True, blank=True)
+    validation_errors = models.JSONField(default=list, blank=True)
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def aspect_ratio(self):
+        if self.width and self.height:
+            return round(self.width / self.height, 4)
+        return None
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} references)"
+
+
+class FacebookMediaUpload(models.Model):
+    """A blob already uploaded to an ad account's /adimages or /advideos"""
+    MEDIA_TYPES = [
+        ('image', 'Image'),
+        ('video', 'Video'),
+    ]
+
+    blob = models.ForeignKey(CreativeBlob, on_delete=models.CASCADE, related_name='facebook_uploads')
+    ad_account_id = models.CharField(max_length=100)
+    media_type = models.CharField(max_length=10, choices=MEDIA_TYPES)
+    # Image hash for images, video ID for videos
+    facebook_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blob', 'ad_account_id'], name='unique_facebook_media_upload'),
+        ]
+
+    def __str__(self):
+        return f"{self.media_type} {self.facebook_id} in act_{self.ad_account_id}"
+
+
 class CampaignCreative(models.Model):
     campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='creatives')
-    file = models.FileField(upload_to='campaign_creatives/%Y/%m/%d/')
+    file = models.FileField(upload_to='campaign_creatives/%Y/%m/%d/', max_length=255)
+    # Set once the content hash is known; file then points at the blob's file
+    blob = models.ForeignKey(CreativeBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='creatives')
     file_type = models.CharField(max_length=50)
     file_name = models.CharField(max_length=255)
-    file_size = models.IntegerField()
+    file_size = models.BigIntegerField()
+    facebook_creative_id = models.CharField(max_length=100, null=True, blank=True)
+    facebook_ad_id = models.CharField(max_length=100, null=True, blank=True)
+    # Storage key of the direct upload token it was finalized from; the token
+    # is spent once a creative carries its key
+    upload_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.file_name} - {self.campaign.name}"
 
 
+class CreativeUpload(models.Model):
+    """A resumable upload of one creative, sent as numbered parts"""
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('completing', 'Completing'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='creative_uploads')
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='uploads')
+    file_name = models.CharField(max_length=255)
+    file_type = models.CharField(max_length=50)
+    file_size = models.BigIntegerField()
+    part_size = models.PositiveIntegerField()
+    # Storage name of the finished file, and the S3 multipart upload ID
+    storage_name = models.CharField(max_length=500)
+    multipart_upload_id = models.CharField(max_length=1024, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    creative = models.OneToOneField(CampaignCreative, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def part_count(self):
+        return max(1, -(-self.file_size // self.part_size))
+
+    def __str__(self):
+        return f"Upload {self.id} - {self.file_name} ({self.status})"
+
+
+class CreativeUploadPart(models.Model):
+    upload = models.ForeignKey(CreativeUpload, on_delete=models.CASCADE, related_name='parts')
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    etag = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['upload', 'number'], name='unique_creative_upload_part'),
+        ]
+
+    def __str__(self):
+        return f"Part {self.number} of upload {self.upload_id}"
+
+
 class UserCredit(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='credits')
     balance = models.IntegerField(default=0)
+    # Credits held by pending launches; spendable credits are balance - reserved
+    reserved = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @property
+    def available(self):
+        return self.balance - self.reserved
+
     def __str__(self):
         return f"{self.user.username} - {self.balance} credits"
 
@@ -85,7 +309,106 @@ class CreditTransaction(models.Model):
     description = models.TextField(null=True, blank=True)
     stripe_payment_id = models.CharField(max_length=100, null=True, blank=True)
     campaign = models.ForeignKey(Campaign, on_delete=models.SET_NULL, null=True, blank=True, related_name='credit_transactions')
+    idempotency_key = models.CharField(max_length=100, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_credit_transaction_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='credit_tx_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.transaction_type} - {self.amount} credits"
+
+
+class CreditBalanceSnapshot(models.Model):
+    """Per-user SUM(CreditTransaction.amount) up to the last reconciliation checkpoint"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='credit_snapshot')
+    ledger_balance = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - ledger {self.ledger_balance} credits"
+
+
+class CreditReconciliation(models.Model):
+    """Checkpoint written by each run of the credit reconciliation"""
+    last_transaction_id = models.BigIntegerField()
+    transactions_scanned = models.IntegerField(default=0)
+    users_updated = models.IntegerField(default=0)
+    drift_count = models.IntegerField(default=0)
+    repaired_count = models.IntegerField(default=0)
+    drift_details = models.JSONField(default=list, blank=True)
+    timings = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Reconciliation up to transaction {self.last_transaction_id} ({self.drift_count} drifted)"
+
+
+class CreditReservation(models.Model):
+    STATUS_CHOICES = [
+        ('held', 'Held'),
+        ('settled', 'Settled'),
+        ('released', 'Released'),
+        ('expired', 'Expired'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='credit_reservations')
+    amount = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='held')
+    campaign = models.ForeignKey(Campaign, on_delete=models.SET_NULL, null=True, blank=True, related_name='credit_reservations')
+    description = models.TextField(null=True, blank=True)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # The expiry sweeper only ever scans open holds
+            models.Index(fields=['expires_at'], condition=models.Q(status='held'), name='credit_res_held_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.amount} credits ({self.status})"
+
+
+class LaunchJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        # Interrupted after its objects were sent; waits for reconciliation
+        ('unconfirmed', 'Unconfirmed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='launch_jobs')
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name='launch_jobs')
+    reservation = models.ForeignKey(CreditReservation, on_delete=models.SET_NULL, null=True, blank=True, related_name='launch_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    error = models.TextField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Renewed while the launch runs; the lease runs out LAUNCH_JOB_LEASE after it
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Set before the first request creating objects on Facebook; a sent job is never run again
+    sent_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='launch_job_user_created_idx'),
+        ]
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def __str__(self):
+        return f"Launch {self.id} - {self.campaign.name} ({self.status})"
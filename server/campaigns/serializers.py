@@ -1,5 +1,8 @@
 from rest_framework import serializers
-from .models import Campaign, CampaignCreative, FacebookAdAccount, UserCredit, CreditTransaction
+from .models import (
+    Campaign, CampaignCreative, FacebookAdAccount, UserCredit, CreditTransaction,
+    LaunchJob, CreativeUpload
+)
 
 
 class FacebookAdAccountSerializer(serializers.ModelSerializer):
@@ -10,13 +13,68 @@ class FacebookAdAccountSerializer(serializers.ModelSerializer):
 
 
 class CampaignCreativeSerializer(serializers.ModelSerializer):
+    # Measured by the processing pipeline; null until the file is processed
+    processing_status = serializers.CharField(source='blob.processing_status', read_only=True, allow_null=True, default='pending')
+    width = serializers.IntegerField(source='blob.width', read_only=True, allow_null=True, default=None)
+    height = serializers.IntegerField(source='blob.height', read_only=True, allow_null=True, default=None)
+    duration = serializers.FloatField(source='blob.duration', read_only=True, allow_null=True, default=None)
+    aspect_ratio = serializers.FloatField(source='blob.aspect_ratio', read_only=True, allow_null=True, default=None)
+    preview = serializers.FileField(source='blob.preview', read_only=True, allow_null=True, default=None)
+    validation_errors = serializers.JSONField(source='blob.validation_errors', read_only=True, default=list)
+    
     class Meta:
         model = CampaignCreative
-        fields = ['id', 'file', 'file_type', 'file_name', 'file_size', 'created_at']
-        read_only_fields = ['created_at']
+        fields = [
+            'id', 'file', 'file_type', 'file_name', 'file_size',
+            'facebook_creative_id', 'facebook_ad_id', 'created_at',
+            'processing_status', 'width', 'height', 'duration', 'aspect_ratio',
+            'preview', 'validation_errors'
+        ]
+        read_only_fields = ['created_at', 'facebook_creative_id', 'facebook_ad_id']
+
+
+class CreativeUploadSerializer(serializers.ModelSerializer):
+    part_count = serializers.IntegerField(read_only=True)
+    received_parts = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = CreativeUpload
+        fields = [
+            'id', 'file_name', 'file_type', 'file_size', 'part_size', 'part_count',
+            'received_parts', 'status', 'creative', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['part_size', 'status', 'creative', 'created_at', 'updated_at']
+    
+    def get_received_parts(self, obj):
+        """Part numbers already stored, so a client can resume after a failure"""
+        return list(obj.parts.order_by('number').values_list('number', flat=True))
 
 
-class CampaignSerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """
+    Limit the serialized fields with a ``?fields=id,name,...`` query parameter
+
+    Only applies to GET requests; unknown names are ignored.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+def requested_fields(request):
+    """The set of field names asked for with ``?fields=``, or None for all fields"""
+    if request is None or request.method != 'GET':
+        return None
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(',') if name.strip()}
+
+
+class CampaignSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     creatives = CampaignCreativeSerializer(many=True, read_only=True)
     
     class Meta:
@@ -24,17 +82,51 @@ class CampaignSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'objective', 'status', 'budget', 
             'start_date', 'end_date', 'target_audience', 
-            'facebook_campaign_id', 'created_at', 'updated_at',
-            'creatives'
+            'facebook_campaign_id', 'facebook_ad_set_id', 'facebook_status', 'status_checked_at',
+            'is_template', 'cloned_from', 'created_at', 'updated_at', 'creatives'
         ]
-        read_only_fields = ['created_at', 'updated_at', 'facebook_campaign_id']
+        read_only_fields = [
+            'created_at', 'updated_at', 'facebook_campaign_id', 'facebook_ad_set_id',
+            'facebook_status', 'status_checked_at', 'cloned_from'
+        ]
+
+
+class CampaignOverridesSerializer(serializers.ModelSerializer):
+    """Settings a clone may change; every field is optional"""
+
+    class Meta:
+        model = Campaign
+        fields = ['name', 'objective', 'budget', 'start_date', 'end_date', 'target_audience']
+        extra_kwargs = {field: {'required': False} for field in fields}
+
+
+class CampaignCloneSerializer(serializers.Serializer):
+    """
+    Body of the clone endpoint: ``count`` copies sharing ``overrides``, or
+    one copy per entry of ``clones``
+    """
+    MAX_CLONES = 500
+
+    count = serializers.IntegerField(min_value=1, max_value=MAX_CLONES, required=False, default=1)
+    overrides = CampaignOverridesSerializer(required=False)
+    clones = CampaignOverridesSerializer(many=True, required=False, allow_empty=False)
+
+    def validate(self, attrs):
+        if 'clones' in attrs:
+            if len(attrs['clones']) > self.MAX_CLONES:
+                raise serializers.ValidationError(f"At most {self.MAX_CLONES} clones per request")
+            shared = attrs.get('overrides', {})
+            attrs['overrides_list'] = [{**shared, **overrides} for overrides in attrs['clones']]
+        else:
+            attrs['overrides_list'] = [attrs.get('overrides', {})] * attrs['count']
+        return attrs
 
 
 class UserCreditSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserCredit
-        fields = ['balance', 'created_at', 'updated_at']
-        read_only_fields = ['created_at', 'updated_at']
+        fields = ['balance', 'reserved', 'created_at', 'updated_at']
+        read_only_fields = ['reserved', 'created_at', 'updated_at']
 
 
 class CreditTransactionSerializer(serializers.ModelSerializer):
@@ -45,3 +137,48 @@ class CreditTransactionSerializer(serializers.ModelSerializer):
             'stripe_payment_id', 'campaign', 'created_at'
         ]
         read_only_fields = ['created_at']
+
+
+class LaunchJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LaunchJob
+        fields = [
+            'id', 'campaign', 'status', 'error', 'attempts',
+            'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
+
+
+class BulkCampaignCreateSerializer(serializers.Serializer):
+    """Body of the bulk campaign creation endpoint; items are validated one by one"""
+    MAX_ITEMS = 500
+
+    campaigns = serializers.ListField(child=serializers.DictField(), min_length=1, max_length=MAX_ITEMS)
+
+
+class BulkLaunchSerializer(serializers.Serializer):
+    """Body of the bulk launch endpoint"""
+    MAX_ITEMS = 500
+
+    campaign_ids = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=MAX_ITEMS)
+
+
+class AnalyticsQuerySerializer(serializers.Serializer):
+    """Query parameters of the analytics endpoint"""
+    MAX_BUCKETS = 1000
+
+    since = serializers.DateField()
+    until = serializers.DateField()
+    interval = serializers.ChoiceField(choices=['day', 'week', 'month'], required=False, allow_null=True, default=None)
+    group_by = serializers.MultipleChoiceField(choices=['account', 'objective'], required=False, default=set)
+    account = serializers.CharField(required=False)
+    objective = serializers.ChoiceField(choices=Campaign.OBJECTIVE_CHOICES, required=False)
+
+    def validate(self, attrs):
+        if attrs['since'] > attrs['until']:
+            raise serializers.ValidationError("since must not be after until")
+        days = (attrs['until'] - attrs['since']).days + 1
+        per_bucket = {'day': 1, 'week': 7, 'month': 28}.get(attrs['interval'])
+        if per_bucket and days / per_bucket > self.MAX_BUCKETS:
+            raise serializers.ValidationError(f"At most {self.MAX_BUCKETS} {attrs['interval']} buckets per query")
+        return attrs
@@ -0,0 +1,152 @@
+"""
+Facebook ad account discovery for QuickCampaigns
+
+Agency users can have hundreds of ad accounts spread over many pages of
+``/me/adaccounts``. The OAuth callback saves the first page and returns;
+the remaining pages are fetched on the task queue. Cursor pages must be
+read in order, so the next page is fetched while the current one is being
+written, overlapping network and database time.
+"""
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.utils import timezone
+from ..models import FacebookAdAccount
+from . import response_cache
+from .async_graph_client import async_graph_client
+from .bulk import bulk_upsert
+from .graph_client import graph_client
+from .graph_scheduler import BACKGROUND, graph_context
+
+logger = logging.getLogger(__name__)
+
+# Accounts requested per page; Graph caps the real page size per edge
+PAGE_LIMIT = 500
+AD_ACCOUNT_FIELDS = 'id,name,account_status'
+
+# Graph account_status value of a usable account
+ACCOUNT_STATUS_ACTIVE = 1
+
+
+class AccountDiscoveryError(Exception):
+    """Raised when Facebook refuses to list the user's ad accounts"""
+
+
+def fetch_ad_accounts_page(access_token, after=None):
+    """
+    Fetch one page of the token owner's ad accounts
+
+    Args:
+        access_token: User access token
+        after: Paging cursor returned by the previous page
+
+    Returns:
+        Tuple of (accounts, next cursor or None)
+    """
+    response = graph_client.get('me/adaccounts', params=_page_params(access_token, after))
+    return _parse_page(response)
+
+
+async def fetch_ad_accounts_page_async(access_token, after=None, client=None):
+    """fetch_ad_accounts_page for coroutines, on an AsyncGraphClient (default: the shared one)"""
+    client = client or async_graph_client
+    response = await client.get('me/adaccounts', params=_page_params(access_token, after))
+    return _parse_page(response)
+
+
+def _page_params(access_token, after):
+    params = {
+        'access_token': access_token,
+        'fields': AD_ACCOUNT_FIELDS,
+        'limit': PAGE_LIMIT,
+    }
+    if after:
+        params['after'] = after
+    return params
+
+
+def _parse_page(response):
+    if response.status_code != 200:
+        raise AccountDiscoveryError(f"Error fetching ad accounts: {response.text}")
+
+    payload = response.json()
+    paging = payload.get('paging', {})
+    next_cursor = paging.get('cursors', {}).get('after') if paging.get('next') else None
+    return payload.get('data', []), next_cursor
+
+
+def save_ad_accounts(user, access_token, accounts):
+    """
+    Upsert a page of ad accounts for a user in a constant number of queries
+
+    Accounts already connected by another user are left untouched.
+
+    Args:
+        user: Owner of the accounts
+        access_token: Token the accounts were listed with
+        accounts: Account dictionaries from the Graph API
+
+    Returns:
+        Tuple of (created count, updated count)
+    """
+    account_ids = [account['id'] for account in accounts]
+    taken = set(
+        FacebookAdAccount.objects.filter(account_id__in=account_ids)
+        .exclude(user=user)
+        .values_list('account_id', flat=True)
+    )
+    if taken:
+        logger.warning(f"Skipping {len(taken)} ad accounts connected by another user")
+
+    now = timezone.now()
+    rows = [
+        FacebookAdAccount(
+            user=user,
+            account_id=account['id'],
+            name=account.get('name', account['id']),
+            access_token=access_token,
+            is_active=account.get('account_status', ACCOUNT_STATUS_ACTIVE) == ACCOUNT_STATUS_ACTIVE,
+            updated_at=now,
+        )
+        for account in accounts
+        if account['id'] not in taken
+    ]
+    created, updated = bulk_upsert(
+        FacebookAdAccount,
+        rows,
+        key_fields=['account_id'],
+        update_fields=['name', 'access_token', 'is_active', 'updated_at'],
+    )
+    response_cache.invalidate(user.pk)
+    return len(created), len(updated)
+
+
+def discover_remaining_accounts(user, access_token, after):
+    """
+    Follow the paging cursors from ``after`` to the last page
+
+    The request for page k+1 is in flight while page k is written.
+
+    Args:
+        user: Owner of the accounts
+        access_token: User access token
+        after: Cursor of the first page not yet saved
+
+    Returns:
+        Number of accounts saved
+    """
+    saved = 0
+    with graph_context(priority=BACKGROUND), ThreadPoolExecutor(max_workers=1) as executor:
+        # The fetching thread keeps the background priority of this one
+        fetch = lambda cursor: executor.submit(
+            contextvars.copy_context().run, fetch_ad_accounts_page, access_token, cursor
+        )
+        pending = fetch(after)
+        while pending is not None:
+            accounts, next_cursor = pending.result()
+            pending = fetch(next_cursor) if next_cursor else None
+            created, updated = save_ad_accounts(user, access_token, accounts)
+            saved += created + updated
+
+    logger.info(f"Discovered {saved} additional Facebook ad accounts for user {user.id}")
+    return saved
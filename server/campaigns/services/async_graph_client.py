@@ -0,0 +1,220 @@
+"""
+Async Graph API HTTP client for QuickCampaigns
+
+The coroutine counterpart of GraphClient, built on httpx. Launches and the
+async views served under ASGI await their Graph calls instead of holding
+a thread for each one, so a single process can keep many launches in
+flight at once.
+
+Each event loop gets one httpx.AsyncClient with at most
+GRAPH_API_POOL_MAXSIZE connections to graph.facebook.com; calls beyond
+that wait for a free connection instead of opening more. Every attempt
+goes through the same circuit breaker, rate limit scheduler, bulkhead,
+retries and metrics as GraphClient. Their Redis round trips run in
+threads, so a slow Redis never stalls the loop; their waits and the
+backoff are awaited.
+"""
+import asyncio
+import time
+import weakref
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .circuit_breaker import GraphUnavailable, breaker, bulkhead
+from .graph_client import (
+    GRAPH_URL, IDEMPOTENT_METHODS, endpoint_label, is_throttled, record_error, record_response, request_cost,
+    retry_delay, retry_reason, throttled_error
+)
+from .graph_scheduler import current_priority, fails_fast, scheduler
+
+
+def _in_thread(func):
+    """Run the Redis work of a call in any thread of the pool: it uses no database connection"""
+    return sync_to_async(func, thread_sensitive=False)
+
+
+class GraphRequestError(Exception):
+    """Raised when the Graph API answers a call with an error"""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        try:
+            error = response.json().get('error', {})
+        except (ValueError, AttributeError):
+            error = {}
+        self.code = error.get('code')
+        self.error_subcode = error.get('error_subcode')
+        self.message = error.get('message') or f"HTTP {response.status_code}"
+        super().__init__(f"Graph API error {self.code}: {self.message}" if self.code else self.message)
+
+
+class AsyncGraphClient:
+    """
+    Pooled, retrying async HTTP client for the Graph API
+
+    Usable as ``async with AsyncGraphClient() as client:`` to close the
+    pool of the current event loop on exit; the shared async_graph_client
+    keeps its pools for as long as their loops run, such as the worker
+    loop synchronous callers share (worker_loop).
+    """
+
+    def __init__(self, api_version=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff_base=0.5, backoff_max=8.0, pool_maxsize=None, transport=None):
+        """
+        Args:
+            api_version: Graph API version (e.g. 'v17.0')
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for a response, or for a pooled connection
+            max_retries: Retries after the first attempt
+            backoff_base: Initial backoff in seconds, doubled per attempt
+            backoff_max: Upper bound of a single backoff
+            pool_maxsize: Most connections open to graph.facebook.com per event loop
+            transport: Optional httpx transport answering every request
+                instead of Facebook (httpx.MockTransport in tests)
+        """
+        self.api_version = api_version or settings.GRAPH_API_VERSION
+        self.timeout = httpx.Timeout(
+            read_timeout or settings.GRAPH_API_READ_TIMEOUT,
+            connect=connect_timeout or settings.GRAPH_API_CONNECT_TIMEOUT,
+        )
+        self.max_retries = settings.GRAPH_API_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        pool_maxsize = pool_maxsize or settings.GRAPH_API_POOL_MAXSIZE
+        self.limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+        self.transport = transport
+        # An httpx client is bound to the loop it first ran on
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def http(self):
+        """The httpx.AsyncClient of the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, transport=self.transport)
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """Close the connection pool of the running event loop"""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def url(self, path):
+        """Absolute URL for a Graph path such as 'me/adaccounts'"""
+        if path.startswith('http'):
+            return path
+        return f"{GRAPH_URL}/{self.api_version}/{path.lstrip('/')}"
+
+    async def request(self, method, path, timeout=None, max_retries=None, **kwargs):
+        """
+        Send a request to the Graph API
+
+        Args:
+            method: HTTP method
+            path: Graph path ('me/adaccounts') or absolute URL (paging links)
+            timeout: Optional httpx.Timeout overriding the default
+            max_retries: Optional retry count overriding the default
+            **kwargs: Passed to httpx (params, data, files, ...)
+
+        Returns:
+            httpx.Response of the last attempt
+        """
+        url = self.url(path)
+        send = lambda: self.http.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        return await self.execute(send, method, url, max_retries=max_retries, cost=request_cost(kwargs))
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def call(self, method, path, **kwargs):
+        """
+        Send a request and decode its JSON body
+
+        Returns:
+            Decoded response body
+
+        Raises:
+            GraphRequestError: if Facebook answered with an error
+        """
+        response = await self.request(method, path, **kwargs)
+        if response.status_code >= 400:
+            raise GraphRequestError(response)
+        return response.json()
+
+    async def execute(self, send, method, url, max_retries=None, cost=1):
+        """
+        Await ``send`` with rate limiting, retries, backoff and latency metrics
+
+        Args:
+            send: Coroutine function performing one HTTP attempt
+            method: HTTP method, used to decide what is safe to retry
+            url: Request URL, used for logging, metric labels and rate limit buckets
+            max_retries: Optional retry count overriding the default
+            cost: Graph calls the request counts as (operations of a batch)
+
+        Returns:
+            httpx.Response
+
+        Raises:
+            GraphUnavailable: if the circuit breaker, rate limit scheduler or
+                bulkhead does not admit the first attempt in time, or if
+                Facebook throttled the call inside graph_context(fail_fast=True)
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        endpoint = endpoint_label(url)
+        method = method.upper()
+        attempt = 0
+        response = None
+
+        while True:
+            try:
+                await _in_thread(breaker.before_call)(endpoint)
+                await scheduler.acquire_async(url, cost)
+                lease = await bulkhead.acquire_async(current_priority())
+            except GraphUnavailable:
+                # A retry that is not admitted in time gets the last answer
+                if response is None:
+                    raise
+                return response
+            start = time.monotonic()
+            try:
+                response = await send()
+            except httpx.TransportError as e:
+                await _in_thread(record_error)(endpoint, e, time.monotonic() - start)
+                # A request that timed out while reading may have been applied
+                unsafe = isinstance(e, httpx.ReadTimeout) and method not in IDEMPOTENT_METHODS
+                if attempt >= max_retries or unsafe:
+                    raise
+                await self._sleep(attempt, None, endpoint, type(e).__name__)
+                attempt += 1
+                continue
+            finally:
+                if lease is not None:
+                    await _in_thread(bulkhead.release)(lease)
+
+            await _in_thread(record_response)(endpoint, url, response, time.monotonic() - start)
+            reason = retry_reason(method, response)
+            if reason is None or attempt >= max_retries:
+                return response
+            if fails_fast() and is_throttled(response):
+                raise throttled_error(endpoint, response)
+            await self._sleep(attempt, response.headers.get('Retry-After'), endpoint, reason)
+            attempt += 1
+
+    async def _sleep(self, attempt, retry_after, endpoint, reason):
+        await asyncio.sleep(retry_delay(attempt, retry_after, endpoint, reason, self.backoff_base, self.backoff_max))
+
+
+async_graph_client = AsyncGraphClient()
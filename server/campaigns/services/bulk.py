@@ -0,0 +1,76 @@
+"""
+Bulk database helpers for QuickCampaigns
+"""
+from django.db import connection, transaction
+
+
+def bulk_insert(model, objs, batch_size=500):
+    """
+    Insert many rows and make sure their primary keys are set
+
+    PostgreSQL returns the keys of a bulk_create. Backends that cannot
+    (SQLite on Django 3.2, used in local development) insert the rows one
+    by one instead.
+
+    Returns:
+        The saved instances
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+    with transaction.atomic():
+        for obj in objs:
+            obj.save(force_insert=True)
+    return objs
+
+
+def bulk_upsert(model, objs, key_fields, update_fields, batch_size=500):
+    """
+    Insert or update many rows with a constant number of queries
+
+    Django 3.2's bulk_create has no ``update_conflicts``, so existing rows
+    are looked up in one query, then new rows are inserted with
+    bulk_create and existing ones changed with bulk_update.
+
+    Args:
+        model: Model class
+        objs: Unsaved model instances
+        key_fields: Field names that identify a row (a unique constraint)
+        update_fields: Fields to overwrite on existing rows
+        batch_size: Rows per INSERT / UPDATE statement
+
+    Returns:
+        Tuple of (created, updated) instance lists
+    """
+    if not objs:
+        return [], []
+
+    def key_of(obj):
+        return tuple(getattr(obj, field) for field in key_attnames)
+
+    key_attnames = [model._meta.get_field(field).attname for field in key_fields]
+    lookup = {
+        f"{attname}__in": {getattr(obj, attname) for obj in objs}
+        for attname in key_attnames
+    }
+    existing = {
+        key_of(row): row
+        for row in model.objects.filter(**lookup).only('pk', *key_attnames)
+    }
+
+    to_create = []
+    to_update = {}
+    for obj in objs:
+        row = existing.get(key_of(obj))
+        if row is None:
+            to_create.append(obj)
+        else:
+            obj.pk = row.pk
+            to_update[obj.pk] = obj  # last write wins for duplicated keys
+
+    with transaction.atomic():
+        if to_create:
+            model.objects.bulk_create(to_create, batch_size=batch_size, ignore_conflicts=True)
+        if to_update:
+            model.objects.bulk_update(list(to_update.values()), update_fields, batch_size=batch_size)
+
+    return to_create, list(to_update.values())
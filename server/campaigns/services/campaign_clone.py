@@ -0,0 +1,118 @@
+"""
+Campaign cloning for QuickCampaigns
+
+Repeat campaigns mostly differ in their dates and budget. A clone copies a
+campaign's settings, targeting and creatives into new draft campaigns,
+with per-clone overrides, in a fixed number of queries however many
+clones are made: a locking read of the creatives' blobs, one INSERT for
+the campaigns, one for their creatives and one UPDATE per distinct
+reference count increase.
+
+No file bytes are copied. A cloned CampaignCreative points at the same
+CreativeBlob as the original, and the blob's ref_count grows, so the file
+lives until the last creative using it is deleted. Files are shared
+copy-on-write: replacing a creative's file moves that creative to the
+blob of its new content and leaves every other creative untouched (see
+CampaignCreativeViewSet.perform_update).
+"""
+import logging
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import F
+from ..models import Campaign, CampaignCreative, CreativeBlob
+from . import response_cache
+from .bulk import bulk_insert
+
+logger = logging.getLogger(__name__)
+
+# Campaign fields a clone takes from its source, and that overrides may change
+CLONED_FIELDS = ['name', 'objective', 'budget', 'start_date', 'end_date', 'target_audience']
+CLONED_CREATIVE_FIELDS = ['file', 'blob_id', 'file_type', 'file_name', 'file_size']
+
+
+class CreativesNotStored(Exception):
+    """Raised when a creative's file is still being hashed and cannot be shared yet"""
+
+    def __init__(self, creative_ids):
+        self.creative_ids = creative_ids
+        super().__init__(f"Creatives {', '.join(str(pk) for pk in creative_ids)} are still being stored")
+
+
+def clone_campaign(source, overrides_list):
+    """
+    Create draft copies of a campaign and its creatives
+
+    Args:
+        source: Campaign (or template) to copy
+        overrides_list: One dictionary of CLONED_FIELDS values per clone;
+            an empty dictionary makes a plain copy
+
+    Returns:
+        List of the new Campaigns, in the order of ``overrides_list``
+
+    Raises:
+        CreativesNotStored: if a creative has no blob yet. Its file is
+            about to be moved to its content-addressed name, so it cannot
+            be shared until then.
+    """
+    clones = []
+    for number, overrides in enumerate(overrides_list, start=1):
+        values = {field: getattr(source, field) for field in CLONED_FIELDS}
+        values['name'] = f"{source.name} (copy {number})" if len(overrides_list) > 1 else f"{source.name} (copy)"
+        values.update({field: value for field, value in overrides.items() if field in CLONED_FIELDS})
+        clones.append(Campaign(
+            user_id=source.user_id,
+            facebook_account_id=source.facebook_account_id,
+            status='draft',
+            cloned_from=source,
+            **values,
+        ))
+
+    with transaction.atomic():
+        creatives = lock_creatives(source)
+        clones = bulk_insert(Campaign, clones)
+        CampaignCreative.objects.bulk_create([
+            CampaignCreative(campaign=clone, **{field: getattr(creative, field) for field in CLONED_CREATIVE_FIELDS})
+            for clone in clones
+            for creative in creatives
+        ], batch_size=1000)
+
+        # Every clone adds one reference per creative using the blob
+        increments = defaultdict(list)
+        for blob_id, uses in Counter(creative.blob_id for creative in creatives).items():
+            increments[uses * len(clones)].append(blob_id)
+        for increment, blob_ids in increments.items():
+            CreativeBlob.objects.filter(pk__in=blob_ids).update(ref_count=F('ref_count') + increment)
+        response_cache.invalidate(source.user_id)
+
+    logger.info(
+        f"Cloned campaign {source.id} {len(clones)} times with {len(creatives)} shared creatives each"
+    )
+    return clones
+
+
+def lock_creatives(source):
+    """
+    Read a campaign's creatives with their blobs locked
+
+    A creative deleted concurrently drops its blob reference; once the
+    blob row is locked that has either happened, and the creative is gone
+    from the list read after it, or it waits until the clones hold their
+    own references. Creatives are read again until every blob they use is
+    locked.
+
+    Raises:
+        CreativesNotStored: if a creative has no blob yet
+    """
+    locked = set()
+    while True:
+        creatives = list(source.creatives.all())
+        unstored = [creative.id for creative in creatives if not creative.blob_id]
+        if unstored:
+            raise CreativesNotStored(unstored)
+        needed = {creative.blob_id for creative in creatives} - locked
+        if not needed:
+            return creatives
+        locked.update(
+            CreativeBlob.objects.select_for_update().filter(pk__in=needed).order_by('pk').values_list('pk', flat=True)
+        )
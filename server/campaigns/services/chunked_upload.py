@@ -0,0 +1,374 @@
+"""
+Resumable chunked creative uploads for QuickCampaigns
+
+A client starts an upload, PUTs numbered parts of ``part_size`` bytes in
+any order (re-sending any part that failed) and then completes it. Each
+part is streamed from the request body to storage in small fixed reads:
+with S3 into a multipart upload, locally into part files under
+MEDIA_ROOT that are joined on completion. Nothing is buffered per file,
+so memory stays flat whatever the creative size, and the CampaignCreative
+row is only written once every part has arrived.
+
+Completion marks the upload 'completing' in a short transaction and
+joins the parts outside it, so no row lock is held while a large file is
+assembled; the status keeps other completions and part PUTs out meanwhile.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import shutil
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from ..models import CampaignCreative, CreativeUpload, CreativeUploadPart
+from . import creative_store
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the request body per iteration
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Bytes of an S3 part kept in memory before it is spooled to a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+LOCAL_PARTS_DIR = 'creative_uploads'
+
+
+class UploadError(Exception):
+    """Raised when an upload request does not fit the upload session"""
+
+
+class BodyReader:
+    """
+    File-like view of exactly ``length`` bytes of a request body
+
+    Raises UploadError if the body ends early, so a truncated part is
+    never stored as complete.
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(min(size, STREAM_CHUNK_SIZE))
+        if not data:
+            raise UploadError("Request body ended before Content-Length bytes were read")
+        self.remaining -= len(data)
+        return data
+
+    def chunks(self):
+        while self.remaining > 0:
+            yield self.read(STREAM_CHUNK_SIZE)
+
+
+class LocalUploadBackend:
+    """Parts are written to MEDIA_ROOT and joined into the final file"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def parts_dir(self, upload):
+        return os.path.join(settings.MEDIA_ROOT, LOCAL_PARTS_DIR, str(upload.id))
+
+    def part_path(self, upload, number):
+        return os.path.join(self.parts_dir(upload), f"{number:05d}")
+
+    def start(self, upload):
+        os.makedirs(self.parts_dir(upload), exist_ok=True)
+        return None
+
+    def upload_part(self, upload, number, reader):
+        path = self.part_path(upload, number)
+        digest = hashlib.md5()
+        with open(f"{path}.partial", 'wb') as part_file:
+            for chunk in reader.chunks():
+                digest.update(chunk)
+                part_file.write(chunk)
+        # Only a fully received part replaces an earlier attempt
+        os.replace(f"{path}.partial", path)
+        return digest.hexdigest()
+
+    def complete(self, upload, parts):
+        """Join the parts, hashing them on the way; returns the SHA-256"""
+        target = self.storage.path(upload.storage_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        streaming_hash = creative_store.StreamingHash()
+        with open(target, 'wb') as output:
+            for part in parts:
+                with open(self.part_path(upload, part.number), 'rb') as part_file:
+                    for chunk in iter(lambda: part_file.read(STREAM_CHUNK_SIZE), b''):
+                        streaming_hash.update(chunk)
+                        output.write(chunk)
+        shutil.rmtree(self.parts_dir(upload), ignore_errors=True)
+        return streaming_hash.sha256
+
+    def abort(self, upload):
+        shutil.rmtree(self.parts_dir(upload), ignore_errors=True)
+
+
+class S3UploadBackend:
+    """Parts are sent to an S3 multipart upload on the media bucket"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.client = storage.connection.meta.client
+        self.bucket = storage.bucket_name
+
+    def key(self, upload):
+        if self.storage.location:
+            return posixpath.join(self.storage.location, upload.storage_name)
+        return upload.storage_name
+
+    def start(self, upload):
+        params = {'Bucket': self.bucket, 'Key': self.key(upload)}
+        content_type = mimetypes.guess_type(upload.file_name)[0]
+        if content_type:
+            params['ContentType'] = content_type
+        if self.storage.default_acl:
+            params['ACL'] = self.storage.default_acl
+        if self.storage.object_parameters.get('CacheControl'):
+            params['CacheControl'] = self.storage.object_parameters['CacheControl']
+        return self.client.create_multipart_upload(**params)['UploadId']
+
+    def upload_part(self, upload, number, reader):
+        # boto3 rewinds the body to checksum and retry it, which a request
+        # stream cannot do; the part is spooled to a seekable file first
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as body:
+            for chunk in reader.chunks():
+                body.write(chunk)
+            length = body.tell()
+            body.seek(0)
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key(upload),
+                UploadId=upload.multipart_upload_id,
+                PartNumber=number,
+                Body=body,
+                ContentLength=length,
+            )
+        return response['ETag']
+
+    def complete(self, upload, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key(upload),
+            UploadId=upload.multipart_upload_id,
+            MultipartUpload={'Parts': [{'ETag': part.etag, 'PartNumber': part.number} for part in parts]},
+        )
+        # The bytes never pass through the app; they are hashed on the task queue
+        return None
+
+    def abort(self, upload):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key(upload),
+            UploadId=upload.multipart_upload_id,
+        )
+
+
+def creative_storage_name(file_name, unique):
+    """Storage name of a creative; ``unique`` keeps names from colliding"""
+    return timezone.now().strftime('campaign_creatives/%Y/%m/%d/') + f"{unique}-{get_valid_filename(file_name)}"
+
+
+def get_backend():
+    if settings.USE_S3:
+        return S3UploadBackend(default_storage)
+    return LocalUploadBackend(default_storage)
+
+
+def expected_part_size(upload, number):
+    """Every part is part_size bytes except the last, which holds the rest"""
+    if number < upload.part_count:
+        return upload.part_size
+    return upload.file_size - upload.part_size * (upload.part_count - 1)
+
+
+def start_upload(user, campaign, file_name, file_type, file_size):
+    """
+    Open an upload session for one creative
+
+    Args:
+        user: Uploading user
+        campaign: Campaign the creative belongs to
+        file_name: Original file name
+        file_type: MIME type reported by the client
+        file_size: Total size in bytes
+
+    Returns:
+        CreativeUpload
+
+    Raises:
+        UploadError: if the size is outside the allowed range
+    """
+    if file_size <= 0 or file_size > settings.CREATIVE_UPLOAD_MAX_SIZE:
+        raise UploadError(f"File size must be between 1 and {settings.CREATIVE_UPLOAD_MAX_SIZE} bytes")
+
+    upload = CreativeUpload(
+        user=user,
+        campaign=campaign,
+        file_name=file_name,
+        file_type=file_type,
+        file_size=file_size,
+        part_size=settings.CREATIVE_UPLOAD_PART_SIZE,
+    )
+    upload.storage_name = creative_storage_name(file_name, upload.id.hex)
+    upload.multipart_upload_id = get_backend().start(upload)
+    upload.save()
+
+    logger.info(f"Started upload {upload.id} of {file_size} bytes in {upload.part_count} parts")
+    return upload
+
+
+def upload_part(upload, number, stream, length):
+    """
+    Stream one part of the file to storage
+
+    Re-sending a part replaces the earlier copy, so a client can retry any
+    part that failed.
+
+    Args:
+        upload: CreativeUpload in progress
+        number: 1-based part number
+        stream: Request body stream
+        length: Content-Length of the body
+
+    Returns:
+        CreativeUploadPart
+
+    Raises:
+        UploadError: if the upload is closed or the part has the wrong size
+    """
+    if upload.status != 'uploading':
+        raise UploadError(f"Upload is {upload.status}")
+    if not 1 <= number <= upload.part_count:
+        raise UploadError(f"Part number must be between 1 and {upload.part_count}")
+    expected = expected_part_size(upload, number)
+    if length != expected:
+        raise UploadError(f"Part {number} must be {expected} bytes, got {length}")
+
+    etag = get_backend().upload_part(upload, number, BodyReader(stream, length))
+    part, _ = CreativeUploadPart.objects.update_or_create(
+        upload=upload, number=number, defaults={'size': length, 'etag': etag}
+    )
+    # Keeps an upload that is still receiving parts away from the stale sweeper
+    CreativeUpload.objects.filter(pk=upload.pk).update(updated_at=timezone.now())
+    return part
+
+
+def complete_upload(upload):
+    """
+    Assemble the parts and create the CampaignCreative
+
+    Completing twice returns the same creative.
+
+    Returns:
+        CampaignCreative
+
+    Raises:
+        UploadError: if parts are missing, the upload was aborted or
+            another request is completing it
+    """
+    with transaction.atomic():
+        upload = CreativeUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status == 'completed':
+            return upload.creative
+        if upload.status != 'uploading':
+            raise UploadError(f"Upload is {upload.status}")
+
+        parts = list(upload.parts.order_by('number'))
+        received = {part.number for part in parts}
+        missing = [number for number in range(1, upload.part_count + 1) if number not in received]
+        if missing:
+            raise UploadError(f"Missing parts: {missing[:20]}")
+
+        upload.status = 'completing'
+        upload.save(update_fields=['status', 'updated_at'])
+
+    try:
+        content_hash = get_backend().complete(upload, parts)
+    except Exception:
+        # The parts are still stored; the client may complete again
+        CreativeUpload.objects.filter(pk=upload.pk, status='completing').update(
+            status='uploading', updated_at=timezone.now()
+        )
+        raise
+
+    with transaction.atomic():
+        upload = CreativeUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status != 'completing':
+            raise UploadError(f"Upload is {upload.status}")
+
+        creative = CampaignCreative(
+            campaign_id=upload.campaign_id,
+            file_type=upload.file_type,
+            file_name=upload.file_name,
+            file_size=upload.file_size,
+        )
+        creative.file.name = upload.storage_name
+        creative.save()
+        if content_hash:
+            creative_store.register_creative(creative, content_hash, upload.file_size)
+        else:
+            creative_store.schedule_index(creative)
+
+        upload.status = 'completed'
+        upload.creative = creative
+        upload.save(update_fields=['status', 'creative', 'updated_at'])
+        upload.parts.all().delete()
+
+    logger.info(f"Completed upload {upload.id} as creative {creative.id}")
+    return creative
+
+
+def abort_upload(upload, stale=False):
+    """
+    Discard an unfinished upload and its stored parts
+
+    Args:
+        upload: CreativeUpload to discard
+        stale: Also give up a completion whose request died; only the
+            stale sweeper passes it
+    """
+    abortable = ('uploading', 'completing') if stale else ('uploading',)
+    with transaction.atomic():
+        upload = CreativeUpload.objects.select_for_update().get(pk=upload.pk)
+        if upload.status not in abortable:
+            return False
+        upload.status = 'aborted'
+        upload.save(update_fields=['status', 'updated_at'])
+        upload.parts.all().delete()
+
+    try:
+        get_backend().abort(upload)
+    except Exception as e:
+        logger.warning(f"Could not discard stored parts of upload {upload.id}: {str(e)}")
+    return True
+
+
+def abort_stale_uploads(now=None, limit=500):
+    """
+    Abort uploads that have not been completed within CREATIVE_UPLOAD_TTL
+
+    Returns:
+        Number of uploads aborted
+    """
+    now = now or timezone.now()
+    stale = CreativeUpload.objects.filter(
+        status__in=['uploading', 'completing'],
+        updated_at__lt=now - timedelta(seconds=settings.CREATIVE_UPLOAD_TTL),
+    ).order_by('updated_at')[:limit]
+    aborted = sum(1 for upload in stale if abort_upload(upload, stale=True))
+    if aborted:
+        logger.info(f"Aborted {aborted} stale creative uploads")
+    return aborted
@@ -0,0 +1,371 @@
+"""
+Circuit breakers and bulkheads around Graph API calls for QuickCampaigns
+
+When Graph degrades, calls hang until their read timeout and then fail.
+Without isolation, every web and worker process ends up waiting on them.
+GraphClient wraps every attempt in two guards, both shared by all
+processes through Redis:
+
+- A circuit breaker per endpoint (endpoint_label, e.g. '{id}/campaigns').
+  It is closed while the endpoint works. GRAPH_CIRCUIT_FAILURE_THRESHOLD
+  failures (connection errors, timeouts, 5xx, transient Graph errors)
+  within GRAPH_CIRCUIT_WINDOW seconds open it. While open, calls fail
+  immediately with CircuitOpen. Once the open period is over, the breaker
+  is half-open: a single probe call goes through. If the probe succeeds
+  the breaker closes; if it fails, the breaker opens again for twice as
+  long, up to GRAPH_CIRCUIT_MAX_OPEN_SECONDS.
+- A bulkhead per priority (interactive, background). It caps how many
+  Graph calls may be in flight at once. A call waits up to
+  GRAPH_BULKHEAD_WAIT seconds for a slot and then fails with
+  BulkheadFull, so a slow Graph can only tie up that many workers, and
+  background syncs can never take the slots of launches and OAuth.
+
+Both raise GraphUnavailable subclasses carrying a retry_after, which the
+API turns into a 503 with a Retry-After header. Every state transition
+is counted in the ``graph.circuit.transition`` metric. If Redis is
+unreachable, both guards let calls through.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from ..metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+CIRCUIT_KEY_PREFIX = 'graph-circuit:'
+BULKHEAD_KEY_PREFIX = 'graph-bulkhead:'
+# Circuit state is forgotten after a day without calls
+KEY_TTL = 24 * 60 * 60
+# Seconds the half-open probe has before another caller may probe
+PROBE_TIMEOUT = 60
+# Seconds between attempts to get a bulkhead slot
+BULKHEAD_POLL = 0.05
+
+# KEYS: circuit hash. ARGV: now, probe timeout, key ttl.
+# Returns {decision, seconds, transition}: decision is 'allow' or
+# 'reject', seconds the time until a retry may pass.
+BEFORE_CALL_SCRIPT = """
+local now = tonumber(ARGV[1])
+local h = redis.call('HMGET', KEYS[1], 'state', 'open_until', 'probe_until')
+local state = h[1] or 'closed'
+if state == 'closed' then
+    return {'allow', '0', ''}
+end
+if state == 'open' then
+    local open_until = tonumber(h[2]) or 0
+    if now < open_until then
+        return {'reject', tostring(open_until - now), ''}
+    end
+    redis.call('HSET', KEYS[1], 'state', 'half_open', 'probe_until', now + tonumber(ARGV[2]))
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+    return {'allow', '0', 'open->half_open'}
+end
+local probe_until = tonumber(h[3]) or 0
+if now < probe_until then
+    return {'reject', tostring(probe_until - now), ''}
+end
+-- The previous probe never reported back; this call probes instead
+redis.call('HSET', KEYS[1], 'probe_until', now + tonumber(ARGV[2]))
+return {'allow', '0', ''}
+"""
+
+# KEYS: circuit hash. ARGV: now, ok (1/0), failure threshold, window,
+# open seconds, max open seconds, key ttl. Returns the transition or ''.
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ok = ARGV[2] == '1'
+local h = redis.call('HMGET', KEYS[1], 'state', 'window_start', 'failures', 'trips')
+local state = h[1] or 'closed'
+local trips = tonumber(h[4]) or 0
+local transition = ''
+if state == 'half_open' then
+    if ok then
+        redis.call('DEL', KEYS[1])
+        return 'half_open->closed'
+    end
+    trips = trips + 1
+    transition = 'half_open->open'
+elseif state == 'closed' then
+    if ok then
+        return ''
+    end
+    local window_start = tonumber(h[2]) or 0
+    local failures = tonumber(h[3]) or 0
+    if now - window_start > tonumber(ARGV[4]) then
+        window_start = now
+        failures = 0
+    end
+    failures = failures + 1
+    redis.call('HSET', KEYS[1], 'window_start', window_start, 'failures', failures)
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[7]))
+    if failures < tonumber(ARGV[3]) then
+        return ''
+    end
+    trips = 1
+    transition = 'closed->open'
+else
+    -- Calls that started before the breaker opened change nothing
+    return ''
+end
+local open_seconds = math.min(tonumber(ARGV[6]), tonumber(ARGV[5]) * 2 ^ (trips - 1))
+redis.call('HSET', KEYS[1], 'state', 'open', 'open_until', now + open_seconds, 'trips', trips,
+           'failures', 0, 'window_start', now)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[7]))
+return transition
+"""
+
+# KEYS: bulkhead sorted set of leases. ARGV: now, lease id, lease expiry,
+# limit. Leases of crashed processes expire instead of leaking a slot.
+ACQUIRE_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3]) - tonumber(ARGV[1])))
+return 1
+"""
+
+
+class GraphUnavailable(Exception):
+    """Raised when a Graph call is refused locally to protect the service"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(GraphUnavailable):
+    """Raised when the circuit breaker of an endpoint is open"""
+
+
+class BulkheadFull(GraphUnavailable):
+    """Raised when no Graph call slot frees up in time"""
+
+
+class CircuitBreaker:
+    """Per-endpoint circuit breakers, shared through Redis"""
+
+    def __init__(self):
+        self._before_call = None
+        self._record = None
+
+    def _scripts(self):
+        if self._before_call is None:
+            conn = get_redis_connection('default')
+            self._before_call = conn.register_script(BEFORE_CALL_SCRIPT)
+            self._record = conn.register_script(RECORD_SCRIPT)
+
+    def before_call(self, endpoint):
+        """
+        Let a call to the endpoint through, or refuse it
+
+        Raises:
+            CircuitOpen: if the breaker is open, or half-open with a probe in flight
+        """
+        if not settings.GRAPH_CIRCUIT_BREAKER:
+            return
+        try:
+            self._scripts()
+            decision, seconds, transition = self._before_call(
+                keys=[f"{CIRCUIT_KEY_PREFIX}{endpoint}"], args=[time.time(), PROBE_TIMEOUT, KEY_TTL]
+            )
+        except RedisError as e:
+            logger.warning(f"Circuit breaker unavailable, letting call through: {str(e)}")
+            return
+        if transition:
+            _transition(endpoint, transition.decode())
+        if decision == b'reject':
+            metrics.incr('graph.circuit.rejected', endpoint=endpoint)
+            raise CircuitOpen(
+                f"Facebook API endpoint {endpoint} is failing, calls are paused", retry_after=float(seconds)
+            )
+
+    def record(self, endpoint, ok):
+        """Report the outcome of a call let through by before_call"""
+        if not settings.GRAPH_CIRCUIT_BREAKER:
+            return
+        try:
+            self._scripts()
+            transition = self._record(keys=[f"{CIRCUIT_KEY_PREFIX}{endpoint}"], args=[
+                time.time(), 1 if ok else 0,
+                settings.GRAPH_CIRCUIT_FAILURE_THRESHOLD, settings.GRAPH_CIRCUIT_WINDOW,
+                settings.GRAPH_CIRCUIT_OPEN_SECONDS, settings.GRAPH_CIRCUIT_MAX_OPEN_SECONDS, KEY_TTL,
+            ])
+        except RedisError as e:
+            logger.warning(f"Circuit breaker unavailable, outcome not recorded: {str(e)}")
+            return
+        if transition:
+            _transition(endpoint, transition.decode())
+
+    def raise_if_open(self, endpoints):
+        """
+        Fail fast before starting work that needs these endpoints
+
+        Unlike before_call this only reads: it never claims the half-open probe.
+
+        Raises:
+            CircuitOpen: if any of the endpoints' breakers is open
+        """
+        if not settings.GRAPH_CIRCUIT_BREAKER:
+            return
+        now = time.time()
+        try:
+            conn = get_redis_connection('default')
+            with conn.pipeline() as pipe:
+                for endpoint in endpoints:
+                    pipe.hmget(f"{CIRCUIT_KEY_PREFIX}{endpoint}", 'state', 'open_until')
+                states = pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Circuit breaker unavailable, not checking: {str(e)}")
+            return
+        for endpoint, (state, open_until) in zip(endpoints, states):
+            if state == OPEN.encode() and float(open_until or 0) > now:
+                metrics.incr('graph.circuit.rejected', endpoint=endpoint)
+                raise CircuitOpen(
+                    f"Facebook API endpoint {endpoint} is failing, calls are paused",
+                    retry_after=float(open_until) - now,
+                )
+
+    def states(self):
+        """
+        Current breaker of every endpoint that recently failed
+
+        Returns:
+            Dictionary of endpoint to {'state', 'failures', 'open_until'}
+        """
+        result = {}
+        try:
+            conn = get_redis_connection('default')
+            for key in conn.scan_iter(match=f"{CIRCUIT_KEY_PREFIX}*", count=100):
+                fields = {name.decode(): value.decode() for name, value in conn.hgetall(key).items()}
+                result[key.decode()[len(CIRCUIT_KEY_PREFIX):]] = {
+                    'state': fields.get('state', CLOSED),
+                    'failures': int(fields.get('failures', 0)),
+                    'open_until': float(fields['open_until']) if 'open_until' in fields else None,
+                }
+        except RedisError as e:
+            logger.warning(f"Circuit breaker states unavailable: {str(e)}")
+        return result
+
+
+class Bulkhead:
+    """Bounded number of in-flight Graph calls per priority, shared through Redis"""
+
+    def __init__(self):
+        self._acquire = None
+
+    def acquire(self, compartment):
+        """
+        Wait for a call slot in the compartment
+
+        Args:
+            compartment: Priority of the call ('interactive' or 'background')
+
+        Returns:
+            Lease to pass to release(), or None if no slot was needed
+
+        Raises:
+            BulkheadFull: if no slot freed up within GRAPH_BULKHEAD_WAIT seconds
+        """
+        return run_waits(self.waits(compartment))
+
+    async def acquire_async(self, compartment):
+        """acquire() for coroutines: waits without blocking the event loop"""
+        return await run_waits_async(self.waits(compartment))
+
+    def waits(self, compartment):
+        """
+        Generator taking a slot: yields the seconds to wait before the next
+        attempt and returns the lease
+        """
+        limit = settings.GRAPH_BULKHEAD_LIMITS.get(compartment)
+        if not settings.GRAPH_CIRCUIT_BREAKER or not limit:
+            return None
+        key = f"{BULKHEAD_KEY_PREFIX}{compartment}"
+        lease = uuid.uuid4().hex
+        # A lease outlives the longest possible call, then frees itself
+        lease_seconds = 2 * (settings.GRAPH_API_CONNECT_TIMEOUT + settings.GRAPH_API_READ_TIMEOUT)
+        deadline = time.monotonic() + settings.GRAPH_BULKHEAD_WAIT
+        try:
+            if self._acquire is None:
+                self._acquire = get_redis_connection('default').register_script(ACQUIRE_SLOT_SCRIPT)
+            while True:
+                now = time.time()
+                if self._acquire(keys=[key], args=[now, lease, now + lease_seconds, limit]):
+                    return (key, lease)
+                if time.monotonic() >= deadline:
+                    break
+                yield BULKHEAD_POLL
+        except RedisError as e:
+            logger.warning(f"Bulkhead unavailable, letting call through: {str(e)}")
+            return None
+        metrics.incr('graph.bulkhead.rejected', compartment=compartment)
+        raise BulkheadFull(
+            f"Too many Facebook API calls in flight ({compartment})", retry_after=settings.GRAPH_BULKHEAD_WAIT
+        )
+
+    def release(self, lease):
+        if lease is None:
+            return
+        key, member = lease
+        try:
+            get_redis_connection('default').zrem(key, member)
+        except RedisError as e:
+            logger.warning(f"Bulkhead unavailable, lease left to expire: {str(e)}")
+
+
+def run_waits(waits):
+    """
+    Run a generator that yields seconds to sleep, sleeping in this thread
+
+    Returns:
+        The generator's return value
+    """
+    try:
+        while True:
+            time.sleep(next(waits))
+    except StopIteration as done:
+        return done.value
+
+
+async def run_waits_async(waits):
+    """
+    run_waits() for coroutines, sleeping on the event loop
+
+    Each step of the generator makes a Redis round trip, so it runs in a
+    thread: a slow Redis never stalls the other coroutines of the loop.
+    """
+    step = sync_to_async(_step, thread_sensitive=False)
+    while True:
+        done, value = await step(waits)
+        if done:
+            return value
+        await asyncio.sleep(value)
+
+
+def _step(waits):
+    # StopIteration cannot be raised through a future
+    try:
+        return False, next(waits)
+    except StopIteration as done:
+        return True, done.value
+
+
+def _transition(endpoint, transition):
+    metrics.incr('graph.circuit.transition', endpoint=endpoint, transition=transition)
+    log = logger.info if transition.endswith(CLOSED) else logger.warning
+    log(f"Circuit breaker of Graph endpoint {endpoint}: {transition}")
+
+
+breaker = CircuitBreaker()
+bulkhead = Bulkhead()
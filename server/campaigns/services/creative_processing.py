@@ -0,0 +1,256 @@
+"""
+Creative processing pipeline for QuickCampaigns
+
+Once a creative's content hash is known, its blob is processed on the
+``creatives`` task queue, whose worker runs a small fixed pool of
+processes. The real MIME type is sniffed from the file header, images are
+measured with Pillow and videos probed with ffprobe. A downscaled JPEG
+preview is stored, and the result is checked against Facebook's feed
+specs. Launches read the stored verdict instead of finding out from a
+failed Graph call.
+
+Processing is per blob, so a file shared by many campaigns is processed
+once, and claiming a blob is a conditional update, so a duplicated task
+does no work.
+"""
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from datetime import timedelta
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image
+from ..models import CampaignCreative, CreativeBlob
+from . import creative_store, response_cache
+
+logger = logging.getLogger(__name__)
+
+# Facebook feed specs
+IMAGE_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/bmp'}
+VIDEO_MIME_TYPES = {'video/mp4', 'video/quicktime', 'video/webm', 'video/x-matroska', 'video/x-msvideo'}
+IMAGE_MAX_SIZE = 30 * 1024 * 1024
+VIDEO_MAX_SIZE = 4 * 1024 * 1024 * 1024
+IMAGE_MIN_WIDTH = 600
+VIDEO_MIN_WIDTH = 120
+VIDEO_MIN_DURATION = 1
+VIDEO_MAX_DURATION = 241 * 60
+# Width / height, from 9:16 portrait to 1.91:1 landscape
+MIN_ASPECT_RATIO = 9 / 16
+MAX_ASPECT_RATIO = 1.91
+
+PREVIEW_MAX_SIZE = (480, 480)
+SNIFF_BYTES = 64
+
+# A claim older than this is assumed to belong to a worker that died
+PROCESSING_TIMEOUT = timedelta(minutes=15)
+FFPROBE_TIMEOUT = 60
+
+
+def sniff_mime_type(header):
+    """
+    MIME type of a file from its first bytes, or None if unrecognized
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header.startswith(b'BM'):
+        return 'image/bmp'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+        return 'video/x-msvideo'
+    if header[4:8] == b'ftyp':
+        return 'video/quicktime' if header[8:10] == b'qt' else 'video/mp4'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm' if b'webm' in header else 'video/x-matroska'
+    return None
+
+
+def claim_blob(blob_id):
+    """
+    Mark a blob as being processed
+
+    Returns:
+        CreativeBlob, or None if it is already processed or being processed
+    """
+    now = timezone.now()
+    claimed = CreativeBlob.objects.filter(
+        Q(processing_status__in=['pending', 'failed']) |
+        Q(processing_status='processing', processing_started_at__lt=now - PROCESSING_TIMEOUT),
+        pk=blob_id,
+    ).update(processing_status='processing', processing_started_at=now)
+    if not claimed:
+        return None
+    return CreativeBlob.objects.get(pk=blob_id)
+
+
+def process_blob(blob_id):
+    """
+    Sniff, measure, preview and validate one blob
+
+    Args:
+        blob_id: CreativeBlob primary key
+
+    Returns:
+        Final processing status, or None if the blob was not claimed
+    """
+    blob = claim_blob(blob_id)
+    if blob is None:
+        logger.info(f"Creative blob {blob_id} already processed, skipping")
+        return None
+
+    try:
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(blob.file.name)[1]) as local:
+            # Constant memory: the file is streamed to local disk for the probes
+            for chunk in creative_store.iter_stored_file(blob.file.name):
+                local.write(chunk)
+            local.flush()
+
+            with open(local.name, 'rb') as header_file:
+                blob.mime_type = sniff_mime_type(header_file.read(SNIFF_BYTES))
+
+            preview = None
+            if blob.mime_type in IMAGE_MIME_TYPES or blob.mime_type == 'image/webp':
+                preview = _measure_image(blob, local.name)
+            elif blob.mime_type and blob.mime_type.startswith('video/'):
+                preview = _measure_video(blob, local.name)
+
+        blob.validation_errors = validate(blob)
+        if preview is not None:
+            if blob.preview:
+                default_storage.delete(blob.preview.name)
+            name = default_storage.save(f"creative_previews/{blob.sha256}.jpg", ContentFile(preview))
+            blob.preview.name = name
+        blob.processing_status = 'invalid' if blob.validation_errors else 'valid'
+    except Exception as e:
+        logger.error(f"Error processing creative blob {blob.id}: {str(e)}")
+        blob.processing_status = 'failed'
+        blob.validation_errors = [f"Processing failed: {str(e)}"]
+
+    blob.processed_at = timezone.now()
+    blob.save(update_fields=[
+        'processing_status', 'mime_type', 'width', 'height', 'duration', 'preview',
+        'validation_errors', 'processed_at',
+    ])
+
+    # The creatives now report what the file is, not what the client said
+    if blob.mime_type:
+        CampaignCreative.objects.filter(blob=blob).update(file_type=blob.mime_type, file_size=blob.file_size)
+        response_cache.invalidate(*CampaignCreative.objects.filter(blob=blob).values_list(
+            'campaign__user_id', flat=True
+        ).distinct())
+
+    logger.info(f"Processed creative blob {blob.sha256[:12]}: {blob.processing_status}")
+    return blob.processing_status
+
+
+def validate(blob):
+    """
+    Check a measured blob against the Facebook specs
+
+    Returns:
+        List of human-readable problems; empty if the creative is usable
+    """
+    errors = []
+    if blob.mime_type in IMAGE_MIME_TYPES:
+        if blob.file_size > IMAGE_MAX_SIZE:
+            errors.append(f"Images must be at most {IMAGE_MAX_SIZE // (1024 * 1024)} MB")
+        if blob.width is not None and blob.width < IMAGE_MIN_WIDTH:
+            errors.append(f"Images must be at least {IMAGE_MIN_WIDTH} pixels wide")
+    elif blob.mime_type in VIDEO_MIME_TYPES:
+        if blob.file_size > VIDEO_MAX_SIZE:
+            errors.append(f"Videos must be at most {VIDEO_MAX_SIZE // (1024 ** 3)} GB")
+        if blob.width is not None and blob.width < VIDEO_MIN_WIDTH:
+            errors.append(f"Videos must be at least {VIDEO_MIN_WIDTH} pixels wide")
+        if blob.duration is not None and not VIDEO_MIN_DURATION <= blob.duration <= VIDEO_MAX_DURATION:
+            errors.append(f"Videos must be between {VIDEO_MIN_DURATION} second and {VIDEO_MAX_DURATION // 60} minutes long")
+    else:
+        errors.append(f"Unsupported file type: {blob.mime_type or 'unknown'}")
+        return errors
+
+    ratio = blob.aspect_ratio
+    if ratio is not None and not MIN_ASPECT_RATIO - 0.01 <= ratio <= MAX_ASPECT_RATIO + 0.01:
+        errors.append(f"Aspect ratio {ratio:.2f} is outside 9:16 to 1.91:1")
+    return errors
+
+
+def _measure_image(blob, path):
+    with Image.open(path) as image:
+        blob.width, blob.height = image.size
+        # draft() lets JPEG decode at a reduced scale instead of full size
+        image.draft('RGB', PREVIEW_MAX_SIZE)
+        image = image.convert('RGB')
+        image.thumbnail(PREVIEW_MAX_SIZE)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+def _measure_video(blob, path):
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None:
+        logger.warning("ffprobe is not installed; video dimensions and duration are not checked")
+        return None
+
+    result = subprocess.run(
+        [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+         'stream=width,height:format=duration', '-of', 'json', path],
+        capture_output=True, timeout=FFPROBE_TIMEOUT, check=True,
+    )
+    probe = json.loads(result.stdout or b'{}')
+    streams = probe.get('streams') or [{}]
+    blob.width = streams[0].get('width')
+    blob.height = streams[0].get('height')
+    duration = probe.get('format', {}).get('duration')
+    blob.duration = float(duration) if duration else None
+
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None
+    # One frame, one second in (or the first frame of very short clips)
+    seek = '1' if (blob.duration or 0) > 1 else '0'
+    frame = subprocess.run(
+        [ffmpeg, '-v', 'error', '-ss', seek, '-i', path, '-frames:v', '1',
+         '-vf', f"scale='min({PREVIEW_MAX_SIZE[0]},iw)':-2", '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1'],
+        capture_output=True, timeout=FFPROBE_TIMEOUT,
+    )
+    return frame.stdout or None
+
+
+def schedule_processing(blob):
+    """Queue a blob for processing once the current transaction commits"""
+    from ..tasks import process_creative_blob
+
+    transaction.on_commit(lambda: process_creative_blob.delay(blob.id))
+
+
+def creative_problems(creatives):
+    """
+    Processing verdicts that rule out a launch
+
+    Creatives still being processed are not held against the launch.
+
+    Returns:
+        Dictionary of creative ID to list of problems
+    """
+    problems = {}
+    for creative in creatives:
+        blob = creative.blob if creative.blob_id else None
+        if blob is None:
+            continue
+        if blob.processing_status == 'invalid':
+            problems[creative.id] = blob.validation_errors
+        elif blob.processing_status == 'valid' and blob.mime_type in VIDEO_MIME_TYPES and not blob.preview:
+            # Video ads need a thumbnail; the preview frame is sent as one
+            problems[creative.id] = ["No thumbnail could be taken from the video (is ffmpeg installed?)"]
+    return problems
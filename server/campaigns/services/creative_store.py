@@ -0,0 +1,201 @@
+"""
+Content-addressed creative storage for QuickCampaigns
+
+Every creative file is stored once under ``creative_blobs/`` and named
+after its SHA-256 hash. A CampaignCreative points at the CreativeBlob
+holding its bytes, and the blob counts its references. Uploading the same
+logo to twenty campaigns therefore stores one file, and the blob is also
+the key for the Facebook media cache in ``facebook_media``.
+
+The hash is computed while the bytes stream through the app when they do
+(multipart posts, local chunked uploads). For files that went straight to
+S3 it is computed on the task queue by streaming the object back.
+"""
+import hashlib
+import logging
+import os
+import posixpath
+import shutil
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from ..models import CampaignCreative, CreativeBlob
+from . import creative_processing, response_cache
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class StreamingHash:
+    """SHA-256 and size of a file, updated chunk by chunk as it streams"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def update(self, chunk):
+        self.digest.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+
+def hash_chunks(chunks):
+    """
+    Hash an iterable of byte chunks
+
+    Returns:
+        Tuple of (sha256 hex digest, size in bytes)
+    """
+    streaming_hash = StreamingHash()
+    for chunk in chunks:
+        streaming_hash.update(chunk)
+    return streaming_hash.sha256, streaming_hash.size
+
+
+def blob_storage_name(sha256, file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    return f"creative_blobs/{sha256[:2]}/{sha256}{extension}"
+
+
+def find_blob(sha256):
+    return CreativeBlob.objects.filter(sha256=sha256).first()
+
+
+def s3_key(name):
+    location = default_storage.location
+    return posixpath.join(location, name) if location else name
+
+
+def iter_stored_file(name):
+    """Stream a stored file in fixed-size chunks"""
+    if settings.USE_S3:
+        body = default_storage.connection.meta.client.get_object(
+            Bucket=default_storage.bucket_name, Key=s3_key(name)
+        )['Body']
+        yield from body.iter_chunks(HASH_CHUNK_SIZE)
+        return
+    with open(default_storage.path(name), 'rb') as stored:
+        for chunk in iter(lambda: stored.read(HASH_CHUNK_SIZE), b''):
+            yield chunk
+
+
+def copy_stored_file(old_name, new_name):
+    """Copy a stored file without sending its bytes through the app"""
+    if old_name == new_name:
+        return
+    if settings.USE_S3:
+        client = default_storage.connection.meta.client
+        bucket = default_storage.bucket_name
+        extra = {'ACL': default_storage.default_acl} if default_storage.default_acl else {}
+        client.copy_object(
+            Bucket=bucket, Key=s3_key(new_name),
+            CopySource={'Bucket': bucket, 'Key': s3_key(old_name)}, **extra
+        )
+        return
+    old_path = default_storage.path(old_name)
+    new_path = default_storage.path(new_name)
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    # A hard link shares the bytes; the rename makes the new name appear whole
+    temp_path = f"{new_path}.{os.getpid()}.partial"
+    try:
+        os.link(old_path, temp_path)
+    except OSError:
+        shutil.copyfile(old_path, temp_path)
+    os.replace(temp_path, new_path)
+
+
+def register_creative(creative, sha256, size):
+    """
+    Point a stored creative at the blob for its content
+
+    If a blob with the same hash exists, the creative's own copy is deleted
+    and it shares the existing file; otherwise its file is copied to the
+    content-addressed name and becomes a new blob. The creative's own copy
+    is only deleted once the transaction commits, so after a rollback the
+    creative still finds its file where its row says it is.
+
+    Args:
+        creative: Saved CampaignCreative whose file holds the content
+        sha256: Hex digest of the file
+        size: File size in bytes
+
+    Returns:
+        CreativeBlob
+    """
+    own_name = creative.file.name
+    with transaction.atomic():
+        blob = CreativeBlob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            name = blob_storage_name(sha256, creative.file_name)
+            copy_stored_file(own_name, name)
+            try:
+                with transaction.atomic():
+                    blob = CreativeBlob.objects.create(
+                        sha256=sha256, file=name, file_size=size, content_type=creative.file_type
+                    )
+            except IntegrityError:
+                # Stored concurrently; our copy wrote the same bytes to the same name
+                blob = CreativeBlob.objects.select_for_update().get(sha256=sha256)
+        if own_name != blob.file.name:
+            transaction.on_commit(lambda: default_storage.delete(own_name))
+
+        CreativeBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        CampaignCreative.objects.filter(pk=creative.pk).update(blob=blob, file=blob.file.name)
+        response_cache.invalidate(creative.campaign.user_id)
+        creative.blob = blob
+        creative.file.name = blob.file.name
+        if blob.processing_status in ('pending', 'failed'):
+            creative_processing.schedule_processing(blob)
+
+    logger.info(f"Creative {creative.id} stored as blob {sha256[:12]}")
+    return blob
+
+
+def index_creative(creative_id):
+    """
+    Hash a creative that was uploaded without passing through the app
+
+    Returns:
+        CreativeBlob, or None if the creative is gone or already indexed
+    """
+    creative = CampaignCreative.objects.filter(pk=creative_id).first()
+    if creative is None or creative.blob_id:
+        return None
+    sha256, size = hash_chunks(iter_stored_file(creative.file.name))
+    return register_creative(creative, sha256, size)
+
+
+def schedule_index(creative):
+    """Hash the creative on the task queue once the current transaction commits"""
+    from ..tasks import index_creative_blob
+
+    transaction.on_commit(lambda: index_creative_blob.delay(creative.id))
+
+
+def release_blob(blob_id):
+    """
+    Drop one reference to a blob, deleting it and its file at zero
+
+    Called when a CampaignCreative is deleted.
+    """
+    with transaction.atomic():
+        CreativeBlob.objects.filter(pk=blob_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        blob = CreativeBlob.objects.select_for_update().filter(pk=blob_id, ref_count__lte=0).first()
+        if blob is None:
+            return
+        # A creative may still be mid-delete in another transaction
+        if blob.creatives.exists():
+            return
+        names = [blob.file.name] + ([blob.preview.name] if blob.preview else [])
+        blob.delete()
+
+        def delete_files():
+            for name in names:
+                default_storage.delete(name)
+        transaction.on_commit(delete_files)
+    logger.info(f"Deleted unreferenced creative blob {blob.sha256[:12]}")
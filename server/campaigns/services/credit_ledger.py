@@ -0,0 +1,390 @@
+"""
+Credit ledger for QuickCampaigns
+
+Every change to UserCredit.balance goes through this module. The balance
+row is locked with SELECT ... FOR UPDATE, changed with an F() expression
+and the matching CreditTransaction is written in the same database
+transaction, so concurrent launches and purchases can neither lose an
+update nor record a transaction without moving the balance.
+
+Launches use two-phase reservations so no lock is held across a Graph
+call: ``reserve`` holds credits in a short transaction, and once the job
+finishes ``settle`` turns the hold into a usage transaction or
+``release`` returns it. A bulk launch holds one reservation for all its
+campaigns and settles it piecewise with ``settle_part``. Holds left behind by crashed jobs are expired by
+a periodic sweeper; holds whose launch jobs are still queued, running or
+unconfirmed are extended instead, so a requeued launch keeps its credits.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from ..models import UserCredit, CreditTransaction, CreditReservation
+from . import live_events, response_cache
+
+logger = logging.getLogger(__name__)
+
+# Longest idempotency key a transaction can store
+IDEMPOTENCY_KEY_MAX_LENGTH = CreditTransaction._meta.get_field('idempotency_key').max_length
+
+
+class InsufficientCredits(Exception):
+    """Raised when a debit or reservation exceeds the available credits"""
+
+    def __init__(self, available, amount):
+        self.available = available
+        self.amount = amount
+        super().__init__(f"Insufficient credits: available {available}, required {amount}")
+
+
+def debit(user, amount, transaction_type='usage', description=None, campaign=None,
+          idempotency_key=None):
+    """
+    Remove credits from a user's balance
+
+    Args:
+        user: User to charge
+        amount: Positive number of credits
+        transaction_type: CreditTransaction.transaction_type
+        description: Optional description
+        campaign: Optional Campaign the credits were spent on
+        idempotency_key: Optional key; a repeated call with the same key
+            returns the original transaction without charging again
+
+    Returns:
+        Tuple of (CreditTransaction, new balance)
+
+    Raises:
+        InsufficientCredits: if fewer than amount credits are available
+    """
+    if amount <= 0:
+        raise ValueError("Debit amount must be positive")
+    return _apply(user, -amount, transaction_type, description, campaign,
+                  idempotency_key=idempotency_key)
+
+
+def credit(user, amount, transaction_type='purchase', description=None, campaign=None,
+           stripe_payment_id=None, idempotency_key=None):
+    """
+    Add credits to a user's balance
+
+    Args:
+        user: User to credit
+        amount: Positive number of credits
+        transaction_type: CreditTransaction.transaction_type
+        description: Optional description
+        campaign: Optional related Campaign (e.g. for refunds)
+        stripe_payment_id: Optional Stripe payment reference
+        idempotency_key: Optional key; a repeated call with the same key
+            returns the original transaction without crediting again
+
+    Returns:
+        Tuple of (CreditTransaction, new balance)
+    """
+    if amount <= 0:
+        raise ValueError("Credit amount must be positive")
+    return _apply(user, amount, transaction_type, description, campaign,
+                  stripe_payment_id=stripe_payment_id, idempotency_key=idempotency_key)
+
+
+def lock_balance(user):
+    """
+    Lock and return the user's UserCredit row, creating it if needed
+
+    Must be called inside transaction.atomic(). The balance is about to
+    change with a queryset update(), which sends no signals, so the
+    user's cached responses are dropped and the new balance is published
+    to their live event streams once the transaction commits.
+
+    Args:
+        user: User instance or primary key
+    """
+    user_id = getattr(user, 'pk', user)
+    response_cache.invalidate(user_id)
+    live_events.credits_changed(user_id)
+    try:
+        return UserCredit.objects.select_for_update().get(user_id=user_id)
+    except UserCredit.DoesNotExist:
+        pass
+    try:
+        with transaction.atomic():
+            UserCredit.objects.create(user_id=user_id)
+    except IntegrityError:
+        # Created concurrently by another request
+        pass
+    return UserCredit.objects.select_for_update().get(user_id=user_id)
+
+
+def _apply(user, amount, transaction_type, description, campaign,
+           stripe_payment_id=None, idempotency_key=None):
+    with transaction.atomic():
+        user_credit = lock_balance(user)
+
+        # Checked after taking the lock, so a concurrent request with the
+        # same key has either committed (and is found) or not started yet
+        if idempotency_key:
+            existing = CreditTransaction.objects.filter(
+                user=user, idempotency_key=idempotency_key
+            ).first()
+            if existing:
+                return existing, user_credit.balance
+
+        # Credits held by pending launches cannot be spent twice
+        if amount < 0 and user_credit.available + amount < 0:
+            raise InsufficientCredits(user_credit.available, -amount)
+
+        UserCredit.objects.filter(pk=user_credit.pk).update(
+            balance=F('balance') + amount,
+            updated_at=timezone.now(),
+        )
+        ledger_entry = CreditTransaction.objects.create(
+            user=user,
+            amount=amount,
+            transaction_type=transaction_type,
+            description=description,
+            stripe_payment_id=stripe_payment_id,
+            campaign=campaign,
+            idempotency_key=idempotency_key,
+        )
+
+    balance = user_credit.balance + amount
+    logger.info(f"Applied {amount:+d} credits ({transaction_type}) for user {user.id}, balance {balance}")
+    return ledger_entry, balance
+
+
+def reserve(user, amount, campaign=None, description=None, ttl=None):
+    """
+    Hold credits for an operation that will settle later
+
+    Args:
+        user: User whose credits are held
+        amount: Positive number of credits
+        campaign: Optional Campaign the hold is for
+        description: Optional description
+        ttl: Seconds before an unsettled hold is released by the sweeper.
+            Defaults to settings.CREDIT_RESERVATION_TTL
+
+    Returns:
+        CreditReservation
+
+    Raises:
+        InsufficientCredits: if fewer than amount credits are available
+    """
+    if amount <= 0:
+        raise ValueError("Reservation amount must be positive")
+    ttl = settings.CREDIT_RESERVATION_TTL if ttl is None else ttl
+
+    with transaction.atomic():
+        user_credit = lock_balance(user)
+        if user_credit.available < amount:
+            raise InsufficientCredits(user_credit.available, amount)
+
+        UserCredit.objects.filter(pk=user_credit.pk).update(
+            reserved=F('reserved') + amount,
+            updated_at=timezone.now(),
+        )
+        reservation = CreditReservation.objects.create(
+            user=user,
+            amount=amount,
+            campaign=campaign,
+            description=description,
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+        )
+
+    logger.info(f"Reserved {amount} credits for user {user.id} (reservation {reservation.id})")
+    return reservation
+
+
+def settle(reservation_id, amount=None, transaction_type='usage', description=None, campaign=None):
+    """
+    Convert a held reservation into a debit
+
+    Settling twice is a no-op. If the hold already expired, the credits are
+    charged with a regular debit, which still refuses to overspend.
+
+    Args:
+        reservation_id: CreditReservation primary key
+        amount: Credits actually used, at most the reserved amount. The
+            rest of the hold is returned. Defaults to the full amount
+        transaction_type: CreditTransaction.transaction_type
+        description: Optional description
+        campaign: Optional Campaign the credits were spent on
+
+    Returns:
+        CreditTransaction, or None when nothing was charged
+
+    Raises:
+        InsufficientCredits: if the hold expired and the credits have since
+            been spent elsewhere
+    """
+    idempotency_key = f"reservation:{reservation_id}"
+    with transaction.atomic():
+        reservation = CreditReservation.objects.select_for_update().get(pk=reservation_id)
+        amount = reservation.amount if amount is None else min(amount, reservation.amount)
+        campaign = campaign or reservation.campaign
+
+        if reservation.status == 'settled':
+            return CreditTransaction.objects.filter(
+                user_id=reservation.user_id, idempotency_key=idempotency_key
+            ).first()
+
+        if reservation.status != 'held':
+            logger.warning(f"Settling {reservation.status} reservation {reservation.id} with a direct debit")
+            if amount == 0:
+                return None
+            ledger_entry, _ = debit(
+                reservation.user, amount, transaction_type=transaction_type,
+                description=description, campaign=campaign, idempotency_key=idempotency_key,
+            )
+            return ledger_entry
+
+        user_credit = lock_balance(reservation.user_id)
+        UserCredit.objects.filter(pk=user_credit.pk).update(
+            balance=F('balance') - amount,
+            reserved=F('reserved') - reservation.amount,
+            updated_at=timezone.now(),
+        )
+        ledger_entry = None
+        if amount:
+            ledger_entry = CreditTransaction.objects.create(
+                user_id=reservation.user_id,
+                amount=-amount,
+                transaction_type=transaction_type,
+                description=description,
+                campaign=campaign,
+                idempotency_key=idempotency_key,
+            )
+        reservation.status = 'settled'
+        reservation.save(update_fields=['status', 'updated_at'])
+
+    logger.info(f"Settled reservation {reservation_id}: charged {amount} credits")
+    return ledger_entry
+
+
+def settle_part(reservation_id, part, used, released=0, description=None):
+    """
+    Charge and return part of a reservation shared by several launches
+
+    The charged credits are recorded as one usage transaction. Once the
+    whole hold is accounted for, the reservation is settled. Settling the
+    same part twice is a no-op, including when the hold already expired
+    and the part is charged with a direct debit.
+
+    Args:
+        reservation_id: CreditReservation primary key
+        part: Identifier of the part, unique within the reservation (at
+            most 50 characters)
+        used: Credits to charge
+        released: Credits to return to the available balance
+        description: Optional description of the usage transaction
+
+    Returns:
+        CreditTransaction, or None when nothing was charged
+
+    Raises:
+        InsufficientCredits: if the hold expired and the credits have since
+            been spent elsewhere
+    """
+    if used < 0 or released < 0:
+        raise ValueError("Settled amounts must not be negative")
+    idempotency_key = f"reservation:{reservation_id}:{part}"
+    with transaction.atomic():
+        reservation = CreditReservation.objects.select_for_update().get(pk=reservation_id)
+        settled = CreditTransaction.objects.filter(
+            user_id=reservation.user_id, idempotency_key=idempotency_key
+        ).first()
+        if settled:
+            return settled
+
+        if reservation.status != 'held':
+            logger.warning(f"Settling part of {reservation.status} reservation {reservation.id} with a direct debit")
+            if not used:
+                return None
+            ledger_entry, _ = debit(
+                reservation.user, used, description=description, idempotency_key=idempotency_key
+            )
+            return ledger_entry
+
+        taken = min(used + released, reservation.amount)
+        used = min(used, taken)
+        user_credit = lock_balance(reservation.user_id)
+        UserCredit.objects.filter(pk=user_credit.pk).update(
+            balance=F('balance') - used,
+            reserved=F('reserved') - taken,
+            updated_at=timezone.now(),
+        )
+        ledger_entry = None
+        if used:
+            ledger_entry = CreditTransaction.objects.create(
+                user_id=reservation.user_id,
+                amount=-used,
+                transaction_type='usage',
+                description=description,
+                idempotency_key=idempotency_key,
+            )
+        reservation.amount -= taken
+        if reservation.amount == 0:
+            reservation.status = 'settled'
+        reservation.save(update_fields=['amount', 'status', 'updated_at'])
+
+    logger.info(f"Settled part of reservation {reservation_id}: charged {used}, returned {taken - used} credits")
+    return ledger_entry
+
+
+def release(reservation_id, status='released'):
+    """
+    Return held credits without charging them
+
+    Args:
+        reservation_id: CreditReservation primary key
+        status: Final status, 'released' or 'expired'
+
+    Returns:
+        True if the hold was released, False if it was no longer held
+    """
+    with transaction.atomic():
+        reservation = CreditReservation.objects.select_for_update().get(pk=reservation_id)
+        if reservation.status != 'held':
+            return False
+
+        user_credit = lock_balance(reservation.user_id)
+        UserCredit.objects.filter(pk=user_credit.pk).update(
+            reserved=F('reserved') - reservation.amount,
+            updated_at=timezone.now(),
+        )
+        reservation.status = status
+        reservation.save(update_fields=['status', 'updated_at'])
+
+    logger.info(f"Reservation {reservation_id} {status}, returned {reservation.amount} credits")
+    return True
+
+
+def expire_stale_reservations(now=None, limit=1000):
+    """
+    Release holds that passed their expiry time
+
+    Holds of launch jobs that are still queued or running (a requeued
+    launch may wait longer than the TTL), or unconfirmed until their
+    campaign is read back from Facebook, are extended by another TTL
+    instead. Each hold is released in its own short transaction so the
+    sweeper never holds many UserCredit locks at once.
+
+    Returns:
+        Number of reservations expired
+    """
+    now = now or timezone.now()
+    stale = CreditReservation.objects.filter(status='held', expires_at__lt=now)
+    stale.filter(launch_jobs__status__in=['queued', 'running', 'unconfirmed']).update(
+        expires_at=now + timedelta(seconds=settings.CREDIT_RESERVATION_TTL),
+        updated_at=now,
+    )
+    stale_ids = list(
+        stale.order_by('expires_at')
+        .values_list('id', flat=True)[:limit]
+    )
+    expired = sum(1 for reservation_id in stale_ids if release(reservation_id, status='expired'))
+    if expired:
+        logger.warning(f"Expired {expired} stale credit reservations")
+    return expired
@@ -0,0 +1,195 @@
+"""
+Credit balance reconciliation for QuickCampaigns
+
+UserCredit.balance is a materialized SUM(CreditTransaction.amount) per
+user. Reconciliation keeps a per-user snapshot of that sum and, on each
+run, folds in only the transactions added since the last checkpoint with
+one grouped aggregate query. Balances are then compared with the
+snapshots in the database, so neither transactions nor balances are
+loaded into Python beyond the rows that disagree.
+"""
+import logging
+import time
+from datetime import timedelta
+from itertools import islice
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from ..models import CreditBalanceSnapshot, CreditReconciliation, CreditTransaction, UserCredit
+from .credit_ledger import lock_balance
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'credit-reconciliation-lock'
+LOCK_TIMEOUT = 60 * 60
+
+# Transactions younger than this are left for the next run. Row IDs are
+# allocated before commit, so a slow transaction can become visible after
+# a newer ID; the lag keeps the checkpoint behind any such stragglers.
+COMMIT_LAG = timedelta(minutes=1)
+
+# Drifted users recorded on the checkpoint row
+MAX_DRIFT_DETAILS = 1000
+
+
+class ReconciliationInProgress(Exception):
+    """Raised when another reconciliation holds the lock"""
+
+
+def reconcile_balances(repair=False, full=False, chunk_size=2000):
+    """
+    Fold new transactions into the snapshots and check every balance
+
+    Args:
+        repair: Overwrite drifted balances with the ledger value
+        full: Rebuild every snapshot from the first transaction
+        chunk_size: Rows fetched and written per round trip
+
+    Returns:
+        The CreditReconciliation checkpoint written by this run
+
+    Raises:
+        ReconciliationInProgress: if another run is still going
+    """
+    if not cache.add(LOCK_KEY, 'locked', LOCK_TIMEOUT):
+        raise ReconciliationInProgress("Another credit reconciliation is running")
+    try:
+        return _reconcile(repair, full, chunk_size)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _reconcile(repair, full, chunk_size):
+    timings = {}
+    started = time.monotonic()
+
+    previous = None if full else CreditReconciliation.objects.order_by('-id').first()
+    since = previous.last_transaction_id if previous else 0
+    if full:
+        CreditBalanceSnapshot.objects.all().delete()
+
+    high_water = CreditTransaction.objects.filter(
+        id__gt=since, created_at__lt=timezone.now() - COMMIT_LAG
+    ).aggregate(high_water=Max('id'))['high_water'] or since
+
+    # Phase 1: SUM(amount) GROUP BY user over the new transactions only
+    phase = time.monotonic()
+    deltas = (
+        CreditTransaction.objects.filter(id__gt=since, id__lte=high_water)
+        .values('user_id')
+        .annotate(total=Sum('amount'), count=Count('id'))
+        .order_by('user_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    transactions_scanned = 0
+    users_updated = 0
+    for chunk in _chunks(deltas, chunk_size):
+        transactions_scanned += sum(row['count'] for row in chunk)
+        users_updated += _apply_deltas(chunk)
+    timings['aggregate'] = time.monotonic() - phase
+
+    # Phase 2: compare balances with snapshots in the database
+    phase = time.monotonic()
+    candidates = (
+        UserCredit.objects.annotate(
+            ledger=Coalesce(F('user__credit_snapshot__ledger_balance'), Value(0))
+        )
+        .exclude(balance=F('ledger'))
+        .values_list('user_id', 'balance', 'ledger')
+        .order_by('user_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    drifted = []
+    for chunk in _chunks(candidates, chunk_size):
+        drifted.extend(_confirm_drift(chunk, high_water))
+    timings['compare'] = time.monotonic() - phase
+
+    # Phase 3: optionally repair, under the same row lock the ledger uses
+    phase = time.monotonic()
+    repaired = 0
+    if repair:
+        repaired = sum(1 for drift in drifted if _repair(drift['user_id'], high_water))
+    timings['repair'] = time.monotonic() - phase
+    timings['total'] = time.monotonic() - started
+
+    for drift in drifted[:MAX_DRIFT_DETAILS]:
+        logger.warning(
+            f"Credit drift for user {drift['user_id']}: balance {drift['balance']}, "
+            f"ledger {drift['ledger']}"
+        )
+
+    return CreditReconciliation.objects.create(
+        last_transaction_id=high_water,
+        transactions_scanned=transactions_scanned,
+        users_updated=users_updated,
+        drift_count=len(drifted),
+        repaired_count=repaired,
+        drift_details=drifted[:MAX_DRIFT_DETAILS],
+        timings={key: round(value, 4) for key, value in timings.items()},
+    )
+
+
+def _apply_deltas(rows):
+    """Add one chunk of per-user sums to the snapshots"""
+    totals = {row['user_id']: row['total'] for row in rows}
+    with transaction.atomic():
+        existing = CreditBalanceSnapshot.objects.select_for_update().in_bulk(
+            list(totals), field_name='user_id'
+        )
+        now = timezone.now()
+        for user_id, snapshot in existing.items():
+            snapshot.ledger_balance += totals[user_id]
+            snapshot.updated_at = now
+        CreditBalanceSnapshot.objects.bulk_update(existing.values(), ['ledger_balance', 'updated_at'])
+        CreditBalanceSnapshot.objects.bulk_create([
+            CreditBalanceSnapshot(user_id=user_id, ledger_balance=total)
+            for user_id, total in totals.items()
+            if user_id not in existing
+        ])
+    return len(totals)
+
+
+def _confirm_drift(rows, high_water):
+    """
+    Filter out balances that only differ by transactions after the checkpoint
+    """
+    user_ids = [user_id for user_id, _, _ in rows]
+    recent = dict(
+        CreditTransaction.objects.filter(user_id__in=user_ids, id__gt=high_water)
+        .values('user_id')
+        .annotate(total=Sum('amount'))
+        .values_list('user_id', 'total')
+    )
+    return [
+        {'user_id': user_id, 'balance': balance, 'ledger': ledger + recent.get(user_id, 0)}
+        for user_id, balance, ledger in rows
+        if balance != ledger + recent.get(user_id, 0)
+    ]
+
+
+def _repair(user_id, high_water):
+    with transaction.atomic():
+        user_credit = lock_balance(user_id)
+        snapshot = CreditBalanceSnapshot.objects.filter(user_id=user_id).values_list(
+            'ledger_balance', flat=True
+        ).first() or 0
+        recent = CreditTransaction.objects.filter(
+            user_id=user_id, id__gt=high_water
+        ).aggregate(total=Sum('amount'))['total'] or 0
+        expected = snapshot + recent
+        if user_credit.balance == expected:
+            return False
+        UserCredit.objects.filter(pk=user_credit.pk).update(balance=expected, updated_at=timezone.now())
+    logger.warning(f"Repaired credit balance for user {user_id}: {user_credit.balance} -> {expected}")
+    return True
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,243 @@
+"""
+Direct-to-storage creative uploads for QuickCampaigns
+
+The API hands the client a presigned URL and the client sends the file
+straight to the media bucket, so upload bandwidth never reaches the app
+servers. The URL comes with a signed upload token naming the user,
+campaign and storage key; finalizing with that token reads the object's
+size and content type from storage and creates the CampaignCreative.
+A token is single use: the creative records the token's storage key, a
+second finalize returns that creative and the local endpoint refuses
+further PUTs, so the indexed content cannot be swapped afterwards.
+
+Without S3 the "presigned" URL points at a small local endpoint that
+checks the same token and writes the body under MEDIA_ROOT. That keeps
+development and tests on the same flow as production.
+"""
+import logging
+import mimetypes
+import os
+import posixpath
+import uuid
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from ..models import CampaignCreative
+from . import creative_store
+from .chunked_upload import BodyReader, UploadError, creative_storage_name
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = 'campaigns.direct-upload'
+
+
+class S3DirectBackend:
+    """Presigned POST and PUT URLs on the media bucket"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.client = storage.connection.meta.client
+        self.bucket = storage.bucket_name
+
+    def key(self, name):
+        if self.storage.location:
+            return posixpath.join(self.storage.location, name)
+        return name
+
+    def presign(self, name, file_type, expires_in, local_url=None):
+        key = self.key(name)
+        fields = {'Content-Type': file_type}
+        conditions = [
+            {'Content-Type': file_type},
+            ['content-length-range', 1, settings.CREATIVE_UPLOAD_MAX_SIZE],
+        ]
+        if self.storage.default_acl:
+            fields['acl'] = self.storage.default_acl
+            conditions.append({'acl': self.storage.default_acl})
+
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket, Key=key, Fields=fields, Conditions=conditions, ExpiresIn=expires_in
+        )
+        put_params = {'Bucket': self.bucket, 'Key': key, 'ContentType': file_type}
+        put_headers = {'Content-Type': file_type}
+        if self.storage.default_acl:
+            put_params['ACL'] = self.storage.default_acl
+            put_headers['x-amz-acl'] = self.storage.default_acl
+        put_url = self.client.generate_presigned_url(
+            'put_object', Params=put_params, ExpiresIn=expires_in
+        )
+        return {
+            'post': {'url': post['url'], 'fields': post['fields']},
+            'put': {'url': put_url, 'headers': put_headers},
+        }
+
+    def stat(self, name):
+        """(size, content type) of a stored object, or None if it is missing"""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return head['ContentLength'], head.get('ContentType')
+
+
+class LocalDirectBackend:
+    """Stand-in for S3 that stores PUT bodies under MEDIA_ROOT"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def presign(self, name, file_type, expires_in, local_url=None):
+        return {
+            'post': None,
+            'put': {'url': local_url, 'headers': {'Content-Type': file_type}},
+        }
+
+    def stat(self, name):
+        path = self.storage.path(name)
+        if not os.path.exists(path):
+            return None
+        return os.path.getsize(path), mimetypes.guess_type(name)[0]
+
+    def write(self, name, stream, length):
+        path = self.storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        reader = BodyReader(stream, length)
+        with open(f"{path}.partial", 'wb') as output:
+            for chunk in reader.chunks():
+                output.write(chunk)
+        os.replace(f"{path}.partial", path)
+
+
+def get_backend():
+    if settings.USE_S3:
+        return S3DirectBackend(default_storage)
+    return LocalDirectBackend(default_storage)
+
+
+def create_upload_token(user, campaign, file_name, file_type):
+    """
+    Reserve a storage name for a creative and sign it for this user
+
+    Returns:
+        Tuple of (token, storage name)
+    """
+    name = creative_storage_name(file_name, uuid.uuid4().hex)
+    token = signing.dumps(
+        {'user': user.id, 'campaign': campaign.id, 'name': name,
+         'file_name': file_name, 'file_type': file_type},
+        salt=TOKEN_SALT,
+    )
+    return token, name
+
+
+def read_upload_token(token):
+    """
+    Decode an upload token
+
+    Raises:
+        UploadError: if the token is forged or older than the URL lifetime
+    """
+    try:
+        return signing.loads(token, salt=TOKEN_SALT, max_age=settings.CREATIVE_PRESIGNED_URL_TTL)
+    except signing.BadSignature:
+        raise UploadError("Upload token is invalid or expired")
+
+
+def presign_upload(user, campaign, file_name, file_type, local_url_for):
+    """
+    Hand out URLs the client can upload one creative to
+
+    Args:
+        user: Uploading user
+        campaign: Campaign the creative will belong to
+        file_name: Original file name
+        file_type: MIME type the client will send
+        local_url_for: Callable building the local upload URL from a token
+
+    Returns:
+        Dictionary with the upload token and the POST / PUT targets
+    """
+    token, name = create_upload_token(user, campaign, file_name, file_type)
+    expires_in = settings.CREATIVE_PRESIGNED_URL_TTL
+    targets = get_backend().presign(name, file_type, expires_in, local_url=local_url_for(token))
+    return {
+        'upload_token': token,
+        'key': name,
+        'expires_in': expires_in,
+        'max_size': settings.CREATIVE_UPLOAD_MAX_SIZE,
+        **targets,
+    }
+
+
+def store_local_upload(token, stream, length):
+    """Write a PUT body for the local stand-in backend"""
+    backend = get_backend()
+    if not isinstance(backend, LocalDirectBackend):
+        raise UploadError("Uploads go directly to storage")
+    if not 0 < length <= settings.CREATIVE_UPLOAD_MAX_SIZE:
+        raise UploadError(f"File size must be between 1 and {settings.CREATIVE_UPLOAD_MAX_SIZE} bytes")
+    payload = read_upload_token(token)
+    if CampaignCreative.objects.filter(upload_key=payload['name']).exists():
+        raise UploadError("Upload token was already used")
+    backend.write(payload['name'], stream, length)
+
+
+def finalize_upload(user, campaign, token, expected_size=None):
+    """
+    Create the CampaignCreative for an object uploaded with a presigned URL
+
+    Size and content type come from storage, not from the client.
+    Finalizing the same token twice returns the same creative.
+
+    Args:
+        user: Uploading user
+        campaign: Campaign named in the token
+        token: Upload token returned by presign_upload
+        expected_size: Optional size the client sent, checked against storage
+
+    Returns:
+        CampaignCreative
+
+    Raises:
+        UploadError: if the token does not match or the object is missing
+    """
+    payload = read_upload_token(token)
+    if payload['user'] != user.id or payload['campaign'] != campaign.id:
+        raise UploadError("Upload token does not belong to this campaign")
+
+    name = payload['name']
+    existing = CampaignCreative.objects.filter(campaign=campaign, upload_key=name).first()
+    if existing:
+        return existing
+
+    stat = get_backend().stat(name)
+    if stat is None:
+        raise UploadError("Uploaded file was not found in storage")
+    size, content_type = stat
+    if expected_size is not None and size != expected_size:
+        raise UploadError(f"Stored file is {size} bytes, expected {expected_size}")
+    if not 0 < size <= settings.CREATIVE_UPLOAD_MAX_SIZE:
+        raise UploadError(f"File size must be between 1 and {settings.CREATIVE_UPLOAD_MAX_SIZE} bytes")
+
+    creative = CampaignCreative(
+        campaign=campaign,
+        file_type=content_type or payload['file_type'],
+        file_name=payload['file_name'],
+        file_size=size,
+        upload_key=name,
+    )
+    creative.file.name = name
+    try:
+        with transaction.atomic():
+            creative.save()
+            creative_store.schedule_index(creative)
+    except IntegrityError:
+        # Finalized concurrently with the same token
+        return CampaignCreative.objects.get(campaign=campaign, upload_key=name)
+
+    logger.info(f"Finalized direct upload {name} as creative {creative.id}")
+    return creative
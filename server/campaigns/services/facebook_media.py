@@ -0,0 +1,124 @@
+"""
+Facebook media cache for QuickCampaigns
+
+Uploading media is the most expensive Graph work in a launch. Each
+CreativeBlob is uploaded to an ad account's /adimages or /advideos once;
+the image hash or video ID is kept in FacebookMediaUpload and reused by
+every later launch into that account, whichever campaign the creative
+belongs to.
+"""
+import asyncio
+import base64
+import logging
+from asgiref.sync import sync_to_async
+from ..models import FacebookMediaUpload
+from .creative_store import iter_stored_file
+
+logger = logging.getLogger(__name__)
+
+# Launch plan key prefix of blob video uploads, followed by the blob ID
+VIDEO_KEY_PREFIX = 'video-b'
+
+
+def media_type(creative):
+    return 'video' if creative.file_type.startswith('video') else 'image'
+
+
+def cached_media(ad_account_id, creatives):
+    """
+    Look up the blobs of these creatives that are already in the ad account
+
+    Returns:
+        Dictionary of blob ID to image hash or video ID
+    """
+    blob_ids = {creative.blob_id for creative in creatives if creative.blob_id}
+    if not blob_ids:
+        return {}
+    return dict(
+        FacebookMediaUpload.objects.filter(ad_account_id=ad_account_id, blob_id__in=blob_ids)
+        .values_list('blob_id', 'facebook_id')
+    )
+
+
+async def upload_image(client, auth_params, ad_account_id, blob):
+    """
+    Upload a blob to /adimages and cache its image hash
+
+    Args:
+        client: AsyncGraphClient
+        auth_params: access_token (and appsecret_proof) of the account's owner
+        ad_account_id: Ad account without the 'act_' prefix
+        blob: CreativeBlob holding the image
+
+    Returns:
+        Image hash
+    """
+    encoded = await sync_to_async(read_base64)(blob)
+    payload = await client.call(
+        'POST', f"act_{ad_account_id}/adimages", data={**auth_params, 'bytes': encoded},
+    )
+    images = payload.get('images', {})
+    image_hash = next(iter(images.values()))['hash']
+
+    await sync_to_async(FacebookMediaUpload.objects.bulk_create)([
+        FacebookMediaUpload(blob=blob, ad_account_id=ad_account_id, media_type='image', facebook_id=image_hash)
+    ], ignore_conflicts=True)
+    logger.info(f"Uploaded image blob {blob.sha256[:12]} to act_{ad_account_id}")
+    return image_hash
+
+
+def read_base64(blob):
+    """A stored blob's content, base64-encoded for an upload"""
+    return base64.b64encode(b''.join(iter_stored_file(blob.file.name))).decode('ascii')
+
+
+async def prepare_media(client, auth_params, ad_account_id, creatives):
+    """
+    Make sure every image blob of a launch is in the ad account
+
+    The missing images are uploaded concurrently, each blob once. Videos
+    are uploaded inside the launch batch instead (see LaunchPlan); their
+    IDs are recorded afterwards with record_video_uploads. Creatives
+    without a blob, or whose image upload fails, fall back to image_url.
+
+    Returns:
+        Dictionary of blob ID to image hash or video ID
+    """
+    media = await sync_to_async(cached_media)(ad_account_id, creatives)
+    blobs = {
+        creative.blob_id: creative.blob
+        for creative in creatives
+        if creative.blob_id and creative.blob_id not in media and media_type(creative) == 'image'
+    }
+    uploads = await asyncio.gather(
+        *(upload_image(client, auth_params, ad_account_id, blob) for blob in blobs.values()),
+        return_exceptions=True,
+    )
+    for blob_id, upload in zip(blobs, uploads):
+        if isinstance(upload, BaseException):
+            logger.warning(f"Could not upload image blob {blob_id}, using its URL: {str(upload)}")
+        else:
+            media[blob_id] = upload
+    return media
+
+
+def record_video_uploads(ad_account_id, object_ids):
+    """
+    Cache the IDs of videos uploaded by a launch plan
+
+    Args:
+        ad_account_id: Ad account the plan ran in
+        object_ids: Plan keys to Facebook IDs, as returned by the plan
+    """
+    uploads = [
+        FacebookMediaUpload(
+            blob_id=int(key[len(VIDEO_KEY_PREFIX):]),
+            ad_account_id=ad_account_id,
+            media_type='video',
+            facebook_id=video_id,
+        )
+        for key, video_id in object_ids.items()
+        if key.startswith(VIDEO_KEY_PREFIX)
+    ]
+    if uploads:
+        FacebookMediaUpload.objects.bulk_create(uploads, ignore_conflicts=True)
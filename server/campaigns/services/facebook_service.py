@@ -1,44 +1,64 @@
 """
 Facebook Marketing API Service for QuickCampaigns
+
+AsyncFacebookService talks to the Graph API through AsyncGraphClient, so
+a coroutine waiting on Facebook holds no thread. FacebookService keeps the
+synchronous interface for code that is not running on an event loop.
 """
-import os
+import hashlib
+import hmac
+import json
 import logging
-from facebook_business.api import FacebookAdsApi
-from facebook_business.adobjects.adaccount import AdAccount
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from facebook_business.adobjects.campaign import Campaign
-from facebook_business.adobjects.adset import AdSet
-from facebook_business.adobjects.ad import Ad
-from facebook_business.adobjects.adcreative import AdCreative
-from facebook_business.exceptions import FacebookRequestError
+from . import facebook_media, worker_loop
+from .async_graph_client import GraphRequestError, async_graph_client
+from .launch_plan import FB_OBJECTIVE_MAP, LaunchPlan, LaunchPlanError, encode_params, execute_operations
 
 logger = logging.getLogger(__name__)
 
-class FacebookService:
+class AsyncFacebookService:
     """
-    Service class for interacting with the Facebook Marketing API
+    Service class for interacting with the Facebook Marketing API from coroutines
     """
-    def __init__(self, access_token=None, ad_account_id=None):
+    def __init__(self, access_token=None, ad_account_id=None, client=None):
         """
         Initialize the Facebook API with credentials
         
         Args:
             access_token: Optional user-specific access token. If not provided, uses system token
             ad_account_id: Optional ad account ID. If not provided, uses system account
+            client: Optional AsyncGraphClient. Defaults to the shared async_graph_client
         """
-        self.app_id = os.environ.get('FACEBOOK_APP_ID')
-        self.app_secret = os.environ.get('FACEBOOK_APP_SECRET')
+        self.app_id = settings.FACEBOOK_APP_ID
+        self.app_secret = settings.FACEBOOK_APP_SECRET
         
         # Use provided token or fall back to system token
-        self.access_token = access_token or os.environ.get('FACEBOOK_ACCESS_TOKEN')
+        self.access_token = access_token or settings.FACEBOOK_ACCESS_TOKEN
         
         # Use provided ad account or fall back to system account
-        self.ad_account_id = ad_account_id or os.environ.get('FACEBOOK_AD_ACCOUNT_ID')
+        self.ad_account_id = ad_account_id or settings.FACEBOOK_AD_ACCOUNT_ID
         
-        # Initialize the Facebook API
-        FacebookAdsApi.init(self.app_id, self.app_secret, self.access_token)
-        self.ad_account = AdAccount(f'act_{self.ad_account_id}')
+        self.client = client or async_graph_client
     
-    def create_campaign(self, name, objective, daily_budget, start_time, end_time=None, status='PAUSED'):
+    def auth_params(self):
+        """access_token and, with an app secret, the appsecret_proof of every call"""
+        params = {'access_token': self.access_token}
+        if self.app_secret:
+            params['appsecret_proof'] = hmac.new(
+                self.app_secret.encode('utf-8'), self.access_token.encode('utf-8'), hashlib.sha256
+            ).hexdigest()
+        return params
+    
+    async def _create(self, edge, params):
+        """POST to one of the ad account's edges; returns the new object's ID"""
+        result = await self.client.call(
+            'POST', f"act_{self.ad_account_id}/{edge}", data={**encode_params(params), **self.auth_params()}
+        )
+        return result['id']
+    
+    async def create_campaign(self, name, objective, daily_budget, start_time, end_time=None, status='PAUSED'):
         """
         Create a Facebook ad campaign
         
@@ -55,13 +75,7 @@ class FacebookService:
         """
         try:
             # Map Django model objective to Facebook objective
-            fb_objective_map = {
-                'website': 'CONVERSIONS',
-                'lead': 'LEAD_GENERATION',
-                'traffic': 'TRAFFIC',
-            }
-            
-            fb_objective = fb_objective_map.get(objective, 'CONVERSIONS')
+            fb_objective = FB_OBJECTIVE_MAP.get(objective, 'CONVERSIONS')
             
             params = {
                 'name': name,
@@ -75,34 +89,36 @@ class FacebookService:
             if end_time:
                 params['end_time'] = end_time
             
-            campaign = self.ad_account.create_campaign(params=params)
-            logger.info(f"Created Facebook campaign: {name} with ID: {campaign['id']}")
-            return campaign['id']
-            
-        except FacebookRequestError as e:
+            campaign_id = await self._create('campaigns', params)
+            logger.info(f"Created Facebook campaign: {name} with ID: {campaign_id}")
+            return campaign_id
+        
+        except GraphRequestError as e:
             logger.error(f"Facebook API error: {str(e)}")
             raise
     
-    def get_campaign(self, campaign_id):
+    async def get_campaign(self, campaign_id, fields=None):
         """
         Get campaign details
         
         Args:
             campaign_id: Facebook campaign ID
-            
+            fields: Optional list of fields to read. Defaults to Facebook's default fields
+        
         Returns:
-            Campaign object
+            Dictionary of the campaign's fields
         """
+        params = self.auth_params()
+        if fields:
+            params['fields'] = ','.join(fields)
         try:
-            campaign = Campaign(campaign_id)
-            campaign.remote_read()
-            return campaign
-        except FacebookRequestError as e:
+            return await self.client.call('GET', str(campaign_id), params=params)
+        except GraphRequestError as e:
             logger.error(f"Facebook API error: {str(e)}")
             raise
     
-    def create_ad_set(self, campaign_id, name, targeting, optimization_goal, 
-                     bid_amount, start_time, end_time=None, status='PAUSED'):
+    async def create_ad_set(self, campaign_id, name, targeting, optimization_goal,
+                            bid_amount, start_time, end_time=None, status='PAUSED'):
         """
         Create an ad set within a campaign
         
@@ -115,7 +131,7 @@ class FacebookService:
             start_time: Start time in ISO format
             end_time: Optional end time in ISO format
             status: Ad set status (ACTIVE, PAUSED)
-            
+        
         Returns:
             Ad set ID
         """
@@ -134,15 +150,15 @@ class FacebookService:
             if end_time:
                 params['end_time'] = end_time
             
-            ad_set = self.ad_account.create_ad_set(params=params)
-            logger.info(f"Created Facebook ad set: {name} with ID: {ad_set['id']}")
-            return ad_set['id']
-            
-        except FacebookRequestError as e:
+            ad_set_id = await self._create('adsets', params)
+            logger.info(f"Created Facebook ad set: {name} with ID: {ad_set_id}")
+            return ad_set_id
+        
+        except GraphRequestError as e:
             logger.error(f"Facebook API error: {str(e)}")
             raise
     
-    def create_ad_creative(self, name, image_url, page_id, message, headline, description, link_url):
+    async def create_ad_creative(self, name, image_url, page_id, message, headline, description, link_url):
         """
         Create an ad creative
         
@@ -154,7 +170,7 @@ class FacebookService:
             headline: Ad headline
             description: Ad description
             link_url: URL to link to
-            
+        
         Returns:
             Ad creative ID
         """
@@ -173,15 +189,15 @@ class FacebookService:
                 }
             }
             
-            creative = self.ad_account.create_ad_creative(params=params)
-            logger.info(f"Created Facebook ad creative: {name} with ID: {creative['id']}")
-            return creative['id']
-            
-        except FacebookRequestError as e:
+            creative_id = await self._create('adcreatives', params)
+            logger.info(f"Created Facebook ad creative: {name} with ID: {creative_id}")
+            return creative_id
+        
+        except GraphRequestError as e:
             logger.error(f"Facebook API error: {str(e)}")
             raise
     
-    def create_ad(self, name, ad_set_id, creative_id, status='PAUSED'):
+    async def create_ad(self, name, ad_set_id, creative_id, status='PAUSED'):
         """
         Create an ad
         
@@ -190,7 +206,7 @@ class FacebookService:
             ad_set_id: Ad set ID
             creative_id: Ad creative ID
             status: Ad status (ACTIVE, PAUSED)
-            
+        
         Returns:
             Ad ID
         """
@@ -202,10 +218,196 @@ class FacebookService:
                 'status': status,
             }
             
-            ad = self.ad_account.create_ad(params=params)
-            logger.info(f"Created Facebook ad: {name} with ID: {ad['id']}")
-            return ad['id']
-            
-        except FacebookRequestError as e:
+            ad_id = await self._create('ads', params)
+            logger.info(f"Created Facebook ad: {name} with ID: {ad_id}")
+            return ad_id
+        
+        except GraphRequestError as e:
             logger.error(f"Facebook API error: {str(e)}")
             raise
+    
+    async def create_launch_plan(self, campaign, creatives, status='ACTIVE'):
+        """
+        Build the launch plan for a campaign and its creatives
+        
+        Images not yet in the ad account are uploaded first so the plan can
+        reference them by image hash.
+        
+        Args:
+            campaign: Campaign model instance
+            creatives: Iterable of CampaignCreative instances
+            status: Status of the created objects (ACTIVE, PAUSED)
+        
+        Returns:
+            LaunchPlan
+        """
+        media = await facebook_media.prepare_media(self.client, self.auth_params(), self.ad_account_id, creatives)
+        return LaunchPlan.for_campaign(campaign, creatives, self.ad_account_id, status=status, media=media)
+    
+    async def create_launch_plans(self, launches, status='ACTIVE'):
+        """
+        Build the launch plans of several campaigns in this ad account
+        
+        Images shared by the campaigns are uploaded once.
+        
+        Args:
+            launches: List of (Campaign, creatives) tuples
+            status: Status of the created objects (ACTIVE, PAUSED)
+        
+        Returns:
+            List of LaunchPlan, in the order of ``launches``
+        """
+        all_creatives = [creative for _, creatives in launches for creative in creatives]
+        media = await facebook_media.prepare_media(self.client, self.auth_params(), self.ad_account_id, all_creatives)
+        return [
+            LaunchPlan.for_campaign(campaign, creatives, self.ad_account_id, status=status, media=media)
+            for campaign, creatives in launches
+        ]
+    
+    async def _send_batch(self, items):
+        return await self.client.call(
+            'POST', '', data={'batch': json.dumps(items), 'include_headers': 'false', **self.auth_params()}
+        )
+    
+    async def execute_launch_plans(self, plans):
+        """
+        Create the objects of several launch plans through shared batch requests
+        
+        Operation names carry each plan's prefix, so the plans are sent as
+        one stream of batches and the results split up afterwards. A plan
+        failing does not affect the others.
+        
+        Args:
+            plans: List of LaunchPlan
+        
+        Returns:
+            List of (object_ids, errors) tuples, in the order of ``plans``
+        """
+        operations = [operation for plan in plans for operation in plan.operations]
+        results, errors = await execute_operations(self._send_batch, operations)
+        await self._activate(plans, results, errors)
+        
+        outcomes = []
+        for plan in plans:
+            object_ids = plan.object_ids(results)
+            await sync_to_async(facebook_media.record_video_uploads)(self.ad_account_id, object_ids)
+            plan_errors = {name: message for name, message in errors.items() if name.startswith(plan.prefix)}
+            outcomes.append((object_ids, plan_errors))
+        
+        logger.info(f"Created {len(results)} Facebook objects in batch for {len(plans)} plans")
+        return outcomes
+    
+    async def execute_launch_plan(self, plan):
+        """
+        Create every object of a launch plan using Graph batch requests
+        
+        A campaign with N creatives needs 2N+2 objects; they are sent as
+        ceil((2N+2) / 50) batch requests instead of 2N+2 round trips.
+        
+        Args:
+            plan: LaunchPlan
+        
+        Returns:
+            Dictionary mapping plan keys ('campaign', 'adset',
+            'creative-<id>', 'ad-<id>') to Facebook object IDs
+        
+        Raises:
+            LaunchPlanError: if any operation failed. The IDs of the objects
+                that were created are available on the exception; the
+                campaign was left paused.
+        """
+        results, errors = await execute_operations(self._send_batch, plan.operations)
+        await self._activate([plan], results, errors)
+        
+        object_ids = plan.object_ids(results)
+        await sync_to_async(facebook_media.record_video_uploads)(self.ad_account_id, object_ids)
+        if errors:
+            logger.error(f"Facebook batch launch failed: {errors}")
+            raise LaunchPlanError(errors, object_ids)
+        
+        logger.info(f"Created {len(object_ids)} Facebook objects in batch for plan {plan.prefix}")
+        return object_ids
+    
+    async def _activate(self, plans, results, errors):
+        """Switch on the campaigns of the plans created in full; failures are added to ``errors``"""
+        activations = [
+            plan.activation(results) for plan in plans
+            if plan.activate and not any(name.startswith(plan.prefix) for name in errors)
+        ]
+        if activations:
+            _, failed = await execute_operations(self._send_batch, activations)
+            errors.update(failed)
+
+
+class FacebookService:
+    """
+    Synchronous wrapper around AsyncFacebookService
+    
+    Each call runs the coroutine to completion on the process's long-lived
+    worker loop, whose connections to Facebook are reused from call to call.
+    Must not be called from a coroutine; await AsyncFacebookService there.
+    """
+    def __init__(self, access_token=None, ad_account_id=None):
+        """
+        Initialize the Facebook API with credentials
+        
+        Args:
+            access_token: Optional user-specific access token. If not provided, uses system token
+            ad_account_id: Optional ad account ID. If not provided, uses system account
+        """
+        self.service = AsyncFacebookService(access_token, ad_account_id)
+        self.access_token = self.service.access_token
+        self.ad_account_id = self.service.ad_account_id
+    
+    def _run(self, method, *args, **kwargs):
+        return worker_loop.run(getattr(self.service, method), *args, **kwargs)
+    
+    def create_campaign(self, name, objective, daily_budget, start_time, end_time=None, status='PAUSED'):
+        """Create a Facebook ad campaign; returns its ID (see AsyncFacebookService)"""
+        return self._run('create_campaign', name, objective, daily_budget, start_time, end_time, status)
+    
+    def get_campaign(self, campaign_id):
+        """
+        Get campaign details
+        
+        Args:
+            campaign_id: Facebook campaign ID
+        
+        Returns:
+            Campaign object
+        """
+        campaign = Campaign(campaign_id)
+        campaign._set_data(self._run('get_campaign', campaign_id))
+        return campaign
+    
+    def create_ad_set(self, campaign_id, name, targeting, optimization_goal,
+                     bid_amount, start_time, end_time=None, status='PAUSED'):
+        """Create an ad set within a campaign; returns its ID (see AsyncFacebookService)"""
+        return self._run(
+            'create_ad_set', campaign_id, name, targeting, optimization_goal,
+            bid_amount, start_time, end_time, status
+        )
+    
+    def create_ad_creative(self, name, image_url, page_id, message, headline, description, link_url):
+        """Create an ad creative; returns its ID (see AsyncFacebookService)"""
+        return self._run('create_ad_creative', name, image_url, page_id, message, headline, description, link_url)
+    
+    def create_ad(self, name, ad_set_id, creative_id, status='PAUSED'):
+        """Create an ad; returns its ID (see AsyncFacebookService)"""
+        return self._run('create_ad', name, ad_set_id, creative_id, status)
+    
+    def create_launch_plan(self, campaign, creatives, status='ACTIVE'):
+        """Build the launch plan for a campaign and its creatives (see AsyncFacebookService)"""
+        return self._run('create_launch_plan', campaign, creatives, status)
+    
+    def create_launch_plans(self, launches, status='ACTIVE'):
+        """Build the launch plans of several campaigns (see AsyncFacebookService)"""
+        return self._run('create_launch_plans', launches, status)
+    
+    def execute_launch_plans(self, plans):
+        """Create the objects of several launch plans (see AsyncFacebookService)"""
+        return self._run('execute_launch_plans', plans)
+    
+    def execute_launch_plan(self, plan):
+        """Create every object of a launch plan (see AsyncFacebookService)"""
+        return self._run('execute_launch_plan', plan)
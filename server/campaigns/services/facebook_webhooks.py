@@ -0,0 +1,292 @@
+"""
+Facebook webhook receiver for QuickCampaigns
+
+Facebook notifies the app when ad objects of a subscribed ad account
+change state: leaving review (``in_process_ad_objects``) or running into
+problems (``with_issues_ad_objects``). Status updates then cost one event
+each instead of a poll of every campaign.
+
+The endpoint only checks the X-Hub-Signature-256 HMAC and pushes the raw
+body onto a Redis list, so it answers within milliseconds. The first
+push schedules a drain task WEBHOOK_COALESCE_SECONDS later, and every
+payload arriving in that window is applied in the same batch. The drain
+moves the batch to a processing list and only removes it once the
+updates are committed; a drain that fails or dies leaves it there, and
+the next drain applies it first.
+
+- Redeliveries are dropped by content key, both within the batch and
+  across batches, through short-lived Redis markers set after commit.
+- Several events for one campaign are coalesced to the newest.
+- An event older than the campaign's last known state (status_checked_at)
+  is ignored, so late deliveries never roll a status back.
+- Events about ad sets and ads cannot say what the campaign's status is.
+  They move the owning campaign's next poll to now instead.
+
+Campaign statuses are written with one bulk_update per batch.
+"""
+import hashlib
+import hmac
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_redis import get_redis_connection
+from ..metrics import metrics
+from ..models import Campaign
+from . import live_events, response_cache
+from .status_sync import STATUS_UPDATE_FIELDS, record_status
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'facebook-webhook-events'
+# Payloads of the batch being applied
+PROCESSING_KEY = 'facebook-webhook-processing'
+DRAIN_SCHEDULED_KEY = 'facebook-webhook-drain-scheduled'
+SEEN_KEY_PREFIX = 'facebook-webhook-seen:'
+# Facebook retries failed deliveries for up to a day
+SEEN_TTL = 24 * 60 * 60
+
+SIGNATURE_HEADER = 'HTTP_X_HUB_SIGNATURE_256'
+
+# Webhook field -> effective_status it implies; None reads it from the value
+STATUS_FIELDS = {
+    'in_process_ad_objects': None,
+    'with_issues_ad_objects': 'WITH_ISSUES',
+}
+
+WebhookEvent = namedtuple('WebhookEvent', ['key', 'object_id', 'level', 'effective_status', 'time'])
+
+
+class InvalidSignature(Exception):
+    """Raised when a webhook body does not match its X-Hub-Signature-256"""
+
+
+def sign_payload(body, secret=None):
+    """
+    X-Hub-Signature-256 header value for a body
+
+    Args:
+        body: Raw request body (bytes)
+        secret: App secret, defaults to FACEBOOK_APP_SECRET
+    """
+    secret = secret or settings.FACEBOOK_APP_SECRET
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body, signature):
+    """
+    Raises:
+        InvalidSignature: if the signature is missing or wrong
+    """
+    if not settings.FACEBOOK_APP_SECRET:
+        raise InvalidSignature("FACEBOOK_APP_SECRET is not configured")
+    if not signature or not hmac.compare_digest(sign_payload(body), signature):
+        raise InvalidSignature("Webhook signature does not match")
+
+
+def build_payload(ad_account_id, object_id, field='in_process_ad_objects', status_name='ACTIVE',
+                  level='CAMPAIGN', time=None):
+    """
+    A webhook body as Facebook sends it, for local testing
+
+    Returns:
+        Body bytes
+    """
+    value = {'id': object_id, 'level': level}
+    if field == 'in_process_ad_objects':
+        value['status_name'] = status_name
+    return json.dumps({
+        'object': 'ad_account',
+        'entry': [{
+            'id': ad_account_id.replace('act_', ''),
+            'time': int(time if time is not None else timezone.now().timestamp()),
+            'changes': [{'field': field, 'value': value}],
+        }],
+    }).encode()
+
+
+def enqueue_payload(body):
+    """
+    Queue a verified webhook body and make sure a drain is scheduled
+
+    Called on the request path; one Redis round trip when a drain is
+    already pending.
+    """
+    from ..tasks import apply_facebook_webhook_events
+
+    conn = get_redis_connection('default')
+    with conn.pipeline() as pipe:
+        pipe.rpush(QUEUE_KEY, body)
+        pipe.set(DRAIN_SCHEDULED_KEY, 1, nx=True, ex=SEEN_TTL)
+        _, first = pipe.execute()
+    metrics.incr('webhook.facebook.received')
+    if first:
+        apply_facebook_webhook_events.apply_async(countdown=settings.WEBHOOK_COALESCE_SECONDS)
+
+
+def drain_queue():
+    """
+    Apply up to WEBHOOK_BATCH_SIZE queued payloads
+
+    Reschedules itself while payloads remain, including a batch left in
+    the processing list because applying it failed.
+
+    Returns:
+        Number of campaigns whose status changed
+    """
+    from ..tasks import apply_facebook_webhook_events
+
+    conn = get_redis_connection('default')
+    try:
+        bodies = claim_batch(conn, settings.WEBHOOK_BATCH_SIZE)
+        events = []
+        for body in bodies:
+            try:
+                events.extend(parse_events(json.loads(body)))
+            except (ValueError, AttributeError, TypeError) as e:
+                logger.warning(f"Skipping malformed Facebook webhook payload: {str(e)}")
+        events = unseen_events(conn, events)
+        with transaction.atomic():
+            changed = apply_events(events)
+
+        # Only committed events count as seen, and only then is the batch dropped
+        with conn.pipeline() as pipe:
+            for event in events:
+                pipe.set(f"{SEEN_KEY_PREFIX}{event.key}", 1, ex=SEEN_TTL)
+            pipe.delete(PROCESSING_KEY)
+            pipe.execute()
+    finally:
+        # Payloads pushed while this batch ran found the flag set; pick them up
+        conn.delete(DRAIN_SCHEDULED_KEY)
+        pending = conn.llen(QUEUE_KEY) or conn.llen(PROCESSING_KEY)
+        if pending and conn.set(DRAIN_SCHEDULED_KEY, 1, nx=True, ex=SEEN_TTL):
+            apply_facebook_webhook_events.apply_async(countdown=settings.WEBHOOK_COALESCE_SECONDS)
+    return changed
+
+
+def claim_batch(conn, batch_size):
+    """
+    Payloads to apply: a batch left by a failed drain, or the next queued ones
+
+    Queued payloads are moved to the processing list atomically, so a
+    payload is always in one of the two lists until its batch is applied.
+    """
+    bodies = conn.lrange(PROCESSING_KEY, 0, -1)
+    if bodies:
+        logger.warning(f"Applying {len(bodies)} Facebook webhook payloads left by a failed drain")
+        return bodies
+    with conn.pipeline() as pipe:
+        for _ in range(batch_size):
+            pipe.lmove(QUEUE_KEY, PROCESSING_KEY, 'LEFT', 'RIGHT')
+        return [body for body in pipe.execute() if body is not None]
+
+
+def parse_events(payload):
+    """
+    Events of the ad objects named in a webhook payload
+
+    Returns:
+        List of WebhookEvent
+    """
+    if payload.get('object') != 'ad_account':
+        return []
+    events = []
+    for entry in payload.get('entry', []):
+        timestamp = entry.get('time')
+        event_time = (
+            datetime.fromtimestamp(timestamp, tz=dt_timezone.utc) if timestamp else timezone.now()
+        )
+        for change in entry.get('changes', []):
+            value = change.get('value') or {}
+            object_id = value.get('id')
+            if not object_id:
+                continue
+            field = change.get('field')
+            effective_status = STATUS_FIELDS.get(field) or value.get('status_name')
+            key = hashlib.sha256(
+                json.dumps([entry.get('id'), timestamp, field, value], sort_keys=True).encode()
+            ).hexdigest()
+            events.append(WebhookEvent(
+                key=key,
+                object_id=str(object_id),
+                level=(value.get('level') or 'CAMPAIGN').upper(),
+                effective_status=effective_status.upper() if effective_status else None,
+                time=event_time,
+            ))
+    return events
+
+
+def unseen_events(conn, events):
+    """Drop events already applied by an earlier batch or repeated in this one"""
+    unique = list({event.key: event for event in events}.values())
+    if not unique:
+        return []
+    with conn.pipeline() as pipe:
+        for event in unique:
+            pipe.exists(f"{SEEN_KEY_PREFIX}{event.key}")
+        seen = pipe.execute()
+    fresh = [event for event, applied in zip(unique, seen) if not applied]
+    duplicates = len(events) - len(fresh)
+    if duplicates:
+        metrics.incr('webhook.facebook.duplicates', value=duplicates)
+    return fresh
+
+
+def apply_events(events, now=None):
+    """
+    Write the newest status of each campaign named in the events
+
+    Args:
+        events: Deduplicated WebhookEvent list, in any order
+
+    Returns:
+        Number of campaigns whose status changed
+    """
+    now = now or timezone.now()
+    latest = {}
+    poll_campaigns, poll_ad_sets, poll_ads = set(), set(), set()
+    for event in events:
+        if event.level == 'CAMPAIGN' and event.effective_status:
+            current = latest.get(event.object_id)
+            if current is None or event.time >= current.time:
+                latest[event.object_id] = event
+        elif event.level == 'CAMPAIGN':
+            poll_campaigns.add(event.object_id)
+        elif event.level == 'ADSET':
+            poll_ad_sets.add(event.object_id)
+        else:
+            poll_ads.add(event.object_id)
+
+    updated, changed, stale = [], [], 0
+    for campaign in Campaign.objects.filter(facebook_campaign_id__in=latest):
+        event = latest[campaign.facebook_campaign_id]
+        if campaign.status_checked_at and event.time <= campaign.status_checked_at:
+            stale += 1
+            continue
+        if record_status(campaign, {'effective_status': event.effective_status}, now, checked_at=event.time):
+            changed.append(campaign)
+        updated.append(campaign)
+    if updated:
+        Campaign.objects.bulk_update(updated, STATUS_UPDATE_FIELDS)
+        response_cache.invalidate(*{campaign.user_id for campaign in updated})
+        live_events.campaign_statuses_changed(changed)
+
+    if poll_campaigns or poll_ad_sets or poll_ads:
+        Campaign.objects.filter(
+            Q(facebook_campaign_id__in=poll_campaigns) |
+            Q(facebook_ad_set_id__in=poll_ad_sets) |
+            Q(creatives__facebook_ad_id__in=poll_ads)
+        ).update(next_status_check_at=now)
+
+    metrics.incr('webhook.facebook.events', value=len(events))
+    if stale:
+        metrics.incr('webhook.facebook.stale', value=stale)
+    logger.info(
+        f"Applied {len(events)} Facebook webhook events: {len(changed)} status changes, "
+        f"{stale} stale, {len(poll_campaigns) + len(poll_ad_sets) + len(poll_ads)} objects to poll"
+    )
+    return len(changed)
@@ -0,0 +1,300 @@
+"""
+Shared Graph API HTTP client for QuickCampaigns
+
+Every synchronous call to graph.facebook.com -- the OAuth flow, account
+discovery, status and insights syncs -- goes through one tuned urllib3
+connection pool, with per-call timeouts, retries with jittered
+exponential backoff and latency metrics. Each attempt is first
+admitted by the endpoint's circuit breaker, the rate limit scheduler in
+graph_scheduler and a bulkhead slot (see circuit_breaker). Coroutines use
+AsyncGraphClient (async_graph_client), which applies the same policy.
+"""
+import json
+import logging
+import random
+import re
+import time
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from ..metrics import metrics
+from .circuit_breaker import GraphUnavailable, breaker, bulkhead
+from .graph_scheduler import GraphThrottled, current_priority, fails_fast, scheduler, throttle_wait
+
+logger = logging.getLogger(__name__)
+
+GRAPH_URL = 'https://graph.facebook.com'
+
+# HTTP statuses worth retrying. 5xx are only retried for idempotent methods,
+# since a POST may have been applied before the server failed.
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+THROTTLED_STATUS_CODES = {429}
+
+# Graph error codes for throttling and transient failures. Facebook rejects
+# the call before applying it, so these are safe to retry for any method.
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613, 80000, 80001, 80002, 80003, 80004, 80005, 80006, 80008, 80009, 80014}
+TRANSIENT_ERROR_CODES = {1, 2}
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'DELETE'}
+
+_ID_SEGMENT = re.compile(r'^(act_)?\d+$')
+
+
+class GraphClient:
+    """
+    Pooled, retrying HTTP client for the Graph API
+    """
+
+    def __init__(self, api_version=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff_base=0.5, backoff_max=8.0, pool_maxsize=None):
+        """
+        Args:
+            api_version: Graph API version (e.g. 'v17.0')
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for a response
+            max_retries: Retries after the first attempt
+            backoff_base: Initial backoff in seconds, doubled per attempt
+            backoff_max: Upper bound of a single backoff
+            pool_maxsize: Connections kept alive to graph.facebook.com
+        """
+        self.api_version = api_version or settings.GRAPH_API_VERSION
+        self.timeout = (
+            connect_timeout or settings.GRAPH_API_CONNECT_TIMEOUT,
+            read_timeout or settings.GRAPH_API_READ_TIMEOUT,
+        )
+        self.max_retries = settings.GRAPH_API_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_maxsize or settings.GRAPH_API_POOL_MAXSIZE,
+            max_retries=0,
+        )
+        self.session = self.new_session()
+
+    def new_session(self):
+        """
+        A requests session sharing this client's connection pool
+
+        Sessions keep their own default params and headers while all of
+        them reuse the same keep-alive connections.
+        """
+        session = GraphSession(self)
+        session.mount('https://', self.adapter)
+        return session
+
+    def url(self, path):
+        """Absolute URL for a Graph path such as 'me/adaccounts'"""
+        if path.startswith('http'):
+            return path
+        return f"{GRAPH_URL}/{self.api_version}/{path.lstrip('/')}"
+
+    def request(self, method, path, timeout=None, max_retries=None, **kwargs):
+        """
+        Send a request to the Graph API
+
+        Args:
+            method: HTTP method
+            path: Graph path ('me/adaccounts') or absolute URL (paging links)
+            timeout: Optional (connect, read) timeout overriding the default
+            max_retries: Optional retry count overriding the default
+            **kwargs: Passed to requests (params, data, files, ...)
+
+        Returns:
+            requests.Response of the last attempt
+        """
+        return self.session.request(
+            method, self.url(path), timeout=timeout, max_retries=max_retries, **kwargs
+        )
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def execute(self, send, method, url, max_retries=None, cost=1):
+        """
+        Run ``send`` with rate limiting, retries, backoff and latency metrics
+
+        Args:
+            send: Callable performing one HTTP attempt and returning a response
+            method: HTTP method, used to decide what is safe to retry
+            url: Request URL, used for logging, metric labels and rate limit buckets
+            max_retries: Optional retry count overriding the default
+            cost: Graph calls the request counts as (operations of a batch)
+
+        Returns:
+            requests.Response
+
+        Raises:
+            GraphUnavailable: if the circuit breaker, rate limit scheduler or
+                bulkhead does not admit the first attempt in time, or if
+                Facebook throttled the call inside graph_context(fail_fast=True)
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        endpoint = endpoint_label(url)
+        method = method.upper()
+        attempt = 0
+        response = None
+
+        while True:
+            try:
+                breaker.before_call(endpoint)
+                scheduler.acquire(url, cost)
+                lease = bulkhead.acquire(current_priority())
+            except GraphUnavailable:
+                # A retry that is not admitted in time gets the last answer
+                if response is None:
+                    raise
+                return response
+            start = time.monotonic()
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                record_error(endpoint, e, time.monotonic() - start)
+                # A request that timed out while reading may have been applied
+                unsafe = isinstance(e, requests.ReadTimeout) and method not in IDEMPOTENT_METHODS
+                if attempt >= max_retries or unsafe:
+                    raise
+                self._sleep(attempt, None, endpoint, type(e).__name__)
+                attempt += 1
+                continue
+            finally:
+                bulkhead.release(lease)
+
+            record_response(endpoint, url, response, time.monotonic() - start)
+            reason = retry_reason(method, response)
+            if reason is None or attempt >= max_retries:
+                return response
+            if fails_fast() and is_throttled(response):
+                raise throttled_error(endpoint, response)
+            self._sleep(attempt, response.headers.get('Retry-After'), endpoint, reason)
+            attempt += 1
+
+    def _sleep(self, attempt, retry_after, endpoint, reason):
+        time.sleep(retry_delay(attempt, retry_after, endpoint, reason, self.backoff_base, self.backoff_max))
+
+
+class GraphSession(requests.Session):
+    """requests.Session whose calls go through a GraphClient's retry policy"""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def request(self, method, url, timeout=None, max_retries=None, **kwargs):
+        timeout = timeout or self.client.timeout
+        send = lambda: super(GraphSession, self).request(method, url, timeout=timeout, **kwargs)
+        return self.client.execute(send, method, url, max_retries=max_retries, cost=request_cost(kwargs))
+
+    def close(self):
+        # The connection pool belongs to the client and outlives this session
+        for adapter in self.adapters.values():
+            if adapter is not self.client.adapter:
+                adapter.close()
+
+
+def record_error(endpoint, error, elapsed):
+    """Metrics and breaker outcome of an attempt that got no response"""
+    breaker.record(endpoint, ok=False)
+    metrics.observe('graph.request.latency', elapsed, endpoint=endpoint)
+    metrics.incr('graph.request.errors', endpoint=endpoint, reason=type(error).__name__)
+
+
+def record_response(endpoint, url, response, elapsed):
+    """Metrics, breaker outcome and rate limit usage of an answered attempt"""
+    metrics.observe('graph.request.latency', elapsed, endpoint=endpoint)
+    metrics.incr('graph.request.count', endpoint=endpoint, status=response.status_code)
+    code = graph_error_code(response) if response.status_code >= 400 else None
+    breaker.record(endpoint, ok=response.status_code < 500 and code not in TRANSIENT_ERROR_CODES)
+    scheduler.observe(url, response, throttle_code=code if code in RATE_LIMIT_ERROR_CODES else None)
+
+
+def retry_reason(method, response):
+    """Why a response is worth retrying (a metric label), or None"""
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return 'throttled'
+    if response.status_code < 400:
+        return None
+    code = graph_error_code(response)
+    if code in RATE_LIMIT_ERROR_CODES:
+        return f"rate_limit_{code}"
+    if method in IDEMPOTENT_METHODS:
+        if code in TRANSIENT_ERROR_CODES:
+            return f"transient_{code}"
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            return f"http_{response.status_code}"
+    return None
+
+
+def is_throttled(response):
+    """True if Facebook refused a call for exceeding a rate limit"""
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return True
+    return response.status_code >= 400 and graph_error_code(response) in RATE_LIMIT_ERROR_CODES
+
+
+def throttled_error(endpoint, response):
+    """GraphThrottled for a throttled call that is not retried inline"""
+    metrics.incr('graph.request.throttled', endpoint=endpoint)
+    logger.warning(f"Graph call to {endpoint} throttled, not retrying inline")
+    return GraphThrottled(f"Facebook is throttling calls to {endpoint}", retry_after=throttle_wait(response))
+
+
+def retry_delay(attempt, retry_after, endpoint, reason, base, maximum):
+    """Count and log a retry of a call; returns the seconds to back off first"""
+    delay = backoff_delay(attempt, base, maximum, retry_after)
+    metrics.incr('graph.request.retries', endpoint=endpoint, reason=reason)
+    logger.warning(f"Retrying Graph call to {endpoint} in {delay:.2f}s ({reason})")
+    return delay
+
+
+def backoff_delay(attempt, base, maximum, retry_after=None):
+    """
+    Full-jitter exponential backoff, honouring Retry-After when present
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), maximum)
+        except ValueError:
+            pass
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+def request_cost(kwargs):
+    """Graph calls a request counts as: one, or one per operation of a batch"""
+    for source in (kwargs.get('data'), kwargs.get('params')):
+        if isinstance(source, dict) and source.get('batch'):
+            batch = source['batch']
+            try:
+                return max(1, len(json.loads(batch) if isinstance(batch, str) else batch))
+            except (TypeError, ValueError):
+                return 1
+    return 1
+
+
+def graph_error_code(response):
+    """The Graph ``error.code`` of a failed response, if any"""
+    try:
+        return response.json().get('error', {}).get('code')
+    except (ValueError, AttributeError):
+        return None
+
+
+def endpoint_label(url):
+    """
+    Low-cardinality metric label for a Graph URL
+
+    'https://graph.facebook.com/v17.0/act_123/campaigns?x=1' -> '{id}/campaigns'
+    """
+    path = url.split('?', 1)[0]
+    if path.startswith(GRAPH_URL):
+        path = path[len(GRAPH_URL):]
+    segments = [segment for segment in path.split('/') if segment]
+    if segments and re.match(r'^v\d+\.\d+$', segments[0]):
+        segments = segments[1:]
+    return '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment for segment in segments) or '/'
+
+
+graph_client = GraphClient()
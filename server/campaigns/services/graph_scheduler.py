@@ -0,0 +1,341 @@
+"""
+Rate-limit aware scheduling of Graph API calls for QuickCampaigns
+
+Facebook throttles each app and each ad account separately. It reports
+how close a caller is to those limits in the X-App-Usage,
+X-Ad-Account-Usage and X-Business-Use-Case-Usage headers, and locks the
+caller out for a while once a limit trips (error codes 4, 17, 613,
+800xx). GraphClient asks this scheduler before every attempt and reports
+every response back to it.
+
+State is shared by every web and worker process through Redis: one
+token bucket per app and one per ad account, each a hash updated by a
+Lua script so that checking and taking tokens is atomic. A call takes a
+token from every bucket it belongs to, or waits until all can give one.
+
+- Usage headers scale a bucket's refill rate. Below 50% usage it is full
+  speed, then it slows linearly down to MIN_RATE_FACTOR at 100%.
+- A throttling error blocks the bucket for Retry-After, or Facebook's
+  estimated time to regain access, or an exponential penalty per
+  consecutive strike, whichever is longest.
+- Priorities decide who may use the last tokens. Interactive calls
+  (launches, OAuth) may drain a bucket. Background calls (syncs,
+  discovery) leave BACKGROUND_RESERVE of it untouched and stop once
+  reported usage passes their USAGE_LIMITS entry.
+- A call that would wait longer than its priority allows raises
+  GraphThrottled instead of holding a worker. Inside
+  graph_context(fail_fast=True), so does a call Facebook throttled: a
+  web request answers 503 with Retry-After instead of retrying inline.
+
+If Redis is unreachable the scheduler lets calls through rather than
+stopping all Graph traffic.
+"""
+import contextvars
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from ..metrics import metrics
+from .circuit_breaker import GraphUnavailable, run_waits, run_waits_async
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Share of a bucket background calls leave for interactive ones
+BACKGROUND_RESERVE = 0.3
+# Reported usage (percent) at which calls of each priority hold off
+USAGE_LIMITS = {INTERACTIVE: 95, BACKGROUND: 75}
+# Seconds a usage report is trusted; afterwards a call may probe again
+USAGE_TTL = 60
+# Refill rate is full below this usage and slows down linearly above it
+FULL_RATE_USAGE = 50
+MIN_RATE_FACTOR = 0.05
+
+# Lockout after the first throttling error, doubled per consecutive one
+BLOCK_BASE = 60
+BLOCK_MAX = 60 * 60
+
+# Graph error codes of an app-wide throttle; the other rate limit codes
+# (17, 32, 613, 800xx) apply to the user or ad account of the call
+APP_THROTTLE_CODES = {4}
+
+KEY_PREFIX = 'graph-bucket:'
+KEY_TTL = 2 * 60 * 60
+
+_ACCOUNT_IN_URL = re.compile(r'/act_(\d+)')
+
+_context = contextvars.ContextVar('graph_context', default={})
+
+# KEYS: bucket hashes. ARGV: now, cost, reserve, usage limit, usage ttl,
+# key ttl, then rate and capacity of each bucket. Returns the seconds to
+# wait as a string (Lua numbers are truncated to integers otherwise),
+# '0' once the tokens were taken.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local usage_limit = tonumber(ARGV[4])
+local usage_ttl = tonumber(ARGV[5])
+local key_ttl = tonumber(ARGV[6])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[5 + 2 * i])
+    local capacity = tonumber(ARGV[6 + 2 * i])
+    -- A call costing more than a full bucket waits for a full bucket
+    local take = math.min(cost, capacity)
+    local h = redis.call('HMGET', key, 'tokens', 'ts', 'factor', 'usage', 'usage_at', 'blocked_until')
+    rate = rate * (tonumber(h[3]) or 1)
+    local tokens = tonumber(h[1]) or capacity
+    local ts = tonumber(h[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+
+    local blocked_until = tonumber(h[6]) or 0
+    if blocked_until > now then
+        wait = math.max(wait, blocked_until - now)
+    end
+    local usage_at = tonumber(h[5]) or 0
+    if (tonumber(h[4]) or 0) >= usage_limit and now - usage_at < usage_ttl then
+        wait = math.max(wait, usage_at + usage_ttl - now)
+    end
+    local floor = math.min(capacity * reserve, capacity - take)
+    if tokens - take < floor then
+        wait = math.max(wait, (floor + take - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', levels[i] - math.min(cost, tonumber(ARGV[6 + 2 * i])), 'ts', now)
+    redis.call('EXPIRE', key, key_ttl)
+end
+return '0'
+"""
+
+
+class GraphThrottled(GraphUnavailable):
+    """Raised when a Graph call would wait longer than its priority allows"""
+
+
+@contextmanager
+def graph_context(priority=None, ad_account_id=None, fail_fast=None):
+    """
+    Tag the Graph calls made inside the block
+
+    Args:
+        priority: INTERACTIVE (default) or BACKGROUND
+        ad_account_id: Ad account the calls are for, for calls whose URL
+            does not name it (?ids= reads, report runs, batches)
+        fail_fast: Raise GraphThrottled as soon as Facebook throttles a
+            call instead of retrying it; for calls a web request waits on
+    """
+    current = dict(_context.get())
+    if priority:
+        current['priority'] = priority
+    if ad_account_id:
+        current['ad_account_id'] = str(ad_account_id).replace('act_', '')
+    if fail_fast is not None:
+        current['fail_fast'] = fail_fast
+    token = _context.set(current)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def graph_tags():
+    """The tags of the enclosing graph_context, to apply them again with graph_context(**tags)"""
+    return dict(_context.get())
+
+
+def current_priority():
+    return _context.get().get('priority', INTERACTIVE)
+
+
+def fails_fast():
+    """True inside graph_context(fail_fast=True)"""
+    return _context.get().get('fail_fast', False)
+
+
+class GraphScheduler:
+    """Token buckets per app and per ad account, shared through Redis"""
+
+    def __init__(self):
+        self._take = None
+
+    def buckets(self, url):
+        """(kind, Redis key) of every bucket a call to ``url`` draws from"""
+        buckets = [('app', f"{KEY_PREFIX}app:{settings.FACEBOOK_APP_ID or 'default'}")]
+        account = _context.get().get('ad_account_id')
+        if not account:
+            match = _ACCOUNT_IN_URL.search(url.split('?', 1)[0])
+            account = match.group(1) if match else None
+        if account:
+            buckets.append(('account', f"{KEY_PREFIX}account:{account}"))
+        return buckets
+
+    def limits(self, kind):
+        if kind == 'app':
+            return settings.GRAPH_APP_RATE, settings.GRAPH_APP_BURST
+        return settings.GRAPH_ACCOUNT_RATE, settings.GRAPH_ACCOUNT_BURST
+
+    def acquire(self, url, cost=1):
+        """
+        Wait until every bucket of the call has ``cost`` tokens, and take them
+
+        Raises:
+            GraphThrottled: if that would take longer than the priority's maximum wait
+        """
+        run_waits(self.waits(url, cost))
+
+    async def acquire_async(self, url, cost=1):
+        """acquire() for coroutines: waits without blocking the event loop"""
+        await run_waits_async(self.waits(url, cost))
+
+    def waits(self, url, cost=1):
+        """Generator taking the tokens: yields the seconds to wait before the next attempt"""
+        if not settings.GRAPH_RATE_LIMITING:
+            return
+        priority = current_priority()
+        max_wait = settings.GRAPH_BACKGROUND_MAX_WAIT if priority == BACKGROUND else settings.GRAPH_INTERACTIVE_MAX_WAIT
+        buckets = self.buckets(url)
+        waited = 0.0
+        while True:
+            wait = self._try_take(buckets, priority, cost)
+            if wait <= 0:
+                if waited:
+                    metrics.observe('graph.scheduler.wait', waited, priority=priority)
+                return
+            if waited + wait > max_wait:
+                metrics.incr('graph.scheduler.throttled', priority=priority)
+                raise GraphThrottled(
+                    f"Graph API rate limit: {priority} call would wait {waited + wait:.0f}s", retry_after=wait
+                )
+            yield wait
+            waited += wait
+
+    def _try_take(self, buckets, priority, cost):
+        reserve = BACKGROUND_RESERVE if priority == BACKGROUND else 0
+        args = [time.time(), cost, reserve, USAGE_LIMITS[priority], USAGE_TTL, KEY_TTL]
+        for kind, _ in buckets:
+            args.extend(self.limits(kind))
+        try:
+            if self._take is None:
+                self._take = get_redis_connection('default').register_script(TAKE_SCRIPT)
+            return float(self._take(keys=[key for _, key in buckets], args=args))
+        except RedisError as e:
+            logger.warning(f"Graph scheduler unavailable, not rate limiting: {str(e)}")
+            return 0
+
+    def observe(self, url, response, throttle_code=None):
+        """
+        Update the buckets of a call from its response
+
+        Args:
+            url: Request URL
+            response: requests.Response
+            throttle_code: Graph rate limit error code, if the call was throttled
+        """
+        if not settings.GRAPH_RATE_LIMITING:
+            return
+        now = time.time()
+        buckets = dict(self.buckets(url))
+        app_usage = header_usage(response.headers.get('x-app-usage'))
+        account_usage, regain_seconds = account_header_usage(response.headers)
+
+        try:
+            conn = get_redis_connection('default')
+            with conn.pipeline() as pipe:
+                for kind, usage in (('app', app_usage), ('account', account_usage)):
+                    key = buckets.get(kind)
+                    if key is None or usage is None:
+                        continue
+                    pipe.hset(key, mapping={'usage': usage, 'usage_at': now, 'factor': rate_factor(usage)})
+                    pipe.expire(key, KEY_TTL)
+
+                if throttle_code is not None:
+                    kind = 'app' if throttle_code in APP_THROTTLE_CODES or 'account' not in buckets else 'account'
+                    strikes = conn.hincrby(buckets[kind], 'strikes', 1)
+                    block = min(BLOCK_MAX, max(
+                        retry_after_seconds(response),
+                        regain_seconds,
+                        BLOCK_BASE * 2 ** (strikes - 1),
+                    ))
+                    pipe.hset(buckets[kind], 'blocked_until', now + block)
+                    pipe.expire(buckets[kind], KEY_TTL)
+                    metrics.incr('graph.scheduler.blocked', scope=kind, code=throttle_code)
+                    logger.warning(f"Graph API throttled ({throttle_code}), pausing {kind} calls for {block:.0f}s")
+                elif response.status_code < 400:
+                    for key in buckets.values():
+                        pipe.hset(key, 'strikes', 0)
+                pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Graph scheduler unavailable, usage not recorded: {str(e)}")
+
+
+def rate_factor(usage):
+    """Share of the full refill rate at a reported usage percentage"""
+    if usage <= FULL_RATE_USAGE:
+        return 1.0
+    return max(MIN_RATE_FACTOR, (100 - usage) / (100 - FULL_RATE_USAGE))
+
+
+def header_usage(value):
+    """Highest percentage in an X-App-Usage style header, or None"""
+    if not value:
+        return None
+    try:
+        usage = json.loads(value)
+    except ValueError:
+        return None
+    numbers = [number for number in usage.values() if isinstance(number, (int, float))]
+    return max(numbers) if numbers else None
+
+
+def account_header_usage(headers):
+    """
+    Ad account usage from X-Ad-Account-Usage and X-Business-Use-Case-Usage
+
+    Returns:
+        Tuple of (highest usage percentage or None, seconds until access is regained)
+    """
+    usage, regain_seconds = None, 0
+    try:
+        account = json.loads(headers.get('x-ad-account-usage') or '{}')
+        business = json.loads(headers.get('x-business-use-case-usage') or '{}')
+    except ValueError:
+        return None, 0
+
+    if 'acc_id_util_pct' in account:
+        usage = account['acc_id_util_pct']
+    for entries in business.values():
+        for entry in entries if isinstance(entries, list) else []:
+            for field in ('call_count', 'total_cputime', 'total_time'):
+                if isinstance(entry.get(field), (int, float)):
+                    usage = max(usage or 0, entry[field])
+            regain_seconds = max(regain_seconds, (entry.get('estimated_time_to_regain_access') or 0) * 60)
+    return usage, regain_seconds
+
+
+def retry_after_seconds(response):
+    try:
+        return float(response.headers.get('Retry-After') or 0)
+    except ValueError:
+        return 0
+
+
+def throttle_wait(response):
+    """Seconds before a throttled caller should try again"""
+    _, regain_seconds = account_header_usage(response.headers)
+    return min(BLOCK_MAX, max(retry_after_seconds(response), regain_seconds) or BLOCK_BASE)
+
+
+scheduler = GraphScheduler()
@@ -0,0 +1,333 @@
+"""
+Campaign insights sync for QuickCampaigns
+
+Delivery metrics of launched campaigns are pulled from the ad account's
+``/insights`` edge at ``level=campaign`` with one row per campaign per
+day. Each Graph call covers up to INSIGHTS_CAMPAIGNS_PER_CALL campaigns
+through a ``campaign.id IN [...]`` filter rather than one call per
+campaign. Long date ranges are requested as asynchronous report runs,
+which Facebook builds in the background instead of timing out.
+
+Every ad account keeps an InsightSyncCheckpoint with the last synced day.
+The next run only asks for the days after it, plus a short lookback
+because Facebook restates recent days as late conversions are attributed.
+For the same reason campaigns that were paused or completed since the
+start of that lookback are still synced along with the active ones.
+Rows are upserted in bulk one page at a time, so re-running a window is
+harmless and memory stays flat. Each stored page also refreshes the
+account's metric rollups for the days it touched.
+
+Accounts are synced by separate tasks on the ``insights`` queue. Within
+an account the calls are sequential and back off when the insights
+throttle header reports high usage.
+"""
+import json
+import logging
+import time
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from ..models import Campaign, CampaignDailyInsight, FacebookAdAccount, InsightSyncCheckpoint
+from . import metric_rollups
+from .bulk import bulk_upsert
+from .graph_client import graph_client
+from .graph_scheduler import BACKGROUND, graph_context
+
+logger = logging.getLogger(__name__)
+
+INSIGHT_FIELDS = 'campaign_id,impressions,reach,clicks,inline_link_clicks,spend,actions'
+# Action types counted as conversions for the objectives QuickCampaigns launches
+CONVERSION_ACTION_TYPES = {'purchase', 'lead', 'complete_registration'}
+PAGE_LIMIT = 500
+
+# Facebook keeps 37 months of insights
+MAX_HISTORY_DAYS = 37 * 30
+
+# Async report runs
+ASYNC_POLL_INTERVAL = 5
+ASYNC_TIMEOUT = 15 * 60
+ASYNC_DONE = 'Job Completed'
+ASYNC_FAILED = {'Job Failed', 'Job Skipped'}
+
+# x-fb-ads-insights-throttle utilisation (percent) at which calls slow down
+THROTTLE_PCT = 75
+THROTTLE_PAUSE = 30
+
+LOCK_TIMEOUT = 60 * 60
+
+# Campaign.status of launched campaigns that stopped delivering
+STOPPED_STATUSES = ['paused', 'completed']
+
+
+class InsightSyncError(Exception):
+    """Raised when Facebook refuses an insights request or a report run fails"""
+
+
+def synced_campaigns(stopped_since):
+    """
+    Filter for the launched campaigns whose insights are synced
+
+    Args:
+        stopped_since: Date from which paused and completed campaigns are
+            still synced. Their updated_at is when the stop was recorded.
+    """
+    return Q(facebook_campaign_id__isnull=False) & (
+        Q(status='active') | Q(status__in=STOPPED_STATUSES, updated_at__date__gte=stopped_since)
+    )
+
+
+def schedule_account_syncs(today=None):
+    """
+    Queue a sync for every active ad account with running or recently stopped campaigns
+
+    Args:
+        today: Current date, defaults to today
+
+    Returns:
+        Number of accounts queued
+    """
+    from ..tasks import sync_account_insights
+
+    stopped_since = (today or timezone.localdate()) - timedelta(days=settings.INSIGHTS_LOOKBACK_DAYS)
+    account_ids = list(
+        Campaign.objects.filter(synced_campaigns(stopped_since), facebook_account__is_active=True)
+        .values_list('facebook_account_id', flat=True).distinct()
+    )
+    for account_id in account_ids:
+        sync_account_insights.delay(account_id)
+    logger.info(f"Queued insights sync for {len(account_ids)} ad accounts")
+    return len(account_ids)
+
+
+def sync_account(account_pk, today=None):
+    """
+    Sync the daily insights of one ad account's active and recently stopped campaigns
+
+    The checkpoint only moves once every batch of campaigns succeeded, so
+    a failed run is simply repeated by the next one.
+
+    Args:
+        account_pk: FacebookAdAccount primary key
+        today: Last day to sync, defaults to today
+
+    Returns:
+        Number of daily rows stored, or None if the account was skipped
+    """
+    lock_key = f"insights-sync-lock:{account_pk}"
+    if not cache.add(lock_key, 'locked', LOCK_TIMEOUT):
+        logger.info(f"Insights sync of ad account {account_pk} already running, skipping")
+        return None
+    try:
+        account = FacebookAdAccount.objects.filter(pk=account_pk, is_active=True).first()
+        if account is None:
+            return None
+        with graph_context(priority=BACKGROUND, ad_account_id=account.account_id):
+            return _sync_account(account, today or timezone.localdate())
+    finally:
+        cache.delete(lock_key)
+
+
+def _sync_account(account, today):
+    checkpoint, _ = InsightSyncCheckpoint.objects.get_or_create(facebook_account=account)
+    # Campaigns stopped within the lookback may still have days restated
+    stopped_since = (checkpoint.last_synced_date or today) - timedelta(days=settings.INSIGHTS_LOOKBACK_DAYS)
+    campaigns = list(
+        Campaign.objects.filter(synced_campaigns(stopped_since), facebook_account=account)
+        .only('id', 'facebook_campaign_id', 'start_date')
+    )
+    if not campaigns:
+        return 0
+
+    since, until = sync_window(checkpoint.last_synced_date, campaigns, today)
+    campaign_ids = {campaign.facebook_campaign_id: campaign.id for campaign in campaigns}
+    ad_account_id = account.account_id.replace('act_', '')
+    batch_size = settings.INSIGHTS_CAMPAIGNS_PER_CALL
+    use_async = (until - since).days + 1 > settings.INSIGHTS_ASYNC_RANGE_DAYS
+
+    stored = 0
+    try:
+        fb_ids = list(campaign_ids)
+        for start in range(0, len(fb_ids), batch_size):
+            params = insight_params(account.access_token, fb_ids[start:start + batch_size], since, until)
+            pages = fetch_async(ad_account_id, params) if use_async else fetch_pages(ad_account_id, params)
+            for rows in pages:
+                insights = store_rows(rows, campaign_ids)
+                metric_rollups.refresh_rollups(account.account_id, {insight.date for insight in insights})
+                stored += len(insights)
+    except Exception as e:
+        logger.error(f"Error syncing insights of ad account {account.account_id}: {str(e)}")
+        checkpoint.last_error = str(e)
+        checkpoint.last_run_at = timezone.now()
+        checkpoint.save(update_fields=['last_error', 'last_run_at', 'updated_at'])
+        raise
+
+    checkpoint.last_synced_date = until
+    checkpoint.last_run_at = timezone.now()
+    checkpoint.rows_synced = stored
+    checkpoint.last_error = None
+    checkpoint.save()
+    logger.info(
+        f"Synced {stored} daily insight rows for {len(campaigns)} campaigns of ad account "
+        f"{account.account_id} ({since} to {until}{', async' if use_async else ''})"
+    )
+    return stored
+
+
+def sync_window(last_synced_date, campaigns, today):
+    """
+    Days to request for an account
+
+    Args:
+        last_synced_date: Checkpoint of the account, or None on the first run
+        campaigns: Campaigns being synced
+        today: Last day to sync
+
+    Returns:
+        Tuple of (since, until) dates, both inclusive
+    """
+    if last_synced_date:
+        since = last_synced_date - timedelta(days=settings.INSIGHTS_LOOKBACK_DAYS)
+    else:
+        since = min(campaign.start_date for campaign in campaigns)
+    since = max(since, today - timedelta(days=MAX_HISTORY_DAYS))
+    return min(since, today), today
+
+
+def insight_params(access_token, campaign_ids, since, until):
+    return {
+        'access_token': access_token,
+        'level': 'campaign',
+        'fields': INSIGHT_FIELDS,
+        'time_increment': 1,
+        'time_range': json.dumps({'since': since.isoformat(), 'until': until.isoformat()}),
+        'filtering': json.dumps([{'field': 'campaign.id', 'operator': 'IN', 'value': campaign_ids}]),
+        'limit': PAGE_LIMIT,
+    }
+
+
+def fetch_pages(ad_account_id, params):
+    """
+    Read insights synchronously, following the paging links
+
+    Yields:
+        Lists of insight rows, one list per page
+    """
+    response = graph_client.get(f"act_{ad_account_id}/insights", params=params)
+    yield from _follow_pages(response)
+
+
+def fetch_async(ad_account_id, params):
+    """
+    Request insights as an async report run, wait for it and read its pages
+
+    Yields:
+        Lists of insight rows, one list per page
+    """
+    response = graph_client.post(f"act_{ad_account_id}/insights", data=params)
+    report_run_id = _json(response).get('report_run_id')
+    if not report_run_id:
+        raise InsightSyncError(f"No report run returned: {response.text}")
+
+    deadline = time.monotonic() + ASYNC_TIMEOUT
+    while True:
+        status = _json(graph_client.get(
+            report_run_id,
+            params={'access_token': params['access_token'], 'fields': 'async_status,async_percent_completion'},
+        ))
+        if status.get('async_status') == ASYNC_DONE:
+            break
+        if status.get('async_status') in ASYNC_FAILED:
+            raise InsightSyncError(f"Report run {report_run_id} ended with {status.get('async_status')}")
+        if time.monotonic() > deadline:
+            raise InsightSyncError(f"Report run {report_run_id} did not finish in {ASYNC_TIMEOUT} seconds")
+        time.sleep(ASYNC_POLL_INTERVAL)
+
+    response = graph_client.get(
+        f"{report_run_id}/insights",
+        params={'access_token': params['access_token'], 'limit': PAGE_LIMIT},
+    )
+    yield from _follow_pages(response)
+
+
+def _follow_pages(response):
+    while True:
+        payload = _json(response)
+        yield payload.get('data', [])
+        _respect_throttle(response)
+        next_url = payload.get('paging', {}).get('next')
+        if not next_url:
+            return
+        response = graph_client.get(next_url)
+
+
+def _json(response):
+    if response.status_code != 200:
+        raise InsightSyncError(f"Error fetching insights: {response.text}")
+    return response.json()
+
+
+def _respect_throttle(response):
+    """Pause while the app or the ad account is close to its insights limit"""
+    try:
+        throttle = json.loads(response.headers.get('x-fb-ads-insights-throttle') or '{}')
+    except ValueError:
+        return
+    usage = max(throttle.get('app_id_util_pct', 0), throttle.get('acc_id_util_pct', 0))
+    if usage >= THROTTLE_PCT:
+        logger.warning(f"Insights throttle at {usage}%, pausing {THROTTLE_PAUSE}s")
+        time.sleep(THROTTLE_PAUSE)
+
+
+def store_rows(rows, campaign_ids):
+    """
+    Upsert a page of insight rows
+
+    Args:
+        rows: Insight dictionaries from the Graph API
+        campaign_ids: Facebook campaign ID to Campaign primary key
+
+    Returns:
+        List of stored CampaignDailyInsight rows
+    """
+    now = timezone.now()
+    insights = []
+    for row in rows:
+        campaign_id = campaign_ids.get(row.get('campaign_id'))
+        if campaign_id is None:
+            continue
+        insights.append(CampaignDailyInsight(
+            campaign_id=campaign_id,
+            date=date.fromisoformat(row['date_start']),
+            impressions=int(row.get('impressions', 0)),
+            reach=int(row.get('reach', 0)),
+            clicks=int(row.get('clicks', 0)),
+            link_clicks=int(row.get('inline_link_clicks', 0)),
+            conversions=count_conversions(row.get('actions')),
+            spend=_decimal(row.get('spend')),
+            updated_at=now,
+        ))
+    bulk_upsert(
+        CampaignDailyInsight,
+        insights,
+        key_fields=['campaign', 'date'],
+        update_fields=['impressions', 'reach', 'clicks', 'link_clicks', 'conversions', 'spend', 'updated_at'],
+    )
+    return insights
+
+
+def count_conversions(actions):
+    return sum(
+        int(float(action.get('value', 0)))
+        for action in actions or []
+        if action.get('action_type') in CONVERSION_ACTION_TYPES
+    )
+
+
+def _decimal(value):
+    try:
+        return Decimal(value or 0)
+    except InvalidOperation:
+        return Decimal(0)
@@ -0,0 +1,419 @@
+"""
+Launch plans for QuickCampaigns
+
+A launch plan is the full Facebook object tree for one Campaign:
+
+    campaign -> ad set -> (creative -> ad) for every CampaignCreative
+
+Instead of one HTTPS round trip per object, the plan is sent through the
+Graph API batch endpoint. Objects that depend on each other are wired with
+``{result=<name>:$.id}`` references so Facebook resolves the IDs server-side.
+
+A campaign launched ACTIVE is created paused and only switched on by a
+last request once its whole tree exists, so a launch that fails halfway
+leaves nothing delivering on Facebook.
+"""
+import json
+import logging
+from urllib.parse import urlencode
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Graph API accepts at most 50 operations per batch request
+MAX_BATCH_SIZE = 50
+# Error of an operation whose batch request failed as a whole: it may have been applied
+NOT_CONFIRMED = "Not confirmed"
+
+FB_OBJECTIVE_MAP = {
+    'website': 'CONVERSIONS',
+    'lead': 'LEAD_GENERATION',
+    'traffic': 'TRAFFIC',
+}
+
+FB_OPTIMIZATION_GOAL_MAP = {
+    'website': 'OFFSITE_CONVERSIONS',
+    'lead': 'LEAD_GENERATION',
+    'traffic': 'LINK_CLICKS',
+}
+
+DEFAULT_TARGETING = {'geo_locations': {'countries': ['US']}}
+
+
+class LaunchPlanError(Exception):
+    """Raised when one or more operations of a launch plan failed"""
+
+    def __init__(self, errors, object_ids=None):
+        self.errors = errors
+        self.object_ids = object_ids or {}
+        super().__init__('; '.join(f"{name}: {message}" for name, message in errors.items()))
+
+    @property
+    def may_be_live(self):
+        """True if the request switching the campaign on got no answer, so it may have been applied"""
+        return any(
+            name.endswith('activate') and message.startswith(NOT_CONFIRMED)
+            for name, message in self.errors.items()
+        )
+
+
+class ResultRef:
+    """Placeholder for the ID returned by another operation of the plan"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"ResultRef({self.name!r})"
+
+
+class BatchOperation:
+    """A single request inside a Graph API batch"""
+
+    def __init__(self, name, method, relative_url, params=None):
+        self.name = name
+        self.method = method
+        self.relative_url = relative_url
+        self.params = params or {}
+
+    def dependencies(self):
+        """Names of the operations this one references"""
+        names = set()
+        _collect_refs(self.params, names)
+        return names
+
+    def to_batch_item(self, resolved_ids):
+        """
+        Serialize the operation for the ``batch`` parameter
+
+        Args:
+            resolved_ids: IDs of operations executed in earlier batches. Any
+                reference not found here is left as a ``{result=...}``
+                expression for Facebook to resolve within the same batch.
+        """
+        body = encode_params(_resolve_refs(self.params, resolved_ids))
+        return {
+            'method': self.method,
+            'relative_url': self.relative_url,
+            'name': self.name,
+            'omit_response_on_success': False,
+            'body': urlencode(body),
+        }
+
+
+class LaunchPlan:
+    """
+    Ordered Graph operations that create a campaign's object tree
+
+    Operation names are prefixed with the campaign ID so several plans can
+    share one batch request.
+    """
+
+    def __init__(self, ad_account_id, prefix=''):
+        self.ad_account_id = ad_account_id
+        self.prefix = prefix
+        self.operations = []
+        self.refs = {}
+        # Whether the campaign is switched on once every operation succeeded
+        self.activate = False
+
+    def add(self, key, edge, params):
+        """
+        Append a POST to one of the ad account's edges
+
+        Args:
+            key: Name of the operation, unique within the plan
+            edge: Ad account edge (e.g. 'campaigns', 'adsets')
+            params: Request parameters; may contain ResultRef values
+
+        Returns:
+            ResultRef pointing to the created object's ID
+        """
+        name = f"{self.prefix}{key}"
+        self.operations.append(
+            BatchOperation(name, 'POST', f"act_{self.ad_account_id}/{edge}", params)
+        )
+        self.refs[key] = ResultRef(name)
+        return self.refs[key]
+
+    def object_ids(self, results):
+        """Map plan keys (without prefix) to the IDs Facebook returned"""
+        return {
+            operation.name[len(self.prefix):]: results[operation.name]
+            for operation in self.operations
+            if operation.name in results
+        }
+
+    def activation(self, results):
+        """
+        Operation switching on the paused campaign created by the plan
+
+        Args:
+            results: Operation names to created object IDs, as returned by
+                execute_operations for the plan's operations
+        """
+        campaign_id = results[self.refs['campaign'].name]
+        return BatchOperation(f"{self.prefix}activate", 'POST', campaign_id, {'status': 'ACTIVE'})
+
+    @classmethod
+    def for_campaign(cls, campaign, creatives, ad_account_id, page_id=None,
+                     link_url=None, status='ACTIVE', media=None):
+        """
+        Build the plan for a Campaign and its CampaignCreative rows
+
+        Args:
+            campaign: Campaign model instance
+            creatives: Iterable of CampaignCreative instances
+            ad_account_id: Facebook ad account ID without the 'act_' prefix
+            page_id: Facebook page the ads are published as
+            link_url: Destination URL of the ads
+            status: Status of the created objects (ACTIVE, PAUSED). An
+                ACTIVE campaign is created paused; send its activation()
+                once every operation succeeded
+            media: Blob ID to image hash / video ID already in the ad
+                account; those files are not uploaded again
+
+        Returns:
+            LaunchPlan
+        """
+        media = media or {}
+        page_id = page_id or settings.FACEBOOK_PAGE_ID
+        link_url = link_url or settings.FACEBOOK_LINK_URL
+        plan = cls(ad_account_id, prefix=f"c{campaign.id}-")
+        plan.activate = status == 'ACTIVE'
+
+        start_time = campaign.start_date.isoformat()
+        end_time = campaign.end_date.isoformat() if campaign.end_date else None
+
+        campaign_params = {
+            'name': campaign.name,
+            'objective': FB_OBJECTIVE_MAP.get(campaign.objective, 'CONVERSIONS'),
+            # Nothing delivers before the whole tree exists
+            'status': 'PAUSED',
+            'special_ad_categories': [],
+            'daily_budget': int(float(campaign.budget) * 100),  # Convert to cents
+            'start_time': start_time,
+        }
+        if end_time:
+            campaign_params['end_time'] = end_time
+        campaign_ref = plan.add('campaign', 'campaigns', campaign_params)
+
+        ad_set_params = {
+            'name': f"{campaign.name} - Ad Set",
+            'campaign_id': campaign_ref,
+            'optimization_goal': FB_OPTIMIZATION_GOAL_MAP.get(campaign.objective, 'LINK_CLICKS'),
+            'billing_event': 'IMPRESSIONS',
+            'targeting': parse_targeting(campaign.target_audience),
+            'status': status,
+            'start_time': start_time,
+        }
+        if end_time:
+            ad_set_params['end_time'] = end_time
+        ad_set_ref = plan.add('adset', 'adsets', ad_set_params)
+
+        for creative in creatives:
+            creative_ref = plan.add(
+                f"creative-{creative.id}",
+                'adcreatives',
+                {
+                    'name': creative.file_name,
+                    'object_story_spec': _object_story_spec(
+                        plan, creative, campaign, page_id, link_url, media
+                    ),
+                }
+            )
+            plan.add(
+                f"ad-{creative.id}",
+                'ads',
+                {
+                    'name': f"{campaign.name} - {creative.file_name}",
+                    'adset_id': ad_set_ref,
+                    'creative': {'creative_id': creative_ref},
+                    'status': status,
+                }
+            )
+
+        return plan
+
+
+def parse_targeting(target_audience):
+    """
+    Decode Campaign.target_audience into a Graph targeting spec
+
+    The field is free text; JSON objects are passed through as-is and
+    anything else falls back to the default targeting.
+    """
+    if target_audience:
+        try:
+            targeting = json.loads(target_audience)
+        except ValueError:
+            targeting = None
+        if isinstance(targeting, dict):
+            return targeting
+    return dict(DEFAULT_TARGETING)
+
+
+def creative_url(creative):
+    """Absolute URL Facebook can fetch the creative file from"""
+    return stored_file_url(creative.file)
+
+
+def stored_file_url(file):
+    """Absolute URL of a stored file (FieldFile)"""
+    url = file.url
+    if url.startswith('/'):
+        url = f"{settings.BACKEND_URL.rstrip('/')}{url}"
+    return url
+
+
+def _object_story_spec(plan, creative, campaign, page_id, link_url, media):
+    if creative.file_type.startswith('video'):
+        video_data = {
+            'video_id': _video_ref(plan, creative, media),
+            'message': campaign.name,
+            'call_to_action': {'type': 'LEARN_MORE', 'value': {'link': link_url}},
+        }
+        # Facebook rejects video creatives without a thumbnail; the
+        # processing pipeline stores a frame of the video as the preview
+        if creative.blob_id and creative.blob.preview:
+            video_data['image_url'] = stored_file_url(creative.blob.preview)
+        return {'page_id': page_id, 'video_data': video_data}
+    link_data = {
+        'message': campaign.name,
+        'link': link_url,
+        'name': campaign.name,
+    }
+    if creative.blob_id in media:
+        link_data['image_hash'] = media[creative.blob_id]
+    else:
+        link_data['image_url'] = creative_url(creative)
+    return {'page_id': page_id, 'link_data': link_data}
+
+
+def _video_ref(plan, creative, media):
+    """
+    Video ID for a creative: cached, or uploaded by the plan
+
+    Creatives sharing a blob share one upload operation.
+    """
+    if creative.blob_id in media:
+        return media[creative.blob_id]
+    key = f"video-b{creative.blob_id}" if creative.blob_id else f"video-{creative.id}"
+    if key in plan.refs:
+        return plan.refs[key]
+    return plan.add(key, 'advideos', {'name': creative.file_name, 'file_url': creative_url(creative)})
+
+
+def split_batches(operations, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Split operations into batch-sized chunks, preserving order
+
+    Dependencies always point backwards, so an operation either references
+    an earlier operation of its own chunk or one from a previous chunk.
+    """
+    return [
+        operations[i:i + max_batch_size]
+        for i in range(0, len(operations), max_batch_size)
+    ]
+
+
+async def execute_operations(send_batch, operations, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Send operations through the Graph batch endpoint
+
+    Chunks are sent one after the other: a chunk may reference the IDs
+    created by the previous ones. If a batch request fails as a whole,
+    its operations and those of the later chunks are reported as errors
+    and the IDs created by the earlier chunks are kept.
+
+    Args:
+        send_batch: Coroutine function posting a list of batch items and
+            returning Facebook's list of responses
+        operations: List of BatchOperation in dependency order
+        max_batch_size: Operations per batch request
+
+    Returns:
+        Tuple of (results, errors): dicts mapping operation names to the
+        created object ID (None for updates), or to an error message
+    """
+    results = {}
+    errors = {}
+
+    for chunk in split_batches(operations, max_batch_size):
+        items = []
+        sent = []
+        for operation in chunk:
+            failed = [name for name in operation.dependencies() if name in errors]
+            if failed:
+                errors[operation.name] = f"Skipped, depends on failed operation {failed[0]}"
+                continue
+            items.append(operation.to_batch_item(results))
+            sent.append(operation)
+
+        if not items:
+            continue
+
+        try:
+            response = await send_batch(items)
+        except Exception as e:
+            # Whatever the failure (Graph error, outage, lost connection),
+            # the earlier chunks' objects exist and their IDs must be kept
+            logger.error(f"Batch request of {len(items)} operations failed: {str(e)}")
+            for operation in operations:
+                if operation.name not in results and operation.name not in errors:
+                    errors[operation.name] = f"{NOT_CONFIRMED}, the batch request failed: {str(e)}"
+            break
+
+        for operation, item in zip(sent, response):
+            if item is None:
+                # Facebook drops requests whose dependencies failed
+                errors[operation.name] = "Not executed, a dependency failed"
+                continue
+            body = _decode_body(item.get('body'))
+            if item.get('code') == 200 and ('id' in body or body.get('success')):
+                results[operation.name] = body.get('id')
+            else:
+                error = body.get('error', {})
+                errors[operation.name] = error.get('message') or f"HTTP {item.get('code')}"
+
+    return results, errors
+
+
+def encode_params(params):
+    """Form-encode Graph parameters: objects and lists are sent as JSON"""
+    return {
+        key: json.dumps(value) if isinstance(value, (dict, list)) else value
+        for key, value in params.items()
+    }
+
+
+def _decode_body(body):
+    if not body:
+        return {}
+    try:
+        return json.loads(body)
+    except ValueError:
+        return {}
+
+
+def _collect_refs(value, names):
+    if isinstance(value, ResultRef):
+        names.add(value.name)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_refs(item, names)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _collect_refs(item, names)
+
+
+def _resolve_refs(value, resolved_ids):
+    if isinstance(value, ResultRef):
+        if value.name in resolved_ids:
+            return resolved_ids[value.name]
+        return f"{{result={value.name}:$.id}}"
+    if isinstance(value, dict):
+        return {key: _resolve_refs(item, resolved_ids) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_resolve_refs(item, resolved_ids) for item in value]
+    return value
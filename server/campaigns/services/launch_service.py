@@ -0,0 +1,970 @@
+"""
+Campaign launch pipeline for QuickCampaigns
+
+The API only enqueues a LaunchJob; the Facebook calls run here, inside a
+Celery worker, so a slow Graph round trip never holds a web worker. The
+launch itself is a coroutine awaiting its Graph calls: workers run it on
+their long-lived event loop (worker_loop), and under ASGI the async launch view runs it
+on the server's loop right away (start_launch).
+
+A claimed job holds a lease of LAUNCH_JOB_LEASE seconds, renewed while
+its launch runs. If the worker or process running it dies, the job is
+claimed again by a redelivered task or put back on the queue by the
+periodic requeue_stale_jobs. A launch only records its outcome, and
+settles or releases its credit, while its job is still running under its
+own claim, so a launch that lost its lease cannot finish a job twice.
+
+A job is marked sent before the first request creating objects on
+Facebook, and a sent job is never run again. If a sent launch crashes,
+or cannot tell whether its campaign was switched on, the job is left
+unconfirmed: the IDs it got are kept, its credit stays held and its
+campaign is queued for a status read. reconcile_unconfirmed_jobs then
+charges or returns the credit from the status Facebook reports.
+
+Bulk launches hold one credit reservation for all their campaigns and
+queue their jobs in chunks of BULK_LAUNCH_CHUNK_SIZE per ad account. A
+worker runs a whole chunk at once: the images are uploaded once and the
+object trees of every campaign share the same Graph batch requests.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Prefetch, Q
+from django.utils import timezone
+from ..models import Campaign, CampaignCreative, LaunchJob
+from . import credit_ledger, live_events, response_cache, worker_loop
+from .circuit_breaker import GraphUnavailable, breaker
+from .creative_processing import creative_problems
+from .facebook_service import AsyncFacebookService
+from .graph_scheduler import INTERACTIVE, graph_context
+from .launch_plan import LaunchPlanError
+from .status_sync import schedule_first_check
+
+logger = logging.getLogger(__name__)
+
+# Graph endpoints (endpoint_label) a launch cannot do without: the batch
+# endpoint creating the object tree, and image uploads
+LAUNCH_ENDPOINTS = ['/', '{id}/adimages']
+# Times a job is put back on the queue while those endpoints' breakers are open
+MAX_LAUNCH_ATTEMPTS = 5
+
+# Launches running on this process's event loop (start_launch)
+_in_process = set()
+
+
+class InvalidCreatives(Exception):
+    """Raised when creatives failed validation and cannot be launched"""
+
+    def __init__(self, problems):
+        self.problems = problems
+        details = '; '.join(
+            f"creative {creative_id}: {', '.join(errors)}" for creative_id, errors in problems.items()
+        )
+        super().__init__(f"Creatives do not meet Facebook's specs ({details})")
+
+
+def enqueue_launch(campaign, user, fb_account, countdown=None):
+    """
+    Reserve a credit, create a LaunchJob and schedule it on the task queue
+
+    If the campaign already has an unfinished job, that job is returned
+    instead so repeated clicks on "launch" do not launch twice. The credit
+    is only held here; the worker settles it once Facebook has accepted
+    the campaign, or releases it if the launch fails.
+
+    Args:
+        campaign: Campaign to launch
+        user: User requesting the launch
+        fb_account: FacebookAdAccount the campaign is launched into
+        countdown: Optional seconds before a worker runs the job, for
+            callers that launch it in process (start_launch) and keep the
+            task queue as a fallback
+
+    Returns:
+        Tuple of (LaunchJob, created)
+
+    Raises:
+        InsufficientCredits: if the user has no credit available
+        InvalidCreatives: if processing found creatives Facebook would reject
+        CircuitOpen: if Facebook is failing; nothing is reserved or queued
+    """
+    from ..tasks import launch_campaign
+
+    breaker.raise_if_open(LAUNCH_ENDPOINTS)
+    problems = creative_problems(campaign.creatives.select_related('blob'))
+    if problems:
+        raise InvalidCreatives(problems)
+
+    with transaction.atomic():
+        # Lock the campaign row so two concurrent requests cannot both enqueue
+        campaign = Campaign.objects.select_for_update().get(pk=campaign.pk)
+        job = campaign.launch_jobs.filter(status__in=['queued', 'running']).first()
+        if job:
+            return job, False
+
+        reservation = credit_ledger.reserve(
+            user, 1, campaign=campaign,  # Assuming 1 credit per campaign
+            description=f"Launch of campaign: {campaign.name}"
+        )
+        job = LaunchJob.objects.create(user=user, campaign=campaign, reservation=reservation)
+        campaign.facebook_account = fb_account
+        campaign.status = 'pending'
+        campaign.save(update_fields=['facebook_account', 'status', 'updated_at'])
+
+        # Only publish the job once the row is visible to the worker
+        transaction.on_commit(lambda: launch_campaign.apply_async((str(job.id),), countdown=countdown))
+
+    return job, True
+
+
+def enqueue_bulk_launch(campaign_ids, user, default_account):
+    """
+    Queue the launch of many campaigns with a single credit reservation
+
+    Campaigns are launched into their own ad account if it is still
+    connected, otherwise into ``default_account``. Campaigns that already
+    have an unfinished job keep it. Problems with single campaigns are
+    reported per item; only a lack of credit refuses the whole request.
+
+    Args:
+        campaign_ids: Campaign primary keys, in the order to report them
+        user: User requesting the launches
+        default_account: FacebookAdAccount for campaigns without one, or None
+
+    Returns:
+        List with one result dictionary per distinct campaign ID:
+        {'campaign', 'status': 'queued', 'job', 'created'} or
+        {'campaign', 'status': 'error', 'detail'[, 'creatives']}
+
+    Raises:
+        InsufficientCredits: if the user cannot pay for every new launch
+        CircuitOpen: if Facebook is failing; nothing is reserved or queued
+    """
+    from ..tasks import launch_campaign_batch
+
+    breaker.raise_if_open(LAUNCH_ENDPOINTS)
+    campaign_ids = list(dict.fromkeys(campaign_ids))
+    campaigns = Campaign.objects.filter(user=user, pk__in=campaign_ids).select_related(
+        'facebook_account'
+    ).prefetch_related(Prefetch('creatives', queryset=CampaignCreative.objects.select_related('blob')))
+    campaigns = {campaign.id: campaign for campaign in campaigns}
+
+    results = {}
+    accounts = {}
+    for campaign_id in campaign_ids:
+        campaign = campaigns.get(campaign_id)
+        if campaign is None:
+            results[campaign_id] = {'campaign': campaign_id, 'status': 'error', 'detail': 'Campaign not found.'}
+            continue
+        if campaign.is_template:
+            results[campaign_id] = {
+                'campaign': campaign_id, 'status': 'error',
+                'detail': 'Templates cannot be launched. Clone the template and launch the copy.',
+            }
+            continue
+        problems = creative_problems(campaign.creatives.all())
+        if problems:
+            error = InvalidCreatives(problems)
+            results[campaign_id] = {
+                'campaign': campaign_id, 'status': 'error', 'detail': str(error), 'creatives': error.problems,
+            }
+            continue
+        account = campaign.facebook_account
+        if account is None or not account.is_active:
+            account = default_account
+        if account is None:
+            results[campaign_id] = {
+                'campaign': campaign_id, 'status': 'error',
+                'detail': 'No connected Facebook ad account found. Please connect your Facebook account first.',
+            }
+            continue
+        accounts[campaign_id] = account
+
+    with transaction.atomic():
+        # Same locks as a single launch, taken in a fixed order
+        locked = list(Campaign.objects.select_for_update().filter(pk__in=accounts).order_by('pk'))
+        existing = {
+            job.campaign_id: job
+            for job in LaunchJob.objects.filter(campaign_id__in=accounts, status__in=['queued', 'running'])
+        }
+        new_ids = [campaign.id for campaign in locked if campaign.id not in existing]
+
+        jobs = []
+        if new_ids:
+            reservation = credit_ledger.reserve(
+                user, len(new_ids),  # Assuming 1 credit per campaign
+                description=f"Bulk launch of {len(new_ids)} campaigns",
+            )
+            jobs = LaunchJob.objects.bulk_create([
+                LaunchJob(user=user, campaign_id=campaign_id, reservation=reservation) for campaign_id in new_ids
+            ])
+
+        by_account = defaultdict(list)
+        for job in jobs:
+            by_account[accounts[job.campaign_id]].append(job)
+        now = timezone.now()
+        for account, account_jobs in by_account.items():
+            Campaign.objects.filter(pk__in=[job.campaign_id for job in account_jobs]).update(
+                facebook_account=account, status='pending', updated_at=now
+            )
+            size = settings.BULK_LAUNCH_CHUNK_SIZE
+            for start in range(0, len(account_jobs), size):
+                job_ids = [str(job.id) for job in account_jobs[start:start + size]]
+                # Only publish the jobs once the rows are visible to the workers
+                transaction.on_commit(lambda job_ids=job_ids: launch_campaign_batch.delay(job_ids))
+        if jobs:
+            response_cache.invalidate(user.pk)
+
+    for job in jobs:
+        results[job.campaign_id] = {'campaign': job.campaign_id, 'status': 'queued', 'job': job.id, 'created': True}
+    for campaign_id, job in existing.items():
+        results[campaign_id] = {'campaign': campaign_id, 'status': 'queued', 'job': job.id, 'created': False}
+    logger.info(f"Queued {len(jobs)} launch jobs for user {user.id} in a bulk launch of {len(campaign_ids)}")
+    return [results[campaign_id] for campaign_id in campaign_ids if campaign_id in results]
+
+
+def claimable(now=None):
+    """
+    Jobs a worker may claim: queued ones, and running ones whose lease ran out
+
+    A claimed job holds a lease of LAUNCH_JOB_LEASE seconds from its last
+    heartbeat. A job still running after that lost its worker or ASGI
+    process, and is claimed again instead of staying running forever,
+    unless it was already sent: requeue_stale_jobs leaves those unconfirmed.
+    """
+    now = now or timezone.now()
+    return Q(status='queued') | Q(status='running', sent_at__isnull=True) & _lease_expired(now)
+
+
+def _lease_expired(now):
+    expired = now - timedelta(seconds=settings.LAUNCH_JOB_LEASE)
+    # Jobs claimed before heartbeats were recorded only have a started_at
+    return Q(heartbeat_at__lt=expired) | Q(heartbeat_at__isnull=True, started_at__lt=expired)
+
+
+def claim_job(job_id):
+    """
+    Atomically move a queued job, or one whose lease expired, to running
+
+    Args:
+        job_id: LaunchJob primary key
+
+    Returns:
+        The claimed LaunchJob, or None if another worker already claimed it
+        (e.g. the broker redelivered a message that is still being processed)
+    """
+    now = timezone.now()
+    claimed = LaunchJob.objects.filter(claimable(now), id=job_id).update(
+        status='running',
+        started_at=now,
+        heartbeat_at=now,
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return None
+    job = LaunchJob.objects.select_related(
+        'user', 'campaign', 'campaign__facebook_account', 'reservation'
+    ).get(id=job_id)
+    live_events.launch_job_changed(job)
+    return job
+
+
+def claim_jobs(job_ids):
+    """
+    Atomically move the claimable jobs among ``job_ids`` to running
+
+    Returns:
+        The claimed LaunchJobs with their campaigns, accounts and creatives
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = list(
+            LaunchJob.objects.select_for_update(skip_locked=True)
+            .filter(claimable(now), id__in=job_ids).values_list('id', flat=True)
+        )
+        LaunchJob.objects.filter(id__in=claimed).update(
+            status='running',
+            started_at=now,
+            heartbeat_at=now,
+            attempts=F('attempts') + 1,
+        )
+    jobs = list(
+        LaunchJob.objects.filter(id__in=claimed)
+        .select_related('user', 'campaign', 'campaign__facebook_account', 'reservation')
+        .prefetch_related(
+            Prefetch('campaign__creatives', queryset=CampaignCreative.objects.select_related('blob'))
+        )
+    )
+    live_events.launch_jobs_changed(jobs)
+    return jobs
+
+
+def requeue_stale_jobs(now=None, limit=1000):
+    """
+    Put the running jobs whose lease expired back on the task queue
+
+    claim_job takes such a job over when the broker redelivers its
+    message, but nothing redelivers a launch the async view ran in
+    process, or a task whose message was already acknowledged. Jobs that
+    used up their attempts are failed instead, so a launch that takes its
+    worker down every time is not retried forever, and jobs that were
+    already sent are left unconfirmed.
+
+    Returns:
+        Number of jobs requeued, failed or left unconfirmed
+    """
+    from ..tasks import launch_campaign, launch_campaign_batch
+
+    now = now or timezone.now()
+    jobs = list(
+        LaunchJob.objects.filter(_lease_expired(now), status='running')
+        .select_related('user', 'campaign', 'reservation')
+        .prefetch_related('campaign__creatives')
+        .order_by('started_at')[:limit]
+    )
+    sent = [job for job in jobs if job.sent_at]
+    _park_jobs(sent, {job.id: ("The launch was interrupted after it was sent to Facebook.", {}) for job in sent})
+    jobs = [job for job in jobs if not job.sent_at]
+    shared = _shared_reservations(jobs)
+
+    requeued = []
+    failed = []
+    for job in jobs:
+        exhausted = job.attempts >= MAX_LAUNCH_ATTEMPTS
+        # Skip jobs claimed or finished since they were read
+        taken = LaunchJob.objects.filter(pk=job.pk, status='running', started_at=job.started_at).update(
+            status='running' if exhausted else 'queued',
+            started_at=now if exhausted else None,
+            heartbeat_at=now if exhausted else None,
+        )
+        if not taken:
+            continue
+        if exhausted:
+            # Failed below under this new claim
+            job.started_at = now
+            failed.append(job)
+        else:
+            job.status = 'queued'
+            requeued.append(job)
+
+    error = "The launch was interrupted too many times. Facebook may hold part of its campaign."
+    for job in failed:
+        if job.reservation_id not in shared:
+            _fail_job(job, error)
+    bulk_failed = [job for job in failed if job.reservation_id in shared]
+    _finish_batch(bulk_failed, {}, {job.id: (error, {}) for job in bulk_failed})
+
+    live_events.launch_jobs_changed(requeued)
+    by_account = defaultdict(list)
+    for job in requeued:
+        if job.reservation_id in shared:
+            by_account[job.campaign.facebook_account_id].append(str(job.id))
+        else:
+            launch_campaign.delay(str(job.id))
+    size = settings.BULK_LAUNCH_CHUNK_SIZE
+    for job_ids in by_account.values():
+        for start in range(0, len(job_ids), size):
+            launch_campaign_batch.delay(job_ids[start:start + size])
+
+    if requeued or failed or sent:
+        logger.warning(
+            f"Requeued {len(requeued)} launch jobs whose lease expired, failed {len(failed)}, "
+            f"left {len(sent)} unconfirmed"
+        )
+    return len(requeued) + len(failed) + len(sent)
+
+
+def _shared_reservations(jobs):
+    """Reservations of ``jobs`` held by a bulk launch, which are settled piecewise"""
+    return set(
+        LaunchJob.objects.filter(reservation_id__in={job.reservation_id for job in jobs} - {None})
+        .values('reservation_id').annotate(jobs=Count('id')).filter(jobs__gt=1)
+        .values_list('reservation_id', flat=True)
+    )
+
+
+def run_launch_job(job_id):
+    """
+    Execute a queued launch from synchronous code (the Celery task)
+
+    Runs launch_job_async on the worker's event loop, whose Graph
+    connections stay open from one launch to the next.
+
+    Args:
+        job_id: LaunchJob primary key
+    """
+    worker_loop.run(launch_job_async, job_id)
+
+
+async def launch_job_async(job_id, client=None):
+    """
+    Execute a queued launch: create the campaign's full object tree on
+    Facebook, then record the result and settle the reserved credit
+
+    No database lock is held and no thread is blocked while the Graph
+    requests are in flight; the database and Redis work runs in a thread.
+    The job's lease is renewed while the launch runs. A crash after the
+    claim fails the job rather than leaving it running until its lease
+    runs out, or leaves it unconfirmed once it was sent.
+
+    Args:
+        job_id: LaunchJob primary key
+        client: Optional AsyncGraphClient. Defaults to the shared async_graph_client
+    """
+    job = await sync_to_async(claim_job)(job_id)
+    if job is None:
+        logger.info(f"Launch job {job_id} already claimed, skipping")
+        return
+
+    try:
+        async with _renewing_lease([job]):
+            await _launch_claimed_job(job, client)
+    except Exception as e:
+        logger.exception(f"Launch job {job.id} crashed: {str(e)}")
+        await sync_to_async(_end_job)(job, str(e))
+
+
+async def _launch_claimed_job(job, client):
+    campaign = job.campaign
+    fb_account = campaign.facebook_account
+    creatives = await sync_to_async(list)(campaign.creatives.select_related('blob'))
+
+    try:
+        if not fb_account or not fb_account.is_active:
+            raise ValueError("No connected Facebook ad account found for this campaign.")
+        
+        # Processing may have finished after the job was queued
+        problems = await sync_to_async(creative_problems)(creatives)
+        if problems:
+            raise InvalidCreatives(problems)
+
+        # Fail fast while Facebook is down instead of timing out mid-launch
+        await sync_to_async(breaker.raise_if_open)(LAUNCH_ENDPOINTS)
+
+        fb_service = AsyncFacebookService(
+            access_token=fb_account.access_token,
+            ad_account_id=fb_account.account_id.replace('act_', ''),  # Remove 'act_' prefix if present
+            client=client,
+        )
+
+        # Launches go ahead of the background syncs of the same account
+        with graph_context(priority=INTERACTIVE, ad_account_id=fb_account.account_id):
+            plan = await fb_service.create_launch_plan(campaign, creatives, status='ACTIVE')
+            # Once objects may exist on Facebook, retrying could create them twice
+            await sync_to_async(_mark_sent)([job])
+            object_ids = await fb_service.execute_launch_plan(plan)
+    except GraphUnavailable as e:
+        if not job.sent_at and job.attempts < MAX_LAUNCH_ATTEMPTS:
+            logger.warning(f"Launch job {job.id} postponed {e.retry_after:.0f}s: {str(e)}")
+            await sync_to_async(_requeue_job)(job, e.retry_after)
+            return
+        logger.error(f"Error launching campaign {campaign.id} to Facebook: {str(e)}")
+        await sync_to_async(_end_job)(job, str(e))
+        return
+    except LaunchPlanError as e:
+        logger.error(f"Error launching campaign {campaign.id} to Facebook: {str(e)}")
+        if e.may_be_live:
+            await sync_to_async(_end_job)(job, str(e), e.object_ids)
+            return
+        # Keep the IDs of whatever was created so it can be found on Facebook
+        await sync_to_async(save_object_ids)(campaign, creatives, e.object_ids)
+        await sync_to_async(_fail_job)(job, str(e))
+        return
+    except Exception as e:
+        logger.error(f"Error launching campaign {campaign.id} to Facebook: {str(e)}")
+        await sync_to_async(_end_job)(job, str(e))
+        return
+
+    try:
+        await sync_to_async(_finish_job)(job, campaign, creatives, object_ids)
+    except Exception as e:
+        # The campaign is live; its IDs must not be lost with the crash
+        logger.exception(f"Could not record the launch of campaign {campaign.id}: {str(e)}")
+        await sync_to_async(_end_job)(job, str(e), object_ids)
+        return
+    logger.info(f"Successfully launched campaign {campaign.id} to Facebook with ID {campaign.facebook_campaign_id}")
+
+
+def _finish_job(job, campaign, creatives, object_ids):
+    with transaction.atomic():
+        if not _close_job(job, 'succeeded'):
+            logger.warning(f"Launch job {job.id} was taken over, dropping its result {object_ids}")
+            return
+
+        # Update campaign with Facebook IDs
+        campaign.status = 'active'
+        schedule_first_check(campaign)
+        save_object_ids(campaign, creatives, object_ids)
+
+        # Charge the credit held when the launch was queued
+        _settle_credit(job, campaign)
+        live_events.launch_job_changed(job, campaign_status=campaign.status)
+
+
+def run_launch_batch(job_ids):
+    """
+    Execute a chunk of queued launches from synchronous code (the Celery task)
+
+    Runs launch_batch_async on the worker's event loop (see run_launch_job).
+
+    Args:
+        job_ids: LaunchJob primary keys, all for campaigns of one ad account
+    """
+    worker_loop.run(launch_batch_async, job_ids)
+
+
+async def launch_batch_async(job_ids, client=None):
+    """
+    Execute a chunk of queued launches into one ad account together
+
+    Every campaign gets its own outcome: one failing campaign does not
+    fail the others. The chunk's share of the bulk reservation is settled
+    in the same transaction that records the outcomes. A crash fails the
+    jobs it left running, or leaves them unconfirmed once they were sent.
+
+    Args:
+        job_ids: LaunchJob primary keys, all for campaigns of one ad account
+        client: Optional AsyncGraphClient. Defaults to the shared async_graph_client
+    """
+    jobs = await sync_to_async(claim_jobs)(job_ids)
+    if not jobs:
+        logger.info(f"Launch jobs {job_ids} already claimed, skipping")
+        return
+
+    try:
+        async with _renewing_lease(jobs):
+            await _launch_claimed_batch(jobs, client)
+    except Exception as e:
+        logger.exception(f"Launch jobs {[str(job.id) for job in jobs]} crashed: {str(e)}")
+        await sync_to_async(_end_batch)(jobs, str(e))
+
+
+async def _launch_claimed_batch(jobs, client):
+    fb_account = jobs[0].campaign.facebook_account
+    failures = {}
+    ready = []
+    problems = await sync_to_async(_creative_problems_by_job)(jobs)
+    for job in jobs:
+        if problems[job.id]:
+            failures[job.id] = (str(InvalidCreatives(problems[job.id])), {})
+        else:
+            ready.append(job)
+
+    outcomes = {}
+    # Launches whose outcome is unknown, like failures
+    unconfirmed = {}
+    sent = False
+    try:
+        if not fb_account or not fb_account.is_active:
+            raise ValueError("No connected Facebook ad account found for this campaign.")
+        if ready:
+            await sync_to_async(breaker.raise_if_open)(LAUNCH_ENDPOINTS)
+            fb_service = AsyncFacebookService(
+                access_token=fb_account.access_token,
+                ad_account_id=fb_account.account_id.replace('act_', ''),
+                client=client,
+            )
+            with graph_context(priority=INTERACTIVE, ad_account_id=fb_account.account_id):
+                plans = await fb_service.create_launch_plans(
+                    [(job.campaign, list(job.campaign.creatives.all())) for job in ready], status='ACTIVE'
+                )
+                await sync_to_async(_mark_sent)(ready)
+                sent = True
+                results = await fb_service.execute_launch_plans(plans)
+            outcomes = {job.id: result for job, result in zip(ready, results)}
+    except GraphUnavailable as e:
+        if not sent and all(job.attempts < MAX_LAUNCH_ATTEMPTS for job in ready):
+            logger.warning(f"Launch jobs {[str(job.id) for job in ready]} postponed {e.retry_after:.0f}s: {str(e)}")
+            await sync_to_async(_requeue_batch)(ready, e.retry_after)
+            ready = []
+        else:
+            (unconfirmed if sent else failures).update({job.id: (str(e), {}) for job in ready})
+    except Exception as e:
+        logger.error(f"Error launching campaigns {[job.campaign_id for job in ready]} to Facebook: {str(e)}")
+        (unconfirmed if sent else failures).update({job.id: (str(e), {}) for job in ready})
+
+    for job_id, (object_ids, errors) in outcomes.items():
+        if errors:
+            error = LaunchPlanError(errors, object_ids)
+            (unconfirmed if error.may_be_live else failures)[job_id] = (str(error), object_ids)
+    finished = [job for job in jobs if job.id not in unconfirmed and (job.id in failures or job.id in outcomes)]
+    await sync_to_async(_park_jobs)([job for job in jobs if job.id in unconfirmed], unconfirmed)
+    try:
+        await sync_to_async(_finish_batch)(finished, outcomes, failures)
+    except Exception as e:
+        # Launched campaigns are live; their IDs must not be lost with the crash
+        logger.exception(f"Could not record the launches of jobs {[str(job.id) for job in finished]}: {str(e)}")
+        await sync_to_async(_end_batch)(
+            finished, str(e), {job_id: object_ids for job_id, (object_ids, _) in outcomes.items()}
+        )
+
+
+def _creative_problems_by_job(jobs):
+    return {job.id: creative_problems(job.campaign.creatives.all()) for job in jobs}
+
+
+def _still_claimed(jobs):
+    """
+    The jobs still running under this claim, locked until the transaction ends
+
+    A job that was finished, requeued or taken over after its lease ran
+    out belongs to someone else now.
+    """
+    started = dict(
+        LaunchJob.objects.select_for_update()
+        .filter(id__in=[job.id for job in jobs], status='running').values_list('id', 'started_at')
+    )
+    return [job for job in jobs if job.id in started and started[job.id] == job.started_at]
+
+
+def _close_job(job, status, error=None):
+    """
+    Record the outcome of a job still running under this claim
+
+    Returns:
+        True if recorded, False if the job was finished, requeued or
+        taken over meanwhile; its credit is then not this launch's to
+        settle or release
+    """
+    now = timezone.now()
+    closed = LaunchJob.objects.filter(pk=job.pk, status='running', started_at=job.started_at).update(
+        status=status, error=error, finished_at=now
+    )
+    if closed:
+        job.status = status
+        job.error = error
+        job.finished_at = now
+    return bool(closed)
+
+
+@asynccontextmanager
+async def _renewing_lease(jobs):
+    """Renew the jobs' lease every third of LAUNCH_JOB_LEASE while the block runs"""
+    async def renew():
+        while True:
+            await asyncio.sleep(settings.LAUNCH_JOB_LEASE / 3)
+            try:
+                await sync_to_async(_renew_lease)(jobs)
+            except Exception as e:
+                logger.error(f"Could not renew the lease of launch jobs {[str(job.id) for job in jobs]}: {str(e)}")
+
+    heartbeat = asyncio.ensure_future(renew())
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+
+
+def _mark_sent(jobs):
+    """Record that the jobs' objects are about to be created on Facebook"""
+    now = timezone.now()
+    claims = reduce(or_, (Q(pk=job.pk, started_at=job.started_at) for job in jobs))
+    LaunchJob.objects.filter(claims, status='running').update(sent_at=now)
+    for job in jobs:
+        job.sent_at = now
+
+
+def _renew_lease(jobs):
+    claims = reduce(or_, (Q(pk=job.pk, started_at=job.started_at) for job in jobs))
+    LaunchJob.objects.filter(claims, status='running').update(heartbeat_at=timezone.now())
+
+
+def start_launch(job_id):
+    """
+    Run a queued launch on the running event loop, in this process
+
+    Under ASGI the async launch view starts the launch right away instead
+    of waiting for a worker: its Graph calls are awaited, so one process
+    runs many launches at once. The job stays on the task queue with a
+    delay; if this process dies before claiming it, a worker does. A
+    launch that crashes after the claim fails its job, and one whose
+    process dies is requeued once its lease runs out.
+
+    Args:
+        job_id: LaunchJob primary key
+    """
+    task = asyncio.ensure_future(_launch_in_process(job_id))
+    # The loop only keeps weak references to its tasks
+    _in_process.add(task)
+    task.add_done_callback(_in_process.discard)
+
+
+async def _launch_in_process(job_id):
+    try:
+        await launch_job_async(job_id)
+    except Exception:
+        logger.exception(f"Launch job {job_id} crashed in process")
+    finally:
+        # No request cycle closes the connection this launch used
+        await sync_to_async(close_old_connections)()
+
+
+def _finish_batch(jobs, outcomes, failures):
+    """Record the outcome of every job of a batch and settle its credits"""
+    with transaction.atomic():
+        # Jobs that lost their lease meanwhile are someone else's to finish
+        jobs = _still_claimed(jobs)
+        if jobs:
+            _record_batch(jobs, outcomes, failures)
+
+
+def _record_batch(jobs, outcomes, failures):
+    """Record the outcomes of claimed jobs, inside _finish_batch's transaction"""
+    now = timezone.now()
+    campaigns = []
+    creatives = []
+    succeeded = defaultdict(int)
+    failed = defaultdict(int)
+    # The chunk's lowest job ID names its part of each shared reservation
+    parts = {}
+    for job in jobs:
+        parts[job.reservation_id] = min(parts.get(job.reservation_id, str(job.id)), str(job.id))
+        campaign = job.campaign
+        error, object_ids = failures.get(job.id, (None, outcomes.get(job.id, ({}, {}))[0]))
+        campaign.facebook_campaign_id = object_ids.get('campaign', campaign.facebook_campaign_id)
+        campaign.facebook_ad_set_id = object_ids.get('adset', campaign.facebook_ad_set_id)
+        campaign.updated_at = now
+        for creative in campaign.creatives.all():
+            creative_id = object_ids.get(f"creative-{creative.id}")
+            ad_id = object_ids.get(f"ad-{creative.id}")
+            if creative_id or ad_id:
+                creative.facebook_creative_id = creative_id or creative.facebook_creative_id
+                creative.facebook_ad_id = ad_id or creative.facebook_ad_id
+                creatives.append(creative)
+
+        if error:
+            logger.error(f"Error launching campaign {campaign.id} to Facebook: {error}")
+            campaign.status = 'error'
+            job.status = 'failed'
+            job.error = error
+            failed[job.reservation_id] += 1
+        else:
+            campaign.status = 'active'
+            schedule_first_check(campaign, now)
+            job.status = 'succeeded'
+            succeeded[job.reservation_id] += 1
+        job.finished_at = now
+        campaigns.append(campaign)
+
+    Campaign.objects.bulk_update(campaigns, [
+        'status', 'facebook_campaign_id', 'facebook_ad_set_id',
+        'status_check_interval', 'next_status_check_at', 'updated_at',
+    ])
+    if creatives:
+        CampaignCreative.objects.bulk_update(creatives, ['facebook_creative_id', 'facebook_ad_id'])
+    LaunchJob.objects.bulk_update(jobs, ['status', 'error', 'finished_at'])
+    response_cache.invalidate(*{campaign.user_id for campaign in campaigns})
+    live_events.publish_many([
+        (job.user_id, live_events.LAUNCH, live_events.launch_payload(job, job.campaign.status)) for job in jobs
+    ])
+    for reservation_id in set(succeeded) | set(failed):
+        if reservation_id is None:
+            continue
+        try:
+            credit_ledger.settle_part(
+                reservation_id, parts[reservation_id],
+                used=succeeded[reservation_id], released=failed[reservation_id],
+                description=f"Credit used for {succeeded[reservation_id]} campaigns of a bulk launch",
+            )
+        except credit_ledger.InsufficientCredits:
+            logger.error(f"Bulk launch reservation {reservation_id} expired and could not be charged")
+
+    logger.info(
+        f"Bulk launch chunk finished: {sum(succeeded.values())} launched, {sum(failed.values())} failed"
+    )
+
+
+def save_object_ids(campaign, creatives, object_ids):
+    """
+    Store the Facebook IDs returned by a launch plan
+
+    Args:
+        campaign: Campaign the plan was built for
+        creatives: CampaignCreative instances included in the plan
+        object_ids: Dictionary returned by AsyncFacebookService.execute_launch_plan
+    """
+    campaign.facebook_campaign_id = object_ids.get('campaign', campaign.facebook_campaign_id)
+    campaign.facebook_ad_set_id = object_ids.get('adset', campaign.facebook_ad_set_id)
+    campaign.save(update_fields=[
+        'status', 'facebook_campaign_id', 'facebook_ad_set_id',
+        'status_check_interval', 'next_status_check_at', 'updated_at',
+    ])
+
+    updated = []
+    for creative in creatives:
+        creative_id = object_ids.get(f"creative-{creative.id}")
+        ad_id = object_ids.get(f"ad-{creative.id}")
+        if creative_id or ad_id:
+            creative.facebook_creative_id = creative_id or creative.facebook_creative_id
+            creative.facebook_ad_id = ad_id or creative.facebook_ad_id
+            updated.append(creative)
+    if updated:
+        CampaignCreative.objects.bulk_update(updated, ['facebook_creative_id', 'facebook_ad_id'])
+        response_cache.invalidate(campaign.user_id)
+
+
+def _settle_credit(job, campaign):
+    description = f"Credit used for campaign: {campaign.name}"
+    if job.reservation_id:
+        try:
+            credit_ledger.settle(job.reservation_id, description=description, campaign=campaign)
+        except credit_ledger.InsufficientCredits:
+            # The hold expired and the credit was spent elsewhere meanwhile
+            logger.error(f"Campaign {campaign.id} launched but its expired credit hold could not be charged")
+    else:
+        # Jobs queued before reservations existed; the key charges them once
+        credit_ledger.debit(
+            job.user, 1, description=description, campaign=campaign,
+            idempotency_key=f"launch:{job.id}",
+        )
+
+
+def _requeue_job(job, countdown):
+    from ..tasks import launch_campaign
+
+    requeued = LaunchJob.objects.filter(pk=job.pk, status='running', started_at=job.started_at).update(
+        status='queued', started_at=None, heartbeat_at=None
+    )
+    if not requeued:
+        return
+    job.status = 'queued'
+    live_events.launch_job_changed(job)
+    launch_campaign.apply_async((str(job.id),), countdown=max(1, int(countdown)))
+
+
+def _requeue_batch(jobs, countdown):
+    from ..tasks import launch_campaign_batch
+
+    with transaction.atomic():
+        jobs = _still_claimed(jobs)
+        job_ids = [job.id for job in jobs]
+        LaunchJob.objects.filter(pk__in=job_ids).update(status='queued', started_at=None, heartbeat_at=None)
+    if not jobs:
+        return
+    for job in jobs:
+        job.status = 'queued'
+    live_events.launch_jobs_changed(jobs)
+    launch_campaign_batch.apply_async(([str(job_id) for job_id in job_ids],), countdown=max(1, int(countdown)))
+
+
+def _end_job(job, error, object_ids=None):
+    """Fail a job that could not finish, or leave it unconfirmed if it was sent"""
+    if job.sent_at:
+        _park_jobs([job], {job.id: (error, object_ids or {})})
+    else:
+        _fail_job(job, error)
+
+
+def _end_batch(jobs, error, object_ids=None):
+    """Fail the jobs of a batch that could not finish, leaving those that were sent unconfirmed"""
+    object_ids = object_ids or {}
+    sent = [job for job in jobs if job.sent_at]
+    _park_jobs(sent, {job.id: (error, object_ids.get(job.id, {})) for job in sent})
+    unsent = [job for job in jobs if not job.sent_at]
+    _finish_batch(unsent, {}, {job.id: (error, {}) for job in unsent})
+
+
+def _park_jobs(jobs, unconfirmed):
+    """
+    Leave sent launches whose outcome is unknown for reconcile_unconfirmed_jobs
+
+    Facebook may be running their campaigns, so their credit is neither
+    charged nor returned. The IDs known are saved and the campaigns are
+    queued for their first status read.
+
+    Args:
+        jobs: LaunchJobs to leave unconfirmed
+        unconfirmed: Dict of job ID to (error, object_ids)
+    """
+    if not jobs:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        # Jobs that lost their lease meanwhile are someone else's to finish
+        jobs = _still_claimed(jobs)
+        for job in jobs:
+            error, object_ids = unconfirmed[job.id]
+            campaign = job.campaign
+            campaign.status = 'pending'
+            schedule_first_check(campaign, now)
+            save_object_ids(campaign, list(campaign.creatives.all()), object_ids)
+            job.status = 'unconfirmed'
+            job.error = error
+            job.finished_at = now
+        LaunchJob.objects.bulk_update(jobs, ['status', 'error', 'finished_at'])
+        response_cache.invalidate(*{job.user_id for job in jobs})
+        live_events.publish_many([
+            (job.user_id, live_events.LAUNCH, live_events.launch_payload(job, job.campaign.status)) for job in jobs
+        ])
+    if jobs:
+        logger.warning(f"Launch jobs {[str(job.id) for job in jobs]} left unconfirmed until their campaigns are read")
+
+
+def reconcile_unconfirmed_jobs(limit=1000):
+    """
+    Settle the unconfirmed launches whose campaigns were read back from Facebook
+
+    A campaign found paused was never switched on: its launch failed and
+    its credit is returned. Any other status means it went live, so its
+    launch succeeded and is charged. Jobs left without the ID of their
+    campaign are never read back and wait for support to resolve them.
+
+    Returns:
+        Number of jobs settled
+    """
+    jobs = list(
+        LaunchJob.objects.filter(status='unconfirmed', campaign__status_checked_at__gt=F('finished_at'))
+        .select_related('user', 'campaign', 'reservation')
+        .order_by('finished_at')[:limit]
+    )
+    shared = _shared_reservations(jobs)
+
+    settled = 0
+    for job in jobs:
+        campaign = job.campaign
+        launched = campaign.status != 'paused'
+        with transaction.atomic():
+            closed = LaunchJob.objects.filter(pk=job.pk, status='unconfirmed').update(
+                status='succeeded' if launched else 'failed',
+                error=None if launched else job.error,
+            )
+            if not closed:
+                continue
+            job.status = 'succeeded' if launched else 'failed'
+            if job.reservation_id in shared:
+                try:
+                    credit_ledger.settle_part(
+                        job.reservation_id, str(job.id), used=int(launched), released=int(not launched),
+                        description=f"Credit used for campaign: {campaign.name}",
+                    )
+                except credit_ledger.InsufficientCredits:
+                    logger.error(f"Campaign {campaign.id} launched but its expired credit hold could not be charged")
+            elif launched:
+                _settle_credit(job, campaign)
+            elif job.reservation_id:
+                credit_ledger.release(job.reservation_id)
+            live_events.launch_job_changed(job, campaign_status=campaign.status)
+        settled += 1
+
+    if settled:
+        logger.info(f"Settled {settled} unconfirmed launch jobs")
+    return settled
+
+
+def _fail_job(job, error):
+    with transaction.atomic():
+        if not _close_job(job, 'failed', error):
+            logger.warning(f"Launch job {job.id} was taken over, not failing it: {error}")
+            return
+        if job.reservation_id:
+            credit_ledger.release(job.reservation_id)
+        Campaign.objects.filter(pk=job.campaign_id).update(status='error', updated_at=timezone.now())
+        response_cache.invalidate(job.user_id)
+        live_events.launch_job_changed(job, campaign_status='error')
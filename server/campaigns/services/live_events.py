@@ -0,0 +1,113 @@
+"""
+Live event publishing for QuickCampaigns
+
+Changes the dashboard would otherwise poll for are published to a Redis
+pub/sub channel per user, ``user-events:{user_id}``. The event stream
+(campaigns.event_stream, served by the ASGI app) forwards them to the
+user's open browser tabs as server-sent events:
+
+- ``launch``: a launch job was claimed, finished, failed or postponed
+- ``campaign.status``: a status sync or webhook changed a campaign's status
+- ``credits``: the credit balance or the reserved credits changed
+
+Events are sent once the writing transaction commits, so a client that
+refetches on an event reads the new rows. Pub/sub does not keep events:
+a client that was not connected misses them, and reloads its state when
+it (re)connects.
+"""
+import json
+import logging
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from ..models import UserCredit
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = 'user-events:'
+
+LAUNCH = 'launch'
+CAMPAIGN_STATUS = 'campaign.status'
+CREDITS = 'credits'
+
+
+def channel(user_id):
+    return f"{CHANNEL_PREFIX}{user_id}"
+
+
+def publish(user_id, event, data):
+    """
+    Send an event to the user's streams once the current transaction commits
+
+    Args:
+        user_id: Primary key of the user to notify
+        event: Event name (LAUNCH, CAMPAIGN_STATUS or CREDITS)
+        data: JSON-serializable payload
+    """
+    publish_many([(user_id, event, data)])
+
+
+def publish_many(events):
+    """Send (user_id, event, data) tuples in one round trip after commit"""
+    if not settings.LIVE_EVENTS or not events:
+        return
+    messages = [
+        (channel(user_id), json.dumps({'event': event, 'data': data}, cls=DjangoJSONEncoder))
+        for user_id, event, data in events
+    ]
+    transaction.on_commit(lambda: _send(messages))
+
+
+def launch_job_changed(job, campaign_status=None):
+    """Publish a launch job's new status"""
+    publish(job.user_id, LAUNCH, launch_payload(job, campaign_status))
+
+
+def launch_jobs_changed(jobs):
+    """Publish the new status of many launch jobs in one round trip"""
+    publish_many([(job.user_id, LAUNCH, launch_payload(job)) for job in jobs])
+
+
+def launch_payload(job, campaign_status=None):
+    payload = {'job': str(job.id), 'campaign': job.campaign_id, 'status': job.status}
+    if job.error:
+        payload['error'] = job.error
+    if campaign_status:
+        payload['campaign_status'] = campaign_status
+    return payload
+
+
+def campaign_statuses_changed(campaigns):
+    """Publish the new status of every campaign, to its owner"""
+    publish_many([
+        (campaign.user_id, CAMPAIGN_STATUS, {
+            'campaign': campaign.id,
+            'status': campaign.status,
+            'facebook_status': campaign.facebook_status,
+        })
+        for campaign in campaigns
+    ])
+
+
+def credits_changed(user_id):
+    """Publish the user's balance as committed; it is read after the commit"""
+    if settings.LIVE_EVENTS:
+        transaction.on_commit(lambda: _send_credits(user_id))
+
+
+def _send_credits(user_id):
+    balance = UserCredit.objects.filter(user_id=user_id).values('balance', 'reserved').first()
+    if balance is not None:
+        _send([(channel(user_id), json.dumps({'event': CREDITS, 'data': balance}, cls=DjangoJSONEncoder))])
+
+
+def _send(messages):
+    try:
+        with get_redis_connection('default').pipeline(transaction=False) as pipe:
+            for name, message in messages:
+                pipe.publish(name, message)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Could not publish {len(messages)} live events: {str(e)}")
@@ -0,0 +1,253 @@
+"""
+Campaign metric rollups for QuickCampaigns
+
+CampaignDailyInsight holds one row per campaign per day, which is too
+many rows to sum on every dashboard request. MetricRollup keeps the same
+metrics summed per user, ad account and objective at three granularities:
+days built from the insight rows, and ISO weeks and calendar months built
+from the days.
+
+Rollups are maintained incrementally. Whenever the insights sync stores a
+page of rows, only the day, week and month buckets of that ad account
+that contain the page's dates are recomputed from their source. A bucket
+is rebuilt rather than adjusted, so restated days never double count.
+
+Queries cover the requested range with the coarsest buckets that fit
+(whole months, then whole weeks, then single days). The rows read grow
+with the number of months in the range, not with the campaign history.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from ..models import CampaignDailyInsight, MetricRollup
+
+logger = logging.getLogger(__name__)
+
+METRIC_FIELDS = ['impressions', 'clicks', 'link_clicks', 'conversions', 'spend']
+# Query dimension to MetricRollup field
+DIMENSIONS = {'account': 'ad_account_id', 'objective': 'objective'}
+# Days refreshed per transaction by a full rebuild
+REBUILD_CHUNK_DAYS = 180
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def month_end(day):
+    next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+BUCKET_START = {'day': lambda day: day, 'week': week_start, 'month': month_start}
+BUCKET_END = {'day': lambda day: day, 'week': lambda day: week_start(day) + timedelta(days=6), 'month': month_end}
+
+
+def refresh_rollups(ad_account_id, dates):
+    """
+    Recompute the rollups of an ad account that contain these dates
+
+    Called by the insights sync, which holds the account's lock, so two
+    refreshes of the same account never overlap.
+
+    Args:
+        ad_account_id: FacebookAdAccount.account_id the insights belong to
+        dates: Days whose insight rows were stored or changed
+    """
+    dates = set(dates)
+    if not dates:
+        return
+    with transaction.atomic():
+        _refresh_days(ad_account_id, dates)
+        _refresh_from_days(ad_account_id, 'week', {week_start(day) for day in dates}, TruncWeek)
+        _refresh_from_days(ad_account_id, 'month', {month_start(day) for day in dates}, TruncMonth)
+
+
+def _refresh_days(ad_account_id, dates):
+    rows = (
+        CampaignDailyInsight.objects.filter(campaign__facebook_account__account_id=ad_account_id, date__in=dates)
+        .values('campaign__user_id', 'campaign__objective', 'date')
+        .annotate(**{field: Sum(field) for field in METRIC_FIELDS})
+    )
+    _replace(ad_account_id, 'day', dates, [
+        MetricRollup(
+            granularity='day',
+            period_start=row['date'],
+            user_id=row['campaign__user_id'],
+            ad_account_id=ad_account_id,
+            objective=row['campaign__objective'],
+            **{field: row[field] for field in METRIC_FIELDS},
+        )
+        for row in rows
+    ])
+
+
+def _refresh_from_days(ad_account_id, granularity, starts, trunc):
+    end = BUCKET_END[granularity](max(starts))
+    rows = (
+        MetricRollup.objects.filter(
+            granularity='day', ad_account_id=ad_account_id, period_start__gte=min(starts), period_start__lte=end
+        )
+        .annotate(bucket=trunc('period_start'))
+        .values('user_id', 'objective', 'bucket')
+        .annotate(**{field: Sum(field) for field in METRIC_FIELDS})
+    )
+    _replace(ad_account_id, granularity, starts, [
+        MetricRollup(
+            granularity=granularity,
+            period_start=row['bucket'],
+            user_id=row['user_id'],
+            ad_account_id=ad_account_id,
+            objective=row['objective'],
+            **{field: row[field] for field in METRIC_FIELDS},
+        )
+        for row in rows
+        if row['bucket'] in starts
+    ])
+
+
+def _replace(ad_account_id, granularity, starts, rollups):
+    MetricRollup.objects.filter(
+        granularity=granularity, ad_account_id=ad_account_id, period_start__in=starts
+    ).delete()
+    MetricRollup.objects.bulk_create(rollups, batch_size=1000)
+
+
+def rebuild_rollups():
+    """
+    Rebuild every rollup from the insight rows
+
+    Returns:
+        Number of ad accounts rebuilt
+    """
+    account_ids = list(
+        CampaignDailyInsight.objects.filter(campaign__facebook_account__isnull=False)
+        .values_list('campaign__facebook_account__account_id', flat=True).distinct()
+    )
+    MetricRollup.objects.all().delete()
+    for ad_account_id in account_ids:
+        dates = sorted(set(
+            CampaignDailyInsight.objects.filter(campaign__facebook_account__account_id=ad_account_id)
+            .values_list('date', flat=True)
+        ))
+        # Weeks and months straddling two chunks are recomputed once per chunk
+        for start in range(0, len(dates), REBUILD_CHUNK_DAYS):
+            refresh_rollups(ad_account_id, dates[start:start + REBUILD_CHUNK_DAYS])
+    logger.info(f"Rebuilt metric rollups of {len(account_ids)} ad accounts")
+    return len(account_ids)
+
+
+def cover(since, until):
+    """
+    Split a date range into the coarsest rollup buckets that tile it
+
+    Whole calendar months are used first, then whole weeks, then days. A
+    week that would cut into a month fitting entirely in the range is
+    split into days instead, so the month can still be read whole.
+
+    Returns:
+        List of (granularity, period_start) tuples
+    """
+    pieces = []
+    day = since
+    while day <= until:
+        if day.day == 1 and month_end(day) <= until:
+            pieces.append(('month', day))
+            day = month_end(day) + timedelta(days=1)
+            continue
+        week_end = day + timedelta(days=6)
+        if day.weekday() == 0 and week_end <= until:
+            next_month = month_end(day) + timedelta(days=1)
+            if not (next_month <= week_end and month_end(next_month) <= until):
+                pieces.append(('week', day))
+                day = week_end + timedelta(days=1)
+                continue
+        pieces.append(('day', day))
+        day += timedelta(days=1)
+    return pieces
+
+
+def interval_buckets(since, until, interval=None):
+    """
+    Result buckets of a query, clipped to the range
+
+    Returns:
+        List of (bucket start, first day, last day) tuples
+    """
+    if interval is None:
+        return [(since, since, until)]
+    buckets = []
+    start = BUCKET_START[interval](since)
+    while start <= until:
+        end = BUCKET_END[interval](start)
+        buckets.append((start, max(start, since), min(end, until)))
+        start = end + timedelta(days=1)
+    return buckets
+
+
+def query_metrics(user, since, until, interval=None, group_by=(), filters=None):
+    """
+    Sum a user's metrics over a date range from the rollups
+
+    Args:
+        user: Owner of the campaigns
+        since: First day, inclusive
+        until: Last day, inclusive
+        interval: None for one total, or 'day', 'week' or 'month' for a series
+        group_by: Dimensions to split by ('account', 'objective')
+        filters: Optional dimension to value filters, e.g. {'objective': 'lead'}
+
+    Returns:
+        Dictionary with one list per column, plus the rollup rows read per granularity
+    """
+    dimension_fields = [DIMENSIONS[dimension] for dimension in group_by]
+    lookups = {DIMENSIONS[dimension]: value for dimension, value in (filters or {}).items()}
+
+    # period_start of each rollup row to read -> result bucket it adds to
+    wanted = defaultdict(dict)
+    for bucket, first, last in interval_buckets(since, until, interval):
+        for granularity, period_start in cover(first, last):
+            wanted[granularity][period_start] = bucket
+
+    cells = defaultdict(lambda: dict.fromkeys(METRIC_FIELDS, 0))
+    rows_read = {}
+    for granularity, buckets in wanted.items():
+        rows = (
+            MetricRollup.objects.filter(
+                user=user, granularity=granularity, period_start__in=list(buckets), **lookups
+            )
+            .values('period_start', *dimension_fields)
+            .annotate(**{field: Sum(field) for field in METRIC_FIELDS})
+        )
+        rows_read[granularity] = 0
+        for row in rows:
+            rows_read[granularity] += 1
+            key = (buckets[row['period_start']],) + tuple(row[field] for field in dimension_fields)
+            cell = cells[key]
+            for field in METRIC_FIELDS:
+                cell[field] += row[field] or 0
+
+    keys = sorted(cells)
+    columns = {}
+    if interval:
+        columns['period'] = [key[0].isoformat() for key in keys]
+    for position, dimension in enumerate(group_by, start=1):
+        columns[dimension] = [key[position] for key in keys]
+    for field in METRIC_FIELDS:
+        columns[field] = [cells[key][field] for key in keys]
+    columns['spend'] = [float(spend) for spend in columns['spend']]
+    columns['ctr'] = [_ratio(clicks * 100, impressions) for clicks, impressions in zip(columns['clicks'], columns['impressions'])]
+    columns['cpc'] = [_ratio(spend, clicks) for spend, clicks in zip(columns['spend'], columns['clicks'])]
+    columns['cpa'] = [_ratio(spend, conversions) for spend, conversions in zip(columns['spend'], columns['conversions'])]
+    return {'columns': columns, 'rollup_rows': rows_read}
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
@@ -0,0 +1,163 @@
+"""
+Per-user response cache for QuickCampaigns
+
+The dashboard polls the campaign list, the credit balance and the ad
+accounts every few seconds, and nearly every poll returns what the last
+one did. Read views hand their handler to ``cached_response``, which
+keeps the rendered JSON body in the Django cache (Redis):
+
+- Keys are per user and carry that user's cache version:
+  ``response-cache:{user_id}:{version}:{digest of URL and media type}``.
+- A write to one of the user's Campaign, CampaignCreative, UserCredit or
+  FacebookAdAccount rows bumps the version with ``invalidate``, which
+  orphans every cached response of that user at once; they expire after
+  RESPONSE_CACHE_TTL. Model signals cover save() and delete(). Services
+  writing with queryset update(), bulk_create() or bulk_update() call
+  ``invalidate`` themselves.
+- The bump runs once the writing transaction commits, and a request reads
+  the version before it queries. A response built from rows that were
+  about to change is therefore stored under the old version, which no
+  request reads any more.
+- Responses carry an ETag of their body. A request whose If-None-Match
+  matches it gets an empty 304, whether the body was cached or not.
+
+If the cache is unreachable, responses are built as if nothing was cached.
+"""
+import hashlib
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+from ..metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'response-cache:'
+VERSION_KEY_PREFIX = 'response-cache-version:'
+
+CACHE_ERRORS = (ConnectionInterrupted, RedisError)
+
+
+def cached_response(request, build):
+    """
+    Serve a read view from the user's cache, or build and cache its response
+
+    Only authenticated GET requests rendered as JSON are cached.
+
+    Args:
+        request: DRF Request of the view
+        build: Callable returning the view's uncached Response
+
+    Returns:
+        Response, HttpResponse with the cached body, or 304 response
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    if (not settings.RESPONSE_CACHE_ENABLED or request.method != 'GET'
+            or not request.user.is_authenticated or getattr(renderer, 'format', None) != 'json'):
+        return build()
+
+    view_name = request.resolver_match.url_name if request.resolver_match else 'unknown'
+    try:
+        # The version is read before the view queries; see the module docstring
+        key = response_key(request, current_version(request.user.pk))
+        entry = cache.get(key)
+    except CACHE_ERRORS as e:
+        logger.warning(f"Response cache unavailable: {str(e)}")
+        return build()
+
+    if entry is not None:
+        metrics.incr('response_cache.hit', view=view_name)
+        etag, content, content_type = entry
+        return _finish(request, HttpResponse(content, content_type=content_type), etag)
+
+    metrics.incr('response_cache.miss', view=view_name)
+    response = build()
+    if response.status_code != 200:
+        return response
+
+    # DRF renders after the view returns; render now to cache the bytes
+    view = request.parser_context['view']
+    response.accepted_renderer = renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = view.get_renderer_context()
+    response.render()
+    etag = f'"{hashlib.sha256(response.content).hexdigest()}"'
+    try:
+        cache.set(key, (etag, response.content, response['Content-Type']), settings.RESPONSE_CACHE_TTL)
+    except CACHE_ERRORS as e:
+        logger.warning(f"Response cache unavailable, response not stored: {str(e)}")
+    return _finish(request, response, etag)
+
+
+def _finish(request, response, etag):
+    if etag_matches(request, etag):
+        metrics.incr('response_cache.not_modified')
+        response = HttpResponseNotModified()
+    response['ETag'] = etag
+    # Browsers keep the body but revalidate it with If-None-Match on every poll
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match names ``etag`` (weak comparison)"""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in {tag[2:] if tag.startswith('W/') else tag for tag in etags}
+
+
+def response_key(request, version):
+    # The absolute URL, since paginated responses link to it
+    digest = hashlib.sha256(
+        f"{request.build_absolute_uri()}|{request.accepted_media_type}".encode()
+    ).hexdigest()
+    return f"{KEY_PREFIX}{request.user.pk}:{version}:{digest}"
+
+
+def current_version(user_id):
+    """
+    The user's cache version
+
+    A missing version starts at the current time in milliseconds, so a
+    version lost to eviction never falls back to one still cached.
+    """
+    key = f"{VERSION_KEY_PREFIX}{user_id}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(*user_ids):
+    """
+    Drop every cached response of the users once the current transaction commits
+
+    Args:
+        user_ids: Primary keys of the users whose rows changed; None is ignored
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        transaction.on_commit(lambda: bump_versions(user_ids))
+
+
+def bump_versions(user_ids):
+    for user_id in user_ids:
+        key = f"{VERSION_KEY_PREFIX}{user_id}"
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                # Never read or evicted: start past every version in use
+                cache.add(key, int(time.time() * 1000), timeout=None)
+        except CACHE_ERRORS as e:
+            logger.error(f"Could not invalidate cached responses of user {user_id}: {str(e)}")
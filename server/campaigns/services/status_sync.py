@@ -0,0 +1,256 @@
+"""
+Campaign status sync for QuickCampaigns
+
+Campaign.status is set to 'active' when a launch succeeds. After that,
+Facebook decides what happens to the campaign: review can reject it, the
+advertiser can pause it in Ads Manager, or its end date can pass. This
+poller reads ``effective_status`` back and maps it onto Campaign.status.
+
+Reads are grouped by ad account, since each account has its own token.
+Up to IDS_PER_CALL campaigns are read per ``?ids=`` request. Only rows
+whose status changed are written with bulk_update. The next-check times
+of the unchanged rows are moved with one UPDATE per interval.
+
+Polling is adaptive. A campaign is checked STATUS_CHECK_MIN_INTERVAL
+after launch, and the interval doubles each time its status is found
+unchanged, up to STATUS_CHECK_MAX_INTERVAL. Any change resets the
+interval to the minimum. Freshly launched campaigns, which go through
+review, are therefore polled often, while long-running ones are polled a
+few times a day.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from ..models import Campaign, FacebookAdAccount
+from . import live_events, response_cache
+from .graph_client import graph_client, graph_error_code
+from .graph_scheduler import BACKGROUND, graph_context
+
+logger = logging.getLogger(__name__)
+
+# Graph caps ?ids= reads at 50 objects
+IDS_PER_CALL = 50
+STATUS_FIELDS = 'effective_status,stop_time'
+
+# Graph error code of a request naming an object that does not exist
+NONEXISTING_OBJECT_CODE = 100
+
+# Campaign.status values the poller keeps in sync. Drafts are never on
+# Facebook, and a failed launch keeps its error; an error reported by
+# Facebook (e.g. a rejected ad) is still followed.
+SYNCED_STATUSES = ['pending', 'active', 'paused', 'completed']
+# Facebook statuses a campaign never leaves
+TERMINAL_STATUSES = ['ARCHIVED', 'DELETED']
+
+# Facebook effective_status -> Campaign.status
+EFFECTIVE_STATUS_MAP = {
+    'ACTIVE': 'active',
+    'PAUSED': 'paused',
+    'CAMPAIGN_PAUSED': 'paused',
+    'ADSET_PAUSED': 'paused',
+    'PENDING_REVIEW': 'pending',
+    'IN_PROCESS': 'pending',
+    'PREAPPROVED': 'pending',
+    'PENDING_BILLING_INFO': 'pending',
+    'DISAPPROVED': 'error',
+    'WITH_ISSUES': 'error',
+    'ARCHIVED': 'completed',
+    'DELETED': 'completed',
+}
+
+LOCK_TIMEOUT = 15 * 60
+
+STATUS_UPDATE_FIELDS = [
+    'status', 'facebook_status', 'status_checked_at', 'status_check_interval',
+    'next_status_check_at', 'updated_at',
+]
+
+
+class StatusSyncError(Exception):
+    """Raised when Facebook refuses a status read"""
+
+
+def due_campaigns(now=None):
+    """Launched campaigns whose status is due for a check"""
+    now = now or timezone.now()
+    return Campaign.objects.filter(
+        Q(next_status_check_at__isnull=True) | Q(next_status_check_at__lte=now),
+        Q(status__in=SYNCED_STATUSES) | Q(status='error', facebook_status__isnull=False),
+        facebook_campaign_id__isnull=False,
+        facebook_account__is_active=True,
+    ).exclude(facebook_status__in=TERMINAL_STATUSES)
+
+
+def schedule_status_syncs():
+    """
+    Queue a status sync for every ad account with campaigns due a check
+
+    Returns:
+        Number of accounts queued
+    """
+    from ..tasks import sync_account_statuses
+
+    account_ids = list(due_campaigns().values_list('facebook_account_id', flat=True).distinct())
+    for account_id in account_ids:
+        sync_account_statuses.delay(account_id)
+    return len(account_ids)
+
+
+def sync_account(account_pk):
+    """
+    Read the status of an ad account's due campaigns and store changes
+
+    Args:
+        account_pk: FacebookAdAccount primary key
+
+    Returns:
+        Number of campaigns whose status changed, or None if skipped
+    """
+    lock_key = f"status-sync-lock:{account_pk}"
+    if not cache.add(lock_key, 'locked', LOCK_TIMEOUT):
+        return None
+    try:
+        account = FacebookAdAccount.objects.filter(pk=account_pk, is_active=True).first()
+        if account is None:
+            return None
+        campaigns = list(
+            due_campaigns().filter(facebook_account=account)
+            .order_by('next_status_check_at')[:settings.STATUS_SYNC_MAX_CAMPAIGNS]
+        )
+        if not campaigns:
+            return 0
+
+        statuses = {}
+        with graph_context(priority=BACKGROUND, ad_account_id=account.account_id):
+            for start in range(0, len(campaigns), IDS_PER_CALL):
+                ids = [campaign.facebook_campaign_id for campaign in campaigns[start:start + IDS_PER_CALL]]
+                statuses.update(fetch_statuses(account.access_token, ids))
+        return apply_statuses(campaigns, statuses)
+    finally:
+        cache.delete(lock_key)
+
+
+def fetch_statuses(access_token, ids):
+    """
+    Read effective_status and stop_time for many campaigns at once
+
+    If a single ID no longer exists, Graph fails the whole ``?ids=``
+    request. The batch is then split in halves until the missing
+    campaigns are isolated; they are reported as DELETED.
+
+    Returns:
+        Dictionary of Facebook campaign ID to its fields
+    """
+    response = graph_client.get('', params={
+        'ids': ','.join(ids),
+        'fields': STATUS_FIELDS,
+        'access_token': access_token,
+    })
+    if response.status_code == 200:
+        return response.json()
+    if graph_error_code(response) != NONEXISTING_OBJECT_CODE:
+        raise StatusSyncError(f"Error reading campaign statuses: {response.text}")
+    if len(ids) == 1:
+        return {ids[0]: {'effective_status': 'DELETED'}}
+    middle = len(ids) // 2
+    return {**fetch_statuses(access_token, ids[:middle]), **fetch_statuses(access_token, ids[middle:])}
+
+
+def map_status(fields, now):
+    """Campaign.status for the fields read from Facebook"""
+    effective_status = fields.get('effective_status')
+    stop_time = parse_datetime(fields['stop_time']) if fields.get('stop_time') else None
+    if effective_status == 'ACTIVE' and stop_time and stop_time <= now:
+        return 'completed'
+    return EFFECTIVE_STATUS_MAP.get(effective_status)
+
+
+def next_interval(campaign, changed):
+    """Seconds until the next check: reset on change, doubled otherwise"""
+    if changed or not campaign.status_check_interval:
+        return settings.STATUS_CHECK_MIN_INTERVAL
+    return min(campaign.status_check_interval * 2, settings.STATUS_CHECK_MAX_INTERVAL)
+
+
+def record_status(campaign, fields, now, checked_at=None):
+    """
+    Apply a status read from, or pushed by, Facebook to a campaign in memory
+
+    Args:
+        campaign: Campaign to update; it is not saved
+        fields: Dictionary with effective_status and optionally stop_time
+        now: Current time, the base of the next check
+        checked_at: Time the fields describe, defaults to now
+
+    Returns:
+        True if the status or Facebook status changed
+    """
+    effective_status = fields.get('effective_status')
+    status = map_status(fields, now) or campaign.status
+    changed = status != campaign.status or effective_status != campaign.facebook_status
+    interval = next_interval(campaign, changed)
+
+    if changed:
+        logger.info(
+            f"Campaign {campaign.id} is {effective_status} on Facebook, "
+            f"status {campaign.status} -> {status}"
+        )
+        campaign.status = status
+        campaign.facebook_status = effective_status
+        campaign.updated_at = now
+    campaign.status_checked_at = checked_at or now
+    campaign.status_check_interval = interval
+    campaign.next_status_check_at = now + timedelta(seconds=interval)
+    return changed
+
+
+def apply_statuses(campaigns, statuses, now=None):
+    """
+    Diff Facebook's statuses against the campaigns and write the changes
+
+    Args:
+        campaigns: Campaigns that were read
+        statuses: Facebook campaign ID to fields, from fetch_statuses
+
+    Returns:
+        Number of campaigns whose status changed
+    """
+    now = now or timezone.now()
+    changed = []
+    # Unchanged campaigns only move their next check, grouped by interval
+    rescheduled = defaultdict(list)
+    checked_users = set()
+    for campaign in campaigns:
+        fields = statuses.get(campaign.facebook_campaign_id)
+        if fields is None:
+            continue
+        checked_users.add(campaign.user_id)
+        if record_status(campaign, fields, now):
+            changed.append(campaign)
+        else:
+            rescheduled[campaign.status_check_interval].append(campaign.id)
+
+    if changed:
+        Campaign.objects.bulk_update(changed, STATUS_UPDATE_FIELDS)
+        live_events.campaign_statuses_changed(changed)
+    for interval, campaign_ids in rescheduled.items():
+        Campaign.objects.filter(pk__in=campaign_ids).update(
+            status_checked_at=now,
+            status_check_interval=interval,
+            next_status_check_at=now + timedelta(seconds=interval),
+        )
+    # Even unchanged campaigns are served with a new status_checked_at
+    response_cache.invalidate(*checked_users)
+    return len(changed)
+
+
+def schedule_first_check(campaign, now=None):
+    """Set a just-launched campaign up for its first, soonest check"""
+    now = now or timezone.now()
+    campaign.status_check_interval = settings.STATUS_CHECK_MIN_INTERVAL
+    campaign.next_status_check_at = now + timedelta(seconds=settings.STATUS_CHECK_MIN_INTERVAL)
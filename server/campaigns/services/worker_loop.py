@@ -0,0 +1,72 @@
+"""
+Long-lived event loop for the synchronous callers of QuickCampaigns
+
+Celery tasks and other synchronous code run launches and Graph calls as
+coroutines. async_to_sync would start a new event loop for every call,
+and an httpx pool belongs to the loop it was opened on, so each task
+would open new connections to graph.facebook.com. Instead, every worker
+process keeps one event loop running in a daemon thread. Coroutines are
+submitted to it with run(), and the shared async_graph_client keeps its
+keep-alive connections there from one task to the next.
+
+The coroutine runs in a fresh context that carries only the caller's
+graph_context. Its thread-sensitive sync_to_async work therefore runs in
+asgiref's single sync thread, never in the blocked caller. The database
+connections of that thread are checked after every call, as Celery does
+for its own threads.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from .graph_scheduler import graph_context, graph_tags
+
+_loop = None
+_lock = threading.Lock()
+
+
+def worker_loop():
+    """This process's event loop, started in a daemon thread on first use"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='worker-loop', daemon=True).start()
+        return _loop
+
+
+def run(coroutine_function, *args, **kwargs):
+    """
+    Run a coroutine function to completion on the worker loop
+
+    Must not be called from a coroutine, nor from a function that
+    sync_to_async runs in its single sync thread.
+
+    Returns:
+        The coroutine's result; its exception is raised here
+    """
+    tags = graph_tags()
+
+    async def call():
+        try:
+            with graph_context(**tags):
+                return await coroutine_function(*args, **kwargs)
+        finally:
+            await sync_to_async(close_old_connections)()
+
+    # An empty context: the caller's asgiref state must not route the
+    # coroutine's sync work back to this thread, which is blocked below
+    future = contextvars.Context().run(asyncio.run_coroutine_threadsafe, call(), worker_loop())
+    return future.result()
+
+
+def _forget_loop():
+    # The loop's thread does not survive a fork (Celery's prefork pool)
+    global _loop, _lock
+    _loop = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_loop)
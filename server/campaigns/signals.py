@@ -0,0 +1,39 @@
+"""
+Model signal handlers for QuickCampaigns
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Campaign, CampaignCreative, CreativeBlob, FacebookAdAccount, UserCredit
+from .services import creative_store, response_cache
+
+
+@receiver(post_delete, sender=CampaignCreative)
+def release_creative_blob(sender, instance, **kwargs):
+    """Drop the deleted creative's reference to its shared file"""
+    if instance.blob_id:
+        creative_store.release_blob(instance.blob_id)
+
+
+@receiver([post_save, post_delete], sender=Campaign)
+@receiver([post_save, post_delete], sender=UserCredit)
+@receiver([post_save, post_delete], sender=FacebookAdAccount)
+def invalidate_owner_responses(sender, instance, **kwargs):
+    """Drop the cached responses of the user owning the changed row"""
+    response_cache.invalidate(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=CampaignCreative)
+def invalidate_creative_responses(sender, instance, **kwargs):
+    """Creatives are served inside their campaign"""
+    response_cache.invalidate(
+        Campaign.objects.filter(pk=instance.campaign_id).values_list('user_id', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=CreativeBlob)
+def invalidate_blob_responses(sender, instance, created, **kwargs):
+    """Processing results of a shared file are served with every creative using it"""
+    if not created:
+        response_cache.invalidate(*CampaignCreative.objects.filter(blob=instance).values_list(
+            'campaign__user_id', flat=True
+        ).distinct())
@@ -0,0 +1,128 @@
+"""
+Celery tasks for QuickCampaigns
+"""
+import logging
+from celery import shared_task
+from django.conf import settings
+from .models import FacebookAdAccount
+from .services import (
+    chunked_upload, creative_processing, creative_store, credit_ledger, facebook_webhooks, insights_sync,
+    status_sync,
+)
+from .services.account_discovery import discover_remaining_accounts
+from .services.credit_reconciliation import ReconciliationInProgress, reconcile_balances
+from .services.launch_service import (
+    reconcile_unconfirmed_jobs, requeue_stale_jobs, run_launch_batch, run_launch_job,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def launch_campaign(job_id):
+    """Run a queued LaunchJob"""
+    run_launch_job(job_id)
+
+
+@shared_task
+def launch_campaign_batch(job_ids):
+    """Run a chunk of queued LaunchJobs of one ad account together"""
+    run_launch_batch(job_ids)
+
+
+@shared_task
+def requeue_stale_launch_jobs():
+    """Queue again the launches whose worker died while running them"""
+    return requeue_stale_jobs()
+
+
+@shared_task
+def reconcile_unconfirmed_launch_jobs():
+    """Charge or return the credit of interrupted launches once their campaigns were read back"""
+    return reconcile_unconfirmed_jobs()
+
+
+@shared_task
+def discover_ad_accounts(account_pk, after):
+    """
+    Save the remaining pages of a user's ad accounts
+
+    Args:
+        account_pk: A FacebookAdAccount saved from the first page; its
+            owner and access token are used for the remaining pages
+        after: Paging cursor of the next page
+    """
+    account = FacebookAdAccount.objects.select_related('user').filter(pk=account_pk).first()
+    if account is None:
+        logger.info(f"Ad account {account_pk} was disconnected, skipping discovery")
+        return
+    discover_remaining_accounts(account.user, account.access_token, after)
+
+
+@shared_task
+def expire_credit_reservations():
+    """Return credits held by launches that never settled"""
+    return credit_ledger.expire_stale_reservations()
+
+
+@shared_task
+def reconcile_credit_balances():
+    """Scheduled reconciliation of balances against the ledger"""
+    try:
+        checkpoint = reconcile_balances(repair=settings.CREDIT_RECONCILIATION_REPAIR)
+    except ReconciliationInProgress:
+        logger.info("Credit reconciliation already running, skipping")
+        return
+    logger.info(
+        f"Credit reconciliation scanned {checkpoint.transactions_scanned} transactions, "
+        f"{checkpoint.drift_count} drifted, {checkpoint.repaired_count} repaired, "
+        f"timings {checkpoint.timings}"
+    )
+
+
+@shared_task
+def abort_stale_creative_uploads():
+    """Discard chunked uploads that were never completed"""
+    return chunked_upload.abort_stale_uploads()
+
+
+@shared_task
+def index_creative_blob(creative_id):
+    """Hash a creative uploaded straight to storage and deduplicate it"""
+    creative_store.index_creative(creative_id)
+
+
+@shared_task
+def process_creative_blob(blob_id):
+    """Measure, preview and validate a creative file (routed to the creatives queue)"""
+    return creative_processing.process_blob(blob_id)
+
+
+@shared_task
+def sync_campaign_insights():
+    """Scheduled insights sync; fans out one task per ad account"""
+    return insights_sync.schedule_account_syncs()
+
+
+@shared_task
+def sync_account_insights(account_pk):
+    """Pull new daily insights of one ad account's campaigns (routed to the insights queue)"""
+    return insights_sync.sync_account(account_pk)
+
+
+@shared_task
+def sync_campaign_statuses():
+    """Scheduled status sync; fans out one task per ad account with campaigns due a check"""
+    return status_sync.schedule_status_syncs()
+
+
+@shared_task
+def sync_account_statuses(account_pk):
+    """Reconcile the status of one ad account's due campaigns with Facebook"""
+    return status_sync.sync_account(account_pk)
+
+
+@shared_task
+def apply_facebook_webhook_events():
+    """Apply the Facebook webhook payloads queued since the last batch"""
+    return facebook_webhooks.drain_queue()
@@ -0,0 +1,1889 @@
+"""
+Tests for QuickCampaigns
+
+Run with ``python manage.py test campaigns``. Redis is replaced by the
+local-memory cache and the Graph API by fakes, so the tests need neither;
+the live event stream, rate limiter and circuit breakers are switched off.
+The tests of the webhook drain, the Graph rate limiter and the circuit
+breakers use the Redis at REDIS_URL and are skipped without one, as are
+the concurrency tests without PostgreSQL.
+"""
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from unittest import mock, skipUnless
+from urllib.parse import parse_qsl
+import httpx
+import redis
+import requests
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Sum
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .models import (
+    Campaign, CampaignCreative, CampaignDailyInsight, CreativeBlob, CreativeUpload, CreditReservation,
+    CreditTransaction, FacebookAdAccount, LaunchJob, MetricRollup, UserCredit
+)
+from .services import (
+    campaign_clone, chunked_upload, creative_store, credit_ledger, facebook_webhooks, insights_sync, launch_service,
+    circuit_breaker, graph_scheduler, metric_rollups, response_cache, status_sync, worker_loop
+)
+from .services.async_graph_client import AsyncGraphClient, async_graph_client
+from .services.circuit_breaker import Bulkhead, BulkheadFull, CircuitBreaker, CircuitOpen
+from .services.facebook_service import AsyncFacebookService, FacebookService
+from .services.graph_client import endpoint_label, graph_client, record_response
+from .services.graph_scheduler import BACKGROUND, GraphScheduler, GraphThrottled, graph_context
+from .services.launch_plan import LaunchPlan, LaunchPlanError
+
+User = get_user_model()
+
+test_settings = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    LIVE_EVENTS=False,
+    GRAPH_RATE_LIMITING=False,
+    GRAPH_CIRCUIT_BREAKER=False,
+)
+
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(REDIS_URL, socket_connect_timeout=1).ping()
+    except redis.RedisError:
+        return False
+
+
+def create_user(username='advertiser', credits=0):
+    user = User.objects.create_user(username, f"{username}@example.com", 'password')
+    if credits:
+        credit_ledger.credit(user, credits, description='Test credits')
+    return user
+
+
+def create_account(user, account_id='act_100'):
+    return FacebookAdAccount.objects.create(user=user, account_id=account_id, name='Ads', access_token='token')
+
+
+def create_campaign(user, account=None, name='Campaign', creatives=0, objective='traffic', **fields):
+    campaign = Campaign.objects.create(
+        user=user, facebook_account=account, name=name, objective=objective, budget=10,
+        start_date=date(2030, 1, 1), **fields
+    )
+    CampaignCreative.objects.bulk_create([
+        CampaignCreative(
+            campaign=campaign, file=f"campaign_creatives/{name}-{number}.png", file_type='image/png',
+            file_name=f"{name}-{number}.png", file_size=100,
+        )
+        for number in range(creatives)
+    ])
+    return campaign
+
+
+@test_settings
+class LaunchLeaseTests(TestCase):
+    def setUp(self):
+        self.user = create_user(credits=10)
+        self.account = create_account(self.user)
+
+    def running_job(self, started_ago, attempts=1):
+        campaign = create_campaign(self.user, self.account, status='pending')
+        return LaunchJob.objects.create(
+            user=self.user, campaign=campaign, status='running', attempts=attempts,
+            started_at=timezone.now() - timedelta(seconds=started_ago),
+            reservation=credit_ledger.reserve(self.user, 1, campaign=campaign),
+        )
+
+    def test_claim_takes_over_an_expired_lease_only(self):
+        with self.settings(LAUNCH_JOB_LEASE=60):
+            live = self.running_job(started_ago=30)
+            stale = self.running_job(started_ago=90)
+
+            self.assertIsNone(launch_service.claim_job(live.id))
+            claimed = launch_service.claim_job(stale.id)
+
+        self.assertEqual(claimed.id, stale.id)
+        self.assertEqual(claimed.attempts, 2)
+        self.assertGreater(claimed.started_at, timezone.now() - timedelta(seconds=5))
+
+    @mock.patch('campaigns.tasks.launch_campaign_batch.delay')
+    @mock.patch('campaigns.tasks.launch_campaign.delay')
+    def test_stale_jobs_are_requeued(self, launch, launch_batch):
+        with self.settings(LAUNCH_JOB_LEASE=60):
+            live = self.running_job(started_ago=30)
+            single = self.running_job(started_ago=90)
+            reservation = credit_ledger.reserve(self.user, 2)
+            bulk = [
+                LaunchJob.objects.create(
+                    user=self.user, campaign=create_campaign(self.user, self.account, name=f"Bulk {n}"),
+                    reservation=reservation, status='running', attempts=1,
+                    started_at=timezone.now() - timedelta(seconds=90),
+                )
+                for n in range(2)
+            ]
+
+            self.assertEqual(launch_service.requeue_stale_jobs(), 3)
+
+        launch.assert_called_once_with(str(single.id))
+        (job_ids,), _ = launch_batch.call_args
+        self.assertEqual(sorted(job_ids), sorted(str(job.id) for job in bulk))
+        statuses = dict(LaunchJob.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[live.id], 'running')
+        self.assertEqual({statuses[job.id] for job in [single] + bulk}, {'queued'})
+        # Nothing was charged or returned; the jobs still hold their credits
+        self.assertEqual(UserCredit.objects.get(user=self.user).reserved, 4)
+
+    @mock.patch('campaigns.tasks.launch_campaign.delay')
+    def test_jobs_out_of_attempts_fail_and_return_their_credit(self, launch):
+        with self.settings(LAUNCH_JOB_LEASE=60):
+            job = self.running_job(started_ago=90, attempts=launch_service.MAX_LAUNCH_ATTEMPTS)
+            self.assertEqual(launch_service.requeue_stale_jobs(), 1)
+
+        launch.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(Campaign.objects.get(pk=job.campaign_id).status, 'error')
+        self.assertEqual(CreditReservation.objects.get(pk=job.reservation_id).status, 'released')
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (10, 0))
+
+    @mock.patch('campaigns.tasks.launch_campaign.delay')
+    def test_stale_jobs_that_were_sent_are_left_unconfirmed(self, launch):
+        with self.settings(LAUNCH_JOB_LEASE=60):
+            job = self.running_job(started_ago=90)
+            LaunchJob.objects.filter(pk=job.pk).update(sent_at=timezone.now() - timedelta(seconds=80))
+
+            self.assertIsNone(launch_service.claim_job(job.id))
+            self.assertEqual(launch_service.requeue_stale_jobs(), 1)
+
+        launch.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'unconfirmed')
+        self.assertEqual(Campaign.objects.get(pk=job.campaign_id).status, 'pending')
+        # Extended rather than expired while the launch is unconfirmed
+        CreditReservation.objects.filter(pk=job.reservation_id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(credit_ledger.expire_stale_reservations(), 0)
+        self.assertEqual(UserCredit.objects.get(user=self.user).reserved, 1)
+
+    def test_lease_is_renewed_while_the_launch_runs(self):
+        job = self.running_job(started_ago=90)
+        LaunchJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(seconds=90))
+
+        async def launch():
+            async with launch_service._renewing_lease([job]):
+                await asyncio.sleep(0.5)
+        with self.settings(LAUNCH_JOB_LEASE=0.3):
+            async_to_sync(launch)()
+        with self.settings(LAUNCH_JOB_LEASE=60):
+            self.assertIsNone(launch_service.claim_job(job.id))
+
+        job.refresh_from_db()
+        self.assertGreater(job.heartbeat_at, timezone.now() - timedelta(seconds=5))
+
+    def test_a_launch_that_lost_its_lease_leaves_the_job_to_its_new_owner(self):
+        job = self.running_job(started_ago=90)
+        campaign = job.campaign
+        bulk = self.running_job(started_ago=90)
+        bulk = LaunchJob.objects.select_related('campaign').prefetch_related('campaign__creatives').get(pk=bulk.pk)
+        # Another worker claimed both jobs after their lease ran out
+        LaunchJob.objects.update(started_at=timezone.now())
+
+        launch_service._finish_job(job, campaign, [], {'campaign': '120200000000001'})
+        launch_service._fail_job(job, 'Facebook is down')
+        launch_service._finish_batch([bulk], {bulk.id: ({'campaign': '120200000000002'}, {})}, {})
+
+        self.assertEqual(set(LaunchJob.objects.values_list('status', flat=True)), {'running'})
+        self.assertEqual(set(Campaign.objects.values_list('status', flat=True)), {'pending'})
+        self.assertEqual(set(Campaign.objects.values_list('facebook_campaign_id', flat=True)), {None})
+        self.assertEqual(set(CreditReservation.objects.values_list('status', flat=True)), {'held'})
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (10, 2))
+
+
+@test_settings
+@skipUnlessDBFeature('has_select_for_update')
+class CreditLedgerConcurrencyTests(TransactionTestCase):
+    """
+    Many threads move one balance at once
+
+    Needs a database with row locks (PostgreSQL); SQLite serializes writers
+    and answers "database is locked" instead.
+    """
+    threads = 16
+    operations = 50
+
+    def test_balance_matches_the_ledger(self):
+        user = create_user(credits=200)
+        errors = []
+
+        def worker(index):
+            rng = random.Random(index)
+            try:
+                for operation in range(self.operations):
+                    try:
+                        if rng.random() < 0.7:
+                            credit_ledger.debit(user, 1, description='Concurrent debit')
+                        elif rng.random() < 0.5:
+                            # Every thread replays the same keys; each may apply once
+                            credit_ledger.credit(user, 5, transaction_type='purchase',
+                                                 idempotency_key=f"purchase:{operation}")
+                        else:
+                            credit_ledger.credit(user, 1, transaction_type='refund')
+                    except credit_ledger.InsufficientCredits:
+                        pass
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        balance = UserCredit.objects.get(user=user).balance
+        ledger = CreditTransaction.objects.filter(user=user)
+        self.assertEqual(balance, ledger.aggregate(total=Sum('amount'))['total'])
+        self.assertGreaterEqual(balance, 0)
+        purchases = ledger.filter(transaction_type='purchase')
+        self.assertEqual(purchases.count(), purchases.values('idempotency_key').distinct().count())
+
+
+@test_settings
+class CampaignQueryCountTests(TestCase):
+    """Listing and reading campaigns costs the same queries however many there are"""
+
+    def setUp(self):
+        cache.clear()
+
+    def client_with_campaigns(self, count):
+        user = create_user(f"owner-{count}")
+        account = create_account(user, account_id=f"act_{count}")
+        campaigns = [create_campaign(user, account, name=f"Campaign {n}", creatives=3) for n in range(count)]
+        client = APIClient()
+        client.force_authenticate(user)
+        return client, campaigns[-1]
+
+    def queries(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_list_and_detail_queries_do_not_grow_with_campaigns(self):
+        client, campaign = self.client_with_campaigns(1)
+        list_queries = self.queries(client, '/api/campaigns/')
+        detail_queries = self.queries(client, f"/api/campaigns/{campaign.id}/")
+
+        for count in (10, 50):
+            with self.subTest(campaigns=count):
+                client, campaign = self.client_with_campaigns(count)
+                with self.assertNumQueries(list_queries):
+                    response = client.get('/api/campaigns/', {'page_size': 100})
+                self.assertEqual(len(response.data['results']), count)
+                self.assertEqual({len(item['creatives']) for item in response.data['results']}, {3})
+                with self.assertNumQueries(detail_queries):
+                    client.get(f"/api/campaigns/{campaign.id}/")
+
+
+@test_settings
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = self.settings(MEDIA_ROOT=media_root, USE_S3=False, CREATIVE_UPLOAD_PART_SIZE=4)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        user = create_user()
+        self.upload = chunked_upload.start_upload(user, create_campaign(user), 'banner.png', 'image/png', 10)
+
+    def send_parts(self, data=b'0123456789'):
+        for number, offset in enumerate(range(0, len(data), 4), start=1):
+            chunk = data[offset:offset + 4]
+            chunked_upload.upload_part(self.upload, number, io.BytesIO(chunk), len(chunk))
+
+    def status(self):
+        return CreativeUpload.objects.get(pk=self.upload.pk).status
+
+    def test_parts_are_joined_outside_the_row_lock(self):
+        self.send_parts()
+        statuses = []
+        join = chunked_upload.LocalUploadBackend.complete
+
+        def complete(backend, upload, parts):
+            statuses.append(self.status())
+            with self.assertRaisesMessage(chunked_upload.UploadError, 'Upload is completing'):
+                chunked_upload.upload_part(CreativeUpload.objects.get(pk=upload.pk), 1, io.BytesIO(b'xxxx'), 4)
+            return join(backend, upload, parts)
+
+        with mock.patch.object(chunked_upload.LocalUploadBackend, 'complete', complete):
+            creative = chunked_upload.complete_upload(self.upload)
+
+        self.assertEqual(statuses, ['completing'])
+        self.assertEqual(self.status(), 'completed')
+        with creative.file.open('rb') as stored:
+            self.assertEqual(stored.read(), b'0123456789')
+        self.assertEqual(chunked_upload.complete_upload(self.upload), creative)
+
+    def test_failed_assembly_can_be_completed_again(self):
+        self.send_parts()
+        with mock.patch.object(chunked_upload.LocalUploadBackend, 'complete', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                chunked_upload.complete_upload(self.upload)
+
+        self.assertEqual(self.status(), 'uploading')
+        self.assertFalse(CampaignCreative.objects.filter(file_name='banner.png').exists())
+
+    def test_s3_parts_are_sent_from_a_seekable_file(self):
+        sent = {}
+
+        def upload_part(Body, ContentLength, **params):
+            sent['seekable'] = Body.seekable()
+            sent['body'] = Body.read()
+            Body.seek(0)
+            sent['retried'] = Body.read()
+            sent['length'] = ContentLength
+            return {'ETag': '"etag"'}
+
+        storage = mock.Mock(bucket_name='media', location='')
+        storage.connection.meta.client.upload_part.side_effect = upload_part
+        self.upload.multipart_upload_id = 'multipart'
+        reader = chunked_upload.BodyReader(io.BytesIO(b'0123'), 4)
+
+        etag = chunked_upload.S3UploadBackend(storage).upload_part(self.upload, 1, reader)
+
+        self.assertEqual(etag, '"etag"')
+        self.assertEqual(sent, {'seekable': True, 'body': b'0123', 'retried': b'0123', 'length': 4})
+
+
+@test_settings
+class DirectUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = self.settings(MEDIA_ROOT=media_root, USE_S3=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        user = create_user()
+        self.campaign = create_campaign(user)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.url = f"/api/campaigns/{self.campaign.id}/creatives/"
+        self.token = self.client.post(
+            f"{self.url}presign/", {'file_name': 'banner.png', 'file_type': 'image/png'}, format='json'
+        ).data['upload_token']
+
+    def put(self, body=b'png bytes'):
+        return self.client.generic('PUT', f"/api/creative-uploads/{self.token}/", body, content_type='image/png')
+
+    def finalize(self):
+        return self.client.post(f"{self.url}finalize/", {'upload_token': self.token}, format='json')
+
+    @mock.patch('campaigns.tasks.index_creative_blob.delay')
+    def test_token_is_spent_by_finalize(self, index):
+        self.assertEqual(self.put().status_code, 200)
+        self.assertEqual(self.put().status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.finalize()
+        self.assertEqual(response.status_code, 201)
+        index.assert_called_once_with(response.data['id'])
+
+        # The stored content can no longer be replaced
+        self.assertEqual(self.put(b'other bytes').status_code, 400)
+
+    @mock.patch('campaigns.tasks.index_creative_blob.delay')
+    def test_finalize_is_idempotent_after_the_file_moves(self, index):
+        self.put()
+        creative_id = self.finalize().data['id']
+        # Indexing points the creative at its content-addressed blob file
+        CampaignCreative.objects.filter(pk=creative_id).update(file='creative_blobs/ab/abcdef.png')
+
+        response = self.finalize()
+
+        self.assertEqual(response.data['id'], creative_id)
+        self.assertEqual(CampaignCreative.objects.filter(campaign=self.campaign).count(), 1)
+
+
+@test_settings
+class CreativeStoreTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = self.settings(MEDIA_ROOT=media_root, USE_S3=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.creative = create_campaign(create_user(), creatives=1).creatives.get()
+        self.own_name = self.creative.file.name
+        default_storage.save(self.own_name, ContentFile(b'png bytes'))
+        self.sha256, self.size = creative_store.hash_chunks([b'png bytes'])
+
+    @mock.patch('campaigns.tasks.process_creative_blob.delay')
+    def test_own_file_is_removed_once_the_blob_commits(self, process):
+        with self.captureOnCommitCallbacks(execute=True):
+            blob = creative_store.register_creative(self.creative, self.sha256, self.size)
+
+        self.assertEqual(CampaignCreative.objects.get(pk=self.creative.pk).file.name, blob.file.name)
+        self.assertFalse(default_storage.exists(self.own_name))
+        with default_storage.open(blob.file.name) as stored:
+            self.assertEqual(stored.read(), b'png bytes')
+
+    def test_rollback_leaves_the_creative_file_in_place(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                creative_store.register_creative(self.creative, self.sha256, self.size)
+                raise RuntimeError("Request failed after indexing")
+
+        creative = CampaignCreative.objects.get(pk=self.creative.pk)
+        self.assertEqual((creative.file.name, creative.blob_id), (self.own_name, None))
+        self.assertTrue(default_storage.exists(self.own_name))
+
+
+def webhook_events(object_id, status_name, time):
+    payload = facebook_webhooks.build_payload('act_100', object_id, status_name=status_name, time=time)
+    return facebook_webhooks.parse_events(json.loads(payload))
+
+
+@test_settings
+@override_settings(FACEBOOK_APP_SECRET='app-secret')
+class FacebookWebhookTests(TestCase):
+    def setUp(self):
+        self.campaign = create_campaign(create_user(), facebook_campaign_id='120200000000001')
+        self.now = int(timezone.now().timestamp())
+
+    def post(self, body, signature):
+        headers = {'HTTP_X_HUB_SIGNATURE_256': signature} if signature else {}
+        return APIClient().post('/api/webhooks/facebook/', body, content_type='application/json', **headers)
+
+    @mock.patch('campaigns.services.facebook_webhooks.enqueue_payload')
+    def test_only_correctly_signed_payloads_are_queued(self, enqueue):
+        body = facebook_webhooks.build_payload('act_100', '120200000000001')
+
+        self.assertEqual(self.post(body, None).status_code, 403)
+        self.assertEqual(self.post(body, facebook_webhooks.sign_payload(body, 'other-secret')).status_code, 403)
+        self.assertEqual(self.post(body + b' ', facebook_webhooks.sign_payload(body)).status_code, 403)
+        enqueue.assert_not_called()
+
+        self.assertEqual(self.post(body, facebook_webhooks.sign_payload(body)).status_code, 200)
+        enqueue.assert_called_once_with(body)
+
+    def test_newest_event_wins_in_any_order(self):
+        events = (
+            webhook_events('120200000000001', 'PAUSED', self.now)
+            + webhook_events('120200000000001', 'ACTIVE', self.now - 60)
+        )
+
+        self.assertEqual(facebook_webhooks.apply_events(events), 1)
+        self.assertEqual(Campaign.objects.get(pk=self.campaign.pk).facebook_status, 'PAUSED')
+
+    def test_late_delivery_does_not_roll_the_status_back(self):
+        facebook_webhooks.apply_events(webhook_events('120200000000001', 'PAUSED', self.now))
+
+        self.assertEqual(facebook_webhooks.apply_events(webhook_events('120200000000001', 'ACTIVE', self.now - 60)), 0)
+        self.assertEqual(Campaign.objects.get(pk=self.campaign.pk).facebook_status, 'PAUSED')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': REDIS_URL}},
+    FACEBOOK_APP_SECRET='app-secret',
+)
+@test_settings
+@skipUnless(redis_available(), "needs Redis at REDIS_URL")
+class FacebookWebhookDrainTests(TestCase):
+    """Queued payloads survive a failed drain and are applied once"""
+
+    def setUp(self):
+        self.conn = facebook_webhooks.get_redis_connection('default')
+        self.clear_redis()
+        self.addCleanup(self.clear_redis)
+        self.campaign = create_campaign(create_user(), facebook_campaign_id='120200000000001')
+        self.now = int(timezone.now().timestamp())
+        schedule = mock.patch('campaigns.tasks.apply_facebook_webhook_events.apply_async')
+        self.schedule = schedule.start()
+        self.addCleanup(schedule.stop)
+
+    def clear_redis(self):
+        keys = [facebook_webhooks.QUEUE_KEY, facebook_webhooks.PROCESSING_KEY, facebook_webhooks.DRAIN_SCHEDULED_KEY]
+        keys += self.conn.keys(f"{facebook_webhooks.SEEN_KEY_PREFIX}*")
+        self.conn.delete(*keys)
+
+    def deliver(self, status_name, time):
+        body = facebook_webhooks.build_payload('act_100', '120200000000001', status_name=status_name, time=time)
+        response = APIClient().post(
+            '/api/webhooks/facebook/', body, content_type='application/json',
+            HTTP_X_HUB_SIGNATURE_256=facebook_webhooks.sign_payload(body),
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def facebook_status(self):
+        return Campaign.objects.get(pk=self.campaign.pk).facebook_status
+
+    def test_redeliveries_are_applied_once(self):
+        for _ in range(3):
+            self.deliver('PAUSED', self.now)
+        self.schedule.assert_called_once()
+
+        self.assertEqual(facebook_webhooks.drain_queue(), 1)
+        self.assertEqual(self.facebook_status(), 'PAUSED')
+
+        # A redelivery after the batch committed is recognised by its marker
+        Campaign.objects.filter(pk=self.campaign.pk).update(facebook_status='ACTIVE', status_checked_at=None)
+        self.deliver('PAUSED', self.now)
+        self.assertEqual(facebook_webhooks.drain_queue(), 0)
+        self.assertEqual(self.facebook_status(), 'ACTIVE')
+
+    def test_failed_drain_keeps_its_payloads(self):
+        self.deliver('PAUSED', self.now)
+        with mock.patch.object(facebook_webhooks, 'apply_events', side_effect=RuntimeError('database went away')):
+            with self.assertRaises(RuntimeError):
+                facebook_webhooks.drain_queue()
+
+        self.assertEqual(self.conn.llen(facebook_webhooks.PROCESSING_KEY), 1)
+        self.assertEqual(self.conn.keys(f"{facebook_webhooks.SEEN_KEY_PREFIX}*"), [])
+        # The drain flag was cleared and a retry scheduled
+        self.assertEqual(self.schedule.call_count, 2)
+        self.assertEqual(self.conn.get(facebook_webhooks.DRAIN_SCHEDULED_KEY), b'1')
+
+        self.deliver('ACTIVE', self.now - 60)
+        self.assertEqual(facebook_webhooks.drain_queue(), 1)
+        self.assertEqual(self.facebook_status(), 'PAUSED')
+        self.assertEqual(self.conn.llen(facebook_webhooks.PROCESSING_KEY), 0)
+        self.assertEqual(self.conn.llen(facebook_webhooks.QUEUE_KEY), 1)
+
+
+@test_settings
+class CampaignCloneTests(TestCase):
+    def setUp(self):
+        self.source = create_campaign(create_user(), creatives=2)
+        self.blob = CreativeBlob.objects.create(sha256='a' * 64, file='creative_blobs/aa/a.png', file_size=100, ref_count=2)
+        self.source.creatives.update(blob=self.blob)
+
+    def test_clones_read_the_creatives_left_when_the_blobs_are_locked(self):
+        deleted = [self.source.creatives.first()]
+        lock = CreativeBlob.objects.select_for_update
+
+        def delete_then_lock():
+            # A delete that committed before the lock was granted
+            if deleted:
+                deleted.pop().delete()
+            return lock()
+
+        with mock.patch.object(CreativeBlob.objects, 'select_for_update', side_effect=delete_then_lock):
+            clones = campaign_clone.clone_campaign(self.source, [{}, {}])
+
+        self.assertEqual([clone.creatives.count() for clone in clones], [1, 1])
+        self.blob.refresh_from_db()
+        self.assertEqual(self.blob.ref_count, 3)
+
+    def test_creatives_without_a_blob_are_not_cloned(self):
+        CampaignCreative.objects.filter(pk=self.source.creatives.first().pk).update(blob=None)
+
+        with self.assertRaises(campaign_clone.CreativesNotStored):
+            campaign_clone.clone_campaign(self.source, [{}])
+        self.assertFalse(Campaign.objects.filter(cloned_from=self.source).exists())
+
+
+@test_settings
+class ResponseCacheTests(TestCase):
+    """A cached response is never served after a write to the rows it shows"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user(credits=10)
+        self.account = create_account(self.user)
+        self.campaign = create_campaign(self.user, self.account, creatives=2, facebook_campaign_id='120200000000001')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def refreshed(self, write, url='/api/campaigns/'):
+        """Body of ``url`` read after ``write`` commits, once a cached copy exists"""
+        self.client.get(url)
+        self.assertFalse(hasattr(self.client.get(url), 'data'), "second read was not served from the cache")
+        with self.captureOnCommitCallbacks(execute=True):
+            write()
+        response = self.client.get(url)
+        self.assertTrue(hasattr(response, 'data'), "stale response served after the write")
+        return json.loads(response.content)
+
+    def campaign_statuses(self, body):
+        return {item['id']: item['status'] for item in body['results']}
+
+    def test_save_and_delete_signals(self):
+        def rename():
+            self.campaign.name = 'Renamed'
+            self.campaign.save()
+
+        body = self.refreshed(rename)
+        self.assertEqual(body['results'][0]['name'], 'Renamed')
+
+        detail = f"/api/campaigns/{self.campaign.id}/"
+        body = self.refreshed(lambda: self.campaign.creatives.first().delete(), detail)
+        self.assertEqual(len(body['creatives']), 1)
+
+        body = self.refreshed(self.campaign.delete)
+        self.assertEqual(body['results'], [])
+
+    def test_credit_ledger(self):
+        body = self.refreshed(lambda: credit_ledger.debit(self.user, 3), '/api/credits/')
+        self.assertEqual([item['balance'] for item in body], [7])
+
+    def test_finished_launch_batch(self):
+        job = LaunchJob.objects.create(user=self.user, campaign=self.campaign, status='running')
+        jobs = list(LaunchJob.objects.select_related('campaign').prefetch_related('campaign__creatives'))
+
+        body = self.refreshed(lambda: launch_service._finish_batch(jobs, {}, {job.id: ('Invalid parameter', {})}))
+        self.assertEqual(self.campaign_statuses(body), {self.campaign.id: 'error'})
+
+    def test_failed_launch_job(self):
+        job = LaunchJob.objects.create(user=self.user, campaign=self.campaign, status='running')
+
+        body = self.refreshed(lambda: launch_service._fail_job(job, 'Facebook is down'))
+        self.assertEqual(self.campaign_statuses(body), {self.campaign.id: 'error'})
+
+    def test_status_sync(self):
+        Campaign.objects.filter(pk=self.campaign.pk).update(status='active')
+        campaigns = list(Campaign.objects.filter(pk=self.campaign.pk))
+
+        body = self.refreshed(lambda: status_sync.apply_statuses(
+            campaigns, {'120200000000001': {'effective_status': 'PAUSED'}}
+        ))
+        self.assertEqual(self.campaign_statuses(body), {self.campaign.id: Campaign.objects.get(pk=self.campaign.pk).status})
+        self.assertNotEqual(Campaign.objects.get(pk=self.campaign.pk).status, 'active')
+
+    def test_facebook_webhook_events(self):
+        Campaign.objects.filter(pk=self.campaign.pk).update(status='active')
+        events = webhook_events('120200000000001', 'PAUSED', int(timezone.now().timestamp()))
+
+        body = self.refreshed(lambda: facebook_webhooks.apply_events(events))
+        self.assertEqual(self.campaign_statuses(body), {self.campaign.id: Campaign.objects.get(pk=self.campaign.pk).status})
+        self.assertNotEqual(Campaign.objects.get(pk=self.campaign.pk).status, 'active')
+
+    def test_campaign_clone(self):
+        blob = CreativeBlob.objects.create(sha256='b' * 64, file='creative_blobs/bb/b.png', file_size=100, ref_count=2)
+        self.campaign.creatives.update(blob=blob)
+
+        body = self.refreshed(lambda: campaign_clone.clone_campaign(self.campaign, [{}, {}]))
+        self.assertEqual(len(body['results']), 3)
+
+    def test_response_built_while_a_write_commits_is_stored_under_the_old_version(self):
+        store = cache.set
+
+        def commit_then_store(key, *args, **kwargs):
+            # The write commits after the response was built from the old rows
+            with self.captureOnCommitCallbacks(execute=True):
+                Campaign.objects.filter(pk=self.campaign.pk).update(name='Renamed')
+                response_cache.invalidate(self.user.pk)
+            store(key, *args, **kwargs)
+
+        with mock.patch.object(response_cache.cache, 'set', side_effect=commit_then_store):
+            racing = self.client.get('/api/campaigns/')
+        self.assertEqual(racing.data['results'][0]['name'], 'Campaign')
+
+        response = self.client.get('/api/campaigns/')
+        self.assertTrue(hasattr(response, 'data'))
+        self.assertEqual(response.data['results'][0]['name'], 'Renamed')
+
+
+@test_settings
+class CreditReservationTests(TestCase):
+    def setUp(self):
+        self.user = create_user(credits=10)
+
+    def balance(self):
+        credits = UserCredit.objects.get(user=self.user)
+        return credits.balance, credits.reserved
+
+    def test_settling_a_part_twice_charges_once(self):
+        reservation = credit_ledger.reserve(self.user, 4)
+
+        for _ in range(2):
+            credit_ledger.settle_part(reservation.id, 'job-1', used=1, released=1)
+
+        self.assertEqual(self.balance(), (9, 2))
+        reservation.refresh_from_db()
+        self.assertEqual((reservation.status, reservation.amount), ('held', 2))
+
+    def test_part_of_an_expired_hold_is_debited_once(self):
+        reservation = credit_ledger.reserve(self.user, 4)
+        credit_ledger.release(reservation.id, status='expired')
+
+        first = credit_ledger.settle_part(reservation.id, 'job-1', used=2)
+        again = credit_ledger.settle_part(reservation.id, 'job-1', used=2)
+        credit_ledger.settle_part(reservation.id, 'job-2', used=1)
+
+        self.assertEqual(first, again)
+        self.assertEqual(self.balance(), (7, 0))
+
+    def test_sweeper_extends_holds_of_jobs_still_waiting(self):
+        campaign = create_campaign(self.user)
+        waiting = credit_ledger.reserve(self.user, 3, ttl=0)
+        LaunchJob.objects.create(user=self.user, campaign=campaign, reservation=waiting)
+        abandoned = credit_ledger.reserve(self.user, 2, ttl=0)
+
+        expired = credit_ledger.expire_stale_reservations(now=timezone.now() + timedelta(seconds=1))
+
+        self.assertEqual(expired, 1)
+        statuses = dict(CreditReservation.objects.values_list('id', 'status'))
+        self.assertEqual((statuses[waiting.id], statuses[abandoned.id]), ('held', 'expired'))
+        self.assertGreater(CreditReservation.objects.get(pk=waiting.id).expires_at, timezone.now())
+        self.assertEqual(self.balance(), (10, 3))
+
+
+@test_settings
+class CreditPurchaseTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def purchase(self, key):
+        return self.client.post('/api/credits/purchase/', {'amount': 5}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_repeated_idempotency_key_is_applied_once(self):
+        self.assertEqual(self.purchase('order-1').status_code, 200)
+        self.assertEqual(self.purchase('order-1').data['balance'], 5)
+
+    def test_overlong_idempotency_key_is_rejected(self):
+        response = self.purchase('k' * 101)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CreditTransaction.objects.exists())
+
+
+def graph_response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode()
+    return response
+
+
+def throttled_response(code=17, retry_after=None):
+    response = graph_response(400, {'error': {'code': code, 'message': 'User request limit reached'}})
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@test_settings
+class ThrottleFailFastTests(TestCase):
+    """Calls a web request waits on are not retried when Facebook throttles them"""
+
+    @mock.patch('campaigns.services.graph_client.time.sleep')
+    @mock.patch('requests.Session.request', return_value=throttled_response(retry_after=120))
+    def test_oauth_callback_answers_503_without_retrying(self, send, sleep):
+        response = APIClient().get('/api/campaigns/auth/facebook/callback/', {'code': 'abc'})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '120')
+        self.assertEqual(send.call_count, 1)
+        sleep.assert_not_called()
+        self.assertFalse(FacebookAdAccount.objects.exists())
+
+    def test_async_client_fails_fast_only_when_asked(self):
+        calls = []
+
+        def throttle(request):
+            calls.append(request)
+            return httpx.Response(429)
+
+        client = AsyncGraphClient(max_retries=2, backoff_base=0, backoff_max=0, transport=httpx.MockTransport(throttle))
+
+        async def get(**context):
+            with graph_context(**context):
+                return await client.get('me')
+
+        with self.assertRaises(GraphThrottled) as raised:
+            async_to_sync(get)(fail_fast=True)
+        self.assertEqual(len(calls), 1)
+        self.assertGreater(raised.exception.retry_after, 0)
+
+        # Background work keeps retrying inline
+        self.assertEqual(async_to_sync(get)().status_code, 429)
+        self.assertEqual(len(calls), 4)
+
+
+@test_settings
+class AsyncGraphClientTests(TestCase):
+    @override_settings(
+        GRAPH_RATE_LIMITING=True, GRAPH_CIRCUIT_BREAKER=True,
+        GRAPH_BULKHEAD_LIMITS={'interactive': 5, 'background': 5},
+    )
+    def test_call_does_its_redis_work_off_the_event_loop(self):
+        checks = []
+
+        def check(name, result=None):
+            def run(*args, **kwargs):
+                checks.append((name, loop_running()))
+                return result
+            return run
+
+        answers = [httpx.ConnectError('Connection refused'), httpx.Response(200, json={'id': '1'})]
+
+        def answer(request):
+            result = answers.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        async def call():
+            async with AsyncGraphClient(max_retries=1, backoff_base=0, transport=httpx.MockTransport(answer)) as client:
+                return await client.call('GET', 'me')
+
+        with mock.patch.object(circuit_breaker.breaker, 'before_call', side_effect=check('before_call')), \
+                mock.patch.object(graph_scheduler.scheduler, '_try_take', side_effect=check('take', 0)), \
+                mock.patch.object(circuit_breaker.bulkhead, '_acquire', side_effect=check('acquire', 1)), \
+                mock.patch.object(circuit_breaker.bulkhead, 'release', side_effect=check('release')), \
+                mock.patch('campaigns.services.async_graph_client.record_error', side_effect=check('record_error')), \
+                mock.patch('campaigns.services.async_graph_client.record_response', side_effect=check('record_response')):
+            self.assertEqual(async_to_sync(call)(), {'id': '1'})
+
+        steps = ['before_call', 'take', 'acquire']
+        self.assertEqual([name for name, _ in checks], steps + ['record_error', 'release'] + steps + ['release', 'record_response'])
+        self.assertEqual({on_loop for _, on_loop in checks}, {False})
+
+    def test_sync_callers_share_one_loop_and_connection_pool(self):
+        calls = []
+
+        def answer(request):
+            calls.append((threading.current_thread().name, graph_scheduler.current_priority()))
+            return httpx.Response(200, json={'id': request.url.path.rsplit('/', 1)[-1], 'name': 'Spring'})
+
+        # The pool opened on the worker loop answers through the mock transport only
+        worker_loop.run(async_graph_client.aclose)
+        self.addCleanup(worker_loop.run, async_graph_client.aclose)
+        service = FacebookService('token', '100')
+        with mock.patch.object(async_graph_client, 'transport', httpx.MockTransport(answer)), \
+                mock.patch('campaigns.services.async_graph_client.httpx.AsyncClient', side_effect=httpx.AsyncClient) as pools:
+            with graph_context(priority=BACKGROUND):
+                self.assertEqual(service.get_campaign('120')['id'], '120')
+            other = threading.Thread(target=service.get_campaign, args=('121',))
+            other.start()
+            other.join()
+
+        self.assertEqual(pools.call_count, 1)
+        self.assertEqual(calls, [('worker-loop', BACKGROUND), ('worker-loop', 'interactive')])
+
+
+class FakeGraph:
+    """
+    Local stand-in for the Graph API batch endpoint, used as an httpx transport
+
+    Runs the operations of each batch request in order like Facebook does:
+    ``{result=<name>:$.id}`` references are resolved against the earlier
+    operations of the same batch only, and an operation whose dependency
+    failed gets a null response. Operations named in ``fail`` are answered
+    with an error. A POST to an object's ID updates it; batch requests past
+    the first ``down_after`` fail with a connection error.
+
+    get() stands in for graph_client on ``?ids=`` reads of the objects'
+    effective_status, failing with error 100 if any ID does not exist.
+    """
+    REF = re.compile(r'\{result=([^:}]+):\$\.id\}')
+
+    def __init__(self, fail=(), down_after=None):
+        self.fail = set(fail)
+        self.down_after = down_after
+        self.batches = []
+        # IDs of each ?ids= read
+        self.reads = []
+        # Created object ID -> (relative_url, params)
+        self.objects = {}
+
+    def transport(self):
+        return httpx.MockTransport(self)
+
+    def __call__(self, request):
+        if self.down_after is not None and len(self.batches) >= self.down_after:
+            raise httpx.ConnectError('Connection refused', request=request)
+        form = dict(parse_qsl(request.content.decode()))
+        items = json.loads(form['batch'])
+        self.batches.append(items)
+        created = {}
+        responses = []
+        for item in items:
+            params = dict(parse_qsl(item['body']))
+            refs = {ref for value in params.values() for ref in self.REF.findall(value)}
+            if refs & self.fail or any(ref not in created and ref in self.names(items) for ref in refs):
+                responses.append(None)
+                continue
+            unknown = [ref for ref in refs if ref not in created]
+            if unknown or item['name'] in self.fail:
+                message = f"Unknown batch reference {unknown[0]}" if unknown else 'Invalid parameter'
+                responses.append({'code': 400, 'body': json.dumps({'error': {'message': message}})})
+                self.fail.add(item['name'])
+                continue
+            params = {key: self.REF.sub(lambda match: created[match.group(1)], value) for key, value in params.items()}
+            if item['relative_url'] in self.objects:
+                self.objects[item['relative_url']][1].update(params)
+                responses.append({'code': 200, 'body': json.dumps({'success': True})})
+                continue
+            object_id = str(1000 + len(self.objects))
+            self.objects[object_id] = (item['relative_url'], params)
+            created[item['name']] = object_id
+            responses.append({'code': 200, 'body': json.dumps({'id': object_id})})
+        return httpx.Response(200, json=responses)
+
+    def get(self, path, params=None, **kwargs):
+        ids = params['ids'].split(',')
+        self.reads.append(ids)
+        missing = [object_id for object_id in ids if object_id not in self.objects]
+        if missing:
+            return graph_response(400, {'error': {'code': 100, 'message': f"Object {missing[0]} does not exist"}})
+        return graph_response(200, {
+            object_id: {'id': object_id, 'effective_status': self.objects[object_id][1]['status']} for object_id in ids
+        })
+
+    @staticmethod
+    def names(items):
+        return {item['name'] for item in items}
+
+    def created(self, edge):
+        return {
+            object_id: params for object_id, (relative_url, params) in self.objects.items()
+            if relative_url.endswith(f"/{edge}")
+        }
+
+
+@test_settings
+@override_settings(FACEBOOK_PAGE_ID='200', FACEBOOK_LINK_URL='https://example.com', FACEBOOK_APP_SECRET=None)
+class LaunchPlanBatchTests(TestCase):
+    def setUp(self):
+        self.user = create_user(credits=10)
+        self.account = create_account(self.user)
+
+    def execute(self, graph, call):
+        async def run():
+            async with AsyncGraphClient(max_retries=0, transport=graph.transport()) as client:
+                return await call(AsyncFacebookService('token', '100', client=client))
+        return async_to_sync(run)()
+
+    def plan(self, campaign):
+        return LaunchPlan.for_campaign(campaign, list(campaign.creatives.order_by('id')), '100')
+
+    def test_references_resolve_across_batches(self):
+        # 2 + 2 * 30 operations: the last ads go out in a second batch and
+        # reference the ad set created by the first; a third switches the
+        # campaign on
+        campaign = create_campaign(self.user, self.account, creatives=30)
+        plan = self.plan(campaign)
+        graph = FakeGraph()
+
+        object_ids = self.execute(graph, lambda service: service.execute_launch_plan(plan))
+
+        self.assertEqual([len(batch) for batch in graph.batches], [50, 12, 1])
+        self.assertEqual(graph.objects[object_ids['campaign']][1]['status'], 'ACTIVE')
+        self.assertEqual(len(graph.created('ads')), 30)
+        for creative in campaign.creatives.all():
+            ad = graph.objects[object_ids[f"ad-{creative.id}"]][1]
+            self.assertEqual(ad['adset_id'], object_ids['adset'])
+            self.assertEqual(json.loads(ad['creative']), {'creative_id': object_ids[f"creative-{creative.id}"]})
+        ad_set = graph.objects[object_ids['adset']][1]
+        self.assertEqual(ad_set['campaign_id'], object_ids['campaign'])
+
+    def test_failed_operations_map_to_their_dependents(self):
+        campaign = create_campaign(self.user, self.account, creatives=30)
+        first = campaign.creatives.order_by('id').first()
+        plan = self.plan(campaign)
+        graph = FakeGraph(fail=[f"c{campaign.id}-adset", f"c{campaign.id}-creative-{first.id}"])
+
+        with self.assertRaises(LaunchPlanError) as raised:
+            self.execute(graph, lambda service: service.execute_launch_plan(plan))
+
+        errors = raised.exception.errors
+        object_ids = raised.exception.object_ids
+        prefix = f"c{campaign.id}-"
+        self.assertEqual(errors[f"{prefix}adset"], 'Invalid parameter')
+        self.assertEqual(errors[f"{prefix}creative-{first.id}"], 'Invalid parameter')
+        # Ads of the first batch were dropped by Facebook, those of the
+        # second were never sent
+        creatives = list(campaign.creatives.order_by('id'))
+        self.assertEqual(errors[f"{prefix}ad-{creatives[0].id}"], 'Not executed, a dependency failed')
+        self.assertEqual(errors[f"{prefix}ad-{creatives[-1].id}"], f"Skipped, depends on failed operation {prefix}adset")
+        self.assertEqual(len(errors), 2 + 30)
+        self.assertEqual(graph.created('ads'), {})
+        self.assertIn('campaign', object_ids)
+        self.assertEqual(len([key for key in object_ids if key.startswith('creative-')]), 29)
+        # The campaign that was created never went live
+        self.assertEqual(graph.objects[object_ids['campaign']][1]['status'], 'PAUSED')
+
+    def test_a_failed_batch_request_keeps_the_ids_of_earlier_ones(self):
+        campaign = create_campaign(self.user, self.account, creatives=30)
+        plan = self.plan(campaign)
+        graph = FakeGraph(down_after=1)
+
+        with self.assertRaises(LaunchPlanError) as raised:
+            self.execute(graph, lambda service: service.execute_launch_plan(plan))
+
+        errors = raised.exception.errors
+        object_ids = raised.exception.object_ids
+        self.assertEqual(set(object_ids), {'campaign', 'adset'} | {
+            f"{kind}-{creative.id}" for creative in campaign.creatives.order_by('id')[:24] for kind in ('creative', 'ad')
+        })
+        self.assertEqual(len(errors), 12)
+        self.assertTrue(all(message.startswith('Not confirmed') for message in errors.values()))
+        self.assertEqual(graph.objects[object_ids['campaign']][1]['status'], 'PAUSED')
+
+    def test_plans_sharing_batches_fail_separately(self):
+        campaigns = [create_campaign(self.user, self.account, name=f"C{n}", creatives=2) for n in range(2)]
+        plans = [self.plan(campaign) for campaign in campaigns]
+        graph = FakeGraph(fail=[f"c{campaigns[0].id}-campaign"])
+
+        outcomes = self.execute(graph, lambda service: service.execute_launch_plans(plans))
+
+        # Only the campaign created in full is switched on
+        self.assertEqual(len(graph.batches), 2)
+        self.assertEqual(FakeGraph.names(graph.batches[1]), {f"c{campaigns[1].id}-activate"})
+        (failed_ids, failed_errors), (object_ids, errors) = outcomes
+        # The creatives do not depend on the failed campaign and were created
+        self.assertEqual(set(failed_ids), {f"creative-{creative.id}" for creative in campaigns[0].creatives.all()})
+        self.assertEqual(len(failed_errors), 1 + 1 + 2)
+        self.assertEqual(errors, {})
+        self.assertEqual(set(object_ids), {'campaign', 'adset'} | {
+            f"{kind}-{creative.id}" for creative in campaigns[1].creatives.all() for kind in ('creative', 'ad')
+        })
+
+    def test_launch_records_partially_created_objects(self):
+        campaign = create_campaign(self.user, self.account, creatives=2, status='pending')
+        first, second = campaign.creatives.order_by('id')
+        reservation = credit_ledger.reserve(self.user, 1, campaign=campaign)
+        job = LaunchJob.objects.create(user=self.user, campaign=campaign, reservation=reservation)
+        graph = FakeGraph(fail=[f"c{campaign.id}-ad-{second.id}"])
+
+        async def run():
+            async with AsyncGraphClient(max_retries=0, transport=graph.transport()) as client:
+                await launch_service.launch_job_async(job.id, client=client)
+        async_to_sync(run)()
+
+        job.refresh_from_db()
+        campaign.refresh_from_db()
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('Invalid parameter', job.error)
+        self.assertEqual(campaign.status, 'error')
+        self.assertIsNotNone(campaign.facebook_campaign_id)
+        self.assertIsNotNone(first.facebook_ad_id)
+        self.assertIsNotNone(second.facebook_creative_id)
+        self.assertIsNone(second.facebook_ad_id)
+        self.assertEqual(graph.objects[campaign.facebook_campaign_id][1]['status'], 'PAUSED')
+        self.assertEqual(CreditReservation.objects.get(pk=reservation.pk).status, 'released')
+
+    def test_video_creatives_carry_their_thumbnail(self):
+        campaign = create_campaign(self.user, self.account)
+        blob = CreativeBlob.objects.create(
+            sha256='a' * 64, file='creative_blobs/video', file_size=100, mime_type='video/mp4',
+            processing_status='valid', preview='creative_previews/video.jpg', ref_count=1,
+        )
+        creative = CampaignCreative.objects.create(
+            campaign=campaign, file=blob.file.name, blob=blob, file_type='video/mp4', file_name='video.mp4',
+            file_size=100,
+        )
+
+        plan = self.plan(campaign)
+
+        spec = next(op for op in plan.operations if op.name.endswith(f"creative-{creative.id}"))
+        video_data = spec.params['object_story_spec']['video_data']
+        self.assertTrue(video_data['image_url'].endswith('/media/creative_previews/video.jpg'))
+        self.assertEqual(video_data['video_id'].name, f"c{campaign.id}-video-b{blob.id}")
+
+
+def loop_running():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@test_settings
+@override_settings(FACEBOOK_PAGE_ID='200', FACEBOOK_LINK_URL='https://example.com', FACEBOOK_APP_SECRET=None)
+class AsyncLaunchFailureTests(TestCase):
+    """
+    A launch that crashes after claiming its jobs does not leave them
+    running: it fails them, or leaves them unconfirmed once they were sent
+    """
+
+    def setUp(self):
+        self.user = create_user(credits=10)
+        self.account = create_account(self.user)
+
+    def job(self, reservation=None):
+        campaign = create_campaign(self.user, self.account, name=f"Campaign {LaunchJob.objects.count()}", creatives=1)
+        reservation = reservation or credit_ledger.reserve(self.user, 1, campaign=campaign)
+        return LaunchJob.objects.create(user=self.user, campaign=campaign, reservation=reservation)
+
+    def launch(self, launch, job_ids, graph=None):
+        async def run():
+            async with AsyncGraphClient(max_retries=0, transport=(graph or FakeGraph()).transport()) as client:
+                await launch(job_ids, client=client)
+        async_to_sync(run)()
+
+    def read_back(self, graph):
+        """Run the status sync against ``graph``, then reconcile"""
+        Campaign.objects.update(next_status_check_at=timezone.now() - timedelta(seconds=1))
+        with mock.patch.object(status_sync, 'graph_client', graph):
+            status_sync.sync_account(self.account.pk)
+        return launch_service.reconcile_unconfirmed_jobs()
+
+    def test_crash_before_sending_fails_the_job(self):
+        job = self.job()
+
+        with mock.patch.object(launch_service, 'creative_problems', side_effect=DatabaseError('connection lost')):
+            self.launch(launch_service.launch_job_async, job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('failed', 'connection lost'))
+        self.assertIsNone(job.sent_at)
+        self.assertEqual(Campaign.objects.get(pk=job.campaign_id).status, 'error')
+        self.assertEqual(CreditReservation.objects.get(pk=job.reservation_id).status, 'released')
+
+    def test_crash_after_sending_leaves_the_job_unconfirmed_until_read_back(self):
+        job = self.job()
+        graph = FakeGraph()
+
+        with mock.patch.object(launch_service, '_finish_job', side_effect=DatabaseError('connection lost')):
+            self.launch(launch_service.launch_job_async, job.id, graph)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('unconfirmed', 'connection lost'))
+        campaign = Campaign.objects.get(pk=job.campaign_id)
+        self.assertEqual(campaign.status, 'pending')
+        self.assertEqual(graph.objects[campaign.facebook_campaign_id][1]['status'], 'ACTIVE')
+        self.assertIsNotNone(campaign.creatives.get().facebook_ad_id)
+        # The credit stays held, and the job is not run a second time
+        self.assertEqual(CreditReservation.objects.get(pk=job.reservation_id).status, 'held')
+        with self.settings(LAUNCH_JOB_LEASE=0):
+            self.assertIsNone(launch_service.claim_job(job.id))
+        self.assertEqual(launch_service.reconcile_unconfirmed_jobs(), 0)
+
+        self.assertEqual(self.read_back(graph), 1)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('succeeded', None))
+        self.assertEqual(Campaign.objects.get(pk=job.campaign_id).status, 'active')
+        self.assertEqual(CreditReservation.objects.get(pk=job.reservation_id).status, 'settled')
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (9, 0))
+
+    def test_unanswered_activation_leaves_the_job_unconfirmed(self):
+        job = self.job()
+        # The object tree is created, the request switching it on gets no answer
+        graph = FakeGraph(down_after=1)
+
+        self.launch(launch_service.launch_job_async, job.id, graph)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'unconfirmed')
+        self.assertIn('Not confirmed', job.error)
+        campaign = Campaign.objects.get(pk=job.campaign_id)
+        self.assertEqual(graph.objects[campaign.facebook_campaign_id][1]['status'], 'PAUSED')
+
+        self.assertEqual(self.read_back(graph), 1)
+
+        # Found paused: never switched on, so the credit is returned
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(Campaign.objects.get(pk=job.campaign_id).status, 'paused')
+        self.assertEqual(CreditReservation.objects.get(pk=job.reservation_id).status, 'released')
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (10, 0))
+
+    def test_crashed_batch_before_sending_fails_its_jobs(self):
+        reservation = credit_ledger.reserve(self.user, 2)
+        jobs = [self.job(reservation), self.job(reservation)]
+
+        with mock.patch.object(launch_service, '_creative_problems_by_job', side_effect=DatabaseError('connection lost')):
+            self.launch(launch_service.launch_batch_async, [job.id for job in jobs])
+
+        self.assertEqual(set(LaunchJob.objects.values_list('status', flat=True)), {'failed'})
+        self.assertEqual(UserCredit.objects.get(user=self.user).reserved, 0)
+
+    def test_crashed_batch_leaves_its_sent_jobs_unconfirmed(self):
+        reservation = credit_ledger.reserve(self.user, 2)
+        jobs = [self.job(reservation), self.job(reservation)]
+        finish_batch = launch_service._finish_batch
+        calls = []
+
+        def crash_first(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise DatabaseError('connection lost')
+            return finish_batch(*args)
+
+        graph = FakeGraph()
+        with mock.patch.object(launch_service, '_finish_batch', side_effect=crash_first):
+            self.launch(launch_service.launch_batch_async, [job.id for job in jobs], graph)
+
+        self.assertEqual(set(LaunchJob.objects.values_list('status', flat=True)), {'unconfirmed'})
+        self.assertEqual(set(Campaign.objects.values_list('facebook_campaign_id', flat=True)), set(graph.created('campaigns')))
+        self.assertEqual(UserCredit.objects.get(user=self.user).reserved, 2)
+
+        # Both went live; each is charged as its own part of the shared hold
+        self.assertEqual(self.read_back(graph), 2)
+
+        self.assertEqual(set(LaunchJob.objects.values_list('status', flat=True)), {'succeeded'})
+        self.assertEqual(CreditReservation.objects.get(pk=reservation.pk).status, 'settled')
+        self.assertEqual(
+            set(CreditTransaction.objects.filter(transaction_type='usage').values_list('idempotency_key', flat=True)),
+            {f"reservation:{reservation.id}:{job.id}" for job in jobs},
+        )
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (8, 0))
+
+    def test_crash_leaves_a_job_taken_over_by_another_worker_alone(self):
+        job = self.job()
+
+        def taken_over(*args):
+            LaunchJob.objects.filter(pk=job.pk).update(started_at=timezone.now() + timedelta(seconds=1))
+            raise DatabaseError('connection lost')
+
+        with mock.patch.object(launch_service, '_finish_job', side_effect=taken_over):
+            self.launch(launch_service.launch_job_async, job.id)
+
+        self.assertEqual(LaunchJob.objects.get(pk=job.pk).status, 'running')
+
+    def test_redis_and_database_checks_run_off_the_event_loop(self):
+        job = self.job()
+        checks = []
+        problems = launch_service.creative_problems
+
+        def creative_problems(creatives):
+            checks.append(('creative_problems', loop_running()))
+            return problems(creatives)
+
+        def raise_if_open(endpoints):
+            checks.append(('raise_if_open', loop_running()))
+
+        with mock.patch.object(launch_service, 'creative_problems', side_effect=creative_problems), \
+                mock.patch.object(launch_service.breaker, 'raise_if_open', side_effect=raise_if_open):
+            self.launch(launch_service.launch_job_async, job.id)
+
+        self.assertEqual(checks, [('creative_problems', False), ('raise_if_open', False)])
+        self.assertEqual(LaunchJob.objects.get(pk=job.pk).status, 'succeeded')
+
+
+@test_settings
+@override_settings(INSIGHTS_LOOKBACK_DAYS=3)
+class InsightsSyncTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.account = create_account(self.user)
+        self.today = timezone.localdate()
+
+    def campaign(self, name, status, account=None, stopped_days_ago=0):
+        campaign = create_campaign(
+            self.user, account or self.account, name=name, status=status, facebook_campaign_id=f"fb-{name}"
+        )
+        Campaign.objects.filter(pk=campaign.pk).update(updated_at=timezone.now() - timedelta(days=stopped_days_ago))
+        return campaign
+
+    def test_campaigns_stopped_within_the_lookback_are_still_synced(self):
+        self.campaign('active', 'active', stopped_days_ago=30)
+        self.campaign('paused', 'paused', stopped_days_ago=2)
+        self.campaign('completed', 'completed', stopped_days_ago=3)
+        self.campaign('long-paused', 'paused', stopped_days_ago=10)
+        self.campaign('failed', 'error')
+        requested = []
+
+        def fetch_pages(ad_account_id, params):
+            requested.extend(json.loads(params['filtering'])[0]['value'])
+            return iter([])
+
+        with mock.patch.object(insights_sync, 'fetch_pages', side_effect=fetch_pages):
+            insights_sync.sync_account(self.account.pk, today=self.today)
+
+        self.assertEqual(sorted(requested), ['fb-active', 'fb-completed', 'fb-paused'])
+
+    @mock.patch('campaigns.tasks.sync_account_insights.delay')
+    def test_accounts_whose_campaigns_just_stopped_are_scheduled(self, sync):
+        recent = create_account(self.user, 'act_200')
+        old = create_account(self.user, 'act_300')
+        self.campaign('paused', 'paused', account=recent, stopped_days_ago=1)
+        self.campaign('long-paused', 'paused', account=old, stopped_days_ago=10)
+
+        self.assertEqual(insights_sync.schedule_account_syncs(today=self.today), 1)
+        sync.assert_called_once_with(recent.pk)
+
+
+@test_settings
+class MetricRollupTests(TestCase):
+    METRICS = ['impressions', 'clicks', 'link_clicks', 'conversions', 'spend']
+
+    def setUp(self):
+        self.user = create_user()
+        self.accounts = [create_account(self.user, 'act_100'), create_account(self.user, 'act_200')]
+        campaigns = [
+            create_campaign(self.user, account, name=f"{account.account_id} {objective}", objective=objective)
+            for account in self.accounts for objective in ('traffic', 'lead')
+        ]
+        numbers = random.Random(16)
+        day = date(2025, 1, 20)
+        insights = []
+        while day <= date(2025, 4, 12):
+            insights += [
+                CampaignDailyInsight(
+                    campaign=campaign, date=day, impressions=numbers.randint(100, 1000),
+                    clicks=numbers.randint(0, 50), link_clicks=numbers.randint(0, 20),
+                    conversions=numbers.randint(0, 5), spend=f"{numbers.randint(100, 5000) / 100:.2f}",
+                )
+                for campaign in campaigns
+            ]
+            day += timedelta(days=1)
+        CampaignDailyInsight.objects.bulk_create(insights)
+        metric_rollups.rebuild_rollups()
+
+    def daily_totals(self, since, until, **filters):
+        totals = CampaignDailyInsight.objects.filter(
+            campaign__user=self.user, date__gte=since, date__lte=until, **filters
+        ).aggregate(**{field: Sum(field) for field in self.METRICS})
+        return {field: totals[field] or 0 for field in self.METRICS}
+
+    def rollup(self, granularity, period_start, account):
+        totals = MetricRollup.objects.filter(
+            granularity=granularity, period_start=period_start, ad_account_id=account.account_id
+        ).aggregate(**{field: Sum(field) for field in self.METRICS})
+        return {field: totals[field] or 0 for field in self.METRICS}
+
+    def test_restating_a_day_rebuilds_its_buckets_without_double_counting(self):
+        account = self.accounts[0]
+        # A Monday: its week runs into April, its month is March
+        day = date(2025, 3, 31)
+        CampaignDailyInsight.objects.filter(campaign__facebook_account=account, date=day).update(
+            impressions=5000, clicks=70, conversions=9, spend='99.99'
+        )
+
+        # Refreshing twice must not add the day in twice
+        metric_rollups.refresh_rollups(account.account_id, {day})
+        metric_rollups.refresh_rollups(account.account_id, {day})
+
+        for granularity, since, until in [
+            ('day', day, day),
+            ('week', day, date(2025, 4, 6)),
+            ('month', date(2025, 3, 1), day),
+        ]:
+            with self.subTest(granularity=granularity):
+                self.assertEqual(
+                    self.rollup(granularity, since, account),
+                    self.daily_totals(since, until, campaign__facebook_account=account),
+                )
+        # The other account's buckets are untouched and still match
+        self.assertEqual(
+            self.rollup('month', date(2025, 3, 1), self.accounts[1]),
+            self.daily_totals(date(2025, 3, 1), day, campaign__facebook_account=self.accounts[1]),
+        )
+
+    def test_query_over_several_months_matches_the_daily_rows(self):
+        since, until = date(2025, 1, 23), date(2025, 4, 9)
+
+        result = metric_rollups.query_metrics(self.user, since, until, group_by=('objective',))
+
+        columns = result['columns']
+        for position, objective in enumerate(columns['objective']):
+            totals = self.daily_totals(since, until, campaign__objective=objective)
+            self.assertEqual(
+                {field: columns[field][position] for field in self.METRICS},
+                {**totals, 'spend': float(totals['spend'])},
+            )
+        self.assertEqual(sorted(columns['objective']), ['lead', 'traffic'])
+        # February and March are read as whole months
+        self.assertEqual(
+            MetricRollup.objects.filter(granularity='month', user=self.user).count(), 4 * 4
+        )
+        self.assertEqual(result['rollup_rows']['month'], 2 * 2)
+
+    def test_monthly_series_matches_the_daily_rows(self):
+        since, until = date(2025, 1, 23), date(2025, 4, 9)
+
+        columns = metric_rollups.query_metrics(self.user, since, until, interval='month')['columns']
+
+        self.assertEqual(columns['period'], ['2025-01-01', '2025-02-01', '2025-03-01', '2025-04-01'])
+        for position, (first, last) in enumerate([
+            (since, date(2025, 1, 31)), (date(2025, 2, 1), date(2025, 2, 28)),
+            (date(2025, 3, 1), date(2025, 3, 31)), (date(2025, 4, 1), until),
+        ]):
+            totals = self.daily_totals(first, last)
+            self.assertEqual(columns['impressions'][position], totals['impressions'])
+            self.assertEqual(columns['spend'][position], float(totals['spend']))
+
+
+@test_settings
+@override_settings(STATUS_CHECK_MIN_INTERVAL=300, STATUS_CHECK_MAX_INTERVAL=1200)
+class StatusSyncTests(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.account = create_account(self.user)
+        self.graph = FakeGraph()
+        patcher = mock.patch.object(status_sync, 'graph_client', self.graph)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def launched(self, name):
+        object_id = str(1000 + len(self.graph.objects))
+        self.graph.objects[object_id] = ('act_100/campaigns', {'status': 'ACTIVE'})
+        return create_campaign(
+            self.user, self.account, name=name, status='active', facebook_status='ACTIVE',
+            facebook_campaign_id=object_id, status_check_interval=300,
+        )
+
+    def sync(self):
+        Campaign.objects.update(next_status_check_at=timezone.now() - timedelta(seconds=1))
+        return status_sync.sync_account(self.account.pk)
+
+    def test_missing_campaigns_are_isolated_by_splitting_the_read(self):
+        ids = [self.launched(f"C{n}").facebook_campaign_id for n in range(8)]
+        requested = ids[:3] + ['9001'] + ids[3:] + ['9002']
+
+        statuses = status_sync.fetch_statuses('token', requested)
+
+        self.assertEqual(
+            {object_id: fields['effective_status'] for object_id, fields in statuses.items()},
+            {**dict.fromkeys(ids, 'ACTIVE'), '9001': 'DELETED', '9002': 'DELETED'},
+        )
+        reads = self.graph.reads
+        self.assertEqual(reads[:2], [requested, requested[:5]])
+        self.assertIn(requested[5:], reads)
+        # Halves without a missing campaign are read whole, not split further
+        self.assertIn(ids[:2], reads)
+        self.assertNotIn([ids[0]], reads)
+        self.assertIn(['9001'], reads)
+
+    def test_interval_doubles_while_unchanged_and_resets_on_change(self):
+        campaign = self.launched('C')
+        intervals = []
+        for _ in range(3):
+            self.assertEqual(self.sync(), 0)
+            intervals.append(Campaign.objects.get(pk=campaign.pk).status_check_interval)
+
+        self.graph.objects[campaign.facebook_campaign_id][1]['status'] = 'PAUSED'
+        self.assertEqual(self.sync(), 1)
+
+        self.assertEqual(intervals, [600, 1200, 1200])
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.status, campaign.facebook_status), ('paused', 'PAUSED'))
+        self.assertEqual(campaign.status_check_interval, 300)
+        self.assertAlmostEqual(
+            campaign.next_status_check_at, timezone.now() + timedelta(seconds=300), delta=timedelta(seconds=5)
+        )
+
+    def test_only_changed_campaigns_are_bulk_updated(self):
+        campaigns = [self.launched(f"C{n}") for n in range(3)]
+        self.graph.objects[campaigns[1].facebook_campaign_id][1]['status'] = 'PAUSED'
+
+        with mock.patch.object(Campaign.objects, 'bulk_update', wraps=Campaign.objects.bulk_update) as bulk_update:
+            self.assertEqual(self.sync(), 1)
+
+        (changed, fields), _ = bulk_update.call_args
+        self.assertEqual(bulk_update.call_count, 1)
+        self.assertEqual([campaign.id for campaign in changed], [campaigns[1].id])
+        self.assertEqual(fields, status_sync.STATUS_UPDATE_FIELDS)
+        rows = dict(Campaign.objects.values_list('id', 'status_check_interval'))
+        self.assertEqual([rows[campaign.id] for campaign in campaigns], [600, 300, 600])
+        self.assertEqual(len(self.graph.reads), 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': REDIS_URL}},
+    GRAPH_RATE_LIMITING=True,
+    FACEBOOK_APP_ID='app',
+    GRAPH_APP_RATE=10, GRAPH_APP_BURST=10,
+    GRAPH_ACCOUNT_RATE=1, GRAPH_ACCOUNT_BURST=3,
+    GRAPH_INTERACTIVE_MAX_WAIT=30, GRAPH_BACKGROUND_MAX_WAIT=3600,
+)
+@test_settings
+@skipUnless(redis_available(), "needs Redis at REDIS_URL")
+class GraphSchedulerTests(TestCase):
+    """Token buckets, usage headers, priorities and throttling lockouts, on a frozen clock"""
+
+    def setUp(self):
+        self.conn = graph_scheduler.get_redis_connection('default')
+        self.clear_redis()
+        self.addCleanup(self.clear_redis)
+        self.scheduler = GraphScheduler()
+        self.now = 1_700_000_000.0
+        clock = mock.patch.object(graph_scheduler.time, 'time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        # record_response reports to the shared scheduler
+        shared = mock.patch.object(graph_scheduler.scheduler, 'observe', side_effect=self.scheduler.observe)
+        shared.start()
+        self.addCleanup(shared.stop)
+
+    def clear_redis(self):
+        keys = self.conn.keys(f"{graph_scheduler.KEY_PREFIX}*")
+        if keys:
+            self.conn.delete(*keys)
+
+    def wait(self, path, **context):
+        """Seconds a call must wait, or 0 once it took its tokens"""
+        with graph_context(**context):
+            return next(self.scheduler.waits(graph_client.url(path)), 0)
+
+    def respond(self, path, status_code=200, code=None, headers=None):
+        body = {'error': {'code': code, 'message': 'User request limit reached'}} if code else {'id': '1'}
+        response = graph_response(status_code, body)
+        response.headers.update(headers or {})
+        url = graph_client.url(path)
+        record_response(endpoint_label(url), url, response, 0.1)
+
+    def test_app_and_account_buckets_refill_separately(self):
+        waits = [self.wait('act_100/campaigns') for _ in range(4)]
+
+        # The account bucket holds 3 calls and refills one per second
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 1)
+        # Another account draws from its own bucket, and both from the app's
+        self.assertEqual([self.wait('act_200/campaigns') for _ in range(3)], [0, 0, 0])
+        self.assertEqual([self.wait('me') for _ in range(4)], [0, 0, 0, 0])
+        self.assertAlmostEqual(self.wait('me'), 0.1)
+        # Batches and ?ids= reads wait for the account named in the context
+        self.assertAlmostEqual(self.wait('', ad_account_id='act_100'), 1)
+
+        self.now += 1
+        self.assertEqual(self.wait('act_100/campaigns'), 0)
+
+    def test_usage_headers_slow_down_the_refill(self):
+        for _ in range(10):
+            self.wait('me')
+        self.assertAlmostEqual(self.wait('me'), 0.1)
+
+        self.respond('me', headers={'x-app-usage': '{"call_count": 90, "total_cputime": 20, "total_time": 30}'})
+
+        # 90% usage: the app bucket refills at a fifth of its rate
+        self.assertAlmostEqual(self.wait('me'), 0.5)
+        self.now += 0.5
+        self.assertEqual(self.wait('me'), 0)
+
+        self.respond('act_100/campaigns', headers={
+            'x-business-use-case-usage': json.dumps({'100': [{'type': 'ADS_MANAGEMENT', 'call_count': 96}]}),
+        })
+        # Past the interactive limit too: calls hold off until the report goes stale
+        self.now += 10
+        self.assertAlmostEqual(self.wait('act_100/campaigns', priority=BACKGROUND), graph_scheduler.USAGE_TTL - 10)
+
+    def test_background_calls_leave_a_reserve_to_interactive_ones(self):
+        background = [self.wait('me', priority=BACKGROUND) for _ in range(8)]
+
+        # 30% of the 10 token app bucket stays for interactive calls
+        self.assertEqual(background[:7], [0] * 7)
+        self.assertAlmostEqual(background[7], 0.1)
+        self.assertEqual([self.wait('me') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.wait('me'), 0.1)
+
+        # Usage that only holds background calls off lets interactive ones through
+        self.now += 10
+        self.respond('me', headers={'x-app-usage': '{"call_count": 80}'})
+        self.assertAlmostEqual(self.wait('me', priority=BACKGROUND), graph_scheduler.USAGE_TTL)
+        self.assertEqual(self.wait('me'), 0)
+
+    def test_throttling_errors_block_the_bucket(self):
+        # Code 17: the account is locked out, with a penalty doubling per strike
+        self.respond('act_100/campaigns', 400, code=17)
+        self.assertAlmostEqual(self.wait('act_100/campaigns', priority=BACKGROUND), 60)
+        self.assertEqual(self.wait('act_200/campaigns'), 0)
+        self.respond('act_100/campaigns', 400, code=17)
+        self.assertAlmostEqual(self.wait('act_100/campaigns', priority=BACKGROUND), 120)
+        # Interactive calls do not wait that long
+        with self.assertRaises(GraphThrottled) as raised:
+            self.wait('act_100/campaigns')
+        self.assertAlmostEqual(raised.exception.retry_after, 120)
+
+        # Code 613 with Retry-After
+        self.respond('act_200/campaigns', 400, code=613, headers={'Retry-After': '300'})
+        self.assertAlmostEqual(self.wait('act_200/campaigns', priority=BACKGROUND), 300)
+
+        # Code 80004: Facebook's estimate of when access is regained, in minutes
+        self.respond('act_300/ads', 400, code=80004, headers={
+            'x-business-use-case-usage': json.dumps({'300': [{
+                'type': 'ADS_MANAGEMENT', 'call_count': 100, 'estimated_time_to_regain_access': 10,
+            }]}),
+        })
+        self.assertAlmostEqual(self.wait('act_300/ads', priority=BACKGROUND), 600)
+
+        # None of these block the app bucket; a success clears the strikes
+        self.assertEqual(self.wait('me'), 0)
+        self.now += 121
+        self.respond('act_100/campaigns')
+        self.respond('act_100/campaigns', 400, code=17)
+        self.assertAlmostEqual(self.wait('act_100/campaigns', priority=BACKGROUND), 60)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': REDIS_URL}},
+    GRAPH_CIRCUIT_BREAKER=True,
+    GRAPH_CIRCUIT_FAILURE_THRESHOLD=3, GRAPH_CIRCUIT_WINDOW=60,
+    GRAPH_CIRCUIT_OPEN_SECONDS=30, GRAPH_CIRCUIT_MAX_OPEN_SECONDS=100,
+    GRAPH_BULKHEAD_LIMITS={'interactive': 2, 'background': 1}, GRAPH_BULKHEAD_WAIT=0,
+    GRAPH_API_CONNECT_TIMEOUT=1, GRAPH_API_READ_TIMEOUT=4,
+)
+@test_settings
+@skipUnless(redis_available(), "needs Redis at REDIS_URL")
+class CircuitBreakerTests(TestCase):
+    """Breaker transitions and bulkhead slots, on a frozen clock"""
+
+    def setUp(self):
+        self.conn = circuit_breaker.get_redis_connection('default')
+        self.clear_redis()
+        self.addCleanup(self.clear_redis)
+        self.breaker = CircuitBreaker()
+        self.bulkhead = Bulkhead()
+        self.now = 1_700_000_000.0
+        clock = mock.patch.object(circuit_breaker.time, 'time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def clear_redis(self):
+        keys = self.conn.keys(f"{circuit_breaker.CIRCUIT_KEY_PREFIX}*")
+        keys += self.conn.keys(f"{circuit_breaker.BULKHEAD_KEY_PREFIX}*")
+        if keys:
+            self.conn.delete(*keys)
+
+    def fail(self, endpoint, times):
+        for _ in range(times):
+            self.breaker.before_call(endpoint)
+            self.breaker.record(endpoint, ok=False)
+
+    def rejected_for(self, endpoint):
+        with self.assertRaises(CircuitOpen) as raised:
+            self.breaker.before_call(endpoint)
+        return raised.exception.retry_after
+
+    def test_breaker_opens_probes_and_closes(self):
+        self.fail('me', 2)
+        self.breaker.before_call('me')
+        # Failures outside the window start a new count
+        self.now += 61
+        self.fail('me', 2)
+        self.breaker.before_call('me')
+        self.breaker.record('me', ok=False)
+
+        self.assertEqual(self.breaker.states()['me']['state'], 'open')
+        self.assertAlmostEqual(self.rejected_for('me'), 30)
+        # A call that started before the breaker opened changes nothing
+        self.breaker.record('me', ok=True)
+        self.assertAlmostEqual(self.rejected_for('me'), 30)
+        # Other endpoints keep working
+        self.breaker.before_call('{id}/campaigns')
+
+        # Half-open after the open period; a failed probe opens it twice as long
+        self.now += 30
+        self.breaker.before_call('me')
+        self.breaker.record('me', ok=False)
+        self.assertAlmostEqual(self.rejected_for('me'), 60)
+        self.now += 60
+        self.breaker.before_call('me')
+        self.breaker.record('me', ok=False)
+        # ... up to GRAPH_CIRCUIT_MAX_OPEN_SECONDS
+        self.assertAlmostEqual(self.rejected_for('me'), 100)
+
+        self.now += 100
+        self.breaker.before_call('me')
+        self.breaker.record('me', ok=True)
+        self.assertNotIn('me', self.breaker.states())
+        self.breaker.before_call('me')
+        # Closed again with a fresh failure count
+        self.fail('me', 2)
+        self.breaker.before_call('me')
+
+    def test_only_one_probe_goes_through_while_half_open(self):
+        self.fail('me', 3)
+        self.now += 30
+
+        self.breaker.before_call('me')
+        self.assertEqual(self.breaker.states()['me']['state'], 'half_open')
+        self.assertAlmostEqual(self.rejected_for('me'), circuit_breaker.PROBE_TIMEOUT)
+        # raise_if_open only reads and never takes the probe
+        self.breaker.raise_if_open(['me'])
+
+        # A probe that never reports back is replaced once it timed out
+        self.now += circuit_breaker.PROBE_TIMEOUT
+        self.breaker.before_call('me')
+        self.assertAlmostEqual(self.rejected_for('me'), circuit_breaker.PROBE_TIMEOUT)
+        # The new probe's success closes the breaker
+        self.breaker.record('me', ok=True)
+        self.assertNotIn('me', self.breaker.states())
+
+    def test_bulkhead_slots_are_capped_per_priority_and_expire(self):
+        first = self.bulkhead.acquire('background')
+        with self.assertRaises(BulkheadFull):
+            self.bulkhead.acquire('background')
+        # Background calls cannot take interactive slots, nor the reverse
+        leases = [self.bulkhead.acquire('interactive') for _ in range(2)]
+        with self.assertRaises(BulkheadFull):
+            self.bulkhead.acquire('interactive')
+
+        self.bulkhead.release(first)
+        crashed = self.bulkhead.acquire('background')
+        self.assertIsNotNone(crashed)
+        for lease in leases:
+            self.bulkhead.release(lease)
+
+        # The lease of a process that died without releasing frees itself
+        with self.assertRaises(BulkheadFull):
+            self.bulkhead.acquire('background')
+        self.now += 2 * (1 + 4) + 1
+        self.assertIsNotNone(self.bulkhead.acquire('background'))
+
+    @mock.patch('campaigns.tasks.launch_campaign.apply_async')
+    def test_open_breaker_answers_503_with_retry_after(self, launch):
+        user = create_user(credits=5)
+        campaign = create_campaign(user, create_account(user), creatives=1)
+        client = APIClient()
+        client.force_authenticate(user)
+        self.fail('/', 3)
+        self.now += 12.5
+
+        response = client.post(f"/api/campaigns/{campaign.id}/launch/")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '18')
+        launch.assert_not_called()
+        self.assertFalse(LaunchJob.objects.exists())
+        self.assertEqual(UserCredit.objects.get(user=user).reserved, 0)
+
+
+@test_settings
+@override_settings(FACEBOOK_PAGE_ID='200', FACEBOOK_LINK_URL='https://example.com', FACEBOOK_APP_SECRET=None)
+class BulkApiTests(TestCase):
+    """Bulk create and bulk launch report every item and share one reservation"""
+
+    def setUp(self):
+        self.user = create_user(credits=10)
+        self.account = create_account(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def bulk_launch(self, campaign_ids):
+        with mock.patch('campaigns.tasks.launch_campaign_batch.delay') as launch_batch, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/campaigns/bulk-launch/', {'campaign_ids': campaign_ids}, format='json')
+        return response, [job_ids for (job_ids,), _ in launch_batch.call_args_list]
+
+    def test_bulk_create_reports_each_item(self):
+        valid = {'name': 'Spring', 'objective': 'traffic', 'budget': '25.00', 'start_date': '2030-03-01'}
+
+        response = self.client.post('/api/campaigns/bulk/', {'campaigns': [
+            valid,
+            {'name': 'Broken', 'objective': 'awareness', 'budget': 'lots', 'start_date': '2030-03-01'},
+            {**valid, 'name': 'Summer'},
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 1))
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'error', 'created'])
+        self.assertEqual(set(results[1]['errors']), {'objective', 'budget'})
+        campaigns = dict(Campaign.objects.filter(user=self.user).values_list('id', 'name'))
+        self.assertEqual({campaigns[results[0]['id']], campaigns[results[2]['id']]}, {'Spring', 'Summer'})
+
+        response = self.client.post('/api/campaigns/bulk/', {'campaigns': [valid]}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_bulk_launch_reports_each_campaign_under_one_reservation(self):
+        inactive = FacebookAdAccount.objects.create(
+            user=self.user, account_id='act_900', name='Old', access_token='token', is_active=False
+        )
+        ready = create_campaign(self.user, self.account, name='Ready', creatives=1)
+        moved = create_campaign(self.user, inactive, name='Moved', creatives=1)
+        template = create_campaign(self.user, self.account, name='Template', is_template=True)
+        stranger = create_campaign(create_user('stranger'), name='Stranger')
+        rejected = create_campaign(self.user, self.account, name='Rejected', creatives=1)
+        blob = CreativeBlob.objects.create(
+            sha256='b' * 64, file='creative_blobs/small', file_size=100, mime_type='image/png',
+            processing_status='invalid', validation_errors=['Image is too small'], ref_count=1,
+        )
+        rejected.creatives.update(blob=blob)
+        running = create_campaign(self.user, self.account, name='Running')
+        earlier = LaunchJob.objects.create(user=self.user, campaign=running)
+        missing = max(campaign.id for campaign in [ready, moved, template, stranger, rejected, running]) + 1
+
+        response, chunks = self.bulk_launch(
+            [ready.id, moved.id, template.id, stranger.id, rejected.id, running.id, missing, ready.id]
+        )
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['queued'], response.data['failed']), (3, 4))
+        results = {result['campaign']: result for result in response.data['results']}
+        self.assertEqual(list(results), [ready.id, moved.id, template.id, stranger.id, rejected.id, running.id, missing])
+        self.assertEqual([results[campaign_id]['status'] for campaign_id in results], [
+            'queued', 'queued', 'error', 'error', 'error', 'queued', 'error',
+        ])
+        self.assertEqual(results[stranger.id]['detail'], 'Campaign not found.')
+        self.assertIn('Templates cannot be launched', results[template.id]['detail'])
+        self.assertEqual(results[rejected.id]['creatives'], {rejected.creatives.get().id: ['Image is too small']})
+        self.assertEqual((results[running.id]['job'], results[running.id]['created']), (earlier.id, False))
+        self.assertIn('status_url', results[ready.id])
+
+        # One hold for the two new launches, queued in one chunk for the connected account
+        reservation = CreditReservation.objects.get()
+        self.assertEqual((reservation.amount, reservation.status), (2, 'held'))
+        self.assertEqual(UserCredit.objects.get(user=self.user).reserved, 2)
+        jobs = LaunchJob.objects.filter(reservation=reservation)
+        self.assertEqual(sorted(chunks[0]), sorted(str(job.id) for job in jobs))
+        self.assertEqual(len(chunks), 1)
+        moved.refresh_from_db()
+        self.assertEqual((moved.facebook_account, moved.status), (self.account, 'pending'))
+
+    def test_bulk_launch_refuses_everything_without_enough_credit(self):
+        campaigns = [create_campaign(self.user, self.account, name=f"C{n}") for n in range(11)]
+
+        response, chunks = self.bulk_launch([campaign.id for campaign in campaigns])
+
+        self.assertEqual(response.status_code, 402)
+        self.assertEqual(chunks, [])
+        self.assertFalse(LaunchJob.objects.exists())
+        self.assertFalse(CreditReservation.objects.exists())
+
+    @override_settings(BULK_LAUNCH_CHUNK_SIZE=2)
+    def test_each_chunk_settles_its_part_of_the_reservation(self):
+        campaigns = [create_campaign(self.user, self.account, name=f"C{n}", creatives=1) for n in range(3)]
+        response, chunks = self.bulk_launch([campaign.id for campaign in campaigns])
+        self.assertEqual(response.status_code, 202)
+        pair, single = sorted(chunks, key=len, reverse=True)
+        self.assertEqual((len(pair), len(single)), (2, 1))
+        reservation = CreditReservation.objects.get()
+        failing = LaunchJob.objects.get(pk=pair[0]).campaign_id
+
+        def run(job_ids):
+            graph = FakeGraph(fail=[f"c{failing}-campaign"])
+
+            async def launch():
+                async with AsyncGraphClient(max_retries=0, transport=graph.transport()) as client:
+                    await launch_service.launch_batch_async(job_ids, client=client)
+            async_to_sync(launch)()
+
+        run(pair)
+        reservation.refresh_from_db()
+        self.assertEqual((reservation.amount, reservation.status), (1, 'held'))
+        self.assertEqual(UserCredit.objects.get(user=self.user).balance, 9)
+
+        run(single)
+        reservation.refresh_from_db()
+        self.assertEqual((reservation.amount, reservation.status), (0, 'settled'))
+        credits = UserCredit.objects.get(user=self.user)
+        self.assertEqual((credits.balance, credits.reserved), (8, 0))
+        # One usage entry per chunk, keyed by the chunk so a retried settlement is a no-op
+        usage = CreditTransaction.objects.filter(transaction_type='usage').order_by('id')
+        self.assertEqual(
+            [(entry.amount, entry.idempotency_key) for entry in usage],
+            [(-1, f"reservation:{reservation.id}:{min(pair)}"), (-1, f"reservation:{reservation.id}:{min(single)}")],
+        )
+        statuses = dict(LaunchJob.objects.values_list('campaign_id', 'status'))
+        self.assertEqual(statuses.pop(failing), 'failed')
+        self.assertEqual(set(statuses.values()), {'succeeded'})
@@ -1,20 +1,26 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested import routers
 from .views import (
-    CampaignViewSet, CampaignCreativeViewSet, 
-    FacebookAdAccountViewSet, UserCreditViewSet
+    CampaignViewSet, CampaignCreativeViewSet, CreativeUploadViewSet,
+    FacebookAdAccountViewSet, UserCreditViewSet, LaunchJobViewSet,
+    campaign_analytics, campaign_launch, creative_direct_upload, facebook_webhook, metrics_snapshot
+)
+from .auth import (
+    facebook_login, facebook_callback, facebook_callback_async, facebook_accounts, disconnect_facebook
 )
-from .auth import facebook_login, facebook_callback, facebook_accounts, disconnect_facebook
 
 router = DefaultRouter()
 router.register(r'campaigns', CampaignViewSet, basename='campaign')
 router.register(r'facebook-accounts', FacebookAdAccountViewSet, basename='facebook-account')
 router.register(r'credits', UserCreditViewSet, basename='credit')
+router.register(r'launch-jobs', LaunchJobViewSet, basename='launch-job')
 
 # Nested routes for campaign creatives
 campaigns_router = routers.NestedSimpleRouter(router, r'campaigns', lookup='campaign')
 campaigns_router.register(r'creatives', CampaignCreativeViewSet, basename='campaign-creative')
+campaigns_router.register(r'uploads', CreativeUploadViewSet, basename='creative-upload')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -25,4 +31,23 @@ urlpatterns = [
     path('campaigns/auth/facebook/callback/', facebook_callback, name='facebook-callback'),
     path('campaigns/auth/facebook/accounts/', facebook_accounts, name='facebook-accounts'),
     path('campaigns/auth/facebook/disconnect/<int:account_id>/', disconnect_facebook, name='facebook-disconnect'),
+    
+    # Facebook ad account change notifications
+    path('webhooks/facebook/', facebook_webhook, name='facebook-webhook'),
+    
+    # Local stand-in for presigned storage URLs when S3 is not configured
+    path('creative-uploads/<str:token>/', creative_direct_upload, name='creative-direct-upload'),
+    
+    # Campaign performance read from the metric rollups
+    path('analytics/', campaign_analytics, name='campaign-analytics'),
+    
+    # Operational metrics (staff only)
+    path('metrics/', metrics_snapshot, name='metrics'),
 ]
+
+if settings.ASYNC_VIEWS:
+    # Under ASGI, the views that wait on Facebook are served as coroutines
+    urlpatterns = [
+        path('campaigns/<int:pk>/launch/', campaign_launch),
+        path('campaigns/auth/facebook/callback/', facebook_callback_async),
+    ] + urlpatterns
@@ -1,18 +1,51 @@
-from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import action
+from rest_framework import mixins, viewsets, permissions, status
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Prefetch
+from django.http import HttpResponse
 import logging
-from .models import Campaign, CampaignCreative, FacebookAdAccount, UserCredit, CreditTransaction
+from .metrics import metrics
+from .models import (
+    Campaign, CampaignCreative, FacebookAdAccount, UserCredit, LaunchJob,
+    CreativeUpload
+)
 from .serializers import (
     CampaignSerializer, CampaignCreativeSerializer, 
     FacebookAdAccountSerializer, UserCreditSerializer,
-    CreditTransactionSerializer
+    CreditTransactionSerializer, LaunchJobSerializer, CreativeUploadSerializer,
+    AnalyticsQuerySerializer, BulkCampaignCreateSerializer, BulkLaunchSerializer, CampaignCloneSerializer,
+    requested_fields
+)
+from .pagination import CampaignCursorPagination
+from .services import (
+    campaign_clone, chunked_upload, circuit_breaker, creative_store, credit_ledger, direct_upload,
+    facebook_webhooks, metric_rollups, response_cache
 )
-from .services.facebook_service import FacebookService
+from .services.bulk import bulk_insert
+from .services.launch_service import InvalidCreatives, enqueue_bulk_launch, enqueue_launch, start_launch
 
 logger = logging.getLogger(__name__)
 
 
+class CachedResponseMixin:
+    """Serve list and retrieve from the user's response cache (see services.response_cache)"""
+    
+    def list(self, request, *args, **kwargs):
+        return response_cache.cached_response(
+            request, lambda: super(CachedResponseMixin, self).list(request, *args, **kwargs)
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        return response_cache.cached_response(
+            request, lambda: super(CachedResponseMixin, self).retrieve(request, *args, **kwargs)
+        )
+
+
 class FacebookAdAccountViewSet(viewsets.ModelViewSet):
     serializer_class = FacebookAdAccountSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -52,89 +85,149 @@ class FacebookAdAccountViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class CampaignViewSet(viewsets.ModelViewSet):
+class CampaignViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     serializer_class = CampaignSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CampaignCursorPagination
+    # Seconds before a worker runs a queued launch; campaign_launch sets it
+    # because it runs the launch in process first
+    launch_countdown = None
     
     def get_queryset(self):
-        return Campaign.objects.filter(user=self.request.user)
+        queryset = Campaign.objects.filter(user=self.request.user)
+        
+        # ?template=true lists only templates, ?template=false only campaigns
+        template = self.request.query_params.get('template')
+        if template in ('true', 'false'):
+            queryset = queryset.filter(is_template=template == 'true')
+        
+        # One extra query for all creatives of the page instead of one per campaign
+        fields = requested_fields(self.request)
+        if fields is None or 'creatives' in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch('creatives', queryset=CampaignCreative.objects.select_related('blob'))
+            )
+        return queryset
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
     
     @action(detail=True, methods=['post'])
     def launch(self, request, pk=None):
-        """Launch a campaign to Facebook Ads"""
+        """Queue a campaign launch to Facebook Ads and return the job"""
         campaign = self.get_object()
+        if campaign.is_template:
+            return Response(
+                {"detail": "Templates cannot be launched. Clone the template and launch the copy."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Check if user has enough credits
-        try:
-            user_credit = UserCredit.objects.get(user=request.user)
-            if user_credit.balance < 1:  # Assuming 1 credit per campaign
-                return Response(
-                    {"detail": "Insufficient credits to launch campaign."},
-                    status=status.HTTP_402_PAYMENT_REQUIRED
-                )
-        except UserCredit.DoesNotExist:
+        # Get user's Facebook ad account
+        fb_account = FacebookAdAccount.objects.filter(user=request.user, is_active=True).first()
+        
+        if not fb_account:
             return Response(
-                {"detail": "No credits available. Please purchase credits."},
-                status=status.HTTP_402_PAYMENT_REQUIRED
+                {"detail": "No connected Facebook ad account found. Please connect your Facebook account first."},
+                status=status.HTTP_400_BAD_REQUEST
             )
         
+        # The Facebook calls run on the task queue; the client polls the job
         try:
-            # Get user's Facebook ad account
-            fb_account = FacebookAdAccount.objects.filter(user=request.user, is_active=True).first()
-            
-            if not fb_account:
-                return Response(
-                    {"detail": "No connected Facebook ad account found. Please connect your Facebook account first."},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # Create Facebook campaign using the user's Facebook account
-            fb_service = FacebookService(
-                access_token=fb_account.access_token,
-                ad_account_id=fb_account.account_id.replace('act_', '')  # Remove 'act_' prefix if present
+            job, created = enqueue_launch(campaign, request.user, fb_account, countdown=self.launch_countdown)
+        except credit_ledger.InsufficientCredits:
+            return Response(
+                {"detail": "Insufficient credits to launch campaign."},
+                status=status.HTTP_402_PAYMENT_REQUIRED
             )
-            
-            facebook_campaign_id = fb_service.create_campaign(
-                name=campaign.name,
-                objective=campaign.objective,
-                daily_budget=str(campaign.budget),
-                start_time=campaign.start_date.isoformat(),
-                end_time=campaign.end_date.isoformat() if campaign.end_date else None,
-                status='ACTIVE'
+        except InvalidCreatives as e:
+            return Response(
+                {"detail": str(e), "creatives": e.problems},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            
-            # Update campaign with Facebook ID
-            campaign.status = 'active'
-            campaign.facebook_campaign_id = facebook_campaign_id
-            campaign.save()
-            
-            # Deduct credits
-            user_credit.balance -= 1
-            user_credit.save()
-            
-            # Record the transaction
-            CreditTransaction.objects.create(
-                user=request.user,
-                amount=-1,
-                transaction_type='usage',
-                description=f"Credit used for campaign: {campaign.name}",
-                campaign=campaign
+        if created:
+            logger.info(f"Queued launch job {job.id} for campaign {campaign.id}")
+        
+        serializer = LaunchJobSerializer(job)
+        status_url = reverse('launch-job-detail', args=[job.id], request=request)
+        return Response(
+            {**serializer.data, 'status_url': status_url},
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': status_url}
+        )
+    
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """Create many campaigns in one request, reporting each item's outcome"""
+        body = BulkCampaignCreateSerializer(data=request.data)
+        body.is_valid(raise_exception=True)
+        
+        # Validate every item first, then insert the valid ones together
+        results = []
+        campaigns = []
+        for index, item in enumerate(body.validated_data['campaigns']):
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                campaigns.append(Campaign(user=request.user, **serializer.validated_data))
+                results.append({'index': index, 'status': 'created'})
+            else:
+                results.append({'index': index, 'status': 'error', 'errors': serializer.errors})
+        
+        created = iter(bulk_insert(Campaign, campaigns))
+        response_cache.invalidate(request.user.id)
+        for result in results:
+            if result['status'] == 'created':
+                campaign = next(created)
+                result.update({'id': campaign.id, 'name': campaign.name})
+        
+        logger.info(f"Bulk created {len(campaigns)} of {len(results)} campaigns for user {request.user.id}")
+        failed = len(results) - len(campaigns)
+        return Response(
+            {'created': len(campaigns), 'failed': failed, 'results': results},
+            status=status.HTTP_201_CREATED if not failed else status.HTTP_207_MULTI_STATUS
+        )
+    
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        """Copy a campaign or template, optionally many times with overrides"""
+        source = self.get_object()
+        body = CampaignCloneSerializer(data=request.data)
+        body.is_valid(raise_exception=True)
+        
+        try:
+            clones = campaign_clone.clone_campaign(source, body.validated_data['overrides_list'])
+        except campaign_clone.CreativesNotStored as e:
+            return Response(
+                {"detail": "Some creatives are still being stored, try again shortly.", "creatives": e.creative_ids},
+                status=status.HTTP_409_CONFLICT
             )
-            
-            logger.info(f"Successfully launched campaign {campaign.id} to Facebook with ID {facebook_campaign_id}")
-            
-            serializer = self.get_serializer(campaign)
-            return Response(serializer.data)
-            
-        except Exception as e:
-            logger.error(f"Error launching campaign to Facebook: {str(e)}")
+        
+        clones = self.get_queryset().filter(pk__in=[clone.pk for clone in clones]).order_by('pk')
+        serializer = self.get_serializer(clones, many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
+    @action(detail=False, methods=['post'], url_path='bulk-launch')
+    def bulk_launch(self, request):
+        """Queue the launch of many campaigns with one credit check"""
+        body = BulkLaunchSerializer(data=request.data)
+        body.is_valid(raise_exception=True)
+        
+        fb_account = FacebookAdAccount.objects.filter(user=request.user, is_active=True).first()
+        try:
+            results = enqueue_bulk_launch(body.validated_data['campaign_ids'], request.user, fb_account)
+        except credit_ledger.InsufficientCredits as e:
             return Response(
-                {"detail": f"Error launching campaign: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"detail": f"Insufficient credits to launch {e.amount} campaigns ({e.available} available)."},
+                status=status.HTTP_402_PAYMENT_REQUIRED
             )
+        
+        for result in results:
+            if result.get('job'):
+                result['status_url'] = reverse('launch-job-detail', args=[result['job']], request=request)
+        queued = sum(1 for result in results if result['status'] == 'queued')
+        return Response(
+            {'queued': queued, 'failed': len(results) - queued, 'results': results},
+            status=status.HTTP_202_ACCEPTED if queued == len(results) else status.HTTP_207_MULTI_STATUS
+        )
 
 
 class CampaignCreativeViewSet(viewsets.ModelViewSet):
@@ -146,15 +239,151 @@ class CampaignCreativeViewSet(viewsets.ModelViewSet):
         return CampaignCreative.objects.filter(
             campaign_id=campaign_id,
             campaign__user=self.request.user
-        )
+        ).select_related('blob')
     
     def perform_create(self, serializer):
         campaign_id = self.kwargs.get('campaign_pk')
         campaign = Campaign.objects.get(id=campaign_id, user=self.request.user)
-        serializer.save(campaign=campaign)
+        
+        # Hash the upload before storing it; content we already have is not stored again
+        sha256, size = creative_store.hash_chunks(serializer.validated_data['file'].chunks())
+        blob = creative_store.find_blob(sha256)
+        if blob:
+            creative = serializer.save(campaign=campaign, file=blob.file.name)
+        else:
+            creative = serializer.save(campaign=campaign)
+        creative_store.register_creative(creative, sha256, size)
+    
+    def perform_update(self, serializer):
+        upload = serializer.validated_data.get('file')
+        if upload is None:
+            serializer.save()
+            return
+        
+        # Copy-on-write: the old blob may be shared with clones, so the
+        # creative moves to the blob of its new content instead
+        previous_blob_id = serializer.instance.blob_id
+        sha256, size = creative_store.hash_chunks(upload.chunks())
+        blob = creative_store.find_blob(sha256)
+        if blob:
+            creative = serializer.save(file=blob.file.name, blob=None)
+        else:
+            creative = serializer.save(blob=None)
+        creative_store.register_creative(creative, sha256, size)
+        if previous_blob_id:
+            creative_store.release_blob(previous_blob_id)
+    
+    @action(detail=False, methods=['post'])
+    def presign(self, request, campaign_pk=None):
+        """Get URLs to upload a creative straight to storage"""
+        campaign = get_object_or_404(Campaign, id=campaign_pk, user=request.user)
+        file_name = request.data.get('file_name')
+        file_type = request.data.get('file_type')
+        if not file_name or not file_type:
+            return Response(
+                {"detail": "file_name and file_type are required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        data = direct_upload.presign_upload(
+            request.user, campaign, file_name, file_type,
+            local_url_for=lambda token: request.build_absolute_uri(
+                reverse('creative-direct-upload', kwargs={'token': token})
+            )
+        )
+        return Response(data)
+    
+    @action(detail=False, methods=['post'])
+    def finalize(self, request, campaign_pk=None):
+        """Create the creative for a file uploaded with a presigned URL"""
+        campaign = get_object_or_404(Campaign, id=campaign_pk, user=request.user)
+        try:
+            expected_size = request.data.get('file_size')
+            expected_size = int(expected_size) if expected_size is not None else None
+        except (TypeError, ValueError):
+            return Response({"detail": "file_size must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            creative = direct_upload.finalize_upload(
+                request.user, campaign, request.data.get('upload_token', ''), expected_size
+            )
+        except chunked_upload.UploadError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        serializer = self.get_serializer(creative)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class CreativeUploadViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                            mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Resumable chunked creative uploads
+    
+    POST an upload with file_name, file_type and file_size, PUT the raw
+    bytes of each part to parts/<n>/, then POST complete/ to create the
+    creative. GET shows which parts arrived; DELETE aborts the upload.
+    """
+    serializer_class = CreativeUploadSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        return CreativeUpload.objects.filter(
+            campaign_id=self.kwargs.get('campaign_pk'),
+            user=self.request.user
+        )
+    
+    def perform_create(self, serializer):
+        campaign = get_object_or_404(Campaign, id=self.kwargs.get('campaign_pk'), user=self.request.user)
+        try:
+            serializer.instance = chunked_upload.start_upload(
+                self.request.user,
+                campaign,
+                serializer.validated_data['file_name'],
+                serializer.validated_data['file_type'],
+                serializer.validated_data['file_size'],
+            )
+        except chunked_upload.UploadError as e:
+            raise ValidationError({"detail": str(e)})
+    
+    def perform_destroy(self, instance):
+        chunked_upload.abort_upload(instance)
+    
+    @action(detail=True, methods=['put'], url_path=r'parts/(?P<part_number>[0-9]+)')
+    def part(self, request, campaign_pk=None, pk=None, part_number=None):
+        """Store one part; the request body is the raw bytes of the part"""
+        upload = self.get_object()
+        
+        # Read straight from the request stream so the part is never parsed or buffered
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        try:
+            part = chunked_upload.upload_part(upload, int(part_number), request.stream, length)
+        except chunked_upload.UploadError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({"number": part.number, "size": part.size, "etag": part.etag})
+    
+    @action(detail=True, methods=['post'])
+    def complete(self, request, campaign_pk=None, pk=None):
+        """Assemble the uploaded parts into a campaign creative"""
+        upload = self.get_object()
+        try:
+            creative = chunked_upload.complete_upload(upload)
+        except chunked_upload.UploadError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        serializer = CampaignCreativeSerializer(creative, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
 
+class LaunchJobViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = LaunchJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        return LaunchJob.objects.filter(user=self.request.user).order_by('-created_at')
 
-class UserCreditViewSet(viewsets.ReadOnlyModelViewSet):
+
+class UserCreditViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = UserCreditSerializer
     permission_classes = [permissions.IsAuthenticated]
     
@@ -166,20 +395,147 @@ class UserCreditViewSet(viewsets.ReadOnlyModelViewSet):
         """Purchase credits using Stripe"""
         # This would be implemented with the Stripe API
         # For now, we'll simulate a successful purchase
-        amount = request.data.get('amount', 10)
-        
-        user_credit, created = UserCredit.objects.get_or_create(user=request.user)
-        user_credit.balance += amount
-        user_credit.save()
+        try:
+            amount = int(request.data.get('amount', 10))
+        except (TypeError, ValueError):
+            amount = 0
+        if amount <= 0:
+            return Response(
+                {"detail": "Amount must be a positive number of credits."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Record the transaction
-        CreditTransaction.objects.create(
-            user=request.user,
-            amount=amount,
+        # Clients may send an Idempotency-Key header so a retried purchase is applied once
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key and len(idempotency_key) > credit_ledger.IDEMPOTENCY_KEY_MAX_LENGTH:
+            return Response(
+                {"detail": f"Idempotency-Key must be at most {credit_ledger.IDEMPOTENCY_KEY_MAX_LENGTH} characters."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        credit_ledger.credit(
+            request.user,
+            amount,
             transaction_type='purchase',
             description=f"Purchased {amount} credits",
-            stripe_payment_id='simulated_payment_id'
+            stripe_payment_id='simulated_payment_id',
+            idempotency_key=idempotency_key
         )
         
+        user_credit = UserCredit.objects.get(user=request.user)
         serializer = self.get_serializer(user_credit)
         return Response(serializer.data)
+
+
+@api_view(['PUT'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def creative_direct_upload(request, token):
+    """
+    Local stand-in for a presigned storage URL, used when USE_S3 is off
+    
+    The signed token in the URL is the credential, as with S3.
+    """
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    try:
+        direct_upload.store_local_upload(token, request.stream, length)
+    except chunked_upload.UploadError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(status=status.HTTP_200_OK)
+
+
+@api_view(['GET', 'POST'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def facebook_webhook(request):
+    """
+    Facebook ad account change notifications
+    
+    GET answers the subscription handshake. POST checks the
+    X-Hub-Signature-256 HMAC and only queues the body; the updates are
+    applied in batches on the task queue.
+    """
+    if request.method == 'GET':
+        if (request.query_params.get('hub.mode') == 'subscribe' and settings.FACEBOOK_WEBHOOK_VERIFY_TOKEN
+                and request.query_params.get('hub.verify_token') == settings.FACEBOOK_WEBHOOK_VERIFY_TOKEN):
+            return HttpResponse(request.query_params.get('hub.challenge', ''), content_type='text/plain')
+        return Response({"detail": "Verification failed"}, status=status.HTTP_403_FORBIDDEN)
+    
+    body = request.body
+    try:
+        facebook_webhooks.verify_signature(body, request.META.get(facebook_webhooks.SIGNATURE_HEADER))
+    except facebook_webhooks.InvalidSignature as e:
+        logger.warning(f"Rejected Facebook webhook: {str(e)}")
+        return Response({"detail": str(e)}, status=status.HTTP_403_FORBIDDEN)
+    facebook_webhooks.enqueue_payload(body)
+    return Response(status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def campaign_analytics(request):
+    """
+    Spend, CTR, CPC and CPA of the user's campaigns over a date range
+    
+    Query parameters: since, until (YYYY-MM-DD), optional interval
+    (day / week / month), group_by (account, objective; repeatable or
+    comma separated) and account / objective filters. Results are read
+    from the metric rollups and returned as one list per column.
+    """
+    params = request.query_params.copy()
+    if 'group_by' in params:
+        params.setlist('group_by', [
+            dimension for value in params.getlist('group_by') for dimension in value.split(',') if dimension
+        ])
+    query = AnalyticsQuerySerializer(data=params)
+    query.is_valid(raise_exception=True)
+    data = query.validated_data
+    
+    group_by = [dimension for dimension in metric_rollups.DIMENSIONS if dimension in data['group_by']]
+    filters = {dimension: data[dimension] for dimension in metric_rollups.DIMENSIONS if dimension in data}
+    result = metric_rollups.query_metrics(
+        request.user, data['since'], data['until'],
+        interval=data['interval'], group_by=group_by, filters=filters,
+    )
+    return Response({
+        'since': data['since'],
+        'until': data['until'],
+        'interval': data['interval'],
+        'group_by': group_by,
+        **result,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def metrics_snapshot(request):
+    """
+    Counters and timings of this worker process (Graph API latency, retries, ...),
+    plus the Graph circuit breakers shared by all processes
+    """
+    return Response({**metrics.snapshot(), 'circuits': circuit_breaker.breaker.states()})
+
+
+_queue_launch = CampaignViewSet.as_view(
+    {'post': 'launch'}, launch_countdown=settings.ASYNC_LAUNCH_FALLBACK_DELAY
+)
+
+
+async def campaign_launch(request, pk):
+    """
+    Async version of CampaignViewSet.launch, routed instead of it when
+    Django is served under ASGI (ASYNC_VIEWS)
+    
+    The launch is validated and queued by the same action, then run on this
+    process's event loop right away instead of waiting for a worker. The
+    queued task only runs if this process never got to claim the job.
+    """
+    response = await sync_to_async(_queue_launch)(request, pk=str(pk))
+    if response.status_code == status.HTTP_202_ACCEPTED:
+        job = response.data
+        # A job that is already running, or postponed, is left to its worker
+        if job['status'] == 'queued' and not job['attempts']:
+            start_launch(job['id'])
+    return response
+
+# Read by CsrfViewMiddleware; Django 3.2's csrf_exempt cannot wrap a coroutine
+campaign_launch.csrf_exempt = True
@@ -3,6 +3,18 @@ ASGI config for server project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Live event streams (campaigns.event_stream) are answered here, outside
+Django, so that thousands of idle connections cost one coroutine each.
+Every other request goes to Django. The API itself keeps running under
+gunicorn (server.wsgi); route /api/events/ to a uvicorn process:
+
+    uvicorn server.asgi:application --port 8001
+
+The API can be served from here too. With ASYNC_VIEWS=True, campaign
+launches and the Facebook OAuth callback are answered by coroutine views
+that await their Graph calls, so launches run on this process's event
+loop instead of occupying a thread or worker each.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
@@ -13,4 +25,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from campaigns.event_stream import EVENTS_PATH, event_stream  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        await event_stream(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,16 @@
+"""
+Celery application for the server project.
+
+Workers are started with ``celery -A server worker``. Setting
+``CELERY_TASK_ALWAYS_EAGER=True`` runs every task in-process instead, which
+is how the launch pipeline is exercised locally without a broker.
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+
+app = Celery('server')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -190,6 +190,14 @@ if USE_S3:
     MEDIA_URL = f'https://{AWS_S3_CUSTOM_DOMAIN}/{MEDIA_LOCATION}/'
     DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 
+# Chunked creative uploads. S3 requires every part but the last to be at least 5 MB
+CREATIVE_UPLOAD_PART_SIZE = int(os.environ.get("CREATIVE_UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+CREATIVE_UPLOAD_MAX_SIZE = int(os.environ.get("CREATIVE_UPLOAD_MAX_SIZE", 4 * 1024 * 1024 * 1024))
+# Unfinished uploads older than this are aborted and their parts deleted
+CREATIVE_UPLOAD_TTL = int(os.environ.get("CREATIVE_UPLOAD_TTL", 24 * 60 * 60))
+# Lifetime of presigned direct-upload URLs and their upload tokens
+CREATIVE_PRESIGNED_URL_TTL = int(os.environ.get("CREATIVE_PRESIGNED_URL_TTL", 60 * 60))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -206,6 +214,64 @@ CACHES = {
     }
 }
 
+# Celery Configuration
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+CELERY_TASK_ALWAYS_EAGER = os.environ.get("CELERY_TASK_ALWAYS_EAGER", "False") == "True"
+CELERY_TASK_EAGER_PROPAGATES = CELERY_TASK_ALWAYS_EAGER
+CELERY_TASK_SERIALIZER = "json"
+CELERY_ACCEPT_CONTENT = ["json"]
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TIMEZONE = TIME_ZONE
+# Creative processing decodes images and runs ffprobe; its own worker bounds the concurrency
+CELERY_TASK_ROUTES = {
+    "campaigns.tasks.process_creative_blob": {"queue": "creatives"},
+    # Few accounts at a time keeps the app inside Facebook's insights limits
+    "campaigns.tasks.sync_account_insights": {"queue": "insights"},
+}
+CELERY_BEAT_SCHEDULE = {
+    "expire-credit-reservations": {
+        "task": "campaigns.tasks.expire_credit_reservations",
+        "schedule": 60.0,
+    },
+    "requeue-stale-launch-jobs": {
+        "task": "campaigns.tasks.requeue_stale_launch_jobs",
+        "schedule": 60.0,
+    },
+    "reconcile-unconfirmed-launch-jobs": {
+        "task": "campaigns.tasks.reconcile_unconfirmed_launch_jobs",
+        "schedule": 60.0,
+    },
+    "reconcile-credit-balances": {
+        "task": "campaigns.tasks.reconcile_credit_balances",
+        "schedule": 60.0 * 60,
+    },
+    "abort-stale-creative-uploads": {
+        "task": "campaigns.tasks.abort_stale_creative_uploads",
+        "schedule": 60.0 * 60,
+    },
+    "sync-campaign-insights": {
+        "task": "campaigns.tasks.sync_campaign_insights",
+        "schedule": float(os.environ.get("INSIGHTS_SYNC_INTERVAL", 60 * 60)),
+    },
+    # Cheap when nothing is due; each campaign carries its own next check time
+    "sync-campaign-statuses": {
+        "task": "campaigns.tasks.sync_campaign_statuses",
+        "schedule": 60.0,
+    },
+}
+
+# Credits reserved for a launch are returned if the job has not settled them by then
+CREDIT_RESERVATION_TTL = int(os.environ.get("CREDIT_RESERVATION_TTL", 15 * 60))
+# Seconds a claimed launch may run before its worker is taken to have died
+# and the job is queued again
+LAUNCH_JOB_LEASE = int(os.environ.get("LAUNCH_JOB_LEASE", 15 * 60))
+# Campaigns of one ad account a worker launches together in a bulk launch
+BULK_LAUNCH_CHUNK_SIZE = int(os.environ.get("BULK_LAUNCH_CHUNK_SIZE", 25))
+# Let the scheduled reconciliation overwrite drifted balances instead of only reporting them
+CREDIT_RECONCILIATION_REPAIR = os.environ.get("CREDIT_RECONCILIATION_REPAIR", "False") == "True"
+
 # Session configuration
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
@@ -219,6 +285,91 @@ STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY', '')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
 
+# Facebook Marketing API Configuration
+FACEBOOK_APP_ID = os.environ.get('FACEBOOK_APP_ID')
+FACEBOOK_APP_SECRET = os.environ.get('FACEBOOK_APP_SECRET')
+FACEBOOK_ACCESS_TOKEN = os.environ.get('FACEBOOK_ACCESS_TOKEN')
+FACEBOOK_AD_ACCOUNT_ID = os.environ.get('FACEBOOK_AD_ACCOUNT_ID')
+FACEBOOK_PAGE_ID = os.environ.get('FACEBOOK_PAGE_ID')
+FACEBOOK_LINK_URL = os.environ.get('FACEBOOK_LINK_URL')
+BACKEND_URL = os.environ.get('BACKEND_URL', 'https://quickcampaigns.onrender.com')
+
+# Graph API HTTP client
+GRAPH_API_VERSION = os.environ.get('GRAPH_API_VERSION', 'v17.0')
+GRAPH_API_CONNECT_TIMEOUT = float(os.environ.get('GRAPH_API_CONNECT_TIMEOUT', 3.05))
+GRAPH_API_READ_TIMEOUT = float(os.environ.get('GRAPH_API_READ_TIMEOUT', 30))
+GRAPH_API_MAX_RETRIES = int(os.environ.get('GRAPH_API_MAX_RETRIES', 3))
+# Keep-alive connections to graph.facebook.com shared by every Graph call in a
+# process (and by every coroutine of an event loop, for the async client)
+GRAPH_API_POOL_MAXSIZE = int(os.environ.get('GRAPH_API_POOL_MAXSIZE', 20))
+
+# Serve the async launch and OAuth callback views; only when Django runs under ASGI
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'False') == 'True'
+# Seconds before a worker picks up a launch the async view runs in process
+ASYNC_LAUNCH_FALLBACK_DELAY = int(os.environ.get('ASYNC_LAUNCH_FALLBACK_DELAY', 60))
+
+# Graph API rate limit scheduler (token buckets per app and per ad account, in Redis)
+GRAPH_RATE_LIMITING = os.environ.get('GRAPH_RATE_LIMITING', 'True') == 'True'
+# Sustained calls per second and burst size of the app-wide bucket
+GRAPH_APP_RATE = float(os.environ.get('GRAPH_APP_RATE', 20))
+GRAPH_APP_BURST = int(os.environ.get('GRAPH_APP_BURST', 200))
+# Sustained calls per second and burst size of each ad account's bucket; a
+# batch request costs one call per operation, up to the burst size
+GRAPH_ACCOUNT_RATE = float(os.environ.get('GRAPH_ACCOUNT_RATE', 10))
+GRAPH_ACCOUNT_BURST = int(os.environ.get('GRAPH_ACCOUNT_BURST', 200))
+# Longest a call may wait for its tokens before GraphThrottled is raised
+GRAPH_INTERACTIVE_MAX_WAIT = float(os.environ.get('GRAPH_INTERACTIVE_MAX_WAIT', 30))
+GRAPH_BACKGROUND_MAX_WAIT = float(os.environ.get('GRAPH_BACKGROUND_MAX_WAIT', 300))
+
+# Graph API circuit breakers (per endpoint) and bulkheads (per priority), in Redis
+GRAPH_CIRCUIT_BREAKER = os.environ.get('GRAPH_CIRCUIT_BREAKER', 'True') == 'True'
+# Failures within the window that open an endpoint's breaker
+GRAPH_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('GRAPH_CIRCUIT_FAILURE_THRESHOLD', 10))
+GRAPH_CIRCUIT_WINDOW = int(os.environ.get('GRAPH_CIRCUIT_WINDOW', 60))
+# Seconds a breaker stays open, doubled each time its probe fails
+GRAPH_CIRCUIT_OPEN_SECONDS = int(os.environ.get('GRAPH_CIRCUIT_OPEN_SECONDS', 30))
+GRAPH_CIRCUIT_MAX_OPEN_SECONDS = int(os.environ.get('GRAPH_CIRCUIT_MAX_OPEN_SECONDS', 600))
+# Graph calls in flight at once across all processes, per priority (0 = unlimited)
+GRAPH_BULKHEAD_LIMITS = {
+    'interactive': int(os.environ.get('GRAPH_BULKHEAD_INTERACTIVE', 20)),
+    'background': int(os.environ.get('GRAPH_BULKHEAD_BACKGROUND', 40)),
+}
+# Seconds a call waits for a bulkhead slot before failing
+GRAPH_BULKHEAD_WAIT = float(os.environ.get('GRAPH_BULKHEAD_WAIT', 5))
+
+# Per-user cache of read responses (campaigns, credits, ad accounts), in Redis
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'True') == 'True'
+# Seconds a cached response is kept; writes invalidate it earlier
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+# Live events pushed to the dashboard over server-sent events (Redis pub/sub)
+LIVE_EVENTS = os.environ.get('LIVE_EVENTS', 'True') == 'True'
+# Seconds between keep-alive comments on an idle stream
+LIVE_EVENTS_HEARTBEAT = float(os.environ.get('LIVE_EVENTS_HEARTBEAT', 15))
+# Events buffered per stream before a slow client is disconnected
+LIVE_EVENTS_QUEUE_SIZE = int(os.environ.get('LIVE_EVENTS_QUEUE_SIZE', 100))
+
+# Campaign insights sync
+INSIGHTS_CAMPAIGNS_PER_CALL = int(os.environ.get('INSIGHTS_CAMPAIGNS_PER_CALL', 100))
+# Days before the checkpoint fetched again, since Facebook restates recent days
+INSIGHTS_LOOKBACK_DAYS = int(os.environ.get('INSIGHTS_LOOKBACK_DAYS', 3))
+# Longer date ranges are requested as async report runs
+INSIGHTS_ASYNC_RANGE_DAYS = int(os.environ.get('INSIGHTS_ASYNC_RANGE_DAYS', 14))
+
+# Facebook webhooks: token echoed by the subscription handshake, how long
+# payloads are collected before a batch is applied, and payloads per batch
+FACEBOOK_WEBHOOK_VERIFY_TOKEN = os.environ.get('FACEBOOK_WEBHOOK_VERIFY_TOKEN', '')
+WEBHOOK_COALESCE_SECONDS = float(os.environ.get('WEBHOOK_COALESCE_SECONDS', 2))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 1000))
+
+# Campaign status sync (seconds between checks of one campaign). With
+# webhooks subscribed the poller is only a safety net and the maximum can
+# be raised to a day or more.
+STATUS_CHECK_MIN_INTERVAL = int(os.environ.get('STATUS_CHECK_MIN_INTERVAL', 5 * 60))
+STATUS_CHECK_MAX_INTERVAL = int(os.environ.get('STATUS_CHECK_MAX_INTERVAL', 12 * 60 * 60))
+# Campaigns read per ad account per run; the rest are picked up a minute later
+STATUS_SYNC_MAX_CAMPAIGNS = int(os.environ.get('STATUS_SYNC_MAX_CAMPAIGNS', 5000))
+
 # Rest Framework Settings
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
@@ -227,6 +378,7 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticated",
     ),
+    "EXCEPTION_HANDLER": "campaigns.exceptions.exception_handler",
 }
 
 # Djoser Settings